@@ -1,53 +1,207 @@
-from fastapi import FastAPI, HTTPException, Depends
-from service import CartService, CheckoutService
+from fastapi import FastAPI, HTTPException, Depends, Request, Header, Query
+from fastapi.responses import PlainTextResponse, JSONResponse
+import sys
+
+# Add shared directory to path
+sys.path.append('/app/../shared')
+
+from service import CartService, CheckoutService, IdempotencyService, ReservationPending, warehouse_http, services_http
 from models.cart_model import Cart
 from models.item_cart_model import ItemCart
 from models.checkout_model import Checkout
+from models.outbox_model import OutboxMessage
+from product_catalog import get_product_catalog
 from pydantic import BaseModel
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import Session, AsyncSessionLocal, async_engine, get_session
 from typing import List, Optional
+from datetime import datetime
+import asyncio
 import os
-import sys
+import threading
+import time
 import logging
-from dotenv import load_dotenv
 
-# Add shared directory to path
-sys.path.append('/app/../shared')
 from events import (
-    EventPublisher, 
+    EventSubscriber,
     OrderEvents, 
+    ProductEvents,
     AggregateTypes,
+    Exchanges,
+    RoutingKeys,
     create_order_initiated_data
 )
-
-load_dotenv()
+from tracing import get_tracer, extract_context
+from outbox import OutboxRelay, enqueue
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Ecommerce API")
+tracer = get_tracer("ecommerce")
+
+def handle_product_changed(event_data: dict):
+    """Handle ProductCreated/Updated/Deleted events - keep the product and price cache in sync"""
+    try:
+        event_type = event_data["event_type"]
+        product_data = event_data["data"]
+        product_id = product_data["product_id"]
+        catalog = get_product_catalog()
+        
+        if event_type == ProductEvents.PRODUCT_DELETED:
+            catalog.invalidate(product_id)
+        else:
+            catalog.put({
+                "id": product_id,
+                "name": product_data.get("name"),
+                "category": product_data.get("category"),
+                "description": product_data.get("description"),
+                "prix_unitaire": product_data.get("prix_unitaire")
+            })
+        logger.info(f"Product cache updated from {event_type} for product {product_id}")
+            
+    except Exception as e:
+        logger.error(f"Error handling product event: {e}")
+
+# Loop the app runs on: the consumer thread hands it the async service calls
+event_loop = None
+
+def run_on_event_loop(coroutine):
+    """Run a coroutine on the app's event loop from the consumer thread and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coroutine, event_loop).result()
+
+def handle_checkout_cancelled(event_data: dict):
+    """Handle CheckoutCancelled - compensation of an order cancelled by the choreographed saga"""
+    checkout_id = event_data["data"]["checkout_id"]
+    
+    async def cancel():
+        async with AsyncSessionLocal() as session:
+            return await CheckoutService(session).cancel_checkout(checkout_id)
+    
+    # Errors propagate so that the command is requeued
+    if not run_on_event_loop(cancel()):
+        logger.warning(f"Checkout {checkout_id} to cancel not found")
+        return
+    logger.info(f"Checkout {checkout_id} cancelled by the saga: {event_data['data'].get('reason')}")
 
-# Database setup
-DATABASE_URL_ECOMMERCE = os.getenv("DATABASE_URL_ECOMMERCE")
-engine = create_engine(DATABASE_URL_ECOMMERCE)
-Session = sessionmaker(bind=engine)
-
-# Event publisher (initialized once)
-event_publisher = None
-
-def get_event_publisher():
-    """Get or create event publisher instance"""
-    global event_publisher
-    if event_publisher is None:
-        try:
-            event_publisher = EventPublisher()
-            logger.info("Event publisher initialized")
-        except Exception as e:
-            logger.error(f"Failed to initialize event publisher: {e}")
-            event_publisher = None
-    return event_publisher
+def handle_cart_cleared(event_data: dict):
+    """Handle CartCleared - compensation of the cart lines added for a cancelled order"""
+    cart_id = event_data["data"]["cart_id"]
+    
+    async def clear():
+        async with AsyncSessionLocal() as session:
+            return await CartService(session).clear_cart(cart_id)
+    
+    cleared = run_on_event_loop(clear())
+    logger.info(f"Cleared {cleared} items of cart {cart_id} for a cancelled order")
+
+def start_event_consumer():
+    """Start the product and saga compensation event consumer in a background thread"""
+    
+    def consumer_loop():
+        max_retries = 5
+        retry_count = 0
+        
+        while retry_count < max_retries:
+            try:
+                event_subscriber = EventSubscriber("ecommerce_service")
+                for routing_key in (RoutingKeys.PRODUCT_CREATED, RoutingKeys.PRODUCT_UPDATED, RoutingKeys.PRODUCT_DELETED):
+                    event_subscriber.subscribe_to_event(
+                        exchange=Exchanges.PRODUCTS,
+                        routing_key=routing_key,
+                        handler=handle_product_changed
+                    )
+                
+                event_subscriber.subscribe_to_event(
+                    exchange=Exchanges.ORDERS,
+                    routing_key=RoutingKeys.CHECKOUT_CANCELLED,
+                    handler=handle_checkout_cancelled
+                )
+                event_subscriber.subscribe_to_event(
+                    exchange=Exchanges.ORDERS,
+                    routing_key=RoutingKeys.CART_CLEARED,
+                    handler=handle_cart_cleared
+                )
+                
+                logger.info("Ecommerce event consumer subscribed to product and saga compensation events")
+                event_subscriber.start_consuming()
+                break
+                
+            except Exception as e:
+                retry_count += 1
+                logger.error(f"Event consumer failed (attempt {retry_count}): {e}")
+                if retry_count < max_retries:
+                    time.sleep(5)  # Wait before retry
+                else:
+                    logger.error("Max retries reached. Event consumer will not start.")
+    
+    consumer_thread = threading.Thread(target=consumer_loop)
+    consumer_thread.daemon = True
+    consumer_thread.start()
+    logger.info("Ecommerce event consumer thread started")
+
+background_tasks = set()
+
+def start_cart_compactor():
+    """Periodically archive abandoned carts so cart lookups stay on a small table and index"""
+    interval = int(os.getenv("CART_COMPACTION_INTERVAL", "3600"))
+    
+    async def compactor_loop():
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with AsyncSessionLocal() as session:
+                    archived = await CartService(session).compact_abandoned_carts()
+                if archived:
+                    logger.info(f"Archived {archived} abandoned carts")
+            except Exception as e:
+                logger.error(f"Cart compaction failed: {e}")
+    
+    task = asyncio.create_task(compactor_loop())
+    background_tasks.add(task)  # Keep a reference so the task is not garbage collected
+    logger.info("Cart compaction task started")
+
+def start_idempotency_key_purger():
+    """Periodically delete the idempotency keys whose response is no longer replayed"""
+    interval = int(os.getenv("IDEMPOTENCY_PURGE_INTERVAL", "3600"))
+    
+    async def purger_loop():
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with AsyncSessionLocal() as session:
+                    purged = await IdempotencyService(session).purge_expired()
+                if purged:
+                    logger.info(f"Purged {purged} expired idempotency keys")
+            except Exception as e:
+                logger.error(f"Idempotency key purge failed: {e}")
+    
+    task = asyncio.create_task(purger_loop())
+    background_tasks.add(task)
+    logger.info("Idempotency key purge task started")
+
+@app.on_event("startup")
+async def startup_event():
+    """Start relaying the events written to the outbox table, keeping the product cache in sync and the background cleanups"""
+    global event_loop
+    event_loop = asyncio.get_running_loop()
+    # The relay and the RabbitMQ consumer block on I/O in their own threads (sync engine, pika)
+    OutboxRelay(Session, OutboxMessage).start()
+    start_event_consumer()
+    start_cart_compactor()
+    start_idempotency_key_purger()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the background tasks and close the HTTP clients and database pool"""
+    for task in background_tasks:
+        task.cancel()
+    await get_product_catalog().http.aclose()
+    await warehouse_http.aclose()
+    await services_http.aclose()
+    await async_engine.dispose()
 
 # Pydantic Models for Request/Response
 class CartSerializer(BaseModel):
@@ -74,12 +228,35 @@ class AddItemToCartSerializer(BaseModel):
     store_id: int
     
 
+class CartLineSerializer(BaseModel):
+    product: int
+    quantite: int
+
+class AddItemsToCartSerializer(BaseModel):
+    cart: int
+    store_id: int
+    items: List[CartLineSerializer]
+
 class UpdateItemSerializer(BaseModel):
     quantity: int
 
 class CheckoutSerializer(BaseModel):
     id: int
     cart_id: int
+    customer_id: Optional[int] = None
+    total: float = 0.0
+    current_status: str = "pending"
+
+class CheckoutSummarySerializer(BaseModel):
+    id: int
+    cart_id: int
+    total: float
+    current_status: str
+    created_at: Optional[datetime] = None
+
+class CheckoutHistorySerializer(BaseModel):
+    items: List[CheckoutSummarySerializer]
+    next_cursor: Optional[str] = None
 
 class CheckoutCreateSerializer(BaseModel):
     cart_id: int
@@ -88,17 +265,36 @@ class CompleteCheckoutSerializer(BaseModel):
     payment_method: str
     payment_reference: Optional[str] = None
 
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Open a server span for each request, continuing the caller's trace if one was propagated"""
+    with tracer.start_span(
+        f"{request.method} {request.url.path}",
+        kind="server",
+        attributes={'http.method': request.method, 'http.target': request.url.path},
+        parent=extract_context(request.headers)
+    ) as span:
+        response = await call_next(request)
+        span.set_attribute('http.status_code', response.status_code)
+        return response
+
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the Ecommerce API"}
 
+@app.get("/metrics")
+def get_metrics():
+    """
+    Prometheus metrics endpoint (includes the cart compaction counters)
+    """
+    return PlainTextResponse(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 # Cart Endpoints
 @app.post("/api/v1/cart/add-item", response_model=ItemCartSerializer)
-def add_item_to_cart(item_data: AddItemToCartSerializer):
+async def add_item_to_cart(item_data: AddItemToCartSerializer, session: AsyncSession = Depends(get_session)):
     """Add item to user's cart"""
-    session = Session()
     cart_service = CartService(session)
-    item = cart_service.add_item_to_cart(
+    item = await cart_service.add_item_to_cart(
         item_data.cart, 
         item_data.product, 
         item_data.quantite,
@@ -106,170 +302,220 @@ def add_item_to_cart(item_data: AddItemToCartSerializer):
     )
     return item
 
+@app.post("/api/v1/cart/add-items", response_model=List[ItemCartSerializer])
+async def add_items_to_cart(items_data: AddItemsToCartSerializer, session: AsyncSession = Depends(get_session)):
+    """Add many products to a cart at once (quick order, reorder)"""
+    cart_service = CartService(session)
+    try:
+        return await cart_service.add_items_to_cart(
+            items_data.cart,
+            items_data.store_id,
+            [{"product_id": item.product, "quantity": item.quantite} for item in items_data.items]
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/api/v1/cart/user/{user_id}", response_model=CartSerializer)
-def get_user_cart(user_id: int):
+async def get_user_cart(user_id: int, session: AsyncSession = Depends(get_session)):
     """Get user's active cart"""
-    session = Session()
     cart_service = CartService(session)
-    cart = cart_service.get_cart_by_user(user_id)
+    cart = await cart_service.get_cart_by_user(user_id)
     if not cart:
         raise HTTPException(status_code=404, detail="Cart not found")
     return cart
 
 @app.get("/api/v1/cart/{cart_id}/details")
-def get_cart_with_items(cart_id: int):
+async def get_cart_with_items(cart_id: int, session: AsyncSession = Depends(get_session)):
     """Get cart with all items and details"""
-    session = Session()
     cart_service = CartService(session)
-    cart_data = cart_service.get_cart_with_items(cart_id)
+    cart_data = await cart_service.get_cart_with_items(cart_id)
     if not cart_data:
         raise HTTPException(status_code=404, detail="Cart not found")
     return cart_data
 
 @app.get("/api/v1/cart/{cart_id}/items", response_model=List[ItemCartSerializer])
-def get_cart_items(cart_id: int):
+async def get_cart_items(cart_id: int, session: AsyncSession = Depends(get_session)):
     """Get all items in a cart"""
-    session = Session()
     cart_service = CartService(session)
-    cart_data = cart_service.get_cart_with_items(cart_id)
+    cart_data = await cart_service.get_cart_with_items(cart_id)
     if not cart_data:
         raise HTTPException(status_code=404, detail="Cart not found")
     return cart_data['items']
 
 @app.put("/api/v1/cart/item/{item_id}", response_model=ItemCartSerializer)
-def update_cart_item(item_id: int, update_data: UpdateItemSerializer):
+async def update_cart_item(item_id: int, update_data: UpdateItemSerializer, session: AsyncSession = Depends(get_session)):
     """Update cart item quantity"""
-    session = Session()
     cart_service = CartService(session)
-    updated_item = cart_service.update_item_quantity(item_id, update_data.quantity)
+    updated_item = await cart_service.update_item_quantity(item_id, update_data.quantity)
     if not updated_item:
         raise HTTPException(status_code=404, detail="Item not found")
     return updated_item
 
 @app.delete("/api/v1/cart/item/{item_id}")
-def remove_cart_item(item_id: int):
+async def remove_cart_item(item_id: int, session: AsyncSession = Depends(get_session)):
     """Remove item from cart"""
-    session = Session()
     cart_service = CartService(session)
-    removed_item = cart_service.remove_item_from_cart(item_id)
+    removed_item = await cart_service.remove_item_from_cart(item_id)
     if not removed_item:
         raise HTTPException(status_code=404, detail="Item not found")
     return {"detail": "Item removed from cart successfully"}
 
 @app.delete("/api/v1/cart/{cart_id}/clear")
-def clear_cart(cart_id: int):
+async def clear_cart(cart_id: int, session: AsyncSession = Depends(get_session)):
     """Clear all items from cart"""
-    session = Session()
     cart_service = CartService(session)
-    cleared_count = cart_service.clear_cart(cart_id)
+    cleared_count = await cart_service.clear_cart(cart_id)
     return {
         "detail": f"Cart cleared successfully", 
         "items_removed": cleared_count
     }
 
 # Checkout Endpoints
+async def replay_idempotent_request(session, idempotency_key, operation, request):
+    """
+    None if the request must run (no Idempotency-Key or first use of the key), otherwise the
+    response of the original request, replayed without running anything
+    """
+    if not idempotency_key:
+        return None
+    try:
+        record = await IdempotencyService(session).claim(idempotency_key, operation, request)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if record is None:
+        return None
+    if record.response_code is None:
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+    logger.info(f"Replaying {operation} response for Idempotency-Key {idempotency_key}")
+    return JSONResponse(
+        status_code=record.response_code,
+        content=record.response_body,
+        headers={"Idempotent-Replayed": "true"}
+    )
+
+def checkout_response(checkout):
+    return CheckoutSerializer.model_validate(checkout, from_attributes=True).model_dump(mode="json")
+
 @app.post("/api/v1/checkout/initiate", response_model=CheckoutSerializer)
-def initiate_checkout(checkout_data: CheckoutCreateSerializer):
-    """Start checkout process"""
-    session = Session()
+async def initiate_checkout(checkout_data: CheckoutCreateSerializer, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"), session: AsyncSession = Depends(get_session)):
+    """Start checkout process (send an Idempotency-Key header to make retries safe)"""
+    replay = await replay_idempotent_request(session, idempotency_key, "checkout_initiate", checkout_data.model_dump())
+    if replay:
+        return replay
     checkout_service = CheckoutService(session)
     
-    checkout = checkout_service.initiate_checkout(
-        checkout_data.cart_id
-    )
-    
-    # Publish OrderInitiated event
-    publisher = get_event_publisher()
-    if publisher:
-        try:
-            # Get cart items for the event
-            cart_service = CartService(session)
-            cart_data = cart_service.get_cart_with_items(checkout_data.cart_id)
-            
-            items_data = []
-            if cart_data and 'items' in cart_data:
-                for item in cart_data['items']:
-                    items_data.append({
-                        "product_id": item.get('product', 0),
-                        "quantity": item.get('quantite', 0),
-                        "unit_price": 25.99,  # Default price - you'd get this from products service
-                        "total_price": item.get('quantite', 0) * 25.99
-                    })
-            
-            event_data = create_order_initiated_data(
+    async def enqueue_order_initiated(checkout, order_items):
+        # OrderInitiated is committed with the checkout itself: both happen or neither does
+        enqueue(
+            session, OutboxMessage,
+            event_type=OrderEvents.ORDER_INITIATED,
+            aggregate_type=AggregateTypes.ORDER,
+            aggregate_id=checkout.id,
+            data=create_order_initiated_data(
                 order_id=checkout.id,
                 customer_id=checkout.customer_id,
                 cart_id=checkout_data.cart_id,
-                total_amount=float(checkout.total),
-                items=items_data
-            )
-            
-            publisher.publish_event(
-                event_type=OrderEvents.ORDER_INITIATED,
-                aggregate_type=AggregateTypes.ORDER,
-                aggregate_id=str(checkout.id),
-                data=event_data,
-                service_name="ecommerce"
-            )
-            
-            logger.info(f"Published OrderInitiated event for checkout {checkout.id}")
-            
-        except Exception as e:
-            logger.error(f"Failed to publish OrderInitiated event: {e}")
-            # Don't fail the checkout if event publishing fails
+                total_amount=checkout.total,
+                items=order_items
+            ),
+            service_name="ecommerce"
+        )
+        if idempotency_key:
+            # The response is saved with the checkout: a retry can never create a second one
+            await IdempotencyService(session).stage_response(idempotency_key, "checkout_initiate", 200, checkout_response(checkout))
     
+    try:
+        checkout = await checkout_service.initiate_checkout(
+            checkout_data.cart_id,
+            before_commit=enqueue_order_initiated
+        )
+    except Exception as e:
+        if idempotency_key:
+            await IdempotencyService(session).release(idempotency_key, "checkout_initiate")
+        if isinstance(e, ValueError):
+            raise HTTPException(status_code=400, detail=str(e))
+        raise
+    
+    logger.info(f"Checkout {checkout.id} initiated, OrderInitiated event enqueued")
     return checkout
 
 @app.post("/api/v1/checkout/{checkout_id}/complete", response_model=CheckoutSerializer)
-def complete_checkout(checkout_id: int):
-    session = Session()
+async def complete_checkout(checkout_id: int, reservation_wait: Optional[float] = None, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"), session: AsyncSession = Depends(get_session)):
+    """
+    Complete a checkout: confirm its stock reservation and emit OrderCreated, at most once per checkout
+    reservation_wait bounds, in seconds, the wait for the warehouse to reserve the stock (409 when it has not yet)
+    """
+    replay = await replay_idempotent_request(session, idempotency_key, "checkout_complete", {"checkout_id": checkout_id})
+    if replay:
+        return replay
     checkout_service = CheckoutService(session)
     
-    completed_checkout = checkout_service.complete_checkout(checkout_id)
-    
-    # Publish OrderCreated event
-    publisher = get_event_publisher()
-    if publisher:
-        try:
-            event_data = {
+    def enqueue_order_created(checkout):
+        enqueue(
+            session, OutboxMessage,
+            event_type=OrderEvents.ORDER_CREATED,
+            aggregate_type=AggregateTypes.ORDER,
+            aggregate_id=checkout_id,
+            data={
                 "order_id": checkout_id,
-                "customer_id": completed_checkout.customer_id,
-                "total_amount": float(completed_checkout.total),
+                "customer_id": checkout.customer_id,
+                "total_amount": checkout.total,
                 "status": "CREATED",
-                "completed_at": completed_checkout.created_at.isoformat() if completed_checkout.created_at else None
-            }
-            
-            publisher.publish_event(
-                event_type=OrderEvents.ORDER_CREATED,
-                aggregate_type=AggregateTypes.ORDER,
-                aggregate_id=str(checkout_id),
-                data=event_data,
-                service_name="ecommerce"
-            )
-            
-            logger.info(f"Published OrderCreated event for order {checkout_id}")
-            
-        except Exception as e:
-            logger.error(f"Failed to publish OrderCreated event: {e}")
+                "completed_at": datetime.utcnow().isoformat()
+            },
+            service_name="ecommerce"
+        )
+    
+    try:
+        completed_checkout = await checkout_service.complete_checkout(
+            checkout_id, before_commit=enqueue_order_created, reservation_wait=reservation_wait
+        )
+    except Exception as e:
+        if idempotency_key:
+            await IdempotencyService(session).release(idempotency_key, "checkout_complete")
+        if isinstance(e, ReservationPending):
+            # The checkout is still pending: the same request can be retried
+            raise HTTPException(status_code=409, detail=str(e))
+        if isinstance(e, ValueError):
+            raise HTTPException(status_code=400, detail=str(e))
+        raise
     
+    if idempotency_key:
+        # Saved after the fact: if this is lost, the retry finds the checkout already completed and does nothing
+        await IdempotencyService(session).save_response(idempotency_key, "checkout_complete", 200, checkout_response(completed_checkout))
+    
+    logger.info(f"Checkout {checkout_id} completed, OrderCreated event enqueued")
     return completed_checkout
 
+@app.get("/api/v1/checkout/customer/{customer_id}/history", response_model=CheckoutHistorySerializer)
+async def get_checkout_history(
+    customer_id: int,
+    status: Optional[List[str]] = Query(None),
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    session: AsyncSession = Depends(get_session)
+):
+    """Customer's checkouts, newest first, one page at a time (pass next_cursor back as cursor for the next page)"""
+    checkout_service = CheckoutService(session)
+    try:
+        return await checkout_service.get_checkout_history(customer_id, status, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/api/v1/checkout/{checkout_id}", response_model=CheckoutSerializer)
-def get_checkout(checkout_id: int):
+async def get_checkout(checkout_id: int, session: AsyncSession = Depends(get_session)):
     """Get checkout details"""
-    session = Session()
     checkout_service = CheckoutService(session)
-    checkout = checkout_service.get_checkout_by_id(checkout_id)
+    checkout = await checkout_service.get_checkout_by_id(checkout_id)
     if not checkout:
         raise HTTPException(status_code=404, detail="Checkout not found")
     return checkout
 
 @app.put("/api/v1/checkout/{checkout_id}/cancel")
-def cancel_checkout(checkout_id: int):
+async def cancel_checkout(checkout_id: int, session: AsyncSession = Depends(get_session)):
     """Cancel a checkout"""
-    session = Session()
     checkout_service = CheckoutService(session)
-    cancelled_checkout = checkout_service.cancel_checkout(checkout_id)
+    cancelled_checkout = await checkout_service.cancel_checkout(checkout_id)
     if not cancelled_checkout:
         raise HTTPException(status_code=404, detail="Checkout not found")
     return {"detail": "Checkout cancelled successfully"}
\ No newline at end of file
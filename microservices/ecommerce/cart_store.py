@@ -0,0 +1,325 @@
+import logging
+import os
+import threading
+from dataclasses import dataclass, asdict
+import redis.asyncio as redis
+from redis.exceptions import WatchError
+
+logging.basicConfig(level=logging.DEBUG, filename='app.log', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logging = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis_ecommerce:6379/0")
+CART_TTL = int(os.getenv("CART_TTL_SECONDS", "172800"))  # un panier inactif expire après 48 h
+
+CART_SEQUENCE = "cart:next_id"
+ITEM_SEQUENCE = "cart_item:next_id"
+LINE_PREFIXES = ("qty:", "price:", "item:")
+
+# Schéma des clés :
+#   cart:{id}                    hash : user, store et, par produit, qty:{p} (quantité), price:{p} (prix unitaire), item:{p} (id de la ligne)
+#   cart:user:{user}             id du dernier panier de l'utilisateur
+#   cart:user:{user}:store:{s}   id du panier de l'utilisateur dans le magasin
+#   cart_item:{id}               "{cart_id}:{product}", pour retrouver une ligne par son id
+# Toutes les clés d'un panier reçoivent CART_TTL à chaque modification.
+
+
+@dataclass
+class StoredCart:
+    """Panier lu depuis Redis, mêmes attributs que models.cart_model.Cart"""
+    id: int
+    user: int
+    store: int
+    total: float = 0.0
+
+@dataclass
+class StoredCartItem:
+    """Ligne de panier lue depuis Redis, mêmes attributs que models.item_cart_model.ItemCart (prix = total de la ligne)"""
+    id: int
+    cart: int
+    product: int
+    quantite: int
+    prix: float
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_redis():
+    """Client Redis partagé par le processus (pool de connexions interne)"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = redis.Redis.from_url(
+                REDIS_URL,
+                decode_responses=True,
+                socket_timeout=float(os.getenv("REDIS_SOCKET_TIMEOUT", "2")),
+                health_check_interval=30
+            )
+        return _client
+
+
+def _cart_key(cart_id):
+    return f"cart:{cart_id}"
+
+def _user_key(user_id):
+    return f"cart:user:{user_id}"
+
+def _user_store_key(user_id, store_id):
+    return f"cart:user:{user_id}:store:{store_id}"
+
+def _item_key(item_id):
+    return f"cart_item:{item_id}"
+
+def _parse(cart_id, fields):
+    """(panier, lignes) à partir du hash du panier, None si le panier n'existe pas ou a expiré"""
+    if not fields or "user" not in fields:
+        return None
+    items = []
+    for field, value in fields.items():
+        if not field.startswith("qty:"):
+            continue
+        product = int(field[4:])
+        quantity = int(value)
+        unit_price = float(fields.get(f"price:{product}", 0.0))
+        items.append(StoredCartItem(
+            id=int(fields.get(f"item:{product}", 0)),
+            cart=cart_id,
+            product=product,
+            quantite=quantity,
+            prix=round(unit_price * quantity, 2)
+        ))
+    items.sort(key=lambda item: item.id)
+    cart = StoredCart(
+        id=cart_id,
+        user=int(fields["user"]),
+        store=int(fields["store"]),
+        total=round(sum(item.prix for item in items), 2)
+    )
+    return cart, items
+
+async def _refresh(client, cart_id, fields):
+    """Prolonger le TTL des clés annexes du panier (index utilisateur, index des lignes) et renvoyer (panier, lignes)"""
+    parsed = _parse(cart_id, fields)
+    if not parsed:
+        return None
+    cart, items = parsed
+    pipe = client.pipeline(transaction=False)
+    pipe.expire(_user_key(cart.user), CART_TTL)
+    pipe.expire(_user_store_key(cart.user, cart.store), CART_TTL)
+    for item in items:
+        pipe.set(_item_key(item.id), f"{cart_id}:{item.product}", ex=CART_TTL)
+    await pipe.execute()
+    return cart, items
+
+
+class RedisCartRepository:
+    """Même interface que repository.CartRepository, paniers stockés dans Redis avec expiration"""
+    def __init__(self, client=None):
+        self.client = client or get_redis()
+
+    async def get_by_id(self, cart_id):
+        logging.debug(f"Fetching cart with id {cart_id} from Redis")
+        cart_with_items = await self.get_with_items(cart_id)
+        return cart_with_items[0] if cart_with_items else None
+
+    async def get_with_items(self, cart_id):
+        """Panier et toutes ses lignes en une seule lecture du hash, None si le panier n'existe pas"""
+        parsed = _parse(cart_id, await self.client.hgetall(_cart_key(cart_id)))
+        if not parsed:
+            logging.warning(f"No cart found with id {cart_id}")
+            return None
+        logging.debug(f"Fetched successfully cart {cart_id} with {len(parsed[1])} items")
+        return parsed
+
+    async def get_by_user_id(self, user_id):
+        logging.debug(f"Fetching cart for user {user_id} from Redis")
+        cart_id = await self.client.get(_user_key(user_id))
+        if not cart_id:
+            logging.warning(f"No cart found for user {user_id}")
+            return None
+        return await self.get_by_id(int(cart_id))
+
+    async def get_by_user_and_store(self, user_id, store_id):
+        logging.debug(f"Fetching cart for user {user_id} in store {store_id} from Redis")
+        cart_id = await self.client.get(_user_store_key(user_id, store_id))
+        if not cart_id:
+            logging.warning(f"No cart found for user {user_id} in store {store_id}")
+            return None
+        return await self.get_by_id(int(cart_id))
+
+    async def get_all_carts(self):
+        logging.debug("Fetching all carts from Redis")
+        carts = []
+        async for key in self.client.scan_iter(match="cart:*", _type="HASH"):
+            cart = await self.get_by_id(int(key.split(":", 1)[1]))
+            if cart:
+                carts.append(cart)
+        if not carts:
+            logging.warning("No carts found")
+            return None
+        logging.debug(f"Fetched successfully {len(carts)} carts")
+        return carts
+
+    async def create_cart(self, user_id, store_id):
+        logging.debug(f"Creating cart for user {user_id} in store {store_id} in Redis")
+        cart_id = await self.client.incr(CART_SEQUENCE)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hset(_cart_key(cart_id), mapping={"user": user_id, "store": store_id})
+        pipe.expire(_cart_key(cart_id), CART_TTL)
+        pipe.set(_user_key(user_id), cart_id, ex=CART_TTL)
+        pipe.set(_user_store_key(user_id, store_id), cart_id, ex=CART_TTL)
+        await pipe.execute()
+        logging.debug(f"Cart created successfully with id {cart_id}")
+        return StoredCart(id=cart_id, user=user_id, store=store_id)
+
+    async def update_cart_total(self, cart_id, new_total):
+        # Le total est toujours calculé à partir des lignes du hash, il n'y a rien à mettre à jour
+        return await self.get_by_id(cart_id)
+
+    async def delete_cart(self, cart_id):
+        logging.debug(f"Deleting cart with id {cart_id} from Redis")
+        parsed = await self.get_with_items(cart_id)
+        if not parsed:
+            logging.error(f"Cart with id {cart_id} does not exist")
+            return None
+        cart, items = parsed
+        pipe = self.client.pipeline(transaction=True)
+        pipe.delete(_cart_key(cart_id), *[_item_key(item.id) for item in items])
+        pipe.delete(_user_key(cart.user), _user_store_key(cart.user, cart.store))
+        await pipe.execute()
+        logging.debug(f"Cart with id {cart_id} deleted successfully")
+        return cart
+
+
+class RedisItemCartRepository:
+    """
+    Même interface que repository.ItemCartRepository, lignes stockées dans le hash du panier
+
+    Chaque modification est une transaction MULTI/EXEC (client redis.asyncio) sur ce hash (HINCRBY pour les ajouts),
+    les ajouts concurrents sur une même ligne ne se perdent donc pas.
+    """
+    def __init__(self, client=None):
+        self.client = client or get_redis()
+
+    async def get_by_id(self, item_id):
+        logging.debug(f"Fetching cart item with id {item_id} from Redis")
+        ref = await self.client.get(_item_key(item_id))
+        if not ref:
+            logging.warning(f"No cart item found with id {item_id}")
+            return None
+        cart_id, product_id = (int(part) for part in ref.split(":"))
+        return await self.get_item_by_cart_and_product(cart_id, product_id)
+
+    async def get_items_by_cart_id(self, cart_id):
+        logging.debug(f"Fetching all items for cart {cart_id} from Redis")
+        parsed = _parse(cart_id, await self.client.hgetall(_cart_key(cart_id)))
+        return parsed[1] if parsed else []
+
+    async def get_item_by_cart_and_product(self, cart_id, product_id):
+        for item in await self.get_items_by_cart_id(cart_id):
+            if item.product == product_id:
+                return item
+        logging.warning(f"No item found for cart {cart_id} and product {product_id}")
+        return None
+
+    async def add_item_to_cart(self, cart_id, product_id, quantity, price):
+        logging.debug(f"Adding item to cart {cart_id}: product {product_id}, quantity {quantity}")
+        items = await self._add_lines(cart_id, {product_id: (quantity, price)})
+        return items[0] if items else None
+
+    async def add_items_to_cart(self, cart_id, lines):
+        """
+        Ajouter plusieurs produits au panier en une transaction
+        lines: {product_id: (quantity, unit_price)}
+        Renvoie les lignes obtenues
+        """
+        logging.debug(f"Adding {len(lines)} items to cart {cart_id}")
+        items = await self._add_lines(cart_id, lines)
+        logging.debug(f"Added {len(items)} items to cart {cart_id}")
+        return [asdict(item) for item in items]
+
+    async def update_item_quantity(self, item_id, new_quantity, unit_price):
+        logging.debug(f"Updating item {item_id} quantity to {new_quantity}")
+        item = await self.get_by_id(item_id)
+        if not item:
+            logging.error(f"Item with id {item_id} does not exist")
+            return None
+
+        if new_quantity <= 0:
+            return await self.remove_item_from_cart(item_id)
+
+        key = _cart_key(item.cart)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hset(key, mapping={
+            f"qty:{item.product}": new_quantity,
+            f"price:{item.product}": unit_price,
+            f"item:{item.product}": item_id
+        })
+        pipe.expire(key, CART_TTL)
+        pipe.hgetall(key)
+        parsed = await _refresh(self.client, item.cart, (await pipe.execute())[-1])
+        logging.debug(f"Item {item_id} quantity updated successfully")
+        return next((line for line in parsed[1] if line.product == item.product), None) if parsed else None
+
+    async def remove_item_from_cart(self, item_id):
+        logging.debug(f"Removing item {item_id} from cart")
+        item = await self.get_by_id(item_id)
+        if not item:
+            logging.error(f"Item with id {item_id} does not exist")
+            return None
+
+        key = _cart_key(item.cart)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hdel(key, *(f"{prefix}{item.product}" for prefix in LINE_PREFIXES))
+        pipe.delete(_item_key(item_id))
+        pipe.expire(key, CART_TTL)
+        pipe.hgetall(key)
+        await _refresh(self.client, item.cart, (await pipe.execute())[-1])
+        logging.debug(f"Item {item_id} removed from cart {item.cart}")
+        return item
+
+    async def clear_cart(self, cart_id):
+        logging.debug(f"Clearing all items from cart {cart_id}")
+        key = _cart_key(cart_id)
+        async with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    # WATCH : une ligne ajoutée entre la lecture et la suppression fait rejouer la transaction
+                    await pipe.watch(key)
+                    fields = await pipe.hgetall(key)
+                    line_fields = [field for field in fields if field.startswith(LINE_PREFIXES)]
+                    item_keys = [_item_key(value) for field, value in fields.items() if field.startswith("item:")]
+                    pipe.multi()
+                    if line_fields:
+                        pipe.hdel(key, *line_fields)
+                    if item_keys:
+                        pipe.delete(*item_keys)
+                    await pipe.execute()
+                    break
+                except WatchError:
+                    continue
+        logging.debug(f"Cleared {len(item_keys)} items from cart {cart_id}")
+        return len(item_keys)
+
+    async def get_cart_total(self, cart_id):
+        parsed = _parse(cart_id, await self.client.hgetall(_cart_key(cart_id)))
+        total = parsed[0].total if parsed else 0.0
+        logging.debug(f"Cart {cart_id} total: {total}")
+        return total
+
+    async def _add_lines(self, cart_id, lines):
+        # Ids réservés d'avance en un INCRBY ; ceux des produits déjà présents dans le panier restent inutilisés
+        first_id = await self.client.incrby(ITEM_SEQUENCE, len(lines)) - len(lines) + 1
+        key = _cart_key(cart_id)
+        pipe = self.client.pipeline(transaction=True)
+        for offset, (product_id, (quantity, price)) in enumerate(lines.items()):
+            pipe.hsetnx(key, f"item:{product_id}", first_id + offset)
+            pipe.hincrby(key, f"qty:{product_id}", quantity)
+            pipe.hset(key, f"price:{product_id}", price)
+        pipe.expire(key, CART_TTL)
+        pipe.hgetall(key)
+        parsed = await _refresh(self.client, cart_id, (await pipe.execute())[-1])
+        if not parsed:
+            logging.error(f"Cart with id {cart_id} does not exist")
+            return []
+        return [item for item in parsed[1] if item.product in lines]
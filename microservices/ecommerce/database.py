@@ -0,0 +1,29 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from dotenv import load_dotenv
+import os
+
+load_dotenv()
+DATABASE_URL_ECOMMERCE = os.getenv("DATABASE_URL_ECOMMERCE", "postgresql://admin:admin@db_ecommerce:5432/postgres")
+
+# Sync engine, only for the outbox relay thread
+engine = create_engine(DATABASE_URL_ECOMMERCE, pool_pre_ping=True)
+Session = sessionmaker(bind=engine)
+
+# Async engine for request handlers and background tasks: a request waiting on the database
+# holds a pooled connection, not a worker thread
+async_engine = create_async_engine(
+    DATABASE_URL_ECOMMERCE.replace("postgresql://", "postgresql+asyncpg://", 1).replace("+psycopg2", "+asyncpg", 1),
+    pool_size=int(os.getenv("DB_POOL_SIZE", "20")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "10")),
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    pool_pre_ping=True
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+async def get_session():
+    """FastAPI dependency: one async session per request, always closed"""
+    async with AsyncSessionLocal() as session:
+        yield session
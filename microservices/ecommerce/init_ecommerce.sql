@@ -1,8 +1,26 @@
 CREATE TABLE carts (
     id SERIAL PRIMARY KEY,
-    total INTEGER,
+    total FLOAT DEFAULT 0.00,
     "user" INTEGER NOT NULL,
-    store INTEGER NOT NULL
+    store INTEGER NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    -- Redis cart a checkout snapshot was copied from, NULL for carts kept in Postgres
+    source_cart_id INTEGER
+);
+
+-- Cart lookup on every add-item, and oldest idle carts first for the compaction job
+CREATE INDEX idx_carts_user_store_updated ON carts ("user", store, updated_at);
+CREATE INDEX idx_carts_updated_at ON carts (updated_at);
+
+-- Abandoned carts removed by the compaction job, lines kept as JSON
+CREATE TABLE carts_archive (
+    id INTEGER PRIMARY KEY,
+    total FLOAT DEFAULT 0.00,
+    "user" INTEGER NOT NULL,
+    store INTEGER NOT NULL,
+    items JSON NOT NULL DEFAULT '[]',
+    updated_at TIMESTAMP,
+    archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 
 CREATE TABLE item_carts (
@@ -10,7 +28,8 @@ CREATE TABLE item_carts (
     quantite INTEGER,
     prix FLOAT DEFAULT 0.00,
     cart INTEGER REFERENCES carts(id),
-    product INTEGER NOT NULL
+    product INTEGER NOT NULL,
+    CONSTRAINT uq_item_carts_cart_product UNIQUE (cart, product)
 );
 
 
@@ -18,9 +37,48 @@ CREATE TABLE item_carts (
 CREATE TABLE checkout  (
     id SERIAL PRIMARY KEY,
     cart_id INTEGER REFERENCES carts(id),
-    current_status VARCHAR(50) NOT NULL DEFAULT 'pending'
+    customer_id INTEGER,
+    total FLOAT NOT NULL DEFAULT 0.00,
+    current_status VARCHAR(50) NOT NULL DEFAULT 'pending',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Checkout history: newest first per customer, keyset-paginated on (created_at, id);
+-- the summary columns are included so a page is read from the index alone
+CREATE INDEX idx_checkout_customer_created ON checkout (customer_id, created_at, id)
+    INCLUDE (current_status, total, cart_id);
+
+-- Transactional outbox: events written with the state change, published by the outbox relay
+CREATE TABLE outbox (
+    id BIGSERIAL PRIMARY KEY,
+    event_id VARCHAR(36) NOT NULL UNIQUE,
+    event_type VARCHAR(100) NOT NULL,
+    aggregate_type VARCHAR(50) NOT NULL,
+    aggregate_id VARCHAR(100) NOT NULL,
+    payload JSON NOT NULL,
+    headers JSON,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+
+CREATE INDEX idx_outbox_unsent ON outbox (id) WHERE sent_at IS NULL;
+
+-- Idempotency-Key of checkout requests and the response they got, replayed on retries
+CREATE TABLE idempotency_keys (
+    key VARCHAR(255) NOT NULL,
+    operation VARCHAR(50) NOT NULL,
+    request_hash VARCHAR(64) NOT NULL,
+    response_code INTEGER,
+    response_body JSON,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    completed_at TIMESTAMP,
+    PRIMARY KEY (key, operation)
+);
+
+CREATE INDEX idx_idempotency_keys_created_at ON idempotency_keys (created_at);
+
 
 -- INSERT INTO carts (id, total, "user", store) VALUES
 -- (1, 5, 1, 1),
@@ -1,5 +1,5 @@
 from sqlalchemy.orm import declarative_base, relationship
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, create_engine 
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, JSON, Index, create_engine, func
 from dotenv import load_dotenv
 import logging
 import os 
@@ -20,6 +20,28 @@ class Cart(Base):
     total = Column(Float, default=0.0)
     user = Column(Integer, nullable=False)  # Assuming a user_id to identify the cart owner and use microservice for this
     store = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False, server_default=func.now(), onupdate=func.now())  # Last activity, bumped by every total update
+    source_cart_id = Column(Integer, nullable=True)  # Redis cart a checkout snapshot was copied from, None for carts kept in Postgres
+
+    __table_args__ = (
+        # Cart lookup on every add-item (most recent cart of the user in the store)
+        Index('idx_carts_user_store_updated', 'user', 'store', 'updated_at'),
+        # Oldest idle carts first for the compaction job
+        Index('idx_carts_updated_at', 'updated_at'),
+    )
 
     def __str__(self):
         return f"Cart ID: {self.id}, User ID: {self.user_id}, Total Price: {self.total_price}, Store ID: {self.store}"
+
+
+class CartArchive(Base):
+    """Abandoned cart removed by the compaction job, lines kept as JSON"""
+    __tablename__ = "carts_archive"
+
+    id = Column(Integer, primary_key=True)
+    total = Column(Float, default=0.0)
+    user = Column(Integer, nullable=False)
+    store = Column(Integer, nullable=False)
+    items = Column(JSON, nullable=False, default=list)
+    updated_at = Column(DateTime)
+    archived_at = Column(DateTime, nullable=False, server_default=func.now())
@@ -1,7 +1,7 @@
 from dotenv import load_dotenv
 import logging
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Enum, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Enum, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -22,7 +22,19 @@ class Checkout(Base):
 
     id = Column(Integer, primary_key=True)
     cart_id = Column(Integer, nullable=False)  # Reference to cart (no FK constraint for microservices)
+    customer_id = Column(Integer)  # Owner of the cart when the checkout started
+    total = Column(Float, nullable=False, default=0.0)  # Priced when the checkout started, charged by payment
     current_status = Column(String(50), nullable=False, default='pending')  # Status of the checkout
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Checkout history: newest first per customer, keyset-paginated on (created_at, id);
+        # the summary columns are included so a page is read from the index alone
+        Index(
+            'idx_checkout_customer_created', 'customer_id', 'created_at', 'id',
+            postgresql_include=['current_status', 'total', 'cart_id']
+        ),
+    )
     
     def __str__(self):
         return f"Checkout {self.id} - Cart: {self.cart_id} - Status: {self.current_status}"
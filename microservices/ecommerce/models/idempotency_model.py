@@ -0,0 +1,16 @@
+from sqlalchemy.orm import declarative_base
+from sqlalchemy import Column, String, Integer, DateTime, JSON, func
+
+Base = declarative_base()
+
+class IdempotencyKey(Base):
+    """Idempotency-Key of a checkout request and the response it got, replayed on retries"""
+    __tablename__ = "idempotency_keys"
+
+    key = Column(String(255), primary_key=True)
+    operation = Column(String(50), primary_key=True)  # Keys are scoped per endpoint
+    request_hash = Column(String(64), nullable=False)  # Same key with another request body is rejected
+    response_code = Column(Integer)  # NULL while the first request is still running
+    response_body = Column(JSON)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+    completed_at = Column(DateTime)
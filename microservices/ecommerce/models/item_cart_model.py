@@ -1,6 +1,6 @@
 from django.db import models
 from sqlalchemy.orm import declarative_base, relationship
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, create_engine 
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, UniqueConstraint, create_engine 
 from dotenv import load_dotenv
 import logging
 import os 
@@ -24,5 +24,10 @@ class ItemCart(Base):
     cart = Column(Integer, nullable=False)
     product = Column(Integer, nullable=False)
 
+    __table_args__ = (
+        # One line per product in a cart, target of the bulk add upsert
+        UniqueConstraint('cart', 'product', name='uq_item_carts_cart_product'),
+    )
+
     def __str__(self):
         return f"Cart ID: {self.id}, User ID: {self.user_id}, Store ID: {self.store}"
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import httpx
+
+logging.basicConfig(level=logging.DEBUG, filename='app.log', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logging = logging.getLogger(__name__)
+
+PRODUCTS_URL = "http://kong-api_gateway:8000/products/api/v1/products"
+
+class _Flight:
+    """Appel en cours pour un produit, partagé par tous les appelants qui le demandent entre-temps"""
+    def __init__(self):
+        self.done = asyncio.Event()
+        self.product = None
+
+class ProductCatalog:
+    """
+    Cache local du catalogue du microservice produits (prix unitaires compris)
+
+    Les produits trouvés sont gardés PRODUCT_CACHE_TTL secondes, les produits inconnus
+    PRODUCT_CACHE_NEGATIVE_TTL secondes, et une entrée est rafraîchie dès qu'un événement
+    ProductCreated/Updated/Deleted arrive. Un seul appel HTTP est fait par produit manquant,
+    les appelants concurrents attendent son résultat. Un appel en échec n'est jamais mis en cache.
+    """
+    def __init__(self, base_url=PRODUCTS_URL):
+        self.base_url = base_url
+        self.ttl = float(os.getenv("PRODUCT_CACHE_TTL", "300"))
+        self.negative_ttl = float(os.getenv("PRODUCT_CACHE_NEGATIVE_TTL", "30"))
+        connect_timeout = float(os.getenv("PRODUCTS_CONNECT_TIMEOUT", "1"))
+        read_timeout = float(os.getenv("PRODUCTS_READ_TIMEOUT", "3"))
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.wait_timeout = connect_timeout + read_timeout
+        self._entries = {}  # product_id -> (expires_at, product dict or None if it does not exist)
+        self._flights = {}  # product_id -> _Flight
+        self._lock = threading.Lock()
+
+        # Client asynchrone : une requête en attente du microservice produits n'occupe qu'une socket
+        self.http = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=int(os.getenv("PRODUCTS_POOL_SIZE", "20")))
+        )
+
+    async def get(self, product_id):
+        """Produit tel que renvoyé par le microservice produits, None s'il n'existe pas ou est injoignable"""
+        with self._lock:
+            entry = self._entries.get(product_id)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+            flight = self._flights.get(product_id)
+            leader = flight is None
+            if leader:
+                flight = self._flights[product_id] = _Flight()
+
+        if not leader:
+            try:
+                await asyncio.wait_for(flight.done.wait(), self.wait_timeout)
+            except asyncio.TimeoutError:
+                return None
+            return flight.product
+
+        try:
+            flight.product = await self._fetch(product_id)
+        finally:
+            with self._lock:
+                self._flights.pop(product_id, None)
+            flight.done.set()
+        return flight.product
+
+    async def get_price(self, product_id):
+        product = await self.get(product_id)
+        return product.get('prix_unitaire') if product else None
+
+    async def get_many(self, product_ids):
+        """{product_id: produit} pour les produits existants, tous les manquants en un seul appel"""
+        now = time.monotonic()
+        products = {}
+        missing = []
+        with self._lock:
+            for product_id in set(product_ids):
+                entry = self._entries.get(product_id)
+                if entry and entry[0] > now:
+                    if entry[1] is not None:
+                        products[product_id] = entry[1]
+                else:
+                    missing.append(product_id)
+
+        if not missing:
+            return products
+
+        try:
+            response = await self.http.get(self.base_url, params={"ids": missing})
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logging.error(f"Échec de récupération de {len(missing)} produits: {e}")
+            return products
+
+        found = {product["id"]: product for product in response.json()}
+        for product_id in missing:
+            self._store(product_id, found.get(product_id))
+        products.update(found)
+        return products
+
+    def put(self, product):
+        self._store(product["id"], product)
+
+    def invalidate(self, product_id):
+        with self._lock:
+            self._entries.pop(product_id, None)
+
+    async def _fetch(self, product_id):
+        try:
+            response = await self.http.get(f"{self.base_url}/{product_id}")
+        except httpx.HTTPError as e:
+            logging.error(f"Échec de récupération du produit {product_id}: {e}")
+            return None
+
+        if response.status_code == 200:
+            product = response.json()
+            self._store(product_id, product)
+            return product
+        if response.status_code == 404:
+            self._store(product_id, None)
+        else:
+            logging.error(f"Statut inattendu {response.status_code} pour le produit {product_id}")
+        return None
+
+    def _store(self, product_id, product):
+        ttl = self.ttl if product is not None else self.negative_ttl
+        with self._lock:
+            self._entries[product_id] = (time.monotonic() + ttl, product)
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+def get_product_catalog():
+    """Obtenir le cache du catalogue partagé par tout le processus"""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = ProductCatalog()
+        return _catalog
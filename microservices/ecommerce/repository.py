@@ -1,126 +1,213 @@
 import logging
+import inspect
+from sqlalchemy import select, update, delete, func, text, tuple_
 from models.cart_model import Cart
 from models.item_cart_model import ItemCart
 from models.checkout_model import Checkout
+from models.idempotency_model import IdempotencyKey
 
 logging.basicConfig(level=logging.DEBUG, filename='app.log', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logging = logging.getLogger(__name__)
 
 class CartRepository:
     def __init__(self, session):
-        self.session = session
-        self.session.expire_on_commit = False  # Prevent session from expiring on commit
+        self.session = session  # AsyncSession, created with expire_on_commit=False
 
 
-    def get_by_id(self, cart_id):
+    async def get_by_id(self, cart_id):
         logging.debug(f"Fetching cart with id {cart_id}")
-        cart = self.session.query(Cart).filter_by(id=cart_id).first()
+        cart = await self.session.scalar(select(Cart).filter_by(id=cart_id))
         if not cart:
             logging.warning(f"No cart found with id {cart_id}")
             return None
         logging.debug(f"Fetched successfully cart with id {cart_id}")
         return cart
-    
-    def get_by_user_id(self, user_id):
+
+    async def get_with_items(self, cart_id):
+        """Cart and all its items in one joined query, None if the cart does not exist"""
+        logging.debug(f"Fetching cart {cart_id} with its items")
+        rows = (await self.session.execute(
+            select(Cart, ItemCart)
+            .outerjoin(ItemCart, ItemCart.cart == Cart.id)
+            .filter(Cart.id == cart_id)
+            .order_by(ItemCart.id)
+        )).all()
+        if not rows:
+            logging.warning(f"No cart found with id {cart_id}")
+            return None
+        items = [item for _, item in rows if item is not None]
+        logging.debug(f"Fetched successfully cart {cart_id} with {len(items)} items")
+        return rows[0][0], items
+
+    async def get_by_user_id(self, user_id):
         logging.debug(f"Fetching cart for user {user_id}")
-        cart = self.session.query(Cart).filter_by(user=user_id).first()
+        cart = await self.session.scalar(select(Cart).filter_by(user=user_id).limit(1))
         if not cart:
             logging.warning(f"No cart found for user {user_id}")
             return None
         logging.debug(f"Fetched successfully cart for user {user_id}")
         return cart
-    
-    def get_by_user_and_store(self, user_id, store_id):
+
+    async def get_by_user_and_store(self, user_id, store_id):
         logging.debug(f"Fetching cart for user {user_id} in store {store_id}")
-        cart = self.session.query(Cart).filter_by(user=user_id, store=store_id).first()
+        cart = await self.session.scalar(
+            select(Cart)
+            .filter_by(user=user_id, store=store_id)
+            .order_by(Cart.updated_at.desc())
+            .limit(1)
+        )
         if not cart:
             logging.warning(f"No cart found for user {user_id} in store {store_id}")
             return None
         logging.debug(f"Fetched successfully cart for user {user_id} in store {store_id}")
         return cart
-    
-    def get_all_carts(self):
+
+    async def get_all_carts(self):
         logging.debug("Fetching all carts")
-        carts = self.session.query(Cart).all()
+        carts = (await self.session.scalars(select(Cart))).all()
         if not carts:
             logging.warning("No carts found")
             return None
         logging.debug(f"Fetched successfully {len(carts)} carts")
         return carts
-    
-    def create_cart(self, user_id, store_id):
+
+    async def create_cart(self, user_id, store_id):
         logging.debug(f"Creating cart for user {user_id} in store {store_id}")
         cart = Cart(user=user_id, store=store_id, total=0.0)
         self.session.add(cart)
-        self.session.commit()
+        await self.session.commit()
         logging.debug(f"Cart created successfully with id {cart.id}")
         return cart
-        
-    def update_cart_total(self, cart_id, new_total):
+
+    async def update_cart_total(self, cart_id, new_total):
         logging.debug(f"Updating cart {cart_id} total to {new_total}")
-        cart = self.get_by_id(cart_id)
+        cart = await self.get_by_id(cart_id)
         if not cart:
             logging.error(f"Cart with id {cart_id} does not exist")
             return None
-        cart.total_price = new_total
-        self.session.commit()
+        cart.total = new_total
+        await self.session.commit()
         logging.debug(f"Cart {cart_id} total updated successfully")
         return cart
-        
-    def delete_cart(self, cart_id):
+
+    async def delete_cart(self, cart_id):
         logging.debug(f"Deleting cart with id {cart_id}")
-        cart = self.get_by_id(cart_id)
+        cart = await self.get_by_id(cart_id)
         if not cart:
             logging.error(f"Cart with id {cart_id} does not exist")
             return None
-        self.session.delete(cart)
-        self.session.commit()
+        await self.session.delete(cart)
+        await self.session.commit()
         logging.debug(f"Cart with id {cart_id} deleted successfully")
         return cart
 
+    async def archive_idle_carts(self, idle_seconds, batch_size):
+        """
+        Move one batch of abandoned carts (idle for idle_seconds, never checked out) and their
+        lines to carts_archive in a single statement, oldest first. Carts locked by a request in
+        progress are skipped. Returns (archived carts, removed lines)
+        """
+        logging.debug(f"Archiving up to {batch_size} carts idle for {idle_seconds}s")
+        try:
+            row = (await self.session.execute(
+                text(
+                    "WITH idle AS ("
+                    "  SELECT c.id FROM carts c "
+                    "  WHERE c.updated_at < now() - make_interval(secs => :idle_seconds) "
+                    "    AND NOT EXISTS (SELECT 1 FROM checkout k WHERE k.cart_id = c.id) "
+                    "  ORDER BY c.updated_at "
+                    "  LIMIT :batch_size "
+                    "  FOR UPDATE SKIP LOCKED"
+                    "), removed_items AS ("
+                    "  DELETE FROM item_carts i USING idle WHERE i.cart = idle.id "
+                    "  RETURNING i.cart, i.product, i.quantite, i.prix"
+                    "), removed_carts AS ("
+                    "  DELETE FROM carts c USING idle WHERE c.id = idle.id "
+                    "  RETURNING c.id, c.total, c.\"user\", c.store, c.updated_at"
+                    "), archived AS ("
+                    "  INSERT INTO carts_archive (id, total, \"user\", store, items, updated_at) "
+                    "  SELECT rc.id, rc.total, rc.\"user\", rc.store, "
+                    "    COALESCE(("
+                    "      SELECT json_agg(json_build_object('product', ri.product, 'quantite', ri.quantite, 'prix', ri.prix)) "
+                    "      FROM removed_items ri WHERE ri.cart = rc.id"
+                    "    ), '[]'::json), "
+                    "    rc.updated_at "
+                    "  FROM removed_carts rc "
+                    "  ON CONFLICT (id) DO NOTHING "
+                    "  RETURNING id"
+                    ") "
+                    "SELECT (SELECT count(*) FROM removed_carts) AS carts, (SELECT count(*) FROM removed_items) AS items"
+                ),
+                {'idle_seconds': float(idle_seconds), 'batch_size': batch_size}
+            )).one()
+            await self.session.commit()
+        except Exception:
+            await self.session.rollback()
+            raise
+        logging.debug(f"Archived {row.carts} carts and {row.items} items")
+        return row.carts, row.items
+
+    async def stage_snapshot(self, cart, items):
+        """
+        Copy a cart kept in another cart store (Redis) and its lines into a new Postgres cart and
+        return its id. Redis ids are not Postgres ids, the copy never reuses them.
+        Nothing is committed: the caller's commit (the checkout) persists it
+        """
+        logging.debug(f"Staging snapshot of cart {cart.id} with {len(items)} items")
+        snapshot = Cart(user=cart.user, store=cart.store, total=cart.total, source_cart_id=cart.id)
+        self.session.add(snapshot)
+        await self.session.flush()
+        self.session.add_all([
+            ItemCart(cart=snapshot.id, product=item.product, quantite=item.quantite, prix=item.prix)
+            for item in items
+        ])
+        return snapshot.id
+
 
 class ItemCartRepository:
     def __init__(self, session):
         self.session = session
 
-    def get_by_id(self, item_id):
+    async def get_by_id(self, item_id):
         logging.debug(f"Fetching cart item with id {item_id}")
-        item = self.session.query(ItemCart).filter_by(id=item_id).first()
+        item = await self.session.scalar(select(ItemCart).filter_by(id=item_id))
         if not item:
             logging.warning(f"No cart item found with id {item_id}")
             return None
         logging.debug(f"Fetched successfully cart item with id {item_id}")
         return item
-    
-    def get_items_by_cart_id(self, cart_id):
+
+    async def get_items_by_cart_id(self, cart_id):
         logging.debug(f"Fetching all items for cart {cart_id}")
-        items = self.session.query(ItemCart).filter_by(cart=cart_id).all()
+        items = (await self.session.scalars(select(ItemCart).filter_by(cart=cart_id))).all()
         if not items:
             logging.warning(f"No items found for cart {cart_id}")
             return []
         logging.debug(f"Fetched successfully {len(items)} items for cart {cart_id}")
         return items
-    
-    def get_item_by_cart_and_product(self, cart_id, product_id):
+
+    async def get_item_by_cart_and_product(self, cart_id, product_id):
         logging.debug(f"Fetching item for cart {cart_id} and product {product_id}")
-        item = self.session.query(ItemCart).filter_by(cart=cart_id, product=product_id).first()
+        item = await self.session.scalar(select(ItemCart).filter_by(cart=cart_id, product=product_id))
         if not item:
             logging.warning(f"No item found for cart {cart_id} and product {product_id}")
             return None
         logging.debug(f"Fetched successfully item for cart {cart_id} and product {product_id}")
         return item
-    
-    def add_item_to_cart(self, cart_id, product_id, quantity, price):
+
+    async def add_item_to_cart(self, cart_id, product_id, quantity, price):
         logging.debug(f"Adding item to cart {cart_id}: product {product_id}, quantity {quantity}")
-        
+
         # Check if item already exists in cart
-        existing_item = self.get_item_by_cart_and_product(cart_id, product_id)
-        
+        existing_item = await self.get_item_by_cart_and_product(cart_id, product_id)
+
         if existing_item:
             # Update existing item quantity
+            previous_price = existing_item.prix
             existing_item.quantite += quantity
             existing_item.prix = price * existing_item.quantite
-            self.session.commit()
+            await self._adjust_cart_total(cart_id, existing_item.prix - previous_price)
+            await self.session.commit()
             logging.debug(f"Updated existing item quantity to {existing_item.quantite}")
             return existing_item
         else:
@@ -132,120 +219,289 @@ class ItemCartRepository:
                 prix=price * quantity
             )
             self.session.add(item)
-            self.session.commit()
+            await self._adjust_cart_total(cart_id, item.prix)
+            await self.session.commit()
             logging.debug(f"Added new item to cart with id {item.id}")
             return item
-    
-    def update_item_quantity(self, item_id, new_quantity, unit_price):
+
+    async def add_items_to_cart(self, cart_id, lines):
+        """
+        Add several products to a cart in one upsert, then update the cart total once
+        lines: {product_id: (quantity, unit_price)}
+        Returns the resulting cart lines
+        """
+        logging.debug(f"Adding {len(lines)} items to cart {cart_id}")
+        try:
+            rows = (await self.session.execute(
+                text(
+                    "INSERT INTO item_carts (cart, product, quantite, prix) "
+                    "SELECT :cart, r.product, r.quantity, r.quantity * r.price "
+                    "FROM unnest(CAST(:products AS integer[]), CAST(:quantities AS integer[]), CAST(:prices AS double precision[])) "
+                    "  AS r(product, quantity, price) "
+                    "ON CONFLICT (cart, product) DO UPDATE SET "
+                    "  quantite = item_carts.quantite + EXCLUDED.quantite, "
+                    "  prix = (item_carts.quantite + EXCLUDED.quantite) * (EXCLUDED.prix / EXCLUDED.quantite) "
+                    "RETURNING id, cart, product, quantite, prix"
+                ),
+                {
+                    'cart': cart_id,
+                    'products': list(lines.keys()),
+                    'quantities': [quantity for quantity, _ in lines.values()],
+                    'prices': [float(price) for _, price in lines.values()]
+                }
+            )).all()
+            await self.session.execute(
+                update(Cart).where(Cart.id == cart_id).values(
+                    total=select(func.coalesce(func.sum(ItemCart.prix), 0.0))
+                    .where(ItemCart.cart == cart_id).scalar_subquery()
+                )
+            )
+            await self.session.commit()
+        except Exception:
+            await self.session.rollback()
+            raise
+        logging.debug(f"Added {len(rows)} items to cart {cart_id}")
+        return [row._asdict() for row in rows]
+
+    async def update_item_quantity(self, item_id, new_quantity, unit_price):
         logging.debug(f"Updating item {item_id} quantity to {new_quantity}")
-        item = self.get_by_id(item_id)
+        item = await self.get_by_id(item_id)
         if not item:
             logging.error(f"Item with id {item_id} does not exist")
             return None
-        
+
         if new_quantity <= 0:
             # Remove item if quantity is 0 or negative
-            return self.remove_item_from_cart(item_id)
-        
+            return await self.remove_item_from_cart(item_id)
+
+        previous_price = item.prix
         item.quantite = new_quantity
         item.prix = unit_price * new_quantity
-        self.session.commit()
+        await self._adjust_cart_total(item.cart, item.prix - previous_price)
+        await self.session.commit()
         logging.debug(f"Item {item_id} quantity updated successfully")
         return item
-    
-    def remove_item_from_cart(self, item_id):
+
+    async def remove_item_from_cart(self, item_id):
         logging.debug(f"Removing item {item_id} from cart")
-        item = self.get_by_id(item_id)
+        item = await self.get_by_id(item_id)
         if not item:
             logging.error(f"Item with id {item_id} does not exist")
             return None
-        
-        cart_id = item.sale_id
-        self.session.delete(item)
-        self.session.commit()
+
+        cart_id = item.cart
+        await self.session.delete(item)
+        await self._adjust_cart_total(cart_id, -item.prix)
+        await self.session.commit()
         logging.debug(f"Item {item_id} removed from cart {cart_id}")
         return item
-    
-    def clear_cart(self, cart_id):
+
+    async def clear_cart(self, cart_id):
         logging.debug(f"Clearing all items from cart {cart_id}")
-        items = self.get_items_by_cart_id(cart_id)
-        for item in items:
-            self.session.delete(item)
-        self.session.commit()
-        logging.debug(f"Cleared {len(items)} items from cart {cart_id}")
-        return len(items)
-    
-    def get_cart_total(self, cart_id):
+        result = await self.session.execute(delete(ItemCart).where(ItemCart.cart == cart_id))
+        await self.session.execute(update(Cart).where(Cart.id == cart_id).values(total=0.0))
+        await self.session.commit()
+        logging.debug(f"Cleared {result.rowcount} items from cart {cart_id}")
+        return result.rowcount
+
+    async def get_cart_total(self, cart_id):
         logging.debug(f"Calculating total for cart {cart_id}")
-        items = self.get_items_by_cart_id(cart_id)
-        total = sum(item.prix for item in items)
+        total = await self.session.scalar(
+            select(func.coalesce(func.sum(ItemCart.prix), 0.0)).where(ItemCart.cart == cart_id)
+        )
         logging.debug(f"Cart {cart_id} total: {total}")
         return total
 
+    async def _adjust_cart_total(self, cart_id, delta):
+        # Apply the price difference of the changed line in the same transaction, atomically in SQL
+        await self.session.execute(
+            update(Cart).where(Cart.id == cart_id).values(total=func.coalesce(Cart.total, 0.0) + delta)
+        )
+
 
 class CheckoutRepository:
     def __init__(self, session):
         self.session = session
 
-    def get_by_id(self, checkout_id):
+    async def get_by_id(self, checkout_id):
         logging.debug(f"Fetching checkout with id {checkout_id}")
-        checkout = self.session.query(Checkout).filter_by(id=checkout_id).first()
+        checkout = await self.session.scalar(select(Checkout).filter_by(id=checkout_id))
         if not checkout:
             logging.warning(f"No checkout found with id {checkout_id}")
             return None
         logging.debug(f"Fetched successfully checkout with id {checkout_id}")
         return checkout
-    
-    def get_by_cart_id(self, cart_id):
+
+    async def get_by_cart_id(self, cart_id):
         logging.debug(f"Fetching checkout for cart {cart_id}")
-        checkout = self.session.query(Checkout).filter_by(cart_id=cart_id).first()
+        checkout = await self.session.scalar(select(Checkout).filter_by(cart_id=cart_id).limit(1))
         if not checkout:
             logging.warning(f"No checkout found for cart {cart_id}")
             return None
         logging.debug(f"Fetched successfully checkout for cart {cart_id}")
         return checkout
-    
-    def get_by_user_id(self, user_id):
+
+    async def get_by_user_id(self, user_id):
         logging.debug(f"Fetching checkouts for user {user_id}")
-        checkouts = self.session.query(Checkout).filter_by(user=user_id).all()
+        checkouts = (await self.session.scalars(select(Checkout).filter_by(customer_id=user_id))).all()
         if not checkouts:
             logging.warning(f"No checkouts found for user {user_id}")
             return []
         logging.debug(f"Fetched successfully {len(checkouts)} checkouts for user {user_id}")
         return checkouts
-    
-    def create_checkout(self, cart_id):
+
+    async def get_history(self, customer_id, statuses=None, limit=20, before=None):
+        """
+        One page of a customer's checkouts, newest first, as summary dicts (no ORM objects).
+        before: (created_at, id) of the last checkout of the previous page. Keyset pagination
+        on idx_checkout_customer_created, so every page costs the same however deep it is.
+        Fetches limit + 1 rows so the caller knows whether another page follows
+        """
+        logging.debug(f"Fetching checkout history of customer {customer_id} (statuses {statuses}, before {before})")
+        query = (
+            select(Checkout.id, Checkout.cart_id, Checkout.total, Checkout.current_status, Checkout.created_at)
+            .where(Checkout.customer_id == customer_id)
+        )
+        if statuses:
+            query = query.where(Checkout.current_status.in_(statuses))
+        if before:
+            query = query.where(tuple_(Checkout.created_at, Checkout.id) < tuple_(*before))
+        query = query.order_by(Checkout.created_at.desc(), Checkout.id.desc()).limit(limit + 1)
+        rows = (await self.session.execute(query)).all()
+        logging.debug(f"Fetched {len(rows)} checkouts for customer {customer_id}")
+        return [row._asdict() for row in rows]
+
+    async def create_checkout(self, cart_id, customer_id, total, before_commit=None):
+        """before_commit(checkout) runs in the same transaction, e.g. to write outbox events"""
         logging.debug(f"Creating checkout for cart {cart_id}")
         checkout = Checkout(
-            cart_id=cart_id
+            cart_id=cart_id,
+            customer_id=customer_id,
+            total=total
         )
         self.session.add(checkout)
-        self.session.commit()
+        await self._commit(checkout, before_commit)
         logging.debug(f"Checkout created successfully with id {checkout.id}")
         return checkout
-    
-    def update_checkout_status(self, checkout_id, new_status):
+
+    async def update_checkout_status(self, checkout_id, new_status):
         logging.debug(f"Updating checkout {checkout_id} status to {new_status}")
-        checkout = self.get_by_id(checkout_id)
+        checkout = await self.get_by_id(checkout_id)
         if not checkout:
             logging.error(f"Checkout with id {checkout_id} does not exist")
             return None
-        checkout.status = new_status
-        self.session.commit()
+        checkout.current_status = new_status
+        await self.session.commit()
         logging.debug(f"Checkout {checkout_id} status updated successfully")
         return checkout
-    
-    def complete_checkout(self, checkout_id):
+
+    async def complete_checkout(self, checkout_id, before_commit=None):
+        """before_commit(checkout) runs in the same transaction, e.g. to write outbox events"""
         logging.debug(f"Completing checkout {checkout_id}")
-        checkout = self.get_by_id(checkout_id)
+        checkout = await self.get_by_id(checkout_id)
         if not checkout:
             logging.error(f"Checkout with id {checkout_id} does not exist")
             return None
         checkout.current_status = "completed"
-        self.session.commit()
+        await self._commit(checkout, before_commit)
         logging.debug(f"Checkout {checkout_id} completed successfully")
         return checkout
 
+    async def claim_for_completion(self, checkout_id):
+        """Move a pending checkout to 'completing' atomically: only one caller can complete it"""
+        logging.debug(f"Claiming checkout {checkout_id} for completion")
+        claimed = (await self.session.execute(
+            update(Checkout)
+            .where(Checkout.id == checkout_id, Checkout.current_status == "pending")
+            .values(current_status="completing")
+            .returning(Checkout.id)
+        )).first()
+        await self.session.commit()
+        return claimed is not None
+
+    async def _commit(self, checkout, before_commit):
+        try:
+            if before_commit:
+                await self.session.flush()
+                # Callbacks may be coroutines (e.g. writing the idempotent response)
+                result = before_commit(checkout)
+                if inspect.isawaitable(result):
+                    await result
+            await self.session.commit()
+        except Exception:
+            await self.session.rollback()
+            raise
+
+
+class IdempotencyRepository:
+    def __init__(self, session):
+        self.session = session
+
+    async def claim(self, key, operation, request_hash, stale_after_seconds):
+        """
+        Reserve an idempotency key for a request about to run. Returns (True, None) when the caller
+        must run the request, (False, record) when the key is already taken: record.response_code is
+        NULL while the first request is running. A key still running after stale_after_seconds
+        (crashed request) is taken over
+        """
+        logging.debug(f"Claiming idempotency key {key} for {operation}")
+        try:
+            claimed = (await self.session.execute(
+                text(
+                    "INSERT INTO idempotency_keys (key, operation, request_hash) "
+                    "VALUES (:key, :operation, :request_hash) "
+                    "ON CONFLICT (key, operation) DO UPDATE SET created_at = now() "
+                    "WHERE idempotency_keys.response_code IS NULL "
+                    "  AND idempotency_keys.request_hash = EXCLUDED.request_hash "
+                    "  AND idempotency_keys.created_at < now() - make_interval(secs => :stale_after) "
+                    "RETURNING key"
+                ),
+                {'key': key, 'operation': operation, 'request_hash': request_hash, 'stale_after': float(stale_after_seconds)}
+            )).first()
+            await self.session.commit()
+        except Exception:
+            await self.session.rollback()
+            raise
+        if claimed:
+            return True, None
+        record = await self.session.scalar(select(IdempotencyKey).filter_by(key=key, operation=operation))
+        logging.debug(f"Idempotency key {key} for {operation} already used")
+        return False, record
+
+    async def stage_response(self, key, operation, response_code, response_body):
+        """Record the response of a claimed key without committing, to be saved with the request's own transaction"""
+        await self.session.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.key == key, IdempotencyKey.operation == operation)
+            .values(response_code=response_code, response_body=response_body, completed_at=func.now())
+        )
+
+    async def save_response(self, key, operation, response_code, response_body):
+        await self.stage_response(key, operation, response_code, response_body)
+        await self.session.commit()
+
+    async def release(self, key, operation):
+        """Forget a claimed key whose request failed, so that it can be retried"""
+        logging.debug(f"Releasing idempotency key {key} for {operation}")
+        await self.session.rollback()
+        await self.session.execute(
+            delete(IdempotencyKey).where(
+                IdempotencyKey.key == key,
+                IdempotencyKey.operation == operation,
+                IdempotencyKey.response_code.is_(None)
+            )
+        )
+        await self.session.commit()
+
+    async def purge_expired(self, max_age_seconds):
+        logging.debug(f"Purging idempotency keys older than {max_age_seconds}s")
+        result = await self.session.execute(
+            text("DELETE FROM idempotency_keys WHERE created_at < now() - make_interval(secs => :max_age)"),
+            {'max_age': float(max_age_seconds)}
+        )
+        await self.session.commit()
+        return result.rowcount
+
 
 # # Composite Repository for complex operations
 # class EcommerceRepository:
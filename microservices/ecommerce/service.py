@@ -1,105 +1,195 @@
-from repository import CartRepository, ItemCartRepository, CheckoutRepository
+from repository import CartRepository, ItemCartRepository, CheckoutRepository, IdempotencyRepository
+from cart_store import RedisCartRepository, RedisItemCartRepository
+from product_catalog import get_product_catalog
+from prometheus_client import Counter, Histogram
+from datetime import datetime
+import asyncio
+import base64
+import binascii
+import hashlib
+import json
 import logging 
-import requests
+import os
+import time
+import httpx
 logging.basicConfig(level=logging.DEBUG, filename='app.log', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logging = logging.getLogger(__name__)
 
+# "postgres" : paniers en base ; "redis" : paniers dans Redis avec expiration, copiés en base au checkout
+CART_STORE = os.getenv("CART_STORE", "postgres")
+
+# Compaction des paniers abandonnés (jamais passés au checkout) en base
+CART_IDLE_SECONDS = int(os.getenv("CART_IDLE_SECONDS", str(7 * 24 * 3600)))
+CART_COMPACTION_BATCH_SIZE = int(os.getenv("CART_COMPACTION_BATCH_SIZE", "500"))
+CART_COMPACTION_MAX_BATCHES = int(os.getenv("CART_COMPACTION_MAX_BATCHES", "20"))
+
+# Clés d'idempotence : une requête en cours depuis plus longtemps est considérée abandonnée,
+# les réponses sont rejouées pendant IDEMPOTENCY_KEY_TTL_SECONDS
+IDEMPOTENCY_STALE_AFTER_SECONDS = int(os.getenv("IDEMPOTENCY_STALE_AFTER_SECONDS", "60"))
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_KEY_TTL_SECONDS", "86400"))
+
+# Historique des checkouts : taille de page par défaut et maximale
+CHECKOUT_HISTORY_PAGE_SIZE = int(os.getenv("CHECKOUT_HISTORY_PAGE_SIZE", "20"))
+CHECKOUT_HISTORY_MAX_PAGE_SIZE = int(os.getenv("CHECKOUT_HISTORY_MAX_PAGE_SIZE", "100"))
+
+# Prometheus metrics
+carts_compacted = Counter('ecommerce_carts_compacted_total', 'Abandoned carts moved to carts_archive')
+cart_items_compacted = Counter('ecommerce_cart_items_compacted_total', 'Cart lines removed with their abandoned cart')
+cart_compaction_duration = Histogram('ecommerce_cart_compaction_duration_seconds', 'Duration of one cart compaction run')
+
+WAREHOUSE_URL = "http://kong-api_gateway:8000/warehouse/api/v1"
+WAREHOUSE_TIMEOUT = httpx.Timeout(
+    float(os.getenv("WAREHOUSE_READ_TIMEOUT", "5")),
+    connect=float(os.getenv("WAREHOUSE_CONNECT_TIMEOUT", "1"))
+)
+WAREHOUSE_POOL_SIZE = int(os.getenv("WAREHOUSE_POOL_SIZE", "10"))
+
+# La réservation de stock est créée par le warehouse à la réception d'OrderInitiated (outbox puis broker) :
+# la finalisation l'attend au plus WAREHOUSE_RESERVATION_WAIT_SECONDS, en relançant la confirmation
+WAREHOUSE_RESERVATION_WAIT_SECONDS = float(os.getenv("WAREHOUSE_RESERVATION_WAIT_SECONDS", "10"))
+WAREHOUSE_RESERVATION_POLL_SECONDS = float(os.getenv("WAREHOUSE_RESERVATION_POLL_SECONDS", "0.25"))
+
+# Connexions HTTP asynchrones réutilisées vers le warehouse, bornées par WAREHOUSE_POOL_SIZE :
+# une requête en attente du warehouse n'occupe qu'une socket, pas un thread
+warehouse_http = httpx.AsyncClient(timeout=WAREHOUSE_TIMEOUT, limits=httpx.Limits(max_connections=WAREHOUSE_POOL_SIZE))
+
+# Client des autres microservices (users)
+services_http = httpx.AsyncClient(timeout=httpx.Timeout(5.0, connect=1.0))
+
+
+class ReservationPending(ValueError):
+    """Le warehouse n'a pas encore réservé le stock de la commande"""
+
+
+def _with_order_items(before_commit, order_items):
+    """Adapter un callback before_commit(checkout, order_items) au repository, qui ne passe que le checkout"""
+    if before_commit is None:
+        return None
+    return lambda checkout: before_commit(checkout, order_items)
+
 class CartService:
-    def __init__(self, session):
+    def __init__(self, session, store=None):
         self.session = session
-        self.cart_repository = CartRepository(session)
-        self.item_repository = ItemCartRepository(session)
+        self.store = store or CART_STORE
+        if self.store == "redis":
+            self.cart_repository = RedisCartRepository()
+            self.item_repository = RedisItemCartRepository()
+        else:
+            self.cart_repository = CartRepository(session)
+            self.item_repository = ItemCartRepository(session)
 
-    def get_cart_by_id(self, cart_id):
-        cart = self.cart_repository.get_by_id(cart_id)
+    async def get_cart_by_id(self, cart_id):
+        cart = await self.cart_repository.get_by_id(cart_id)
         return cart
     
-    def get_cart_by_user(self, user_id):
-        cart = self.cart_repository.get_by_user_id(user_id)
+    async def get_cart_by_user(self, user_id):
+        cart = await self.cart_repository.get_by_user_id(user_id)
         return cart
     
-    def get_or_create_cart(self, user_id, store_id):
+    async def get_or_create_cart(self, user_id, store_id):
         """Obtenir ou créer un panier pour l'utilisateur"""
-        cart = self.cart_repository.get_by_user_and_store(user_id, store_id)
+        cart = await self.cart_repository.get_by_user_and_store(user_id, store_id)
         if not cart:
-            cart = self.cart_repository.create_cart(user_id, store_id)
+            cart = await self.cart_repository.create_cart(user_id, store_id)
         return cart
 
-    def get_cart_with_items(self, cart_id):
+    async def get_cart_with_items(self, cart_id):
         """Obtenir le panier avec tous ses articles"""
-        # 1. Get the cart
-        cart = self.cart_repository.get_by_id(cart_id)
-        if not cart:
+        # 1. Get the cart and its items in one query
+        cart_with_items = await self.cart_repository.get_with_items(cart_id)
+        if not cart_with_items:
             return None
+        cart, items = cart_with_items
         
-        # 2. Get all items for this cart
-        items = self.item_repository.get_items_by_cart_id(cart_id)
-        
-        # 3. Calculate total
+        # 2. Calculate total from the lines already loaded
         calculated_total = sum(item.prix for item in items)
         
-        # 4. Return cart data structure
+        # 3. Return cart data structure
         return {
             'cart': cart,
             'items': items,
             'item_count': len(items),
             'calculated_total': calculated_total
         }
-    def add_item_to_cart(self, cart, product_id, quantity, store_id):
+    async def add_item_to_cart(self, cart, product_id, quantity, store_id):
         """Ajouter un article au panier avec validation complète"""
         user_id = 0  # Assuming a default user_id for now
-        product_info = self._get_product_info(product_id)
+        product_info = await self._get_product_info(product_id)
         if not product_info:
             raise ValueError(f"Produit {product_id} non trouvé")
             
-        if not self._check_stock_availability(product_id, store_id, quantity):
+        if not await self._check_stock_availability(product_id, store_id, quantity):
             raise ValueError(f"Stock insuffisant pour le produit {product_id}")
             
-        cart = self.get_or_create_cart(user_id, store_id)
+        cart = await self.get_or_create_cart(user_id, store_id)
         
-        item = self.item_repository.add_item_to_cart(
+        item = await self.item_repository.add_item_to_cart(
             cart_id=cart.id,
             product_id=product_id,
             quantity=quantity,
             price=product_info.get('prix_unitaire'),
         )
-        
-        # 6. Mettre à jour le total du panier
-        self._update_cart_total(cart.id)
+        # Le total du panier est ajusté dans la même transaction par le repository
         
         return item
     
-    def update_item_quantity(self, item_id, new_quantity):
+    async def add_items_to_cart(self, cart_id, store_id, items):
+        """
+        Ajouter plusieurs articles au panier en une fois
+        Les produits et le stock de toutes les lignes sont obtenus en deux appels concurrents,
+        les lignes sont insérées en un seul upsert et le total mis à jour une seule fois
+        """
+        quantities = {}
+        for item in items:
+            if item["quantity"] <= 0:
+                raise ValueError(f"Quantité invalide pour le produit {item['product_id']}")
+            quantities[item["product_id"]] = quantities.get(item["product_id"], 0) + item["quantity"]
+        
+        if not await self.cart_repository.get_by_id(cart_id):
+            raise ValueError(f"Panier {cart_id} non trouvé")
+        
+        product_ids = list(quantities)
+        products, available = await asyncio.gather(
+            self._get_products_info(product_ids),
+            self._get_available_stock(product_ids, store_id)
+        )
+        
+        missing = [product_id for product_id in product_ids if product_id not in products]
+        if missing:
+            raise ValueError(f"Produits {missing} non trouvés")
+        insufficient = [product_id for product_id, quantity in quantities.items() if available.get(product_id, 0) < quantity]
+        if insufficient:
+            raise ValueError(f"Stock insuffisant pour les produits {insufficient}")
+        
+        return await self.item_repository.add_items_to_cart(cart_id, {
+            product_id: (quantity, products[product_id]['prix_unitaire'])
+            for product_id, quantity in quantities.items()
+        })
+    
+    async def update_item_quantity(self, item_id, new_quantity):
         """Mettre à jour la quantité d'un article dans le panier"""
-        item = self.item_repository.get_by_id(item_id)
+        item = await self.item_repository.get_by_id(item_id)
         if not item:
             raise ValueError(f"Article {item_id} non trouvé")
         
         # Obtenir le prix unitaire du produit
-        product_info = self._get_product_info(item.product_id)
+        product_info = await self._get_product_info(item.product)
         if not product_info:
             raise ValueError(f"Impossible d'obtenir les informations du produit")
         
-        updated_item = self.item_repository.update_item_quantity(
+        updated_item = await self.item_repository.update_item_quantity(
             item_id, new_quantity, product_info['prix_unitaire']
         )
         
-        # Mettre à jour le total du panier
-        self._update_cart_total(item.sale_id)
-        
         return updated_item
     
-    def remove_item_from_cart(self, item_id):
+    async def remove_item_from_cart(self, item_id):
         """Supprimer un article du panier"""
-        item = self.item_repository.get_by_id(item_id)
+        item = await self.item_repository.get_by_id(item_id)
         if not item:
             raise ValueError(f"Article {item_id} non trouvé")
         
-        cart_id = item.sale_id
-        removed_item = self.item_repository.remove_item_from_cart(item_id)
-        
-        # Mettre à jour le total du panier
-        self._update_cart_total(cart_id)
+        removed_item = await self.item_repository.remove_item_from_cart(item_id)
         
         return removed_item
     
@@ -108,30 +198,49 @@ class CartService:
     #     ecommerce_repo = EcommerceRepository(self.session)
     #     return ecommerce_repo.get_cart_with_items(cart_id)
     
-    def clear_cart(self, cart_id):
+    async def clear_cart(self, cart_id):
         """Vider le panier"""
-        cleared_count = self.item_repository.clear_cart(cart_id)
-        self._update_cart_total(cart_id)
+        cleared_count = await self.item_repository.clear_cart(cart_id)
         return cleared_count
     
-    def _update_cart_total(self, cart_id):
-        """Mettre à jour le total du panier"""
-        total = self.item_repository.get_cart_total(cart_id)
-        return self.cart_repository.update_cart_total(cart_id, total)
+    async def recalculate_cart_total(self, cart_id):
+        """Recalculer le total du panier en SQL, p. ex. pour corriger un total désynchronisé"""
+        total = await self.item_repository.get_cart_total(cart_id)
+        return await self.cart_repository.update_cart_total(cart_id, total)
 
-    def _validate_user_exists(self, user_id):
+    async def compact_abandoned_carts(self):
+        """
+        Archiver les paniers inactifs depuis CART_IDLE_SECONDS et jamais passés au checkout,
+        par lots de CART_COMPACTION_BATCH_SIZE (une transaction courte par lot), au plus
+        CART_COMPACTION_MAX_BATCHES lots par exécution. Toujours en base : avec CART_STORE=redis,
+        les paniers expirent d'eux-mêmes dans Redis. Renvoie le nombre de paniers archivés
+        """
+        repository = self.cart_repository if self.store == "postgres" else CartRepository(self.session)
+        started = time.monotonic()
+        total_carts = 0
+        for _ in range(CART_COMPACTION_MAX_BATCHES):
+            carts, items = await repository.archive_idle_carts(CART_IDLE_SECONDS, CART_COMPACTION_BATCH_SIZE)
+            carts_compacted.inc(carts)
+            cart_items_compacted.inc(items)
+            total_carts += carts
+            if carts < CART_COMPACTION_BATCH_SIZE:
+                break
+        cart_compaction_duration.observe(time.monotonic() - started)
+        return total_carts
+
+    async def _validate_user_exists(self, user_id):
         """Valider que l'utilisateur existe via le microservice users"""
         try:
-            response = requests.get(f"http://localhost:8000/users/api/v1/customers/{user_id}")
+            response = await services_http.get(f"http://localhost:8000/users/api/v1/customers/{user_id}")
             return response.status_code == 200
         except Exception as e:
             logging.error(f"Échec de validation de l'utilisateur {user_id}: {e}")
             return False
 
-    def _get_user_info(self, user_id):
+    async def _get_user_info(self, user_id):
         """Obtenir les informations de l'utilisateur depuis le microservice users"""
         try:
-            response = requests.get(f"http://localhost:8000/users/api/v1/customers/{user_id}")
+            response = await services_http.get(f"http://localhost:8000/users/api/v1/customers/{user_id}")
             if response.status_code == 200:
                 return response.json()
             return None
@@ -139,21 +248,34 @@ class CartService:
             logging.error(f"Échec de récupération des infos utilisateur {user_id}: {e}")
             return None
     
-    def _get_product_info(self, product_id):
-        """Obtenir les informations du produit depuis le microservice produits"""
+    async def _get_product_info(self, product_id):
+        """Obtenir les informations du produit depuis le cache du catalogue produits"""
+        return await get_product_catalog().get(product_id)
+    
+    async def _get_products_info(self, product_ids):
+        """Obtenir plusieurs produits depuis le cache du catalogue, les manquants en un appel, {product_id: produit}"""
+        return await get_product_catalog().get_many(product_ids)
+    
+    async def _get_available_stock(self, product_ids, store_id):
+        """Obtenir le stock disponible de plusieurs produits d'un magasin en un appel au microservice warehouse"""
         try:
-            response = requests.get(f"http://kong-api_gateway:8000/products/api/v1/products/{product_id}")
-            if response.status_code == 200:
-                return response.json()
-            return None
+            response = await warehouse_http.get(
+                f"{WAREHOUSE_URL}/inventory",
+                params={"product": product_ids, "store": store_id}
+            )
+            response.raise_for_status()
+            return {
+                line['product_id']: sum(store['available'] for store in line['stores'])
+                for line in response.json()['inventory']
+            }
         except Exception as e:
-            logging.error(f"Échec de récupération des infos produit {product_id}: {e}")
-            return None
+            logging.error(f"Échec de vérification du stock des produits {product_ids}: {e}")
+            raise ValueError("Impossible de vérifier le stock")
             
-    def _check_stock_availability(self, product_id, store_id, quantity):
+    async def _check_stock_availability(self, product_id, store_id, quantity):
         """Vérifier la disponibilité du stock depuis le microservice warehouse"""
         try:
-            response = requests.get(f"http://kong-api_gateway:8000/warehouse/api/v1/stocks/product/{product_id}/store/{store_id}")
+            response = await warehouse_http.get(f"{WAREHOUSE_URL}/stocks/product/{product_id}/store/{store_id}")
             if response.status_code == 200:
                 stock_data = response.json()
                 return stock_data['quantite'] >= quantity
@@ -169,18 +291,51 @@ class CheckoutService:
         self.checkout_repository = CheckoutRepository(session)
         self.cart_service = CartService(session)
 
-    def get_checkout_by_id(self, checkout_id):
-        checkout = self.checkout_repository.get_by_id(checkout_id)
+    async def get_checkout_by_id(self, checkout_id):
+        checkout = await self.checkout_repository.get_by_id(checkout_id)
         return checkout
     
-    def get_checkouts_by_user(self, user_id):
-        checkouts = self.checkout_repository.get_by_user_id(user_id)
+    async def get_checkouts_by_user(self, user_id):
+        checkouts = await self.checkout_repository.get_by_user_id(user_id)
         return checkouts
 
-    def initiate_checkout(self, cart_id):
-        """Initier le processus de checkout avec validation complète"""
+    async def get_checkout_history(self, customer_id, statuses=None, limit=None, cursor=None):
+        """
+        Une page de l'historique des checkouts du client, du plus récent au plus ancien, en résumé
+        (id, cart_id, total, current_status, created_at). cursor est le next_cursor de la page
+        précédente ; next_cursor vaut None sur la dernière page
+        """
+        limit = limit or CHECKOUT_HISTORY_PAGE_SIZE
+        if not 1 <= limit <= CHECKOUT_HISTORY_MAX_PAGE_SIZE:
+            raise ValueError(f"limit doit être entre 1 et {CHECKOUT_HISTORY_MAX_PAGE_SIZE}")
+        before = self._decode_cursor(cursor) if cursor else None
         
-        cart_data = self.cart_service.get_cart_with_items(cart_id)
+        rows = await self.checkout_repository.get_history(customer_id, statuses, limit, before)
+        items = rows[:limit]
+        next_cursor = self._encode_cursor(items[-1]) if len(rows) > limit else None
+        return {'items': items, 'next_cursor': next_cursor}
+
+    @staticmethod
+    def _encode_cursor(row):
+        # Curseur opaque : position (created_at, id) du dernier checkout de la page
+        return base64.urlsafe_b64encode(f"{row['created_at'].isoformat()}|{row['id']}".encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        try:
+            created_at, checkout_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+            return datetime.fromisoformat(created_at), int(checkout_id)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise ValueError("Curseur invalide")
+
+    async def initiate_checkout(self, cart_id, before_commit=None):
+        """
+        Initier le processus de checkout avec validation complète
+        before_commit(checkout, order_items) est appelé dans la transaction de création du checkout,
+        order_items étant les lignes du panier avec leur prix
+        """
+        
+        cart_data = await self.cart_service.get_cart_with_items(cart_id)
         if not cart_data or not cart_data['items']:
             raise ValueError("Le panier est vide ou n'existe pas")
             
@@ -188,54 +343,114 @@ class CheckoutService:
         #     if not self._check_stock_availability(item, cart_data['cart'].store, quantity=item.quantite):
         #         raise ValueError(f"Stock insuffisant pour le produit {item.product}")
                 
-        total_amount = cart_data['calculated_total']
+        order_items, total_amount = await self._price_items(cart_data['items'])
+        
+        checkout_cart_id = cart_id
+        if self.cart_service.store != "postgres":
+            # Le panier n'existe que dans le cart store : le copier dans un nouveau panier en base,
+            # dans la transaction du checkout
+            checkout_cart_id = await CartRepository(self.session).stage_snapshot(cart_data['cart'], cart_data['items'])
         
-        checkout = self.checkout_repository.create_checkout(
-            cart_id
+        checkout = await self.checkout_repository.create_checkout(
+            checkout_cart_id,
+            cart_data['cart'].user,
+            total_amount,
+            before_commit=_with_order_items(before_commit, order_items)
         )
         
         return checkout
     
-    def complete_checkout(self, checkout_id):
-        """Finaliser le checkout avec intégration warehouse"""
-        checkout = self.checkout_repository.get_by_id(checkout_id)
+    async def _price_items(self, items):
+        """
+        Lignes de commande avec prix unitaire et total en une passe sur les articles déjà chargés,
+        au prix courant du catalogue (en cache) ou, à défaut, au prix enregistré dans le panier
+        """
+        products = await get_product_catalog().get_many([item.product for item in items])
+        order_items = []
+        total_amount = 0.0
+        for item in items:
+            unit_price = (products.get(item.product) or {}).get('prix_unitaire')
+            if unit_price is None:
+                unit_price = item.prix / item.quantite if item.quantite else 0.0
+            line_total = round(unit_price * item.quantite, 2)
+            order_items.append({
+                "product_id": item.product,
+                "quantity": item.quantite,
+                "unit_price": unit_price,
+                "total_price": line_total
+            })
+            total_amount += line_total
+        return order_items, round(total_amount, 2)
+    
+    async def complete_checkout(self, checkout_id, before_commit=None, reservation_wait=None):
+        """
+        Finaliser le checkout avec intégration warehouse
+        before_commit(checkout) est appelé dans la transaction de finalisation du checkout
+        reservation_wait borne l'attente de la réservation de stock (le délai restant à l'appelant)
+        """
+        checkout = await self.checkout_repository.get_by_id(checkout_id)
         if not checkout:
             raise ValueError("Checkout non trouvé")
+        
+        # Un seul appel peut faire passer le checkout de pending à completing : une relance
+        # ne confirme jamais la réservation une seconde fois
+        if not await self.checkout_repository.claim_for_completion(checkout_id):
+            await self.session.refresh(checkout)
+            if checkout.current_status == "completed":
+                logging.info(f"Checkout {checkout_id} déjà complété")
+                return checkout
+            raise ValueError(f"Le checkout {checkout_id} ne peut pas être complété (statut {checkout.current_status})")
             
         try:
             
-            # 3. Réduire le stock dans le warehouse pour chaque article
-            cart_data = self.cart_service.get_cart_with_items(checkout.cart_id)
-            cart = cart_data['cart']
-            
-            for item in cart_data['items']:
-                success = self._reduce_warehouse_stock(item.product, cart.store, item.quantite)
-                if not success:
-                    raise ValueError(f"Échec de réduction du stock pour le produit {item.product}")
+            # 3. Le stock est réservé pour la commande (order_id = checkout.id) à la réception d'OrderInitiated :
+            # confirmer la réservation le déduit, le réduire à nouveau le compterait deux fois
+            await self._await_warehouse_confirmation(checkout_id, reservation_wait)
             
             # 4. Finaliser le checkout
-            completed_checkout = self.checkout_repository.complete_checkout(checkout_id)
-            
-            # 5. Vider le panier
-            self.cart_service.clear_cart(checkout.cart_id)
-            
-            logging.info(f"Checkout {checkout_id} complété avec succès pour le cart {checkout.cart_id}")
-            return completed_checkout
+            completed_checkout = await self.checkout_repository.complete_checkout(
+                checkout_id,
+                before_commit=before_commit
+            )
             
+        except ReservationPending:
+            # Rien n'est réservé ni confirmé : le checkout redevient pending, une relance pourra le compléter
+            await self.checkout_repository.update_checkout_status(checkout_id, "pending")
+            raise
         except Exception as e:
-            # En cas d'erreur, annuler le checkout et restaurer le stock si nécessaire
-            self.checkout_repository.update_checkout_status(checkout_id, "cancelled")
+            # En cas d'erreur, annuler le checkout et rendre le stock de la commande, réservé ou confirmé
+            await self._release_warehouse_reservation(checkout_id)
+            await self.checkout_repository.update_checkout_status(checkout_id, "cancelled")
             raise ValueError(f"Échec du checkout: {e}")
+        
+        # 5. Vider le panier, le checkout est déjà finalisé et le stock ne doit plus être restauré
+        await self.cart_service.clear_cart(await self._source_cart_id(checkout))
+        
+        logging.info(f"Checkout {checkout_id} complété avec succès pour le cart {checkout.cart_id}")
+        return completed_checkout
     
-    def cancel_checkout(self, checkout_id):
-        """Annuler un checkout"""
-        return self.checkout_repository.update_checkout_status(checkout_id, "cancelled")
+    async def _source_cart_id(self, checkout):
+        """Panier de l'utilisateur dont le checkout est issu : le panier du cart store copié, ou le panier en base"""
+        if self.cart_service.store == "postgres":
+            return checkout.cart_id
+        snapshot = await CartRepository(self.session).get_by_id(checkout.cart_id)
+        return snapshot.source_cart_id if snapshot and snapshot.source_cart_id else checkout.cart_id
+    
+    async def cancel_checkout(self, checkout_id):
+        """
+        Annuler un checkout et rendre le stock de la commande. Le warehouse retient la libération :
+        une réservation créée après l'annulation (OrderInitiated en retard) ne retient rien
+        """
+        checkout = await self.checkout_repository.update_checkout_status(checkout_id, "cancelled")
+        if checkout:
+            await self._release_warehouse_reservation(checkout_id)
+        return checkout
     
-    def _validate_item_stock(self, item):
+    async def _validate_item_stock(self, item):
         """Valider qu'un article a suffisamment de stock"""
         # Note: On devrait obtenir le store_id du panier
         try:
-            response = requests.get(f"http://localhost:8000/warehouse/api/v1/stocks/product/{item.product_id}")
+            response = await services_http.get(f"http://localhost:8000/warehouse/api/v1/stocks/product/{item.product_id}")
             if response.status_code == 200:
                 stocks = response.json()
                 total_available = sum(stock['quantite'] for stock in stocks)
@@ -245,19 +460,19 @@ class CheckoutService:
             logging.error(f"Échec de validation du stock: {e}")
             return False
 
-    def _validate_user_exists(self, user_id):
+    async def _validate_user_exists(self, user_id):
         """Valider que l'utilisateur existe via le microservice users"""
         try:
-            response = requests.get(f"http://localhost:8000/users/api/v1/customers/{user_id}")
+            response = await services_http.get(f"http://localhost:8000/users/api/v1/customers/{user_id}")
             return response.status_code == 200
         except Exception as e:
             logging.error(f"Échec de validation de l'utilisateur {user_id}: {e}")
             return False
 
-    def _check_stock_availability(self, product_id, store_id, quantity):
+    async def _check_stock_availability(self, product_id, store_id, quantity):
         """Vérifier la disponibilité du stock depuis le microservice warehouse"""
         try:
-            response = requests.get(f"http://kong-api_gateway:8000/warehouse/api/v1/stocks/product/{product_id}/store/{store_id}")
+            response = await warehouse_http.get(f"{WAREHOUSE_URL}/stocks/product/{product_id}/store/{store_id}")
             if response.status_code == 200:
                 stock_data = response.json()
                 return stock_data['quantite'] >= quantity
@@ -266,32 +481,85 @@ class CheckoutService:
             logging.error(f"Échec de vérification du stock: {e}")
             return False
     
-    def _reduce_warehouse_stock(self, product_id, store_id, quantity):
-        """Réduire le stock dans le microservice warehouse"""
+    async def _await_warehouse_confirmation(self, order_id, max_wait=None):
+        """Confirmer la réservation de la commande en attendant, au plus max_wait secondes, que le warehouse l'ait créée"""
+        wait = WAREHOUSE_RESERVATION_WAIT_SECONDS if max_wait is None else min(max_wait, WAREHOUSE_RESERVATION_WAIT_SECONDS)
+        deadline = time.monotonic() + wait
+        while True:
+            try:
+                return await self._confirm_warehouse_reservation(order_id)
+            except ReservationPending:
+                if time.monotonic() + WAREHOUSE_RESERVATION_POLL_SECONDS > deadline:
+                    raise
+                await asyncio.sleep(WAREHOUSE_RESERVATION_POLL_SECONDS)
+
+    async def _confirm_warehouse_reservation(self, order_id):
+        """Confirmer la réservation de stock de la commande dans le microservice warehouse"""
         try:
-            response = requests.post(
-                f"http://kong-api_gateway:8000/warehouse/api/v1/stocks/reduce",
-                params={
-                    "product": product_id,
-                    "store": store_id,
-                    "quantity": quantity
-                }
-            )
-            if response.status_code != 200:
-                logging.error(f"Échec de réduction du stock: {response.text}")
-                return False
-            return True
-        except Exception as e:
-            logging.error(f"Échec de réduction du stock: {e}")
-            return False
+            response = await warehouse_http.post(f"{WAREHOUSE_URL}/reservations/order/{order_id}/confirm")
+        except httpx.HTTPError as e:
+            logging.error(f"Échec de confirmation de la réservation de la commande {order_id}: {e}")
+            raise ValueError("Warehouse injoignable, réservation non confirmée")
+        if response.status_code == 404:
+            raise ReservationPending(f"Stock de la commande {order_id} pas encore réservé par le warehouse")
+        if response.status_code != 200:
+            logging.error(f"Échec de confirmation de la réservation de la commande {order_id}: {response.text}")
+            raise ValueError(f"Échec de confirmation de la réservation: {response.text}")
+        return response.json()
 
-    def _get_user_info(self, user_id):
+    async def _release_warehouse_reservation(self, order_id):
+        """Rendre au warehouse le stock réservé ou déjà confirmé pour la commande"""
+        try:
+            response = await warehouse_http.post(f"{WAREHOUSE_URL}/reservations/order/{order_id}/release")
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logging.error(f"Échec de libération de la réservation de la commande {order_id}: {e}")
+
+    async def _get_user_info(self, user_id):
         """Obtenir les informations de l'utilisateur depuis le microservice users"""
         try:
-            response = requests.get(f"http://kong-api_gateway:8000/users/api/v1/customers/{user_id}")
+            response = await services_http.get(f"http://kong-api_gateway:8000/users/api/v1/customers/{user_id}")
             if response.status_code == 200:
                 return response.json()
             return None
         except Exception as e:
             logging.error(f"Échec de récupération des infos utilisateur {user_id}: {e}")
             return None
+
+
+class IdempotencyService:
+    """
+    Clés Idempotency-Key des requêtes de checkout : la première requête portant une clé est exécutée,
+    les suivantes reçoivent la réponse enregistrée sans rien réexécuter
+    """
+    def __init__(self, session):
+        self.session = session
+        self.repository = IdempotencyRepository(session)
+
+    async def claim(self, key, operation, request):
+        """
+        Réserver la clé pour la requête (dict JSON). Renvoie None si la requête doit être exécutée,
+        sinon l'enregistrement de la requête d'origine (response_code à None si elle est encore en cours)
+        Lève ValueError si la clé a déjà servi pour une autre requête
+        """
+        request_hash = hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+        claimed, record = await self.repository.claim(key, operation, request_hash, IDEMPOTENCY_STALE_AFTER_SECONDS)
+        if claimed:
+            return None
+        if record is not None and record.request_hash != request_hash:
+            raise ValueError("Idempotency-Key déjà utilisée pour une autre requête")
+        return record
+
+    async def stage_response(self, key, operation, response_code, response_body):
+        """Enregistrer la réponse dans la transaction en cours, p. ex. depuis un callback before_commit"""
+        await self.repository.stage_response(key, operation, response_code, response_body)
+
+    async def save_response(self, key, operation, response_code, response_body):
+        await self.repository.save_response(key, operation, response_code, response_body)
+
+    async def release(self, key, operation):
+        """Libérer la clé d'une requête en échec pour qu'elle puisse être relancée"""
+        await self.repository.release(key, operation)
+
+    async def purge_expired(self):
+        return await self.repository.purge_expired(IDEMPOTENCY_KEY_TTL_SECONDS)
@@ -0,0 +1,84 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app as ecommerce_app
+from database import get_session
+
+
+@pytest.fixture
+def client():
+    ecommerce_app.app.dependency_overrides[get_session] = lambda: MagicMock()
+    yield TestClient(ecommerce_app.app)
+    ecommerce_app.app.dependency_overrides.clear()
+
+
+def test_add_items_returns_the_cart_lines(client):
+    with patch.object(ecommerce_app, "CartService") as cart_service:
+        cart_service.return_value.add_items_to_cart = AsyncMock(return_value=[
+            {"id": 1, "cart": 7, "product": 10, "quantite": 2, "prix": 5.0}
+        ])
+        response = client.post("/api/v1/cart/add-items", json={
+            "cart": 7, "store_id": 1, "items": [{"product": 10, "quantite": 2}]
+        })
+
+    assert response.status_code == 200
+    assert response.json() == [{"id": 1, "quantite": 2, "cart": 7, "product": 10}]
+    cart_service.return_value.add_items_to_cart.assert_awaited_once_with(7, 1, [{"product_id": 10, "quantity": 2}])
+
+
+def test_add_items_short_of_stock_is_a_client_error(client):
+    with patch.object(ecommerce_app, "CartService") as cart_service:
+        cart_service.return_value.add_items_to_cart = AsyncMock(side_effect=ValueError("Stock insuffisant pour les produits [10]"))
+        response = client.post("/api/v1/cart/add-items", json={
+            "cart": 7, "store_id": 1, "items": [{"product": 10, "quantite": 9}]
+        })
+
+    assert response.status_code == 400
+    assert "[10]" in response.json()["detail"]
+
+
+def test_completion_before_the_stock_is_reserved_is_a_conflict(client):
+    with patch.object(ecommerce_app, "CheckoutService") as checkout_service:
+        checkout_service.return_value.complete_checkout = AsyncMock(side_effect=ecommerce_app.ReservationPending("pas encore réservé"))
+        response = client.post("/api/v1/checkout/42/complete?reservation_wait=2.5")
+
+    assert response.status_code == 409
+    assert checkout_service.return_value.complete_checkout.await_args.kwargs["reservation_wait"] == 2.5
+
+
+@pytest.fixture
+def compensation():
+    """Runs the consumer's coroutines in place of the app's loop"""
+    session = AsyncMock()
+    session.__aenter__.return_value = session
+    with patch.object(ecommerce_app, "run_on_event_loop", asyncio.run), \
+            patch.object(ecommerce_app, "AsyncSessionLocal", return_value=session):
+        yield session
+
+
+def test_checkout_cancelled_by_the_saga_is_cancelled(compensation):
+    with patch.object(ecommerce_app, "CheckoutService") as checkout_service:
+        checkout_service.return_value.cancel_checkout = AsyncMock(return_value=MagicMock())
+        ecommerce_app.handle_checkout_cancelled({"data": {"checkout_id": 42, "order_id": 42, "reason": "payment_failed"}})
+
+    checkout_service.assert_called_once_with(compensation)
+    checkout_service.return_value.cancel_checkout.assert_awaited_once_with(42)
+
+
+def test_failed_checkout_cancellation_is_requeued(compensation):
+    with patch.object(ecommerce_app, "CheckoutService") as checkout_service:
+        checkout_service.return_value.cancel_checkout = AsyncMock(side_effect=RuntimeError("connection lost"))
+        # The subscriber requeues the command when the handler raises
+        with pytest.raises(RuntimeError):
+            ecommerce_app.handle_checkout_cancelled({"data": {"checkout_id": 42}})
+
+
+def test_cart_cleared_by_the_saga_is_emptied(compensation):
+    with patch.object(ecommerce_app, "CartService") as cart_service:
+        cart_service.return_value.clear_cart = AsyncMock(return_value=2)
+        ecommerce_app.handle_cart_cleared({"data": {"cart_id": 7, "order_id": 42}})
+
+    cart_service.return_value.clear_cart.assert_awaited_once_with(7)
@@ -0,0 +1,145 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from repository import CartRepository, ItemCartRepository
+from service import CartService
+
+
+def make_session():
+    session = AsyncMock()
+    session.add = MagicMock()
+    return session
+
+
+def compiled(statement):
+    return statement.compile(dialect=postgresql.dialect())
+
+
+def executed(session):
+    return [compiled(call.args[0]) for call in session.execute.await_args_list]
+
+
+def test_new_line_adds_its_price_to_the_cart_total():
+    session = make_session()
+    session.scalar.return_value = None
+
+    item = asyncio.run(ItemCartRepository(session).add_item_to_cart(7, 10, 3, 2.5))
+
+    assert item.prix == 7.5
+    [total_update] = executed(session)
+    assert str(total_update).startswith("UPDATE carts SET total=(coalesce(carts.total")
+    assert 7.5 in total_update.params.values()
+    session.commit.assert_awaited_once()
+
+
+def test_existing_line_adjusts_the_total_by_the_difference_only():
+    session = make_session()
+    existing = SimpleNamespace(id=1, cart=7, product=10, quantite=2, prix=5.0)
+    session.scalar.return_value = existing
+
+    asyncio.run(ItemCartRepository(session).add_item_to_cart(7, 10, 1, 2.5))
+
+    assert (existing.quantite, existing.prix) == (3, 7.5)
+    [total_update] = executed(session)
+    assert 2.5 in total_update.params.values()
+    session.commit.assert_awaited_once()
+
+
+def test_removed_line_takes_its_price_off_the_total():
+    session = make_session()
+    session.scalar.return_value = SimpleNamespace(id=1, cart=7, product=10, quantite=2, prix=5.0)
+
+    asyncio.run(ItemCartRepository(session).remove_item_from_cart(1))
+
+    [total_update] = executed(session)
+    assert -5.0 in total_update.params.values()
+    session.commit.assert_awaited_once()
+
+
+def test_clear_cart_deletes_every_line_in_one_statement():
+    session = make_session()
+    session.execute.return_value.rowcount = 4
+
+    assert asyncio.run(ItemCartRepository(session).clear_cart(7)) == 4
+
+    delete, total_update = [str(statement) for statement in executed(session)]
+    assert delete.startswith("DELETE FROM item_carts WHERE item_carts.cart =")
+    assert total_update.startswith("UPDATE carts SET total=")
+    session.commit.assert_awaited_once()
+
+
+def test_cart_total_is_summed_in_sql():
+    session = make_session()
+    session.scalar.return_value = 12.5
+
+    assert asyncio.run(ItemCartRepository(session).get_cart_total(7)) == 12.5
+
+    assert "sum(item_carts.prix)" in str(compiled(session.scalar.await_args.args[0]))
+
+
+def test_cart_with_items_is_loaded_in_one_query():
+    cart = SimpleNamespace(id=7)
+    items = [SimpleNamespace(id=1, prix=5.0), SimpleNamespace(id=2, prix=2.5)]
+    session = make_session()
+    session.execute.return_value = MagicMock()
+    session.execute.return_value.all.return_value = [(cart, item) for item in items]
+
+    details = asyncio.run(CartService(session, store="postgres").get_cart_with_items(7))
+
+    assert details == {'cart': cart, 'items': items, 'item_count': 2, 'calculated_total': 7.5}
+    [query] = [str(statement) for statement in executed(session)]
+    assert "LEFT OUTER JOIN item_carts" in query
+    session.execute.assert_awaited_once()
+
+
+def test_empty_cart_loads_without_items():
+    cart = SimpleNamespace(id=7)
+    session = make_session()
+    session.execute.return_value = MagicMock()
+    session.execute.return_value.all.return_value = [(cart, None)]
+
+    assert asyncio.run(CartRepository(session).get_with_items(7)) == (cart, [])
+
+
+def test_bulk_add_upserts_every_line_then_updates_the_total_once():
+    session = make_session()
+    session.execute.return_value = MagicMock()
+    session.execute.return_value.all.return_value = []
+
+    asyncio.run(ItemCartRepository(session).add_items_to_cart(7, {10: (2, 2.5), 11: (1, 4)}))
+
+    upsert, total_update = [call.args for call in session.execute.await_args_list]
+    assert "ON CONFLICT (cart, product) DO UPDATE" in str(upsert[0])
+    assert upsert[1] == {'cart': 7, 'products': [10, 11], 'quantities': [2, 1], 'prices': [2.5, 4.0]}
+    assert "sum(item_carts.prix)" in str(compiled(total_update[0]))
+    session.commit.assert_awaited_once()
+
+
+def test_failed_bulk_add_rolls_back():
+    session = make_session()
+    session.execute.side_effect = RuntimeError("deadlock detected")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(ItemCartRepository(session).add_items_to_cart(7, {10: (2, 2.5)}))
+
+    session.rollback.assert_awaited_once()
+    session.commit.assert_not_awaited()
+
+
+def test_idle_carts_are_archived_in_one_statement():
+    session = make_session()
+    session.execute.return_value = MagicMock()
+    session.execute.return_value.one.return_value = SimpleNamespace(carts=2, items=5)
+
+    assert asyncio.run(CartRepository(session).archive_idle_carts(3600, 500)) == (2, 5)
+
+    statement, params = session.execute.await_args.args
+    # Carts already checked out are kept, carts locked by a request are skipped
+    assert "NOT EXISTS (SELECT 1 FROM checkout" in str(statement)
+    assert "FOR UPDATE SKIP LOCKED" in str(statement)
+    assert params == {'idle_seconds': 3600.0, 'batch_size': 500}
+    session.commit.assert_awaited_once()
@@ -0,0 +1,101 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+import service
+from service import CartService
+
+
+def make_cart_service(products=None, available=None):
+    cart_service = CartService(MagicMock(), store="postgres")
+    cart_service.cart_repository = AsyncMock()
+    cart_service.cart_repository.get_by_id.return_value = SimpleNamespace(id=7)
+    cart_service.item_repository = AsyncMock()
+    cart_service._get_products_info = AsyncMock(return_value=products if products is not None else {
+        10: {'id': 10, 'prix_unitaire': 2.5}, 11: {'id': 11, 'prix_unitaire': 4.0}
+    })
+    cart_service._get_available_stock = AsyncMock(return_value=available if available is not None else {10: 5, 11: 5})
+    return cart_service
+
+
+def test_bulk_add_merges_lines_of_the_same_product():
+    cart_service = make_cart_service()
+
+    asyncio.run(cart_service.add_items_to_cart(7, 1, [
+        {"product_id": 10, "quantity": 1}, {"product_id": 11, "quantity": 1}, {"product_id": 10, "quantity": 2}
+    ]))
+
+    cart_service._get_products_info.assert_awaited_once_with([10, 11])
+    cart_service._get_available_stock.assert_awaited_once_with([10, 11], 1)
+    cart_service.item_repository.add_items_to_cart.assert_awaited_once_with(7, {10: (3, 2.5), 11: (1, 4.0)})
+
+
+def test_bulk_add_rejects_a_non_positive_quantity():
+    cart_service = make_cart_service()
+
+    with pytest.raises(ValueError, match="Quantité invalide"):
+        asyncio.run(cart_service.add_items_to_cart(7, 1, [{"product_id": 10, "quantity": 0}]))
+
+    cart_service.item_repository.add_items_to_cart.assert_not_awaited()
+
+
+def test_bulk_add_to_a_missing_cart_is_an_error():
+    cart_service = make_cart_service()
+    cart_service.cart_repository.get_by_id.return_value = None
+
+    with pytest.raises(ValueError, match="Panier 7"):
+        asyncio.run(cart_service.add_items_to_cart(7, 1, [{"product_id": 10, "quantity": 1}]))
+
+
+def test_bulk_add_names_every_unknown_product():
+    cart_service = make_cart_service(products={10: {'id': 10, 'prix_unitaire': 2.5}})
+
+    with pytest.raises(ValueError, match=r"\[11\]"):
+        asyncio.run(cart_service.add_items_to_cart(7, 1, [
+            {"product_id": 10, "quantity": 1}, {"product_id": 11, "quantity": 1}
+        ]))
+
+    cart_service.item_repository.add_items_to_cart.assert_not_awaited()
+
+
+def test_bulk_add_checks_the_stock_of_the_merged_quantity():
+    cart_service = make_cart_service(available={10: 2, 11: 5})
+
+    with pytest.raises(ValueError, match=r"Stock insuffisant pour les produits \[10\]"):
+        asyncio.run(cart_service.add_items_to_cart(7, 1, [
+            {"product_id": 10, "quantity": 2}, {"product_id": 10, "quantity": 1}
+        ]))
+
+    cart_service.item_repository.add_items_to_cart.assert_not_awaited()
+
+
+def make_compacting_cart_service(monkeypatch, batches):
+    monkeypatch.setattr(service, "CART_COMPACTION_BATCH_SIZE", 2)
+    monkeypatch.setattr(service, "CART_COMPACTION_MAX_BATCHES", 3)
+    cart_service = CartService(MagicMock(), store="postgres")
+    cart_service.cart_repository = AsyncMock()
+    cart_service.cart_repository.archive_idle_carts.side_effect = batches
+    return cart_service
+
+
+def test_compaction_stops_at_the_first_partial_batch(monkeypatch):
+    cart_service = make_compacting_cart_service(monkeypatch, [(2, 5), (1, 1)])
+    compacted = service.carts_compacted._value.get()
+    items_compacted = service.cart_items_compacted._value.get()
+
+    assert asyncio.run(cart_service.compact_abandoned_carts()) == 3
+
+    assert cart_service.cart_repository.archive_idle_carts.await_count == 2
+    cart_service.cart_repository.archive_idle_carts.assert_awaited_with(service.CART_IDLE_SECONDS, 2)
+    assert service.carts_compacted._value.get() - compacted == 3
+    assert service.cart_items_compacted._value.get() - items_compacted == 6
+
+
+def test_compaction_runs_at_most_the_configured_batches(monkeypatch):
+    cart_service = make_compacting_cart_service(monkeypatch, [(2, 2)] * 5)
+
+    assert asyncio.run(cart_service.compact_abandoned_carts()) == 6
+
+    assert cart_service.cart_repository.archive_idle_carts.await_count == 3
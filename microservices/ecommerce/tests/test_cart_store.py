@@ -0,0 +1,172 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from cart_store import CART_TTL, RedisCartRepository, RedisItemCartRepository, StoredCart, StoredCartItem, _parse
+from repository import CartRepository
+from service import CheckoutService
+
+CART_HASH = {
+    "user": "3", "store": "1",
+    "qty:10": "2", "price:10": "2.5", "item:10": "5",
+    "qty:11": "1", "price:11": "4.0", "item:11": "4"
+}
+
+
+def make_client(pipeline_results=None):
+    """Redis client whose MULTI/EXEC pipelines record their commands and return pipeline_results"""
+    client = AsyncMock()
+    pipe = MagicMock()
+    pipe.execute = AsyncMock(return_value=pipeline_results or [])
+    client.pipeline = MagicMock(return_value=pipe)
+    return client, pipe
+
+
+def test_parse_builds_the_cart_and_its_lines_from_the_hash():
+    cart, items = _parse(7, CART_HASH)
+
+    assert cart == StoredCart(id=7, user=3, store=1, total=9.0)
+    # Lines keep the order they were added in
+    assert items == [
+        StoredCartItem(id=4, cart=7, product=11, quantite=1, prix=4.0),
+        StoredCartItem(id=5, cart=7, product=10, quantite=2, prix=5.0)
+    ]
+
+
+def test_parse_of_a_missing_or_expired_cart_is_none():
+    assert _parse(7, {}) is None
+    assert _parse(7, {"qty:10": "1"}) is None
+
+
+def test_cart_with_items_is_one_hash_read():
+    client, _ = make_client()
+    client.hgetall.return_value = CART_HASH
+
+    cart, items = asyncio.run(RedisCartRepository(client).get_with_items(7))
+
+    client.hgetall.assert_awaited_once_with("cart:7")
+    assert cart.total == 9.0 and len(items) == 2
+
+
+def test_created_cart_and_its_user_indexes_expire():
+    client, pipe = make_client()
+    client.incr.return_value = 7
+
+    cart = asyncio.run(RedisCartRepository(client).create_cart(3, 1))
+
+    assert cart == StoredCart(id=7, user=3, store=1)
+    pipe.hset.assert_called_once_with("cart:7", mapping={"user": 3, "store": 1})
+    pipe.expire.assert_called_once_with("cart:7", CART_TTL)
+    pipe.set.assert_any_call("cart:user:3", 7, ex=CART_TTL)
+    pipe.set.assert_any_call("cart:user:3:store:1", 7, ex=CART_TTL)
+
+
+def test_added_lines_increment_the_quantity_in_one_transaction():
+    client, pipe = make_client()
+    client.incrby.return_value = 12
+    refresh = MagicMock()
+    refresh.execute = AsyncMock()
+    client.pipeline.side_effect = [pipe, refresh]
+    pipe.execute.return_value = [CART_HASH]
+
+    items = asyncio.run(RedisItemCartRepository(client).add_items_to_cart(7, {10: (2, 2.5), 11: (1, 4.0)}))
+
+    client.incrby.assert_awaited_once_with("cart_item:next_id", 2)
+    client.pipeline.assert_any_call(transaction=True)
+    # Concurrent adds of the same product add up instead of overwriting each other
+    pipe.hsetnx.assert_any_call("cart:7", "item:10", 11)
+    pipe.hsetnx.assert_any_call("cart:7", "item:11", 12)
+    pipe.hincrby.assert_any_call("cart:7", "qty:10", 2)
+    pipe.hincrby.assert_any_call("cart:7", "qty:11", 1)
+    assert [item["product"] for item in items] == [11, 10]
+    refresh.expire.assert_any_call("cart:user:3", CART_TTL)
+    refresh.set.assert_any_call("cart_item:5", "7:10", ex=CART_TTL)
+
+
+def test_lines_added_to_an_expired_cart_are_dropped():
+    client, pipe = make_client()
+    client.incrby.return_value = 1
+    pipe.execute.return_value = [{"qty:10": "1"}]
+
+    assert asyncio.run(RedisItemCartRepository(client).add_item_to_cart(7, 10, 1, 2.5)) is None
+
+
+def make_session(snapshot_id=100):
+    """Session whose flush gives the added cart the next Postgres SERIAL id"""
+    session = AsyncMock()
+    session.add = MagicMock()
+    session.add_all = MagicMock()
+
+    async def flush():
+        session.add.call_args.args[0].id = snapshot_id
+
+    session.flush.side_effect = flush
+    return session
+
+
+def test_redis_cart_is_copied_to_postgres_with_the_checkout():
+    cart, items = _parse(7, CART_HASH)
+    session = make_session()
+
+    assert asyncio.run(CartRepository(session).stage_snapshot(cart, items)) == 100
+
+    [snapshot] = session.add.call_args.args
+    assert (snapshot.user, snapshot.store, snapshot.total, snapshot.source_cart_id) == (3, 1, 9.0, 7)
+    [lines] = session.add_all.call_args.args
+    assert [(line.cart, line.product, line.quantite, line.prix) for line in lines] == [(100, 11, 1, 4.0), (100, 10, 2, 5.0)]
+    # The checkout commits the copy, never the repository
+    session.commit.assert_not_awaited()
+
+
+def test_redis_cart_id_taken_by_a_postgres_cart_never_touches_it():
+    # Redis cart 7 while Postgres cart 7 belongs to another user: the copy gets its own id
+    cart, items = _parse(7, CART_HASH)
+    session = make_session(snapshot_id=8)
+
+    assert asyncio.run(CartRepository(session).stage_snapshot(cart, items)) == 8
+
+    [snapshot] = session.add.call_args.args
+    assert snapshot.id == 8
+    session.merge.assert_not_awaited()
+    session.execute.assert_not_awaited()
+    [lines] = session.add_all.call_args.args
+    assert all(line.cart == 8 for line in lines)
+
+
+@pytest.mark.parametrize("store, staged", [("redis", True), ("postgres", False)])
+def test_initiate_checkout_only_copies_carts_kept_outside_postgres(monkeypatch, store, staged):
+    cart, items = _parse(7, CART_HASH)
+    checkout_service = CheckoutService(MagicMock())
+    checkout_service.cart_service = AsyncMock()
+    checkout_service.cart_service.store = store
+    checkout_service.cart_service.get_cart_with_items.return_value = {'cart': cart, 'items': items}
+    checkout_service.checkout_repository = AsyncMock()
+    checkout_service._price_items = AsyncMock(return_value=([], 9.0))
+    stage_snapshot = AsyncMock(return_value=100)
+    monkeypatch.setattr(CartRepository, "stage_snapshot", stage_snapshot)
+
+    asyncio.run(checkout_service.initiate_checkout(7))
+
+    assert stage_snapshot.await_count == (1 if staged else 0)
+    # The checkout points at the Postgres copy, never at the Redis id
+    assert checkout_service.checkout_repository.create_checkout.await_args.args[0] == (100 if staged else 7)
+
+
+def test_completed_checkout_clears_the_redis_cart_it_was_copied_from(monkeypatch):
+    checkout = SimpleNamespace(id=42, cart_id=100, current_status="pending")
+    checkout_service = CheckoutService(MagicMock())
+    checkout_service.checkout_repository = AsyncMock()
+    checkout_service.checkout_repository.get_by_id.return_value = checkout
+    checkout_service.checkout_repository.claim_for_completion.return_value = True
+    checkout_service._await_warehouse_confirmation = AsyncMock()
+    checkout_service.cart_service = AsyncMock()
+    checkout_service.cart_service.store = "redis"
+    get_by_id = AsyncMock(return_value=SimpleNamespace(id=100, source_cart_id=7))
+    monkeypatch.setattr(CartRepository, "get_by_id", get_by_id)
+
+    asyncio.run(checkout_service.complete_checkout(42))
+
+    get_by_id.assert_awaited_once_with(100)
+    checkout_service.cart_service.clear_cart.assert_awaited_once_with(7)
@@ -0,0 +1,120 @@
+import asyncio
+import base64
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.dialects import postgresql
+
+import app as ecommerce_app
+import service
+from database import get_session
+from repository import CheckoutRepository
+from service import CheckoutService
+
+NOW = datetime(2026, 10, 1, 12, 0, 0, 123456)
+
+
+def summary(checkout_id, minutes_ago=0):
+    return {
+        'id': checkout_id, 'cart_id': checkout_id, 'total': 10.0,
+        'current_status': 'completed', 'created_at': NOW - timedelta(minutes=minutes_ago)
+    }
+
+
+def make_checkout_service(rows):
+    checkout_service = CheckoutService(MagicMock())
+    checkout_service.checkout_repository = AsyncMock()
+    checkout_service.checkout_repository.get_history.return_value = rows
+    return checkout_service
+
+
+def test_cursor_round_trips_the_position_of_the_last_checkout():
+    cursor = CheckoutService._encode_cursor(summary(42))
+
+    assert CheckoutService._decode_cursor(cursor) == (NOW, 42)
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    base64.urlsafe_b64encode(b"\xff\xfe").decode(),
+    base64.urlsafe_b64encode(b"2026-10-01T12:00:00").decode(),
+    base64.urlsafe_b64encode(b"yesterday|42").decode()
+])
+def test_tampered_cursor_is_rejected(cursor):
+    with pytest.raises(ValueError, match="Curseur invalide"):
+        CheckoutService._decode_cursor(cursor)
+
+
+def test_full_page_returns_a_cursor_to_the_next_one():
+    rows = [summary(3, 0), summary(2, 1), summary(1, 2)]
+    checkout_service = make_checkout_service(rows)
+
+    page = asyncio.run(checkout_service.get_checkout_history(5, limit=2))
+
+    assert page['items'] == rows[:2]
+    assert CheckoutService._decode_cursor(page['next_cursor']) == (rows[1]['created_at'], 2)
+    checkout_service.checkout_repository.get_history.assert_awaited_once_with(5, None, 2, None)
+
+
+def test_last_page_has_no_cursor():
+    rows = [summary(1)]
+    checkout_service = make_checkout_service(rows)
+    cursor = CheckoutService._encode_cursor(summary(2, -1))
+
+    page = asyncio.run(checkout_service.get_checkout_history(5, ["completed"], 2, cursor))
+
+    assert page == {'items': rows, 'next_cursor': None}
+    checkout_service.checkout_repository.get_history.assert_awaited_once_with(5, ["completed"], 2, (NOW + timedelta(minutes=1), 2))
+
+
+def test_page_size_defaults_and_is_bounded():
+    checkout_service = make_checkout_service([])
+
+    asyncio.run(checkout_service.get_checkout_history(5))
+    assert checkout_service.checkout_repository.get_history.await_args.args[2] == service.CHECKOUT_HISTORY_PAGE_SIZE
+
+    with pytest.raises(ValueError, match="limit"):
+        asyncio.run(checkout_service.get_checkout_history(5, limit=service.CHECKOUT_HISTORY_MAX_PAGE_SIZE + 1))
+
+
+def test_history_query_seeks_past_the_cursor_on_the_index_order():
+    session = AsyncMock()
+    session.execute.return_value = MagicMock()
+    session.execute.return_value.all.return_value = []
+
+    asyncio.run(CheckoutRepository(session).get_history(5, ["completed"], 20, (NOW, 42)))
+
+    query = session.execute.await_args.args[0].compile(dialect=postgresql.dialect())
+    sql = str(query)
+    assert "(checkout.created_at, checkout.id) < (" in sql
+    assert "ORDER BY checkout.created_at DESC, checkout.id DESC" in sql
+    # One extra row tells whether another page follows
+    assert 21 in query.params.values()
+
+
+@pytest.fixture
+def client():
+    ecommerce_app.app.dependency_overrides[get_session] = lambda: MagicMock()
+    yield TestClient(ecommerce_app.app)
+    ecommerce_app.app.dependency_overrides.clear()
+
+
+def test_history_endpoint_passes_the_filters_and_cursor(client):
+    with patch.object(ecommerce_app, "CheckoutService") as checkout_service:
+        checkout_service.return_value.get_checkout_history = AsyncMock(return_value={'items': [summary(3)], 'next_cursor': "abc"})
+        response = client.get("/api/v1/checkout/customer/5/history?status=completed&status=pending&limit=1&cursor=xyz")
+
+    assert response.status_code == 200
+    assert response.json()['next_cursor'] == "abc"
+    assert response.json()['items'][0]['id'] == 3
+    checkout_service.return_value.get_checkout_history.assert_awaited_once_with(5, ["completed", "pending"], 1, "xyz")
+
+
+def test_history_endpoint_rejects_a_bad_cursor(client):
+    with patch.object(ecommerce_app, "CheckoutService") as checkout_service:
+        checkout_service.return_value.get_checkout_history = AsyncMock(side_effect=ValueError("Curseur invalide"))
+        response = client.get("/api/v1/checkout/customer/5/history?cursor=xyz")
+
+    assert response.status_code == 400
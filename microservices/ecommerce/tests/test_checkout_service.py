@@ -0,0 +1,177 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+import service
+from service import CheckoutService, WAREHOUSE_URL
+
+
+def response(status_code, body=None):
+    return SimpleNamespace(
+        status_code=status_code, text='', json=lambda: body or {}, raise_for_status=lambda: None
+    )
+
+
+def make_checkout_service():
+    checkout = SimpleNamespace(id=42, cart_id=7, current_status="pending")
+    checkout_service = CheckoutService(MagicMock())
+    checkout_service.checkout_repository = AsyncMock()
+    checkout_service.checkout_repository.get_by_id.return_value = checkout
+    checkout_service.checkout_repository.claim_for_completion.return_value = True
+    checkout_service.checkout_repository.complete_checkout.return_value = checkout
+    checkout_service.cart_service = AsyncMock()
+    checkout_service.cart_service.store = "postgres"
+    return checkout_service
+
+
+def test_complete_checkout_confirms_the_order_reservation():
+    checkout_service = make_checkout_service()
+    warehouse_http = AsyncMock()
+    warehouse_http.post.return_value = response(200, {"confirmed_lines": 2})
+
+    with patch.object(service, "warehouse_http", warehouse_http):
+        asyncio.run(checkout_service.complete_checkout(42))
+
+    # The stock held since OrderInitiated is confirmed, never reduced a second time
+    warehouse_http.post.assert_awaited_once_with(f"{WAREHOUSE_URL}/reservations/order/42/confirm")
+    checkout_service.cart_service.clear_cart.assert_awaited_once_with(7)
+
+
+def test_failed_completion_releases_the_confirmed_reservation():
+    checkout_service = make_checkout_service()
+    checkout_service.checkout_repository.complete_checkout.side_effect = RuntimeError("db down")
+    warehouse_http = AsyncMock()
+    warehouse_http.post.return_value = response(200)
+
+    with patch.object(service, "warehouse_http", warehouse_http):
+        with pytest.raises(ValueError):
+            asyncio.run(checkout_service.complete_checkout(42))
+
+    assert [call.args[0] for call in warehouse_http.post.await_args_list] == [
+        f"{WAREHOUSE_URL}/reservations/order/42/confirm",
+        f"{WAREHOUSE_URL}/reservations/order/42/release"
+    ]
+    checkout_service.checkout_repository.update_checkout_status.assert_awaited_once_with(42, "cancelled")
+
+
+def test_rejected_reservation_cancels_and_releases_the_order():
+    checkout_service = make_checkout_service()
+    warehouse_http = AsyncMock()
+    warehouse_http.post.side_effect = [response(400), response(200)]
+
+    with patch.object(service, "warehouse_http", warehouse_http):
+        with pytest.raises(ValueError):
+            asyncio.run(checkout_service.complete_checkout(42))
+
+    checkout_service.checkout_repository.complete_checkout.assert_not_awaited()
+    # Released anyway, so that nothing the warehouse reserves later for the order holds stock
+    assert warehouse_http.post.await_args_list[1].args[0] == f"{WAREHOUSE_URL}/reservations/order/42/release"
+    checkout_service.checkout_repository.update_checkout_status.assert_awaited_once_with(42, "cancelled")
+
+
+@pytest.fixture
+def no_poll_delay(monkeypatch):
+    monkeypatch.setattr(service, "WAREHOUSE_RESERVATION_POLL_SECONDS", 0)
+
+
+def test_completion_waits_for_a_reservation_not_made_yet(no_poll_delay):
+    checkout_service = make_checkout_service()
+    warehouse_http = AsyncMock()
+    # OrderInitiated has not reached the warehouse yet when completion starts
+    warehouse_http.post.side_effect = [response(404), response(404), response(200, {"confirmed_lines": 2})]
+
+    with patch.object(service, "warehouse_http", warehouse_http):
+        asyncio.run(checkout_service.complete_checkout(42))
+
+    assert warehouse_http.post.await_count == 3
+    checkout_service.checkout_repository.complete_checkout.assert_awaited_once()
+    checkout_service.checkout_repository.update_checkout_status.assert_not_awaited()
+
+
+def test_reservation_still_missing_leaves_the_checkout_pending(no_poll_delay, monkeypatch):
+    monkeypatch.setattr(service, "WAREHOUSE_RESERVATION_WAIT_SECONDS", 0.05)
+    checkout_service = make_checkout_service()
+    warehouse_http = AsyncMock()
+    warehouse_http.post.return_value = response(404)
+
+    with patch.object(service, "warehouse_http", warehouse_http):
+        with pytest.raises(service.ReservationPending):
+            asyncio.run(checkout_service.complete_checkout(42))
+
+    # Never cancelled: a retry can still complete it once the stock is reserved
+    checkout_service.checkout_repository.update_checkout_status.assert_awaited_once_with(42, "pending")
+    assert all(call.args[0].endswith("/confirm") for call in warehouse_http.post.await_args_list)
+
+
+def test_reservation_wait_is_bounded_by_the_caller(no_poll_delay):
+    checkout_service = make_checkout_service()
+    warehouse_http = AsyncMock()
+    warehouse_http.post.return_value = response(404)
+
+    with patch.object(service, "warehouse_http", warehouse_http):
+        with pytest.raises(service.ReservationPending):
+            asyncio.run(checkout_service.complete_checkout(42, reservation_wait=0))
+
+    warehouse_http.post.assert_awaited_once()
+
+
+def test_cancelled_checkout_gives_back_its_stock():
+    checkout_service = make_checkout_service()
+    warehouse_http = AsyncMock()
+    warehouse_http.post.return_value = response(200)
+
+    with patch.object(service, "warehouse_http", warehouse_http):
+        assert asyncio.run(checkout_service.cancel_checkout(42))
+
+    checkout_service.checkout_repository.update_checkout_status.assert_awaited_once_with(42, "cancelled")
+    warehouse_http.post.assert_awaited_once_with(f"{WAREHOUSE_URL}/reservations/order/42/release")
+
+
+def cart_line(product, quantite, prix):
+    return SimpleNamespace(product=product, quantite=quantite, prix=prix)
+
+
+def test_items_are_priced_from_the_catalog_then_the_cart_line():
+    catalog = MagicMock()
+    catalog.get_many = AsyncMock(return_value={10: {'id': 10, 'prix_unitaire': 2.5}})
+    items = [cart_line(10, 3, 6.0), cart_line(11, 2, 9.0)]
+
+    with patch.object(service, "get_product_catalog", return_value=catalog):
+        order_items, total = asyncio.run(CheckoutService(MagicMock())._price_items(items))
+
+    catalog.get_many.assert_awaited_once_with([10, 11])
+    assert order_items == [
+        {"product_id": 10, "quantity": 3, "unit_price": 2.5, "total_price": 7.5},
+        # No catalog price: the unit price stored on the cart line is charged
+        {"product_id": 11, "quantity": 2, "unit_price": 4.5, "total_price": 9.0}
+    ]
+    assert total == 16.5
+
+
+def test_initiate_checkout_stores_the_priced_total_and_customer():
+    checkout_service = make_checkout_service()
+    cart = SimpleNamespace(id=7, user=3)
+    checkout_service.cart_service.store = "postgres"
+    checkout_service.cart_service.get_cart_with_items.return_value = {'cart': cart, 'items': [cart_line(10, 2, 5.0)]}
+    checkout_service._price_items = AsyncMock(return_value=([{"product_id": 10, "quantity": 2}], 5.0))
+    before_commit = MagicMock()
+
+    asyncio.run(checkout_service.initiate_checkout(7, before_commit=before_commit))
+
+    cart_id, customer_id, total = checkout_service.checkout_repository.create_checkout.await_args.args
+    assert (cart_id, customer_id, total) == (7, 3, 5.0)
+    # OrderInitiated gets the priced lines along with the checkout
+    checkout_service.checkout_repository.create_checkout.await_args.kwargs["before_commit"]("checkout")
+    before_commit.assert_called_once_with("checkout", [{"product_id": 10, "quantity": 2}])
+
+
+def test_empty_cart_cannot_be_checked_out():
+    checkout_service = make_checkout_service()
+    checkout_service.cart_service.get_cart_with_items.return_value = {'cart': SimpleNamespace(id=7, user=3), 'items': []}
+
+    with pytest.raises(ValueError):
+        asyncio.run(checkout_service.initiate_checkout(7))
+
+    checkout_service.checkout_repository.create_checkout.assert_not_awaited()
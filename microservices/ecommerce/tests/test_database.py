@@ -0,0 +1,75 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+import app as ecommerce_app
+import database
+from repository import CheckoutRepository
+
+
+@pytest.fixture
+def session():
+    session = AsyncMock()
+    session.__aenter__.return_value = session
+    with patch.object(database, "AsyncSessionLocal", return_value=session):
+        yield session
+
+
+def test_request_session_is_closed_after_the_request(session):
+    async def run():
+        dependency = database.get_session()
+        assert await dependency.__anext__() is session
+        with pytest.raises(StopAsyncIteration):
+            await dependency.__anext__()
+
+    asyncio.run(run())
+    session.__aexit__.assert_awaited_once()
+
+
+def test_request_session_is_closed_when_the_handler_fails(session):
+    async def run():
+        dependency = database.get_session()
+        await dependency.__anext__()
+        with pytest.raises(RuntimeError):
+            await dependency.athrow(RuntimeError("handler failed"))
+
+    asyncio.run(run())
+    session.__aexit__.assert_awaited_once()
+
+
+def test_handlers_run_on_a_bounded_asyncpg_pool():
+    assert database.async_engine.dialect.driver == "asyncpg"
+    assert database.async_engine.pool.size() == 20
+    assert database.async_engine.pool._pre_ping
+    assert database.AsyncSessionLocal.kw["expire_on_commit"] is False
+
+
+def test_checkouts_of_a_user_are_filtered_on_the_customer():
+    session = AsyncMock()
+    session.scalars.return_value = MagicMock()
+    session.scalars.return_value.all.return_value = []
+
+    asyncio.run(CheckoutRepository(session).get_by_user_id(3))
+
+    query = str(session.scalars.await_args.args[0].compile(dialect=postgresql.dialect()))
+    assert "checkout.customer_id = " in query
+
+
+def test_shutdown_closes_the_http_clients_and_the_pool():
+    catalog = MagicMock()
+    catalog.http.aclose = AsyncMock()
+    with patch.object(ecommerce_app, "get_product_catalog", return_value=catalog), \
+            patch.object(ecommerce_app, "warehouse_http") as warehouse_http, \
+            patch.object(ecommerce_app, "services_http") as services_http, \
+            patch.object(ecommerce_app, "async_engine") as async_engine:
+        warehouse_http.aclose = AsyncMock()
+        services_http.aclose = AsyncMock()
+        async_engine.dispose = AsyncMock()
+        asyncio.run(ecommerce_app.shutdown_event())
+
+    catalog.http.aclose.assert_awaited_once()
+    warehouse_http.aclose.assert_awaited_once()
+    services_http.aclose.assert_awaited_once()
+    async_engine.dispose.assert_awaited_once()
@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import json
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app as ecommerce_app
+import service
+from database import get_session
+from service import CheckoutService, IdempotencyService
+
+CHECKOUT = {"id": 42, "cart_id": 7, "customer_id": 3, "total": 9.0, "current_status": "pending"}
+
+
+def request_hash(request):
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def make_idempotency_service(claimed, record=None):
+    idempotency_service = IdempotencyService(MagicMock())
+    idempotency_service.repository = AsyncMock()
+    idempotency_service.repository.claim.return_value = (claimed, record)
+    return idempotency_service
+
+
+def test_first_use_of_a_key_runs_the_request():
+    idempotency_service = make_idempotency_service(True)
+
+    assert asyncio.run(idempotency_service.claim("k1", "checkout_initiate", {"cart_id": 7})) is None
+
+    key, operation, claimed_hash, stale_after = idempotency_service.repository.claim.await_args.args
+    assert (key, operation, claimed_hash) == ("k1", "checkout_initiate", request_hash({"cart_id": 7}))
+    assert stale_after == service.IDEMPOTENCY_STALE_AFTER_SECONDS
+
+
+def test_reused_key_returns_the_original_request():
+    record = SimpleNamespace(request_hash=request_hash({"cart_id": 7}), response_code=200, response_body=CHECKOUT)
+    idempotency_service = make_idempotency_service(False, record)
+
+    assert asyncio.run(idempotency_service.claim("k1", "checkout_initiate", {"cart_id": 7})) is record
+
+
+def test_key_reused_for_another_request_is_rejected():
+    record = SimpleNamespace(request_hash=request_hash({"cart_id": 8}), response_code=200, response_body=CHECKOUT)
+    idempotency_service = make_idempotency_service(False, record)
+
+    with pytest.raises(ValueError, match="Idempotency-Key"):
+        asyncio.run(idempotency_service.claim("k1", "checkout_initiate", {"cart_id": 7}))
+
+
+@pytest.fixture
+def client():
+    ecommerce_app.app.dependency_overrides[get_session] = lambda: MagicMock()
+    yield TestClient(ecommerce_app.app)
+    ecommerce_app.app.dependency_overrides.clear()
+
+
+def initiate(client, key="k1"):
+    return client.post("/api/v1/checkout/initiate", json={"cart_id": 7}, headers={"Idempotency-Key": key})
+
+
+def test_retried_initiation_replays_the_saved_response(client):
+    record = SimpleNamespace(response_code=200, response_body=CHECKOUT)
+    with patch.object(ecommerce_app, "IdempotencyService") as idempotency_service, \
+            patch.object(ecommerce_app, "CheckoutService") as checkout_service:
+        idempotency_service.return_value.claim = AsyncMock(return_value=record)
+        response = initiate(client)
+
+    assert response.status_code == 200
+    assert response.json() == CHECKOUT
+    assert response.headers["Idempotent-Replayed"] == "true"
+    checkout_service.assert_not_called()
+
+
+def test_initiation_still_running_is_a_conflict(client):
+    record = SimpleNamespace(response_code=None, response_body=None)
+    with patch.object(ecommerce_app, "IdempotencyService") as idempotency_service:
+        idempotency_service.return_value.claim = AsyncMock(return_value=record)
+        response = initiate(client)
+
+    assert response.status_code == 409
+
+
+def test_key_reused_for_another_cart_is_unprocessable(client):
+    with patch.object(ecommerce_app, "IdempotencyService") as idempotency_service:
+        idempotency_service.return_value.claim = AsyncMock(side_effect=ValueError("Idempotency-Key déjà utilisée pour une autre requête"))
+        response = initiate(client)
+
+    assert response.status_code == 422
+
+
+def test_first_initiation_saves_its_response_with_the_checkout(client):
+    checkout = SimpleNamespace(**CHECKOUT)
+
+    async def initiate_checkout(cart_id, before_commit):
+        await before_commit(checkout, [])
+        return checkout
+
+    with patch.object(ecommerce_app, "IdempotencyService") as idempotency_service, \
+            patch.object(ecommerce_app, "CheckoutService") as checkout_service, \
+            patch.object(ecommerce_app, "enqueue") as enqueue:
+        idempotency_service.return_value.claim = AsyncMock(return_value=None)
+        idempotency_service.return_value.stage_response = AsyncMock()
+        checkout_service.return_value.initiate_checkout = initiate_checkout
+        response = initiate(client)
+
+    assert response.status_code == 200
+    enqueue.assert_called_once()
+    idempotency_service.return_value.stage_response.assert_awaited_once_with("k1", "checkout_initiate", 200, CHECKOUT)
+
+
+def test_failed_initiation_releases_the_key(client):
+    with patch.object(ecommerce_app, "IdempotencyService") as idempotency_service, \
+            patch.object(ecommerce_app, "CheckoutService") as checkout_service:
+        idempotency_service.return_value.claim = AsyncMock(return_value=None)
+        idempotency_service.return_value.release = AsyncMock()
+        checkout_service.return_value.initiate_checkout = AsyncMock(side_effect=ValueError("Le panier est vide ou n'existe pas"))
+        response = initiate(client)
+
+    assert response.status_code == 400
+    idempotency_service.return_value.release.assert_awaited_once_with("k1", "checkout_initiate")
+
+
+def test_completing_an_already_completed_checkout_does_nothing_again():
+    checkout = SimpleNamespace(id=42, cart_id=7, current_status="completed")
+    checkout_service = CheckoutService(AsyncMock())
+    checkout_service.checkout_repository = AsyncMock()
+    checkout_service.checkout_repository.get_by_id.return_value = checkout
+    checkout_service.checkout_repository.claim_for_completion.return_value = False
+    checkout_service._confirm_warehouse_reservation = AsyncMock()
+
+    assert asyncio.run(checkout_service.complete_checkout(42)) is checkout
+
+    checkout_service._confirm_warehouse_reservation.assert_not_awaited()
+    checkout_service.checkout_repository.complete_checkout.assert_not_awaited()
+
+
+def test_checkout_claimed_by_another_request_cannot_be_completed():
+    checkout = SimpleNamespace(id=42, cart_id=7, current_status="completing")
+    checkout_service = CheckoutService(AsyncMock())
+    checkout_service.checkout_repository = AsyncMock()
+    checkout_service.checkout_repository.get_by_id.return_value = checkout
+    checkout_service.checkout_repository.claim_for_completion.return_value = False
+
+    with pytest.raises(ValueError, match="completing"):
+        asyncio.run(checkout_service.complete_checkout(42))
@@ -0,0 +1,109 @@
+import asyncio
+from unittest.mock import MagicMock, patch
+
+import httpx
+
+import app as ecommerce_app
+from product_catalog import PRODUCTS_URL, ProductCatalog
+
+
+def make_catalog(handler):
+    """Catalog whose product service is served by handler, returns the catalog and the requests it made"""
+    requests = []
+
+    async def record(request):
+        requests.append(request)
+        return await handler(request)
+
+    catalog = ProductCatalog()
+    catalog.http = httpx.AsyncClient(transport=httpx.MockTransport(record))
+    return catalog, requests
+
+
+async def product_10(request):
+    return httpx.Response(200, json={"id": 10, "prix_unitaire": 2.5})
+
+
+def test_found_product_is_served_from_the_cache():
+    catalog, requests = make_catalog(product_10)
+
+    async def run():
+        return await catalog.get(10), await catalog.get_price(10)
+
+    assert asyncio.run(run()) == ({"id": 10, "prix_unitaire": 2.5}, 2.5)
+    assert len(requests) == 1
+
+
+def test_concurrent_misses_share_one_request():
+    async def slow_product(request):
+        await asyncio.sleep(0.05)
+        return await product_10(request)
+
+    catalog, requests = make_catalog(slow_product)
+
+    async def run():
+        return await asyncio.gather(*(catalog.get(10) for _ in range(5)))
+
+    assert asyncio.run(run()) == [{"id": 10, "prix_unitaire": 2.5}] * 5
+    assert [str(request.url) for request in requests] == [f"{PRODUCTS_URL}/10"]
+
+
+def test_unknown_product_is_cached_but_a_failure_is_not():
+    async def not_found(request):
+        return httpx.Response(404)
+
+    catalog, requests = make_catalog(not_found)
+
+    async def run():
+        return await catalog.get(10), await catalog.get(10)
+
+    assert asyncio.run(run()) == (None, None)
+    assert len(requests) == 1
+
+    async def unavailable(request):
+        return httpx.Response(503)
+
+    catalog, requests = make_catalog(unavailable)
+    asyncio.run(run())
+    assert len(requests) == 2
+
+
+def test_get_many_fetches_only_the_missing_products_in_one_request():
+    async def products(request):
+        assert request.url.params.get_list("ids") == ["11", "12"]
+        return httpx.Response(200, json=[{"id": 11, "prix_unitaire": 4.0}])
+
+    catalog, requests = make_catalog(products)
+    catalog.put({"id": 10, "prix_unitaire": 2.5})
+
+    async def run():
+        return await catalog.get_many([10, 11, 12])
+
+    assert asyncio.run(run()) == {10: {"id": 10, "prix_unitaire": 2.5}, 11: {"id": 11, "prix_unitaire": 4.0}}
+    # Product 12 does not exist and is now cached as such
+    assert asyncio.run(run()) == {10: {"id": 10, "prix_unitaire": 2.5}, 11: {"id": 11, "prix_unitaire": 4.0}}
+    assert len(requests) == 1
+
+
+def test_invalidated_product_is_fetched_again():
+    catalog, requests = make_catalog(product_10)
+    catalog.put({"id": 10, "prix_unitaire": 1.0})
+
+    catalog.invalidate(10)
+
+    assert asyncio.run(catalog.get_price(10)) == 2.5
+    assert len(requests) == 1
+
+
+def test_product_events_update_the_cache():
+    catalog = MagicMock()
+    with patch.object(ecommerce_app, "get_product_catalog", return_value=catalog):
+        ecommerce_app.handle_product_changed({
+            "event_type": "ProductUpdated", "data": {"product_id": 10, "name": "Pomme", "prix_unitaire": 3.0}
+        })
+        ecommerce_app.handle_product_changed({"event_type": "ProductDeleted", "data": {"product_id": 11}})
+
+    catalog.put.assert_called_once_with({
+        "id": 10, "name": "Pomme", "category": None, "description": None, "prix_unitaire": 3.0
+    })
+    catalog.invalidate.assert_called_once_with(11)
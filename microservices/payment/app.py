@@ -7,7 +7,12 @@ import time
 import uuid
 import random
 import logging
-from typing import Dict, Any
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
 
 # Add shared directory to path
 sys.path.append('/app/../shared')
@@ -20,6 +25,8 @@ from events import (
     RoutingKeys,
     create_payment_processed_data
 )
+from database import SessionLocal
+from models import ChargeStatus, PaymentCharge
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -81,6 +88,66 @@ def process_payment(order_id: int, amount: float, payment_method: str = "credit_
             "status": "FAILED"
         }
 
+# StockReserved is delivered at least once, possibly to another replica or after a restart: each order's
+# charge is claimed in payment_charges before charging and its outcome kept there, so that a redelivered
+# event publishes the same outcome again instead of charging the customer twice
+# A claim still pending after this long is taken over: its consumer died mid-charge
+PAYMENT_CLAIM_STALE_SECONDS = float(os.getenv("PAYMENT_CLAIM_STALE_SECONDS", "60"))
+# Delay before requeueing a delivery of an order another consumer is charging
+PAYMENT_IN_PROGRESS_RETRY_DELAY = float(os.getenv("PAYMENT_IN_PROGRESS_RETRY_DELAY", "1"))
+
+class ChargeInProgress(Exception):
+    """Raised when another consumer holds the claim on an order's charge, so that the event is requeued"""
+
+def _claim_charge(session, order_id: int) -> Optional[PaymentCharge]:
+    """Claim the charge of an order. Returns None once claimed, else the charge someone else claimed"""
+    session.add(PaymentCharge(order_id=order_id, status=ChargeStatus.PENDING))
+    try:
+        session.commit()
+        return None
+    except IntegrityError:
+        session.rollback()
+    
+    stale_before = datetime.utcnow() - timedelta(seconds=PAYMENT_CLAIM_STALE_SECONDS)
+    taken_over = session.execute(
+        update(PaymentCharge)
+        .where(PaymentCharge.order_id == order_id, PaymentCharge.status == ChargeStatus.PENDING,
+               PaymentCharge.claimed_at < stale_before)
+        .values(claimed_at=datetime.utcnow())
+    ).rowcount
+    session.commit()
+    if taken_over:
+        logger.warning(f"Taking over the stale charge claim of order {order_id}")
+        return None
+    return session.query(PaymentCharge).filter_by(order_id=order_id).one()
+
+def charge_order_once(order_id: int, amount: float) -> Dict[str, Any]:
+    """Process the payment of an order, or return the result of the charge already made for it"""
+    with SessionLocal() as session:
+        charge = _claim_charge(session, order_id)
+        if charge is not None:
+            if charge.status == ChargeStatus.DONE:
+                logger.info(f"Order {order_id} already charged, replaying payment result")
+                return charge.result
+            raise ChargeInProgress(f"Order {order_id} is being charged by another consumer")
+        
+        # Only this order's claim is held while charging, other orders are charged concurrently
+        try:
+            payment_result = process_payment(order_id, amount)
+        except Exception:
+            # Nothing was charged: drop the claim so that a redelivery can try again right away
+            session.query(PaymentCharge).filter_by(order_id=order_id, status=ChargeStatus.PENDING).delete()
+            session.commit()
+            raise
+        
+        session.execute(
+            update(PaymentCharge)
+            .where(PaymentCharge.order_id == order_id)
+            .values(status=ChargeStatus.DONE, result=payment_result, updated_at=datetime.utcnow())
+        )
+        session.commit()
+        return payment_result
+
 # Event Handlers
 def handle_stock_reserved(event_data: dict):
     """Handle StockReserved event - process payment"""
@@ -89,8 +156,8 @@ def handle_stock_reserved(event_data: dict):
         order_id = stock_data["order_id"]
         correlation_id = event_data["metadata"]["correlation_id"]
         
-        # For demo purposes, use a fixed amount or extract from order data
-        amount = 99.99  # In real scenario, you'd get this from the order
+        # Order total priced by ecommerce, carried over from OrderInitiated by the warehouse
+        amount = stock_data.get("total_amount")
         
         logger.info(f"Received StockReserved for order {order_id}, processing payment")
         
@@ -100,7 +167,18 @@ def handle_stock_reserved(event_data: dict):
             return
         
         # Process payment
-        payment_result = process_payment(order_id, amount)
+        if amount is None:
+            logger.error(f"No total amount in StockReserved for order {order_id}, refusing to charge")
+            payment_result = {
+                "success": False,
+                "payment_id": f"pay_{uuid.uuid4().hex[:8]}",
+                "error_code": "MISSING_AMOUNT",
+                "failure_reason": "missing_amount",
+                "amount": None,
+                "status": "FAILED"
+            }
+        else:
+            payment_result = charge_order_once(order_id, float(amount))
         
         if payment_result["success"]:
             # Publish PaymentProcessed event
@@ -142,6 +220,10 @@ def handle_stock_reserved(event_data: dict):
             
             logger.info(f"Payment failed for order {order_id}: {payment_result['failure_reason']}")
             
+    except ChargeInProgress as e:
+        logger.info(f"{e}, requeuing StockReserved")
+        time.sleep(PAYMENT_IN_PROGRESS_RETRY_DELAY)
+        raise
     except Exception as e:
         logger.error(f"Error handling StockReserved event: {e}")
 
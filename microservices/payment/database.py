@@ -0,0 +1,14 @@
+import os
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+DATABASE_URL = os.getenv("DATABASE_URL_PAYMENT", "postgresql+psycopg2://admin:admin@db_payment:5432/postgres")
+
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "5")),
+    pool_pre_ping=True
+)
+SessionLocal = sessionmaker(bind=engine)
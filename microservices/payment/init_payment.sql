@@ -0,0 +1,9 @@
+-- One row per charged order: the unique order_id is what makes a redelivered StockReserved charge once
+CREATE TABLE IF NOT EXISTS payment_charges (
+    id SERIAL PRIMARY KEY,
+    order_id BIGINT UNIQUE NOT NULL,     -- 64-bit snowflake IDs (see shared/ids)
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    result JSONB,
+    claimed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
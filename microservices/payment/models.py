@@ -0,0 +1,26 @@
+from datetime import datetime
+
+from sqlalchemy import BigInteger, Column, DateTime, Integer, String
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import declarative_base
+
+Base = declarative_base()
+
+class ChargeStatus:
+    PENDING = "pending"
+    DONE = "done"
+
+class PaymentCharge(Base):
+    """
+    Outcome of the charge of an order. The row is inserted (status pending) before charging:
+    it is the claim that keeps every other delivery of the order from charging it again
+    """
+    __tablename__ = "payment_charges"
+
+    id = Column(Integer, primary_key=True)
+    order_id = Column(BigInteger, nullable=False, unique=True)
+    status = Column(String(20), nullable=False, default=ChargeStatus.PENDING)
+    # process_payment() result, replayed to redeliveries once status is done
+    result = Column(JSONB, nullable=True)
+    claimed_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import app
+from models import ChargeStatus, PaymentCharge
+
+
+@pytest.fixture(autouse=True)
+def charges(charge_db, monkeypatch):
+    monkeypatch.setattr(app, "SessionLocal", charge_db)
+    monkeypatch.setattr(app, "PAYMENT_IN_PROGRESS_RETRY_DELAY", 0)
+    return charge_db
+
+
+def stock_reserved(order_id, amount=25.0):
+    return {
+        "data": {"order_id": order_id, "total_amount": amount},
+        "metadata": {"correlation_id": f"corr_{order_id}"}
+    }
+
+
+def test_redelivered_stock_reserved_charges_the_order_once():
+    publisher = MagicMock()
+    result = {"success": True, "payment_id": "pay_1", "status": "PROCESSED"}
+
+    with patch.object(app, "get_event_publisher", return_value=publisher), \
+            patch.object(app, "process_payment", return_value=result) as process_payment:
+        app.handle_stock_reserved(stock_reserved(1))
+        app.handle_stock_reserved(stock_reserved(1))
+
+    process_payment.assert_called_once_with(1, 25.0)
+    # The same outcome is published again, downstream handlers ignore the duplicate
+    payment_ids = [call.kwargs["aggregate_id"] for call in publisher.publish_event.call_args_list]
+    assert payment_ids == ["pay_1", "pay_1"]
+
+
+def test_charge_outcome_outlives_the_process(charges):
+    result = {"success": False, "payment_id": "pay_1", "status": "FAILED"}
+    with patch.object(app, "process_payment", return_value=result):
+        app.charge_order_once(1, 10.0)
+
+    # A redelivery after a restart, or to another replica, reads the outcome back from the table
+    with patch.object(app, "process_payment") as process_payment:
+        assert app.charge_order_once(1, 10.0) == result
+
+    process_payment.assert_not_called()
+    with charges() as session:
+        charge = session.query(PaymentCharge).filter_by(order_id=1).one()
+    assert (charge.status, charge.result) == (ChargeStatus.DONE, result)
+
+
+def claim(charges, order_id, claimed_at):
+    with charges() as session:
+        session.add(PaymentCharge(order_id=order_id, status=ChargeStatus.PENDING, claimed_at=claimed_at))
+        session.commit()
+
+
+def test_order_being_charged_elsewhere_is_requeued(charges):
+    claim(charges, 1, datetime.utcnow())
+
+    with patch.object(app, "get_event_publisher", return_value=MagicMock()), \
+            patch.object(app, "process_payment") as process_payment:
+        # The subscriber requeues the event when the handler raises
+        with pytest.raises(app.ChargeInProgress):
+            app.handle_stock_reserved(stock_reserved(1))
+
+    process_payment.assert_not_called()
+
+
+def test_stale_claim_is_taken_over(charges):
+    claim(charges, 1, datetime.utcnow() - timedelta(seconds=app.PAYMENT_CLAIM_STALE_SECONDS + 1))
+    result = {"success": True, "payment_id": "pay_1", "status": "PROCESSED"}
+
+    with patch.object(app, "process_payment", return_value=result) as process_payment:
+        assert app.charge_order_once(1, 10.0) == result
+
+    process_payment.assert_called_once_with(1, 10.0)
+
+
+def test_failed_charge_attempt_drops_its_claim(charges):
+    with patch.object(app, "process_payment", side_effect=RuntimeError("gateway unreachable")):
+        with pytest.raises(RuntimeError):
+            app.charge_order_once(1, 10.0)
+
+    with charges() as session:
+        assert session.query(PaymentCharge).count() == 0
+
+
+def test_stock_reserved_without_a_total_is_never_charged():
+    publisher = MagicMock()
+
+    with patch.object(app, "get_event_publisher", return_value=publisher), \
+            patch.object(app, "process_payment") as process_payment:
+        app.handle_stock_reserved(stock_reserved(1, amount=None))
+
+    process_payment.assert_not_called()
+    assert publisher.publish_event.call_args.kwargs["event_type"] == app.PaymentEvents.PAYMENT_FAILED
@@ -1,17 +1,67 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Query
 from service import ProductService
 from models.product_model import Product 
 from pydantic import BaseModel
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from typing import List
+from typing import List, Optional
+import logging
+import sys
 
+# Add shared directory to path
+sys.path.append('/app/../shared')
+from events import EventPublisher, ProductEvents, AggregateTypes
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 engine = create_engine("postgresql+psycopg2://admin:admin@db_products:5432/postgres")
 Session = sessionmaker(bind=engine)
 session = Session()
 
+# Event infrastructure
+event_publisher = None
+
+def get_event_publisher():
+    """Get or create event publisher instance"""
+    global event_publisher
+    if event_publisher is None:
+        try:
+            event_publisher = EventPublisher()
+            logger.info("Products event publisher initialized")
+        except Exception as e:
+            logger.error(f"Failed to initialize event publisher: {e}")
+            event_publisher = None
+    return event_publisher
+
+def publish_product_event(event_type: str, product_id: int, product: Product = None):
+    """Let other services (e.g. the warehouse product cache) know the catalog changed"""
+    publisher = get_event_publisher()
+    if not publisher:
+        return
+    
+    data = {"product_id": product_id}
+    if product:
+        data.update({
+            "name": product.name,
+            "category": product.category,
+            "description": product.description,
+            "prix_unitaire": product.prix_unitaire
+        })
+    
+    try:
+        publisher.publish_event(
+            event_type=event_type,
+            aggregate_type=AggregateTypes.PRODUCT,
+            aggregate_id=str(product_id),
+            data=data,
+            service_name="products"
+        )
+    except Exception as e:
+        # The catalog change is committed, consumers fall back on their cache TTL
+        logger.error(f"Failed to publish {event_type} for product {product_id}: {e}")
+
 class ProductSerializer(BaseModel):
     id: int
     name: str
@@ -31,8 +81,11 @@ def read_root():
     return {"message": "Welcome to the Products API"}
 
 @app.get("/api/v1/products", response_model=List[ProductSerializer])
-def get_all_products():
+def get_all_products(ids: Optional[List[int]] = Query(None)):
     service = ProductService(session)
+    if ids:
+        # Bulk lookup, e.g. ?ids=1&ids=2
+        return service.get_products_by_ids(ids) or []
     products = service.get_all_products() or []
     return products
 
@@ -56,6 +109,7 @@ def add_product(product_data: ProductCreateSerializer):
     # Convert Pydantic model to dict, then to SQLAlchemy model
     product_dict = product_data.dict()
     product = service.add_product(Product(**product_dict))
+    publish_product_event(ProductEvents.PRODUCT_CREATED, product.id, product)
     return product
 
 @app.put("/api/v1/products/{product_id}", response_model=ProductSerializer)
@@ -70,7 +124,8 @@ def update_product(
     
     # Update product with new data
     product_dict = product_data.dict()
-    updated_product = service.update_product(Product(**product_dict))
+    updated_product = service.update_product(Product(id=product_id, **product_dict))
+    publish_product_event(ProductEvents.PRODUCT_UPDATED, product_id, updated_product)
     return updated_product
 
 @app.delete("/api/v1/products/{product_id}")
@@ -79,4 +134,5 @@ def delete_product(product_id: int):
     deleted_product = service.delete_product(product_id)
     if not deleted_product:
         raise HTTPException(status_code=404, detail="Not found")
+    publish_product_event(ProductEvents.PRODUCT_DELETED, product_id)
     return {"detail": "Deleted successfully"}
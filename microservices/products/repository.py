@@ -17,6 +17,15 @@ class ProductRepository:
         logging.debug(f"Fetched successfully product with id {id}")
         return product
     
+    def get_by_ids(self, ids):
+        logging.debug(f"Fetching {len(ids)} products by id")
+        products = self.session.query(Product).filter(Product.id.in_(ids)).all()
+        if not products:
+            logging.warning(f"No products found with ids {ids}")
+            return None
+        logging.debug(f"Fetched successfully {len(products)} products")
+        return products
+    
     def get_all_products(self):
         logging.debug("Fetching all products")
         products = self.session.query(Product).all()
@@ -44,15 +53,17 @@ class ProductRepository:
         
     def update_product(self, product):
         logging.debug(f"Updating product {product.id}")
-        existing_product = self.get_by_id(self.session, product.id)
+        existing_product = self.get_by_id(product.id)
         if not existing_product:
             logging.error(f"Product with id {product.id} does not exist")
             return None
         existing_product.name = product.name
-        existing_product.price = product.price
         existing_product.category = product.category
+        existing_product.description = product.description
+        existing_product.prix_unitaire = product.prix_unitaire
         self.session.commit()
         logging.debug(f"Product {product.id} updated successfully")
+        return existing_product
         
     def delete_product(self, product_id):
         logging.debug(f"Deleting product with id {product_id}")
@@ -62,4 +73,5 @@ class ProductRepository:
             return None
         self.session.delete(product)
         self.session.commit()
-        logging.debug(f"Product with id {product_id} deleted successfully")
\ No newline at end of file
+        logging.debug(f"Product with id {product_id} deleted successfully")
+        return product
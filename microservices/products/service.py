@@ -13,6 +13,10 @@ class ProductService:
         products = self.product_repository.get_all_products()
         return products
 
+    def get_products_by_ids(self, ids):
+        products = self.product_repository.get_by_ids(ids)
+        return products
+
     def get_product_by_category(self, category):
         products = self.product_repository.get_product_by_category(category)
         return products
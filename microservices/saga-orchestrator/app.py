@@ -5,12 +5,17 @@ from sqlalchemy.orm import sessionmaker, Session
 from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 import logging
 import os
+import sys
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
 
+# Add shared directory to path
+sys.path.append('/app/../shared')
+
 from models import Base
 from saga_service import SagaService
-from state_machine import OrderStateMachine
+from state_machine import OrderStateMachine, OrderState
+from deadline_scheduler import init_deadline_scheduler
 from typing import Optional
 from datetime import datetime
 
@@ -41,12 +46,38 @@ logger = logging.getLogger(__name__)
 engine = create_engine("postgresql+psycopg2://admin:admin@db_saga:5432/postgres")
 session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# "orchestration" drives sagas over HTTP, "choreography" drives them from RabbitMQ events
+SAGA_MODE = os.getenv("SAGA_MODE", "orchestration")
+
+# Event publisher (initialized once, choreography mode only)
+event_publisher = None
+
+def get_event_publisher():
+    """Get or create event publisher instance"""
+    global event_publisher
+    if event_publisher is None:
+        try:
+            from events import EventPublisher
+            event_publisher = EventPublisher()
+            logger.info("Saga event publisher initialized")
+        except Exception as e:
+            logger.error(f"Failed to initialize event publisher: {e}")
+            event_publisher = None
+    return event_publisher
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     logger.info("Creating database tables...")
     Base.metadata.create_all(bind=engine)
-    logger.info("Saga orchestrator started")
+    if SAGA_MODE == "choreography":
+        from choreography import ChoreographySagaHandler
+        handler = ChoreographySagaHandler(session, get_event_publisher)
+        init_deadline_scheduler(session, handler.handle_deadline)
+        handler.start()
+    else:
+        init_deadline_scheduler(session, lambda db, deadline: SagaService(db).handle_step_timeout(deadline))
+    logger.info(f"Saga orchestrator started in {SAGA_MODE} mode")
     yield
     # Shutdown
     logger.info("Saga orchestrator shutting down")
@@ -187,9 +218,22 @@ def list_sagas(db: Session = Depends(get_db)):
         logger.error(f"Error listing sagas: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/sagas/compensate")
+def compensate_failed_sagas(limit: int = 100, db: Session = Depends(get_db)):
+    """
+    Run outstanding compensation actions for failed sagas in one batch
+    """
+    try:
+        saga_service = SagaService(db)
+        return saga_service.compensate_failed_sagas(limit)
+
+    except Exception as e:
+        logger.error(f"Error running batch compensation: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/api/v1/saga/events")
-def handle_microservice_event(event: dict):
-    """Handle events from microservices"""
+def handle_microservice_event(event: dict, db: Session = Depends(get_db)):
+    """Handle events from microservices posted over HTTP (see SAGA_MODE=choreography for RabbitMQ)"""
     try:
         saga_id = event.get("saga_id")
         event_type = event.get("event_type")
@@ -197,8 +241,7 @@ def handle_microservice_event(event: dict):
         data = event.get("data", {})
         service = event.get("service")
         
-        session = Session()
-        state_machine = OrderStateMachine(session)
+        state_machine = OrderStateMachine(db)
         
         # Process event based on type and success
         if event_type == "stock_verified" and success:
@@ -215,13 +258,11 @@ def handle_microservice_event(event: dict):
             
         elif not success:
             # Handle failure events
-            state_machine.transition_to(saga_id, OrderState.COMPENSATION_STARTED)
-            state_machine.log_step_failed(saga_id, f"{service}_{event_type}", data.get("error", "Unknown error"))
+            error_message = data.get("error", "Unknown error")
+            state_machine.log_step_failed(saga_id, f"{service}_{event_type}", error_message)
             
             # Trigger compensation
-            trigger_compensation(saga_id, state_machine)
-        
-        session.close()
+            SagaService(db)._start_compensation(saga_id, error_message)
         
         return {"status": "event_processed", "saga_id": saga_id}
         
@@ -0,0 +1,349 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Any, Callable, Optional
+
+from sqlalchemy.orm import Session
+from state_machine import OrderStateMachine, OrderState
+from models import SagaInstance, SagaDeadline, CompensationActionType
+from deadline_scheduler import get_deadline_scheduler
+from events import (
+    EventPublisher,
+    EventSubscriber,
+    OrderEvents,
+    AggregateTypes,
+    Exchanges,
+    RoutingKeys
+)
+
+logger = logging.getLogger(__name__)
+
+# The warehouse reserves OrderInitiated items in store 1
+DEFAULT_STORE_ID = 1
+
+# OrderInitiated, StockReserved and the payment results come from different queues. An event seen
+# before the one its saga step depends on is requeued, for at most this long after it was published
+OUT_OF_ORDER_GRACE_SECONDS = float(os.getenv("SAGA_OUT_OF_ORDER_GRACE_SECONDS", "60"))
+# Pause before requeuing, so that the event does not spin on the broker while it waits
+OUT_OF_ORDER_RETRY_DELAY = float(os.getenv("SAGA_OUT_OF_ORDER_RETRY_DELAY", "0.5"))
+
+# Compensations of steps owned by ecommerce, issued as commands it consumes
+COMPENSATION_EVENTS = {
+    CompensationActionType.CANCEL_CHECKOUT.value: OrderEvents.CHECKOUT_CANCELLED,
+    CompensationActionType.REMOVE_ITEM_FROM_CART.value: OrderEvents.CART_CLEARED
+}
+
+
+class EventOutOfOrder(Exception):
+    """Raised from a handler so that the subscriber requeues an event that arrived too early"""
+
+
+class ChoreographySagaHandler:
+    """
+    Drives order sagas from RabbitMQ events instead of synchronous HTTP calls
+
+    OrderInitiated (ecommerce) -> StockReserved / StockUnavailable (warehouse)
+    -> PaymentProcessed / PaymentFailed (payment) -> OrderConfirmed / OrderCancelled
+
+    A cancelled saga is compensated with commands: OrderCancelled releases the stock,
+    CheckoutCancelled (and CartCleared) undo the checkout in ecommerce.
+    """
+
+    def __init__(self, session_factory: Callable[[], Session],
+                 publisher_factory: Callable[[], Optional[EventPublisher]]):
+        self.session_factory = session_factory
+        self.publisher_factory = publisher_factory
+
+    @property
+    def scheduler(self):
+        return get_deadline_scheduler()
+
+    # Event handlers
+
+    def handle_order_initiated(self, event: Dict[str, Any]):
+        """Create the saga and wait for the warehouse to reserve stock"""
+        data = event["data"]
+        order_id = data["order_id"]
+        items = data.get("items", [])
+
+        db = self.session_factory()
+        try:
+            state_machine = OrderStateMachine(db)
+            if state_machine.get_saga_by_order_id(order_id):
+                logger.info(f"Saga already exists for order {order_id}, ignoring duplicate event")
+                return
+
+            saga = state_machine.create_saga(
+                order_id=order_id,
+                customer_id=data.get("customer_id") or 0,
+                product_id=items[0].get("product_id", 0) if items else 0,
+                store_id=DEFAULT_STORE_ID,
+                cart_id=data.get("cart_id") or 0,
+                quantity=sum(item.get("quantity", 0) for item in items),
+                amount=data.get("total_amount")
+            )
+            # The order is the checkout ecommerce initiated (order_id = checkout id)
+            state_machine.add_compensation_action(
+                saga.id,
+                CompensationActionType.CANCEL_CHECKOUT,
+                {'checkout_id': order_id, 'cart_id': data.get("cart_id")}
+            )
+            state_machine.log_step_started(saga.id, "reserve_stock", data)
+            self.scheduler.schedule(db, saga.id, "reserve_stock")
+        finally:
+            db.close()
+
+    def handle_stock_reserved(self, event: Dict[str, Any]):
+        """Record the reservation and wait for the payment result"""
+        data = event["data"]
+        order_id = data["order_id"]
+        store_id = data.get("store_id", DEFAULT_STORE_ID)
+        items = [
+            {'product_id': item["product_id"], 'quantity': item.get("requested_quantity", item.get("quantity"))}
+            for item in data.get("items", [])
+        ]
+
+        db = self.session_factory()
+        try:
+            state_machine = OrderStateMachine(db)
+            saga = state_machine.get_saga_by_order_id(order_id)
+            if not saga:
+                # Dropping the reservation would leave the stock held with no RELEASE_STOCK to undo it
+                self._defer_until_saga_exists(event, order_id)
+                logger.warning(f"No OrderInitiated for order {order_id} after {OUT_OF_ORDER_GRACE_SECONDS}s, releasing its stock")
+                self._publish_order_cancelled(order_id, store_id, items, "order_never_initiated",
+                                              event["metadata"].get("correlation_id"))
+                return
+
+            if state_machine.is_saga_complete(saga.id):
+                # The saga timed out before the warehouse answered: give the stock back
+                logger.warning(f"Stock reserved for finished saga {saga.id}, releasing it")
+                self._publish_order_cancelled(order_id, store_id, items, "saga_already_finished",
+                                              event["metadata"].get("correlation_id"))
+                return
+
+            if saga.current_state != OrderState.CREATED.value:
+                logger.info(f"Saga {saga.id} already past stock reservation, ignoring duplicate event")
+                return
+
+            self.scheduler.cancel(db, saga.id, "reserve_stock")
+            state_machine.transition_to(saga.id, OrderState.STOCK_VERIFIED)
+            state_machine.transition_to(saga.id, OrderState.STOCK_RESERVED)
+            state_machine.log_step_completed(saga.id, "reserve_stock", data)
+            state_machine.add_compensation_action(
+                saga.id,
+                CompensationActionType.RELEASE_STOCK,
+                {'order_id': order_id, 'store_id': store_id, 'items': items}
+            )
+
+            state_machine.log_step_started(saga.id, "process_payment", {'order_id': order_id})
+            self.scheduler.schedule(db, saga.id, "process_payment")
+        finally:
+            db.close()
+
+    def _defer_until_saga_exists(self, event: Dict[str, Any], order_id: int):
+        """
+        Requeue an event whose saga step has not been reached yet, by raising EventOutOfOrder.
+        Returns once the event is older than OUT_OF_ORDER_GRACE_SECONDS: what it waited for never came
+        """
+        published_at = event.get("metadata", {}).get("published_at")
+        if published_at:
+            age = (datetime.utcnow() - datetime.fromisoformat(published_at.rstrip("Z"))).total_seconds()
+            if age > OUT_OF_ORDER_GRACE_SECONDS:
+                return
+        logger.info(f"{event.get('event_type')} for order {order_id} arrived ahead of its saga step, requeuing it")
+        time.sleep(OUT_OF_ORDER_RETRY_DELAY)
+        raise EventOutOfOrder(f"{event.get('event_type')} for order {order_id} arrived out of order")
+
+    def handle_stock_unavailable(self, event: Dict[str, Any]):
+        """Nothing was reserved, the saga is simply cancelled"""
+        data = event["data"]
+        self._fail_saga_for_order(data["order_id"], "reserve_stock",
+                                  f"Stock unavailable: {data.get('reason', 'unknown')}", data)
+
+    def handle_payment_processed(self, event: Dict[str, Any]):
+        """Payment succeeded: confirm the order"""
+        data = event["data"]
+        order_id = data["order_id"]
+
+        db = self.session_factory()
+        try:
+            state_machine = OrderStateMachine(db)
+            saga = state_machine.get_saga_by_order_id(order_id)
+            if not saga or saga.current_state == OrderState.CREATED.value:
+                # Payment charges on StockReserved, which the saga may not have seen yet
+                self._defer_until_saga_exists(event, order_id)
+            if not saga or saga.current_state != OrderState.STOCK_RESERVED.value:
+                logger.info(f"Ignoring PaymentProcessed for order {order_id}: saga not awaiting payment")
+                return
+
+            self.scheduler.cancel(db, saga.id, "process_payment")
+            state_machine.transition_to(saga.id, OrderState.PAYMENT_PROCESSED)
+            state_machine.log_step_completed(saga.id, "process_payment", data)
+            state_machine.transition_to(saga.id, OrderState.ORDER_CONFIRMED)
+
+            publisher = self.publisher_factory()
+            if publisher:
+                publisher.publish_event(
+                    event_type=OrderEvents.ORDER_CONFIRMED,
+                    aggregate_type=AggregateTypes.ORDER,
+                    aggregate_id=str(order_id),
+                    data={
+                        'order_id': order_id,
+                        'saga_id': saga.id,
+                        'payment_id': data.get("payment_id"),
+                        'amount': data.get("amount"),
+                        'status': "CONFIRMED"
+                    },
+                    correlation_id=event["metadata"].get("correlation_id"),
+                    service_name="saga-orchestrator"
+                )
+
+            logger.info(f"Order {order_id} confirmed via event-driven saga {saga.id}")
+        finally:
+            db.close()
+
+    def handle_payment_failed(self, event: Dict[str, Any]):
+        """Payment failed: release the reserved stock"""
+        data = event["data"]
+        self._fail_saga_for_order(data["order_id"], "process_payment",
+                                  f"Payment failed: {data.get('error_code', data.get('failure_reason', 'unknown'))}",
+                                  data)
+
+    # Failure and compensation
+
+    def _fail_saga_for_order(self, order_id: int, step_name: str, error_message: str,
+                             response_data: Optional[Dict[str, Any]] = None):
+        db = self.session_factory()
+        try:
+            state_machine = OrderStateMachine(db)
+            saga = state_machine.get_saga_by_order_id(order_id)
+            if not saga or state_machine.is_saga_complete(saga.id):
+                logger.info(f"Ignoring failure for order {order_id}: saga missing or already finished")
+                return
+
+            self.scheduler.cancel(db, saga.id, step_name)
+            state_machine.log_step_failed(saga.id, step_name, error_message, response_data)
+            self.fail_saga(db, saga, error_message)
+        finally:
+            db.close()
+
+    def fail_saga(self, db: Session, saga: SagaInstance, error_message: str):
+        """Cancel a saga, issuing compensation commands for the steps already done"""
+        state_machine = OrderStateMachine(db)
+
+        if saga.current_state in (OrderState.CREATED.value, OrderState.STOCK_VERIFIED.value):
+            # No stock held yet, only the checkout to cancel
+            self._run_compensations(state_machine, saga, error_message)
+            state_machine.transition_to(saga.id, OrderState.CANCELLED, error_message)
+            return
+
+        state_machine.transition_to(saga.id, OrderState.COMPENSATION_STARTED, error_message)
+        self._run_compensations(state_machine, saga, error_message)
+        state_machine.transition_to(saga.id, OrderState.CANCELLED)
+
+    def _run_compensations(self, state_machine: OrderStateMachine, saga: SagaInstance, error_message: str):
+        for action in reversed(state_machine.get_compensation_actions(saga.id)):
+            try:
+                payload = action.payload
+                if action.action_type == CompensationActionType.RELEASE_STOCK.value:
+                    self._publish_order_cancelled(payload['order_id'], payload['store_id'],
+                                                  payload['items'], error_message)
+                else:
+                    self._publish_compensation(saga.order_id, COMPENSATION_EVENTS[action.action_type],
+                                               payload, error_message)
+                state_machine.mark_compensation_executed(action)
+            except Exception as e:
+                logger.error(f"Compensation action failed for saga {saga.id}: {e}")
+                state_machine.mark_compensation_failed(action, str(e))
+
+    def _publish_compensation(self, order_id: int, event_type: str, payload: Dict[str, Any], reason: str):
+        """Command ecommerce to undo its part of the order (cancel the checkout, clear the cart)"""
+        publisher = self.publisher_factory()
+        if not publisher:
+            raise RuntimeError("Event publisher not available")
+
+        publisher.publish_event(
+            event_type=event_type,
+            aggregate_type=AggregateTypes.ORDER,
+            aggregate_id=str(order_id),
+            data={**payload, 'order_id': order_id, 'reason': reason},
+            service_name="saga-orchestrator"
+        )
+
+    def _publish_order_cancelled(self, order_id: int, store_id: int, items: list, reason: str,
+                                 correlation_id: Optional[str] = None):
+        """Command the warehouse to release the stock it reserved for the order"""
+        publisher = self.publisher_factory()
+        if not publisher:
+            raise RuntimeError("Event publisher not available")
+
+        publisher.publish_event(
+            event_type=OrderEvents.ORDER_CANCELLED,
+            aggregate_type=AggregateTypes.ORDER,
+            aggregate_id=str(order_id),
+            data={
+                'order_id': order_id,
+                'store_id': store_id,
+                'items': items,
+                'reason': reason,
+                'status': "CANCELLED"
+            },
+            correlation_id=correlation_id,
+            service_name="saga-orchestrator"
+        )
+
+    # Deadlines
+
+    def handle_deadline(self, db: Session, deadline: SagaDeadline):
+        """Deadline scheduler callback: the awaited event never arrived"""
+        state_machine = OrderStateMachine(db)
+        saga = state_machine.get_saga(deadline.saga_id)
+        if not saga or state_machine.is_saga_complete(saga.id):
+            return
+
+        error_message = f"Step '{deadline.step_name}' timed out"
+        state_machine.log_step_failed(saga.id, deadline.step_name, error_message)
+        self.fail_saga(db, saga, error_message)
+
+    # Wiring
+
+    def start(self):
+        """Start the event consumer in a background thread"""
+        consumer_thread = threading.Thread(target=self._consumer_loop, daemon=True)
+        consumer_thread.start()
+
+        logger.info("Choreography saga handler started")
+
+    def _consumer_loop(self):
+        max_retries = 5
+        retry_count = 0
+
+        while retry_count < max_retries:
+            try:
+                subscriber = EventSubscriber("saga_orchestrator")
+
+                subscriber.subscribe_to_event(Exchanges.ORDERS, RoutingKeys.ORDER_INITIATED,
+                                              self.handle_order_initiated)
+                subscriber.subscribe_to_event(Exchanges.INVENTORY, RoutingKeys.STOCK_RESERVED,
+                                              self.handle_stock_reserved)
+                subscriber.subscribe_to_event(Exchanges.INVENTORY, RoutingKeys.STOCK_UNAVAILABLE,
+                                              self.handle_stock_unavailable)
+                subscriber.subscribe_to_event(Exchanges.PAYMENTS, RoutingKeys.PAYMENT_PROCESSED,
+                                              self.handle_payment_processed)
+                subscriber.subscribe_to_event(Exchanges.PAYMENTS, RoutingKeys.PAYMENT_FAILED,
+                                              self.handle_payment_failed)
+
+                logger.info("Saga orchestrator subscribed to order, inventory and payment events")
+                subscriber.start_consuming()
+                break
+
+            except Exception as e:
+                retry_count += 1
+                logger.error(f"Saga event consumer failed (attempt {retry_count}): {e}")
+                if retry_count < max_retries:
+                    time.sleep(5)  # Wait before retry
+                else:
+                    logger.error("Max retries reached. Saga event consumer will not start.")
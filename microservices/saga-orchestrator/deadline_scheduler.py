@@ -0,0 +1,197 @@
+import heapq
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+from models import SagaDeadline, DeadlineStatus
+
+logger = logging.getLogger(__name__)
+
+# Seconds each saga step may take before the saga is timed out and compensated.
+# Override per step with SAGA_TIMEOUT_<STEP_NAME>, e.g. SAGA_TIMEOUT_PROCESS_PAYMENT=20
+DEFAULT_STEP_TIMEOUTS = {
+    'verify_stock': 5,
+    'reserve_stock': 30,
+    'process_payment': 60,
+    'confirm_order': 5
+}
+
+DEFAULT_TIMEOUT = 30
+
+
+def get_step_timeout(step_name: str) -> float:
+    """Timeout in seconds configured for a saga step"""
+    override = os.getenv(f"SAGA_TIMEOUT_{step_name.upper()}")
+    if override:
+        return float(override)
+    return DEFAULT_STEP_TIMEOUTS.get(step_name, DEFAULT_TIMEOUT)
+
+
+class DeadlineScheduler:
+    """
+    Fires saga step timeouts in deadline order
+
+    Deadlines are persisted in saga_deadlines (indexed on deadline_at) so they survive
+    restarts, and mirrored in an in-memory min-heap so the scheduler sleeps exactly until
+    the next one is due instead of polling. Cancelled deadlines are dropped lazily when
+    they reach the top of the heap.
+    """
+
+    def __init__(self, session_factory: Callable[[], Session],
+                 on_timeout: Callable[[Session, SagaDeadline], None]):
+        self.session_factory = session_factory
+        self.on_timeout = on_timeout
+        # Reload from the database periodically to pick up deadlines scheduled by other replicas
+        self.resync_interval = float(os.getenv("SAGA_DEADLINE_RESYNC_INTERVAL", "30"))
+        # Delay before firing again a deadline whose timeout handler failed
+        self.retry_delay = float(os.getenv("SAGA_DEADLINE_RETRY_DELAY", "5"))
+        self._heap: List[Tuple[datetime, int]] = []
+        self._known_ids = set()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, db: Session, saga_id: int, step_name: str,
+                 timeout: Optional[float] = None) -> SagaDeadline:
+        """Persist a deadline for a saga step and wake the scheduler if it is now the earliest"""
+        if timeout is None:
+            timeout = get_step_timeout(step_name)
+
+        deadline = SagaDeadline(
+            saga_id=saga_id,
+            step_name=step_name,
+            deadline_at=datetime.utcnow() + timedelta(seconds=timeout),
+            status=DeadlineStatus.PENDING.value
+        )
+        db.add(deadline)
+        db.flush()
+        deadline_at, deadline_id = deadline.deadline_at, deadline.id
+        db.commit()
+
+        self._push(deadline_at, deadline_id)
+        return deadline
+
+    def cancel(self, db: Session, saga_id: int, step_name: Optional[str] = None):
+        """Cancel pending deadlines of a saga (a single step, or all of them)"""
+        query = db.query(SagaDeadline).filter(
+            SagaDeadline.saga_id == saga_id,
+            SagaDeadline.status == DeadlineStatus.PENDING.value
+        )
+        if step_name:
+            query = query.filter(SagaDeadline.step_name == step_name)
+
+        query.update({SagaDeadline.status: DeadlineStatus.CANCELLED.value}, synchronize_session=False)
+        db.commit()
+
+    def start(self):
+        """Load pending deadlines and start firing them in a background thread"""
+        self._load_pending()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        logger.info(f"Deadline scheduler started with {len(self._heap)} pending deadlines")
+
+    def _push(self, deadline_at: datetime, deadline_id: int):
+        with self._condition:
+            if deadline_id in self._known_ids:
+                return
+            self._known_ids.add(deadline_id)
+            heapq.heappush(self._heap, (deadline_at, deadline_id))
+            if self._heap[0][1] == deadline_id:
+                self._condition.notify()
+
+    def _load_pending(self):
+        db = self.session_factory()
+        try:
+            pending = db.query(SagaDeadline.deadline_at, SagaDeadline.id).filter(
+                SagaDeadline.status == DeadlineStatus.PENDING.value
+            ).order_by(SagaDeadline.deadline_at).all()
+        finally:
+            db.close()
+
+        for deadline_at, deadline_id in pending:
+            self._push(deadline_at, deadline_id)
+
+    def _pop_due(self) -> List[int]:
+        """Block until at least one deadline is due (or a resync is needed) and pop the due ones"""
+        with self._condition:
+            if self._heap:
+                wait = (self._heap[0][0] - datetime.utcnow()).total_seconds()
+                if wait > 0:
+                    self._condition.wait(timeout=min(wait, self.resync_interval))
+            else:
+                self._condition.wait(timeout=self.resync_interval)
+
+            now = datetime.utcnow()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                _, deadline_id = heapq.heappop(self._heap)
+                self._known_ids.discard(deadline_id)
+                due.append(deadline_id)
+            return due
+
+    def _run(self):
+        last_resync = datetime.utcnow()
+
+        while True:
+            try:
+                for deadline_id in self._pop_due():
+                    self._fire(deadline_id)
+
+                if (datetime.utcnow() - last_resync).total_seconds() >= self.resync_interval:
+                    self._load_pending()
+                    last_resync = datetime.utcnow()
+            except Exception as e:
+                logger.error(f"Error in deadline scheduler: {e}")
+
+    def _fire(self, deadline_id: int):
+        db = self.session_factory()
+        try:
+            # Claim the deadline so that only one replica fires it
+            deadline = db.query(SagaDeadline).filter(
+                SagaDeadline.id == deadline_id,
+                SagaDeadline.status == DeadlineStatus.PENDING.value
+            ).with_for_update(skip_locked=True).first()
+
+            if not deadline:
+                return  # Cancelled, or already fired elsewhere
+
+            deadline.status = DeadlineStatus.FIRED.value
+            db.commit()
+
+            logger.warning(f"Step '{deadline.step_name}' of saga {deadline.saga_id} timed out")
+            try:
+                self.on_timeout(db, deadline)
+            except Exception as e:
+                logger.error(f"Timeout handler failed for deadline {deadline_id}, retrying in {self.retry_delay}s: {e}")
+                db.rollback()
+                self._retry(db, deadline)
+        except Exception as e:
+            logger.error(f"Error firing deadline {deadline_id}: {e}")
+        finally:
+            db.close()
+
+    def _retry(self, db: Session, deadline: SagaDeadline):
+        """Put a deadline whose timeout handler failed back to pending, due again after retry_delay"""
+        deadline.status = DeadlineStatus.PENDING.value
+        deadline.deadline_at = datetime.utcnow() + timedelta(seconds=self.retry_delay)
+        db.commit()
+
+        self._push(deadline.deadline_at, deadline.id)
+
+
+_scheduler: Optional[DeadlineScheduler] = None
+
+
+def init_deadline_scheduler(session_factory: Callable[[], Session],
+                            on_timeout: Callable[[Session, SagaDeadline], None]) -> DeadlineScheduler:
+    """Create and start the process-wide deadline scheduler"""
+    global _scheduler
+    _scheduler = DeadlineScheduler(session_factory, on_timeout)
+    _scheduler.start()
+    return _scheduler
+
+
+def get_deadline_scheduler() -> Optional[DeadlineScheduler]:
+    return _scheduler
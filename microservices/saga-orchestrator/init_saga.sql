@@ -1,6 +1,6 @@
 CREATE TABLE IF NOT EXISTS saga_instances (
     id SERIAL PRIMARY KEY,
-    order_id INTEGER UNIQUE NOT NULL,
+    order_id BIGINT UNIQUE NOT NULL,     -- 64-bit snowflake IDs (see shared/ids)
     customer_id INTEGER NOT NULL,
     product_id INTEGER NOT NULL,
     store_id INTEGER NOT NULL,          
@@ -12,7 +12,6 @@ CREATE TABLE IF NOT EXISTS saga_instances (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     error_message TEXT,
-    compensation_actions TEXT,
     checkout_id INTEGER
 );
 
@@ -28,3 +27,31 @@ CREATE TABLE IF NOT EXISTS saga_steps (
     response_data TEXT,
     FOREIGN KEY (saga_id) REFERENCES saga_instances(id)
 );
+
+CREATE TABLE IF NOT EXISTS saga_compensations (
+    id SERIAL PRIMARY KEY,
+    saga_id INTEGER NOT NULL,
+    action_type VARCHAR(50) NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    executed_at TIMESTAMP,
+    error_message TEXT,
+    FOREIGN KEY (saga_id) REFERENCES saga_instances(id)
+);
+
+-- Pending compensations are always looked up by saga
+CREATE INDEX IF NOT EXISTS idx_saga_compensations_saga_status ON saga_compensations (saga_id, status);
+
+CREATE TABLE IF NOT EXISTS saga_deadlines (
+    id SERIAL PRIMARY KEY,
+    saga_id INTEGER NOT NULL,
+    step_name VARCHAR(100) NOT NULL,
+    deadline_at TIMESTAMP NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (saga_id) REFERENCES saga_instances(id)
+);
+
+CREATE INDEX IF NOT EXISTS ix_saga_deadlines_saga_id ON saga_deadlines (saga_id);
+CREATE INDEX IF NOT EXISTS ix_saga_deadlines_deadline_at ON saga_deadlines (deadline_at);
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, DECIMAL, DateTime, Text, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, DECIMAL, DateTime, Text, ForeignKey, Index
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 
@@ -23,11 +24,26 @@ class SagaStatus(Enum):
     COMPENSATING = "compensating"
     COMPENSATED = "compensated"
 
+class CompensationActionType(Enum):
+    REMOVE_ITEM_FROM_CART = "remove_item_from_cart"
+    CANCEL_CHECKOUT = "cancel_checkout"
+    RELEASE_STOCK = "release_stock"
+
+class DeadlineStatus(Enum):
+    PENDING = "pending"
+    FIRED = "fired"
+    CANCELLED = "cancelled"
+
+class CompensationStatus(Enum):
+    PENDING = "pending"
+    EXECUTED = "executed"
+    FAILED = "failed"
+
 class SagaInstance(Base):
     __tablename__ = "saga_instances"
     
     id = Column(Integer, primary_key=True, index=True)
-    order_id = Column(Integer, unique=True, nullable=False)
+    order_id = Column(BigInteger, unique=True, nullable=False)
     customer_id = Column(Integer, nullable=False)
     product_id = Column(Integer, nullable=False)
     store_id = Column(Integer, nullable=False)
@@ -39,7 +55,6 @@ class SagaInstance(Base):
     created_at = Column(DateTime, default=func.now())
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
     error_message = Column(Text)
-    compensation_actions = Column(Text)
     checkout_id = Column(Integer)
 
 class SagaStep(Base):
@@ -55,3 +70,27 @@ class SagaStep(Base):
     request_data = Column(Text)
     response_data = Column(Text)
 
+class SagaCompensation(Base):
+    __tablename__ = "saga_compensations"
+    __table_args__ = (
+        Index("idx_saga_compensations_saga_status", "saga_id", "status"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    saga_id = Column(Integer, ForeignKey("saga_instances.id"), nullable=False)
+    action_type = Column(String(50), nullable=False)
+    payload = Column(JSONB, nullable=False, default=dict)
+    status = Column(String(20), nullable=False, default=CompensationStatus.PENDING.value)
+    created_at = Column(DateTime, default=func.now())
+    executed_at = Column(DateTime)
+    error_message = Column(Text)
+
+class SagaDeadline(Base):
+    __tablename__ = "saga_deadlines"
+
+    id = Column(Integer, primary_key=True)
+    saga_id = Column(Integer, ForeignKey("saga_instances.id"), nullable=False, index=True)
+    step_name = Column(String(100), nullable=False)
+    deadline_at = Column(DateTime, nullable=False, index=True)
+    status = Column(String(20), nullable=False, default=DeadlineStatus.PENDING.value)
+    created_at = Column(DateTime, default=func.now())
@@ -3,20 +3,37 @@ import logging
 import time
 import datetime
 import json
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Callable
 from sqlalchemy.orm import Session
 from state_machine import OrderStateMachine, OrderState
-from models import SagaInstance, SagaStatus
+from models import (
+    SagaInstance, SagaStatus, SagaCompensation, SagaDeadline,
+    CompensationActionType, CompensationStatus
+)
 from prometheus_client import Counter, Histogram, Gauge
 from py_api_saga.py_api_saga import SagaAssembler
+from tracing import get_tracer, inject_context
+from ids import next_id
+from deadline_scheduler import get_deadline_scheduler, get_step_timeout
 
 # Configure logging
 logger = logging.getLogger(__name__)
+tracer = get_tracer("saga-orchestrator")
+
+# Extra time granted before the persisted deadline of an in-process step fires, so that it
+# only catches sagas whose orchestrator died mid-step
+DEADLINE_GRACE_SECONDS = 5
+
 # Prometheus metrics
 saga_counter = Counter('saga_total', 'Total number of sagas', ['status'])
 saga_duration = Histogram('saga_duration_seconds', 'Saga execution duration')
 saga_step_duration = Histogram('saga_step_duration_seconds', 'Individual step duration', ['step'])
 active_sagas = Gauge('active_sagas_total', 'Number of currently active sagas')
+saga_downstream_duration = Histogram(
+    'saga_downstream_request_duration_seconds', 'Downstream service call duration', ['service', 'operation']
+)
+saga_compensation_duration = Histogram('saga_compensation_duration_seconds', 'Compensation action duration', ['action'])
+saga_db_commit_duration = Histogram('saga_db_commit_duration_seconds', 'Saga database commit duration', ['operation'])
 
 saga_state_counter = Counter('saga_states_total', 'Total number of state transitions', ['state'])
 saga_current_states = Gauge('saga_current_states', 'Current number of sagas in each state', ['state'])
@@ -26,7 +43,8 @@ class SagaService:
     def __init__(self, db: Session):
         self.db = db
         self.state_machine = OrderStateMachine(db)
-        self.timeout = 30  # seconds
+        self.timeout = 30  # seconds, upper bound for a single call
+        self._step_deadline = None
         
         self.services = {
             'warehouse': 'http://microservices_warehouse-1:8002',
@@ -72,7 +90,7 @@ class SagaService:
         
         try:
             # Generate unique order ID
-            order_id = int(time.time() * 1000) % 1000000
+            order_id = next_id()
             
             # Create saga instance
             saga = self.state_machine.create_saga(
@@ -98,8 +116,13 @@ class SagaService:
                 'quantity': quantity,
             }
             
-            # Execute saga steps
-            success = self._execute_saga_steps(saga.id, order_data)
+            # Execute saga steps under a single root span
+            with tracer.start_span(
+                "saga.order",
+                attributes={'saga.id': saga.id, 'order.id': order_id}
+            ) as span:
+                success = self._execute_saga_steps(saga.id, order_data)
+                span.set_attribute('saga.success', success)
             
             # Record metrics
             saga_duration.observe(time.time() - saga_start_time)
@@ -147,19 +170,19 @@ class SagaService:
 
         try:    
             # Step 1: Verify stock availability
-            if not self._verify_stock(saga_id, order_data):
+            if not self._run_step(saga_id, "verify_stock", self._verify_stock, order_data):
                 return False
             
             # Step 2: Reserve stock
-            if not self._reserve_stock(saga_id, order_data):
+            if not self._run_step(saga_id, "reserve_stock", self._reserve_stock, order_data):
                 return False
             
             # Step 3: Process payment
-            if not self._initiate_checkout(saga_id, order_data):
+            if not self._run_step(saga_id, "process_payment", self._initiate_checkout, order_data):
                 return False
             
             # Step 4: Confirm order
-            if not self._confirm_order(saga_id, order_data):
+            if not self._run_step(saga_id, "confirm_order", self._confirm_order, order_data):
                 return False
             
             return True
@@ -169,20 +192,75 @@ class SagaService:
             self._start_compensation(saga_id, str(e))
             return False
     
+    def _run_step(self, saga_id: int, step_name: str, step: Callable[[int, Dict[str, Any]], bool],
+                  order_data: Dict[str, Any]) -> bool:
+        """Run a saga step within its deadline, in its own span, recording its duration whatever the outcome"""
+        step_start = time.time()
+        step_timeout = get_step_timeout(step_name)
+        self._step_deadline = step_start + step_timeout
+        
+        scheduler = get_deadline_scheduler()
+        if scheduler:
+            scheduler.schedule(self.db, saga_id, step_name, step_timeout + DEADLINE_GRACE_SECONDS)
+        
+        with tracer.start_span(
+            f"saga.{step_name}",
+            attributes={'saga.id': saga_id, 'order.id': order_data['order_id'], 'saga.step.timeout': step_timeout}
+        ) as span:
+            try:
+                success = step(saga_id, order_data)
+                span.set_attribute('saga.step.success', success)
+                return success
+            finally:
+                self._step_deadline = None
+                if scheduler:
+                    scheduler.cancel(self.db, saga_id, step_name)
+                saga_step_duration.labels(step=step_name).observe(time.time() - step_start)
+    
+    def _remaining_timeout(self) -> float:
+        """Time left for a downstream call: the step deadline bounds the per-call timeout"""
+        if self._step_deadline is None:
+            return self.timeout
+        
+        remaining = self._step_deadline - time.time()
+        if remaining <= 0:
+            raise requests.Timeout("Saga step deadline exceeded")
+        return min(self.timeout, remaining)
+    
+    def _call_service(self, method: str, service: str, path: str, operation: str, **kwargs) -> requests.Response:
+        """Call a downstream service, tracing the hop and propagating the trace context"""
+        url = f"{self.services[service]}{path}"
+        request_start = time.time()
+        
+        with tracer.start_span(
+            f"{method} {service}.{operation}",
+            kind="client",
+            attributes={'peer.service': service, 'http.method': method, 'http.url': url}
+        ) as span:
+            try:
+                response = requests.request(
+                    method, url,
+                    headers=inject_context(kwargs.pop('headers', {})),
+                    timeout=self._remaining_timeout(),
+                    **kwargs
+                )
+                span.set_attribute('http.status_code', response.status_code)
+                return response
+            finally:
+                saga_downstream_duration.labels(service=service, operation=operation).observe(time.time() - request_start)
+    
     def _verify_stock(self, saga_id: int, order_data: Dict[str, Any]) -> bool:
         """Step 1: Verify stock availability"""
-        step_start = time.time()
         
         try:
             self.state_machine.log_step_started(saga_id, "verify_stock", order_data)
             
-            response = requests.get(
-                f"{self.services['warehouse']}/api/v1/stocks/product/{order_data['product_id']}/store/{order_data['store_id']}",
-                timeout=self.timeout
+            response = self._call_service(
+                'GET', 'warehouse',
+                f"/api/v1/stocks/product/{order_data['product_id']}/store/{order_data['store_id']}",
+                operation='get_stock'
             )
             
-            saga_step_duration.labels(step='verify_stock').observe(time.time() - step_start)
-            
             if response.status_code == 200:
                 result = response.json()
                 available_quantity = result.get('quantite', 0)
@@ -210,25 +288,22 @@ class SagaService:
     
     def _reserve_stock(self, saga_id: int, order_data: Dict[str, Any]) -> bool:
         """Step 2: Add item to cart (reserve stock)"""
-        step_start = time.time()
         
         try:
             self.state_machine.log_step_started(saga_id, "reserve_stock", order_data)
             
             # Call ecommerce service to add item to cart
-            response = requests.post(
-                f"{self.services['ecommerce']}/api/v1/cart/add-item",
+            response = self._call_service(
+                'POST', 'ecommerce', "/api/v1/cart/add-item",
+                operation='add_item',
                 json={
                     'cart': order_data['cart_id'],
                     'product': order_data['product_id'],
                     'quantite': order_data['quantity'],
                     'store_id': order_data['store_id']
-                },
-                timeout=self.timeout
+                }
             )
             
-            saga_step_duration.labels(step='reserve_stock').observe(time.time() - step_start)
-            
             if response.status_code == 200:
                 result = response.json()
                 self.state_machine.log_step_completed(saga_id, "reserve_stock", result)
@@ -236,8 +311,9 @@ class SagaService:
                 
                 # Add compensation action for removing item from cart
                 self.state_machine.add_compensation_action(
-                    saga_id, 
-                    f"remove_item_from_cart:{order_data['cart_id']}:{order_data['product_id']}"
+                    saga_id,
+                    CompensationActionType.REMOVE_ITEM_FROM_CART,
+                    {'cart_id': order_data['cart_id'], 'product_id': order_data['product_id']}
                 )
                 return True
             else:
@@ -253,18 +329,17 @@ class SagaService:
     
     def _initiate_checkout(self, saga_id: int, order_data: Dict[str, Any]) -> bool:
         """Step 3: Process payment"""
-        step_start = time.time()
         
         try:
             self.state_machine.log_step_started(saga_id, "process_payment", order_data)
             
             # First initiate checkout
-            checkout_response = requests.post(
-                f"{self.services['ecommerce']}/api/v1/checkout/initiate",
+            checkout_response = self._call_service(
+                'POST', 'ecommerce', "/api/v1/checkout/initiate",
+                operation='initiate_checkout',
                 json={
                     'cart_id': order_data['cart_id']
-                },
-                timeout=self.timeout
+                }
             )
             
             if checkout_response.status_code == 200:
@@ -274,23 +349,28 @@ class SagaService:
                 # Update saga with checkout_id
                 saga = self.state_machine.get_saga(saga_id)
                 saga.checkout_id = checkout_id
-                self.db.commit()
+                self.state_machine.commit("set_checkout")
                 
-                # Then complete checkout (process payment)
-                complete_response = requests.post(
-                    f"{self.services['ecommerce']}/api/v1/checkout/{checkout_id}/complete",
-                    timeout=self.timeout
+                # Recorded before completing: a failed or timed out completion must still cancel the
+                # checkout, which gives back any stock the warehouse reserves for it, even later
+                self.state_machine.add_compensation_action(
+                    saga_id,
+                    CompensationActionType.CANCEL_CHECKOUT,
+                    {'checkout_id': checkout_id}
                 )
                 
-                saga_step_duration.labels(step='process_payment').observe(time.time() - step_start)
+                # Then complete checkout (process payment). The warehouse reserves the stock on OrderInitiated,
+                # asynchronously: ecommerce waits for it with what is left of the step, less a second to finish
+                complete_response = self._call_service(
+                    'POST', 'ecommerce', f"/api/v1/checkout/{checkout_id}/complete",
+                    operation='complete_checkout',
+                    params={'reservation_wait': max(self._remaining_timeout() - 1, 0)}
+                )
                 
                 if complete_response.status_code == 200:
                     result = complete_response.json()
                     self.state_machine.log_step_completed(saga_id, "process_payment", result)
                     self.state_machine.transition_to(saga_id, OrderState.PAYMENT_PROCESSED)
-                    
-                    # Add compensation action for payment cancellation
-                    self.state_machine.add_compensation_action(saga_id, f"cancel_checkout:{checkout_id}")
                     return True
                 else:
                     error_msg = f"Payment processing failed: {complete_response.status_code} - {complete_response.text}"
@@ -311,7 +391,6 @@ class SagaService:
     
     def _confirm_order(self, saga_id: int, order_data: Dict[str, Any]) -> bool:
         """Step 4: Confirm order (finalize the saga)"""
-        step_start = time.time()
         
         try:
             self.state_machine.log_step_started(saga_id, "confirm_order", order_data)
@@ -327,8 +406,6 @@ class SagaService:
             self.state_machine.log_step_completed(saga_id, "confirm_order", result)
             self.state_machine.transition_to(saga_id, OrderState.ORDER_CONFIRMED)
             
-            saga_step_duration.labels(step='confirm_order').observe(time.time() - step_start)
-            
             logger.info(f"Order {order_data['order_id']} confirmed successfully via saga {saga_id}")
             return True
             
@@ -342,6 +419,10 @@ class SagaService:
         """Start compensation process to undo completed steps"""
         logger.info(f"Starting compensation for saga {saga_id}: {error_message}")
         
+        # Compensation is often started from inside a failing step: its calls must not inherit
+        # what is left (possibly nothing) of that step's deadline
+        self._step_deadline = None
+        
         try:
             self.state_machine.transition_to(saga_id, OrderState.COMPENSATION_STARTED, error_message)
             
@@ -349,11 +430,7 @@ class SagaService:
             actions = self.state_machine.get_compensation_actions(saga_id)
             
             # Execute compensation actions in reverse order
-            for action in reversed(actions):
-                try:
-                    self._execute_compensation_action(saga_id, action)
-                except Exception as e:
-                    logger.error(f"Compensation action failed for saga {saga_id}: {str(e)}")
+            self._run_compensation_actions(saga_id, actions)
             
             # Mark saga as cancelled
             self.state_machine.transition_to(saga_id, OrderState.CANCELLED)
@@ -361,53 +438,99 @@ class SagaService:
         except Exception as e:
             logger.error(f"Error during compensation for saga {saga_id}: {str(e)}")
     
-    def _execute_compensation_action(self, saga_id: int, action: str):
-        """Execute a specific compensation action"""
-        logger.info(f"Executing compensation action '{action}' for saga {saga_id}")
+    def _run_compensation_actions(self, saga_id: int, actions: List[SagaCompensation]):
+        """Execute compensation actions newest first and record their outcome"""
+        for action in reversed(actions):
+            action_start = time.time()
+            
+            with tracer.start_span(
+                f"saga.compensate.{action.action_type}",
+                attributes={'saga.id': saga_id, 'compensation.id': action.id}
+            ) as span:
+                try:
+                    self._execute_compensation_action(saga_id, action)
+                    self.state_machine.mark_compensation_executed(action)
+                except Exception as e:
+                    logger.error(f"Compensation action failed for saga {saga_id}: {str(e)}")
+                    span.record_exception(e)
+                    self.state_machine.mark_compensation_failed(action, str(e))
+                finally:
+                    saga_compensation_duration.labels(action=action.action_type).observe(time.time() - action_start)
+    
+    def compensate_failed_sagas(self, limit: int = 100) -> Dict[str, Any]:
+        """Run outstanding compensation actions for many failed sagas at once"""
+        saga_ids = [
+            saga_id for (saga_id,) in self.db.query(SagaCompensation.saga_id).join(
+                SagaInstance, SagaInstance.id == SagaCompensation.saga_id
+            ).filter(
+                SagaCompensation.status != CompensationStatus.EXECUTED.value,
+                SagaInstance.saga_status.in_([
+                    SagaStatus.COMPENSATING.value,
+                    SagaStatus.FAILED.value
+                ])
+            ).distinct().order_by(SagaCompensation.saga_id).limit(limit).all()
+        ]
         
-        try:
-            if action.startswith("remove_item_from_cart:"):
-            # Parse: remove_item_from_cart:cart_id:product_id
-                parts = action.split(":")
-                if len(parts) == 3:
-                    cart_id, product_id = parts[1], parts[2]
-                    
-                    # Call ecommerce service to clear items from cart
-                    response = requests.delete(
-                        f"{self.services['ecommerce']}/api/v1/cart/{cart_id}/clear",
-                        timeout=self.timeout
-                    )
-                    
-                    if response.status_code == 200:
-                        logger.info(f"Successfully cleared items in cart {cart_id}")
-                    else:
-                        logger.error(f"Failed to clear cart {cart_id}: {response.status_code}")
-            elif action.startswith("restore_stock:"):
-                # Parse: restore_stock:product_id:store_id:quantity
-                parts = action.split(":")
-                if len(parts) == 4:
-                    product_id, store_id, quantity = parts[1], parts[2], parts[3]
-                    
-                    # Note: You would need to implement a restore stock endpoint
-                    # For now, we'll log it as we don't have this endpoint yet
-                    logger.info(f"Would restore stock: product={product_id}, store={store_id}, quantity={quantity}")
-                    
-            elif action.startswith("cancel_checkout:"):
-                # Parse: cancel_checkout:checkout_id
-                checkout_id = action.split(":")[1]
-                
-                response = requests.put(
-                    f"{self.services['ecommerce']}/api/v1/checkout/{checkout_id}/cancel",
-                    timeout=self.timeout
-                )
-                
-                if response.status_code == 200:
-                    logger.info(f"Successfully cancelled checkout {checkout_id}")
-                else:
-                    logger.error(f"Failed to cancel checkout {checkout_id}: {response.status_code}")
-                    
-        except Exception as e:
-            logger.error(f"Error executing compensation action '{action}': {str(e)}")
+        pending = self.state_machine.get_pending_compensations(saga_ids)
+        
+        for saga_id, actions in pending.items():
+            self._run_compensation_actions(saga_id, actions)
+            
+            saga = self.state_machine.get_saga(saga_id)
+            if saga and saga.current_state == OrderState.COMPENSATION_STARTED.value:
+                self.state_machine.transition_to(saga_id, OrderState.CANCELLED)
+        
+        logger.info(f"Batch compensation processed {len(pending)} sagas")
+        return {
+            'sagas_processed': len(pending),
+            'actions_processed': sum(len(actions) for actions in pending.values())
+        }
+    
+    def _execute_compensation_action(self, saga_id: int, action: SagaCompensation):
+        """Execute a specific compensation action, raising if it could not be applied"""
+        action_type = CompensationActionType(action.action_type)
+        payload = action.payload or {}
+        logger.info(f"Executing compensation action '{action_type.value}' for saga {saga_id}")
+        
+        if action_type == CompensationActionType.REMOVE_ITEM_FROM_CART:
+            cart_id = payload['cart_id']
+            
+            # Call ecommerce service to clear items from cart
+            response = self._call_service(
+                'DELETE', 'ecommerce', f"/api/v1/cart/{cart_id}/clear",
+                operation='clear_cart'
+            )
+            
+            if response.status_code != 200:
+                raise RuntimeError(f"Failed to clear cart {cart_id}: {response.status_code}")
+            logger.info(f"Successfully cleared items in cart {cart_id}")
+            
+        elif action_type == CompensationActionType.CANCEL_CHECKOUT:
+            checkout_id = payload['checkout_id']
+            
+            response = self._call_service(
+                'PUT', 'ecommerce', f"/api/v1/checkout/{checkout_id}/cancel",
+                operation='cancel_checkout'
+            )
+            
+            if response.status_code != 200:
+                raise RuntimeError(f"Failed to cancel checkout {checkout_id}: {response.status_code}")
+            logger.info(f"Successfully cancelled checkout {checkout_id}")
+    
+    def handle_step_timeout(self, deadline: SagaDeadline):
+        """Deadline scheduler callback: a step outlived its deadline (e.g. the orchestrator died mid-step)"""
+        saga = self.state_machine.get_saga(deadline.saga_id)
+        if not saga or self.state_machine.is_saga_complete(saga.id):
+            return
+        
+        error_msg = f"Step '{deadline.step_name}' timed out"
+        self.state_machine.log_step_failed(saga.id, deadline.step_name, error_msg)
+        
+        if saga.current_state in (OrderState.CREATED.value, OrderState.STOCK_VERIFIED.value):
+            # Nothing to undo yet
+            self.state_machine.transition_to(saga.id, OrderState.CANCELLED, error_msg)
+        else:
+            self._start_compensation(saga.id, error_msg)
     
     def get_saga_status(self, saga_id: int) -> Optional[Dict[str, Any]]:
         """Get current status of a saga"""
@@ -1,9 +1,14 @@
 from sqlalchemy.orm import Session
-from models import SagaInstance, SagaStep, OrderState, SagaStatus
+from models import (
+    SagaInstance, SagaStep, SagaCompensation, OrderState, SagaStatus,
+    CompensationActionType, CompensationStatus
+)
 import logging
 import json
+import time
 from datetime import datetime
 from typing import Dict, Any, Optional, List
+from tracing import get_tracer
 
 logger = logging.getLogger(__name__)
 
@@ -19,15 +24,20 @@ VALID_TRANSITIONS = {
 
 saga_state_counter = None
 saga_current_states = None
+saga_db_commit_duration = None
+
+tracer = get_tracer("saga-orchestrator")
 
 
 def initialize_metrics():
     """Initialize metrics - call this from saga_service.py"""
-    global saga_state_counter, saga_current_states
+    global saga_state_counter, saga_current_states, saga_db_commit_duration
     from saga_service import saga_state_counter as state_counter
     from saga_service import saga_current_states as current_states
+    from saga_service import saga_db_commit_duration as db_commit_duration
     saga_state_counter = state_counter
     saga_current_states = current_states
+    saga_db_commit_duration = db_commit_duration
 
 class OrderStateMachine:
     """Manages state transitions for order sagas"""
@@ -38,6 +48,17 @@ class OrderStateMachine:
         if saga_state_counter is None:
             initialize_metrics()
     
+    def commit(self, operation: str):
+        """Commit the session, tracing and timing the database round trip"""
+        commit_start = time.time()
+        
+        with tracer.start_span(f"db.commit {operation}", attributes={'db.system': 'postgresql'}):
+            try:
+                self.db.commit()
+            finally:
+                if saga_db_commit_duration:
+                    saga_db_commit_duration.labels(operation=operation).observe(time.time() - commit_start)
+    
     def create_saga(self, order_id: int, customer_id: int, product_id: int, 
                    store_id: int, cart_id: int, quantity: int, amount: float = None) -> SagaInstance:
         """Create a new saga instance"""
@@ -54,7 +75,7 @@ class OrderStateMachine:
         )
         
         self.db.add(saga)
-        self.db.commit()
+        self.commit("create_saga")
         self.db.refresh(saga)
         
         logger.info(f"Created saga {saga.id} for order {order_id}")
@@ -100,7 +121,7 @@ class OrderStateMachine:
         else:
             saga.saga_status = SagaStatus.IN_PROGRESS.value
         
-        self.db.commit()
+        self.commit("transition")
 
         # UPDATE METRICS HERE
         if saga_state_counter:
@@ -150,7 +171,7 @@ class OrderStateMachine:
         )
         
         self.db.add(step)
-        self.db.commit()
+        self.commit("log_step")
         
         logger.info(f"Started step '{step_name}' for saga {saga_id}")
         return step
@@ -167,7 +188,7 @@ class OrderStateMachine:
             step.step_status = "completed"
             step.completed_at = datetime.utcnow()
             step.response_data = json.dumps(response_data) if response_data else None
-            self.db.commit()
+            self.commit("log_step")
             
             logger.info(f"Completed step '{step_name}' for saga {saga_id}")
         else:
@@ -186,42 +207,63 @@ class OrderStateMachine:
             step.completed_at = datetime.utcnow()
             step.error_message = error_message
             step.response_data = json.dumps(response_data) if response_data else None
-            self.db.commit()
+            self.commit("log_step")
             
             logger.error(f"Failed step '{step_name}' for saga {saga_id}: {error_message}")
         else:
             logger.warning(f"Step '{step_name}' not found for saga {saga_id}")
     
-    def add_compensation_action(self, saga_id: int, action: str):
-        """Add a compensation action to be executed if saga fails"""
-        saga = self.get_saga(saga_id)
-        if not saga:
-            return
-        
-        current_actions = []
-        if saga.compensation_actions:
-            try:
-                current_actions = json.loads(saga.compensation_actions)
-            except json.JSONDecodeError:
-                current_actions = []
+    def add_compensation_action(self, saga_id: int, action_type: CompensationActionType, payload: Dict[str, Any]):
+        """Record a compensation action to be executed if saga fails"""
+        action = SagaCompensation(
+            saga_id=saga_id,
+            action_type=action_type.value,
+            payload=payload,
+            status=CompensationStatus.PENDING.value
+        )
         
-        current_actions.append(action)
-        saga.compensation_actions = json.dumps(current_actions)
-        self.db.commit()
+        # Appending is a single INSERT, the saga row itself is never rewritten
+        self.db.add(action)
+        self.commit("add_compensation")
         
-        logger.info(f"Added compensation action '{action}' to saga {saga_id}")
+        logger.info(f"Added compensation action '{action_type.value}' to saga {saga_id}")
+        return action
     
-    def get_compensation_actions(self, saga_id: int) -> List[str]:
-        """Get list of compensation actions for a saga"""
-        saga = self.get_saga(saga_id)
-        if not saga or not saga.compensation_actions:
-            return []
+    def get_compensation_actions(self, saga_id: int) -> List[SagaCompensation]:
+        """Get compensation actions not yet executed for a saga, in the order they were recorded"""
+        return self.db.query(SagaCompensation).filter(
+            SagaCompensation.saga_id == saga_id,
+            SagaCompensation.status != CompensationStatus.EXECUTED.value
+        ).order_by(SagaCompensation.id).all()
+    
+    def get_pending_compensations(self, saga_ids: List[int]) -> Dict[int, List[SagaCompensation]]:
+        """Get compensation actions not yet executed for many sagas in a single query"""
+        if not saga_ids:
+            return {}
         
-        try:
-            return json.loads(saga.compensation_actions)
-        except json.JSONDecodeError:
-            logger.error(f"Invalid compensation actions JSON for saga {saga_id}")
-            return []
+        actions = self.db.query(SagaCompensation).filter(
+            SagaCompensation.saga_id.in_(saga_ids),
+            SagaCompensation.status != CompensationStatus.EXECUTED.value
+        ).order_by(SagaCompensation.saga_id, SagaCompensation.id).all()
+        
+        pending = {}
+        for action in actions:
+            pending.setdefault(action.saga_id, []).append(action)
+        return pending
+    
+    def mark_compensation_executed(self, action: SagaCompensation):
+        """Mark a compensation action as successfully executed"""
+        action.status = CompensationStatus.EXECUTED.value
+        action.executed_at = datetime.utcnow()
+        action.error_message = None
+        self.commit("mark_compensation")
+    
+    def mark_compensation_failed(self, action: SagaCompensation, error_message: str):
+        """Mark a compensation action as failed, it stays eligible for a later retry"""
+        action.status = CompensationStatus.FAILED.value
+        action.executed_at = datetime.utcnow()
+        action.error_message = error_message
+        self.commit("mark_compensation")
     
     def is_valid_transition(self, current_state: OrderState, new_state: OrderState) -> bool:
         """Check if a state transition is valid"""
@@ -0,0 +1,34 @@
+import os
+import sys
+
+# The service runs from /app with the shared packages next to it, mirror that layout
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR)
+sys.path.insert(0, os.path.join(SERVICE_DIR, '..', 'shared'))
+
+# Spans would otherwise be exported to traces.jsonl in the working directory
+os.environ.setdefault("TRACING_ENABLED", "false")
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import sessionmaker
+
+
+@compiles(JSONB, 'sqlite')
+def compile_jsonb_for_sqlite(type_, compiler, **kw):
+    return 'JSON'
+
+
+@pytest.fixture
+def db():
+    """Session on a fresh in-memory SQLite database holding the saga tables"""
+    from models import Base
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
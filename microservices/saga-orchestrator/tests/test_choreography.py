@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import choreography
+from choreography import ChoreographySagaHandler, EventOutOfOrder
+from events.schemas import OrderEvents
+from models import CompensationActionType
+from state_machine import OrderState
+
+
+def stock_reserved(order_id, published_at=None):
+    return {
+        "event_type": "StockReserved",
+        "data": {
+            "order_id": order_id,
+            "store_id": 1,
+            "items": [{"product_id": 10, "requested_quantity": 2, "available_quantity": 8}],
+            "total_amount": 40.0
+        },
+        "metadata": {"correlation_id": "corr",
+                     "published_at": (published_at or datetime.utcnow()).isoformat() + "Z"}
+    }
+
+
+@pytest.fixture
+def state_machine():
+    state_machine = MagicMock()
+    state_machine.is_saga_complete.return_value = False
+    with patch.object(choreography, "OrderStateMachine", return_value=state_machine), \
+            patch.object(choreography, "get_deadline_scheduler", return_value=MagicMock()):
+        yield state_machine
+
+
+@pytest.fixture(autouse=True)
+def no_requeue_delay(monkeypatch):
+    monkeypatch.setattr(choreography, "OUT_OF_ORDER_RETRY_DELAY", 0)
+
+
+@pytest.fixture
+def handler():
+    return ChoreographySagaHandler(MagicMock, MagicMock)
+
+
+def test_stock_reserved_before_order_initiated_is_requeued(handler, state_machine):
+    state_machine.get_saga_by_order_id.return_value = None
+
+    with pytest.raises(EventOutOfOrder):
+        handler.handle_stock_reserved(stock_reserved(42, published_at=datetime.utcnow()))
+
+    state_machine.create_saga.assert_not_called()
+    state_machine.add_compensation_action.assert_not_called()
+
+
+def test_stock_reserved_for_an_order_never_initiated_is_released(handler, state_machine):
+    state_machine.get_saga_by_order_id.return_value = None
+    publisher = MagicMock()
+    handler.publisher_factory = lambda: publisher
+    stale = datetime.utcnow() - timedelta(seconds=choreography.OUT_OF_ORDER_GRACE_SECONDS + 1)
+
+    handler.handle_stock_reserved(stock_reserved(42, published_at=stale))
+
+    state_machine.create_saga.assert_not_called()
+    published = publisher.publish_event.call_args.kwargs
+    assert published["event_type"] == OrderEvents.ORDER_CANCELLED
+    assert published["data"]["items"] == [{'product_id': 10, 'quantity': 2}]
+
+
+def test_payment_processed_before_stock_reserved_is_requeued(handler, state_machine):
+    state_machine.get_saga_by_order_id.return_value = SimpleNamespace(id=3, current_state=OrderState.CREATED.value)
+    event = {"event_type": "PaymentProcessed", "data": {"order_id": 42},
+             "metadata": {"published_at": datetime.utcnow().isoformat() + "Z"}}
+
+    with pytest.raises(EventOutOfOrder):
+        handler.handle_payment_processed(event)
+
+    state_machine.transition_to.assert_not_called()
+
+
+def test_initiated_order_records_the_checkout_to_cancel(handler, state_machine):
+    state_machine.get_saga_by_order_id.return_value = None
+    state_machine.create_saga.return_value = SimpleNamespace(id=3)
+
+    handler.handle_order_initiated({"data": {"order_id": 42, "customer_id": 7, "cart_id": 9, "items": []}})
+
+    assert state_machine.create_saga.call_args.kwargs["customer_id"] == 7
+    state_machine.add_compensation_action.assert_called_once_with(
+        3, CompensationActionType.CANCEL_CHECKOUT, {'checkout_id': 42, 'cart_id': 9}
+    )
+
+
+def test_cancelled_saga_commands_ecommerce_to_cancel_the_checkout(handler, state_machine):
+    saga = SimpleNamespace(id=3, order_id=42, current_state=OrderState.CREATED.value)
+    action = SimpleNamespace(action_type=CompensationActionType.CANCEL_CHECKOUT.value,
+                             payload={'checkout_id': 42, 'cart_id': 9})
+    state_machine.get_compensation_actions.return_value = [action]
+    publisher = MagicMock()
+    handler.publisher_factory = lambda: publisher
+
+    handler.fail_saga(MagicMock(), saga, "Stock unavailable")
+
+    published = publisher.publish_event.call_args.kwargs
+    assert published["event_type"] == OrderEvents.CHECKOUT_CANCELLED
+    assert published["data"] == {'checkout_id': 42, 'cart_id': 9, 'order_id': 42, 'reason': "Stock unavailable"}
+    state_machine.mark_compensation_executed.assert_called_once_with(action)
+    state_machine.transition_to.assert_called_once_with(3, OrderState.CANCELLED, "Stock unavailable")
+
+
+def test_compensation_without_publisher_is_marked_failed(handler, state_machine):
+    saga = SimpleNamespace(id=3, order_id=42, current_state=OrderState.CREATED.value)
+    action = SimpleNamespace(action_type=CompensationActionType.CANCEL_CHECKOUT.value, payload={'checkout_id': 42})
+    state_machine.get_compensation_actions.return_value = [action]
+    handler.publisher_factory = lambda: None
+
+    handler.fail_saga(MagicMock(), saga, "Stock unavailable")
+
+    state_machine.mark_compensation_failed.assert_called_once()
+    state_machine.mark_compensation_executed.assert_not_called()
+
+
+def test_duplicate_stock_reserved_is_ignored(handler, state_machine):
+    saga = SimpleNamespace(id=3, current_state=OrderState.STOCK_RESERVED.value, customer_id=7)
+    state_machine.get_saga_by_order_id.return_value = saga
+
+    handler.handle_stock_reserved(stock_reserved(42))
+
+    state_machine.create_saga.assert_not_called()
+    state_machine.add_compensation_action.assert_not_called()
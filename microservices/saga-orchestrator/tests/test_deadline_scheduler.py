@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from deadline_scheduler import DeadlineScheduler
+from models import DeadlineStatus, SagaDeadline
+
+
+@pytest.fixture
+def session_factory(db):
+    return sessionmaker(bind=db.get_bind())
+
+
+def make_deadline(db):
+    deadline = SagaDeadline(saga_id=1, step_name="process_payment", status=DeadlineStatus.PENDING.value,
+                            deadline_at=datetime.utcnow() - timedelta(seconds=1))
+    db.add(deadline)
+    db.commit()
+    return deadline.id
+
+
+def test_due_deadline_is_fired_once(db, session_factory):
+    fired = []
+    scheduler = DeadlineScheduler(session_factory, lambda session, deadline: fired.append(deadline.id))
+    deadline_id = make_deadline(db)
+
+    scheduler._fire(deadline_id)
+    scheduler._fire(deadline_id)
+
+    assert fired == [deadline_id]
+    assert db.get(SagaDeadline, deadline_id).status == DeadlineStatus.FIRED.value
+
+
+def test_deadline_whose_handler_fails_is_fired_again(db, session_factory):
+    def fail(session, deadline):
+        raise RuntimeError("broker unavailable")
+
+    scheduler = DeadlineScheduler(session_factory, fail)
+    deadline_id = make_deadline(db)
+
+    scheduler._fire(deadline_id)
+
+    db.expire_all()
+    deadline = db.get(SagaDeadline, deadline_id)
+    # Back to pending, so this replica's heap or another replica's resync picks it up again
+    assert deadline.status == DeadlineStatus.PENDING.value
+    assert deadline.deadline_at > datetime.utcnow()
+    assert scheduler._heap == [(deadline.deadline_at, deadline_id)]
@@ -0,0 +1,103 @@
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+
+import saga_service
+from models import CompensationActionType
+from saga_service import SagaService
+
+
+ORDER_DATA = {'order_id': 1, 'customer_id': 1, 'product_id': 10, 'store_id': 2, 'cart_id': 5, 'quantity': 1}
+
+
+def response(status_code, body=None):
+    return SimpleNamespace(status_code=status_code, text='', json=lambda: body or {})
+
+
+@pytest.fixture
+def service():
+    service = SagaService(MagicMock())
+    service.state_machine = MagicMock()
+    return service
+
+
+@pytest.fixture(autouse=True)
+def no_deadline_scheduler():
+    with patch.object(saga_service, 'get_deadline_scheduler', return_value=None):
+        yield
+
+
+def test_compensation_after_step_timeout_gets_its_own_budget(service, monkeypatch):
+    monkeypatch.setenv('SAGA_TIMEOUT_PROCESS_PAYMENT', '0.05')
+    action = SimpleNamespace(
+        id=1, action_type=CompensationActionType.REMOVE_ITEM_FROM_CART.value,
+        payload={'cart_id': 5, 'product_id': 10}
+    )
+    service.state_machine.get_compensation_actions.return_value = [action]
+
+    def fake_request(method, url, **kwargs):
+        if url.endswith('/checkout/initiate'):
+            time.sleep(0.1)
+            raise requests.Timeout('read timed out')
+        return response(200)
+
+    with patch.object(saga_service.requests, 'request', side_effect=fake_request) as request:
+        assert service._run_step(1, 'process_payment', service._initiate_checkout, ORDER_DATA) is False
+
+    clear_call = request.call_args_list[-1]
+    assert clear_call.args == ('DELETE', 'http://microservices_ecommerce:8004/api/v1/cart/5/clear')
+    assert clear_call.kwargs['timeout'] == service.timeout
+    service.state_machine.mark_compensation_executed.assert_called_once_with(action)
+    service.state_machine.mark_compensation_failed.assert_not_called()
+
+
+def test_step_calls_are_bounded_by_the_step_deadline(service, monkeypatch):
+    monkeypatch.setenv('SAGA_TIMEOUT_VERIFY_STOCK', '2')
+
+    with patch.object(saga_service.requests, 'request', return_value=response(200, {'quantite': 5})) as request:
+        assert service._run_step(1, 'verify_stock', service._verify_stock, ORDER_DATA) is True
+
+    assert 0 < request.call_args.kwargs['timeout'] <= 2
+    assert service._step_deadline is None
+
+
+def test_expired_step_deadline_fails_the_call_without_sending_it(service):
+    service._step_deadline = time.time() - 1
+
+    with patch.object(saga_service.requests, 'request') as request:
+        with pytest.raises(requests.Timeout):
+            service._call_service('GET', 'warehouse', '/api/v1/stocks', operation='get_stock')
+
+    request.assert_not_called()
+
+
+def test_downstream_calls_carry_the_step_trace_context(service):
+    with patch.object(saga_service.requests, 'request', return_value=response(200, {'quantite': 5})) as request:
+        with saga_service.tracer.start_span("saga.verify_stock") as step_span:
+            service._call_service('GET', 'warehouse', '/api/v1/stocks', operation='get_stock')
+
+    traceparent = request.call_args.kwargs['headers']['traceparent']
+    assert traceparent.split('-')[1] == step_span.context.trace_id
+
+
+def test_checkout_is_cancelled_when_its_completion_fails(service):
+    def fake_request(method, url, **kwargs):
+        if url.endswith('/checkout/initiate'):
+            return response(200, {'id': 42})
+        # The warehouse has not reserved the stock within the step
+        return response(409)
+
+    with patch.object(saga_service.requests, 'request', side_effect=fake_request) as request, \
+            patch.object(service, '_start_compensation') as start_compensation:
+        assert service._run_step(1, 'process_payment', service._initiate_checkout, ORDER_DATA) is False
+
+    service.state_machine.add_compensation_action.assert_called_once_with(
+        1, CompensationActionType.CANCEL_CHECKOUT, {'checkout_id': 42}
+    )
+    start_compensation.assert_called_once()
+    # Ecommerce waits for the reservation no longer than the step has left
+    complete_call = request.call_args_list[1]
+    assert 0 <= complete_call.kwargs['params']['reservation_wait'] < complete_call.kwargs['timeout']
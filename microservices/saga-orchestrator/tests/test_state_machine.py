@@ -0,0 +1,77 @@
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import saga_service
+from models import CompensationActionType, CompensationStatus, SagaCompensation
+from saga_service import SagaService
+from state_machine import OrderStateMachine, OrderState
+
+
+def create_saga(state_machine, order_id):
+    return state_machine.create_saga(
+        order_id=order_id, customer_id=1, product_id=10, store_id=1, cart_id=5, quantity=2
+    )
+
+
+def test_compensation_actions_are_stored_with_typed_payloads_in_order(db):
+    state_machine = OrderStateMachine(db)
+    saga = create_saga(state_machine, 1)
+
+    state_machine.add_compensation_action(saga.id, CompensationActionType.REMOVE_ITEM_FROM_CART,
+                                          {'cart_id': 5, 'product_id': 10})
+    state_machine.add_compensation_action(saga.id, CompensationActionType.CANCEL_CHECKOUT, {'checkout_id': 7})
+
+    actions = state_machine.get_compensation_actions(saga.id)
+    assert [(action.action_type, action.payload) for action in actions] == [
+        ('remove_item_from_cart', {'cart_id': 5, 'product_id': 10}),
+        ('cancel_checkout', {'checkout_id': 7})
+    ]
+    assert all(action.status == CompensationStatus.PENDING.value for action in actions)
+
+
+def test_executed_actions_are_no_longer_pending(db):
+    state_machine = OrderStateMachine(db)
+    saga = create_saga(state_machine, 1)
+    done = state_machine.add_compensation_action(saga.id, CompensationActionType.RELEASE_STOCK, {'order_id': 1})
+    failed = state_machine.add_compensation_action(saga.id, CompensationActionType.CANCEL_CHECKOUT, {'checkout_id': 7})
+
+    state_machine.mark_compensation_executed(done)
+    state_machine.mark_compensation_failed(failed, "ecommerce down")
+
+    # A failed action stays eligible for a retry
+    assert state_machine.get_compensation_actions(saga.id) == [failed]
+    assert failed.error_message == "ecommerce down"
+
+
+def test_pending_compensations_of_many_sagas_in_one_query(db):
+    state_machine = OrderStateMachine(db)
+    first, second, untouched = (create_saga(state_machine, order_id) for order_id in (1, 2, 3))
+    for saga in (first, second, first):
+        state_machine.add_compensation_action(saga.id, CompensationActionType.RELEASE_STOCK, {'order_id': saga.order_id})
+    state_machine.add_compensation_action(untouched.id, CompensationActionType.RELEASE_STOCK, {'order_id': 3})
+
+    pending = state_machine.get_pending_compensations([first.id, second.id])
+
+    assert sorted(pending) == [first.id, second.id]
+    assert [len(pending[first.id]), len(pending[second.id])] == [2, 1]
+    assert all(isinstance(action, SagaCompensation) for actions in pending.values() for action in actions)
+    assert state_machine.get_pending_compensations([]) == {}
+
+
+def test_failed_sagas_are_compensated_in_one_batch(db):
+    service = SagaService(db)
+    state_machine = service.state_machine
+    sagas = [create_saga(state_machine, order_id) for order_id in (1, 2)]
+    for saga in sagas:
+        for state in (OrderState.STOCK_VERIFIED, OrderState.STOCK_RESERVED, OrderState.COMPENSATION_STARTED):
+            state_machine.transition_to(saga.id, state)
+        state_machine.add_compensation_action(saga.id, CompensationActionType.REMOVE_ITEM_FROM_CART,
+                                              {'cart_id': saga.cart_id, 'product_id': 10})
+
+    with patch.object(saga_service.requests, 'request', return_value=SimpleNamespace(status_code=200)) as request:
+        assert service.compensate_failed_sagas() == {'sagas_processed': 2, 'actions_processed': 2}
+
+    assert request.call_count == 2
+    for saga in sagas:
+        assert state_machine.get_saga(saga.id).current_state == OrderState.CANCELLED.value
+        assert state_machine.get_compensation_actions(saga.id) == []
@@ -8,6 +8,7 @@ from .schemas import (
     InventoryEvents,
     PaymentEvents,
     ShippingEvents,
+    ProductEvents,
     NotificationEvents,
     AggregateTypes,
     Exchanges,
@@ -25,6 +26,7 @@ __all__ = [
     'InventoryEvents',
     'PaymentEvents',
     'ShippingEvents',
+    'ProductEvents',
     'NotificationEvents',
     'AggregateTypes',
     'Exchanges',
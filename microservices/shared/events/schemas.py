@@ -23,6 +23,9 @@ class OrderEvents:
     ORDER_CONFIRMED = "OrderConfirmed"
     ORDER_CANCELLED = "OrderCancelled"
     ORDER_COMPLETED = "OrderCompleted"
+    # Compensation commands of the choreographed saga, consumed by ecommerce
+    CHECKOUT_CANCELLED = "CheckoutCancelled"
+    CART_CLEARED = "CartCleared"
 
 # Inventory Events
 class InventoryEvents:
@@ -31,6 +34,7 @@ class InventoryEvents:
     STOCK_RELEASED = "StockReleased"
     STOCK_DEDUCTED = "StockDeducted"
     STOCK_UNAVAILABLE = "StockUnavailable"
+    LOW_STOCK_ALERT = "LowStockAlert"
 
 # Payment Events
 class PaymentEvents:
@@ -46,6 +50,12 @@ class ShippingEvents:
     SHIPMENT_DELIVERED = "ShipmentDelivered"
     SHIPMENT_FAILED = "ShipmentFailed"
 
+# Product Catalog Events
+class ProductEvents:
+    PRODUCT_CREATED = "ProductCreated"
+    PRODUCT_UPDATED = "ProductUpdated"
+    PRODUCT_DELETED = "ProductDeleted"
+
 # Notification Events
 class NotificationEvents:
     ORDER_CONFIRMATION_SENT = "OrderConfirmationSent"
@@ -60,6 +70,7 @@ class AggregateTypes:
     SHIPMENT = "shipping"
     NOTIFICATION = "notifications"
     ANALYTICS = "analytics"
+    PRODUCT = "products"
 
 # Exchange Names
 class Exchanges:
@@ -69,6 +80,7 @@ class Exchanges:
     SHIPPING = "ecommerce.shipping"
     NOTIFICATIONS = "ecommerce.notifications"
     ANALYTICS = "ecommerce.analytics"
+    PRODUCTS = "ecommerce.products"
 
 # Routing Keys
 class RoutingKeys:
@@ -77,12 +89,15 @@ class RoutingKeys:
     ORDER_CREATED = "orders.order_created"
     ORDER_CONFIRMED = "orders.order_confirmed"
     ORDER_CANCELLED = "orders.order_cancelled"
+    CHECKOUT_CANCELLED = "orders.checkout_cancelled"
+    CART_CLEARED = "orders.cart_cleared"
     
     # Inventory routing keys
     STOCK_CHECKED = "inventory.stock_checked"
     STOCK_RESERVED = "inventory.stock_reserved"
     STOCK_RELEASED = "inventory.stock_released"
     STOCK_UNAVAILABLE = "inventory.stock_unavailable"
+    LOW_STOCK_ALERT = "inventory.low_stock_alert"
     
     # Payment routing keys
     PAYMENT_PROCESSED = "payments.payment_processed"
@@ -92,6 +107,11 @@ class RoutingKeys:
     SHIPMENT_PREPARED = "shipping.shipment_prepared"
     SHIPMENT_DISPATCHED = "shipping.shipment_dispatched"
     
+    # Product routing keys
+    PRODUCT_CREATED = "products.product_created"
+    PRODUCT_UPDATED = "products.product_updated"
+    PRODUCT_DELETED = "products.product_deleted"
+    
     # Notification routing keys
     CONFIRMATION_SENT = "notifications.order_confirmation_sent"
     SHIPPING_SENT = "notifications.shipping_notification_sent"
@@ -108,13 +128,14 @@ def create_order_initiated_data(order_id: int, customer_id: int, cart_id: int, t
         "created_at": datetime.utcnow().isoformat()
     }
 
-def create_stock_reserved_data(order_id: int, store_id: int, items: list, reservation_id: str = None) -> Dict[str, Any]:
-    """Helper to create StockReserved event data"""
+def create_stock_reserved_data(order_id: int, store_id: int, items: list, reservation_id: str = None, total_amount: float = None) -> Dict[str, Any]:
+    """Helper to create StockReserved event data, total_amount is carried over from OrderInitiated for the payment"""
     return {
         "order_id": order_id,
         "store_id": store_id,
         "reservation_id": reservation_id or f"res_{order_id}_{datetime.utcnow().timestamp()}",
         "items": items,
+        "total_amount": total_amount,
         "reserved_at": datetime.utcnow().isoformat()
     }
 
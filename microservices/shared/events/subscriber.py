@@ -6,6 +6,12 @@ import threading
 from typing import Callable, Dict, Any
 import logging
 
+try:
+    from tracing import get_tracer, extract_context
+except ImportError:
+    # Services that mount the shared folder as a package (e.g. CQRS)
+    from shared.tracing import get_tracer, extract_context
+
 logger = logging.getLogger(__name__)
 
 class EventSubscriber:
@@ -67,8 +73,16 @@ class EventSubscriber:
                 
                 logger.info(f"Received event: {event_type} on {routing_key}")
                 
-                # Call the business logic handler
-                handler(event_data)
+                # Continue the publisher's trace, if it sent one
+                tracer = get_tracer(self.service_name)
+                with tracer.start_span(
+                    f"consume {routing_key}",
+                    kind="consumer",
+                    attributes={"messaging.destination": exchange, "event_type": event_type},
+                    parent=extract_context(properties.headers)
+                ):
+                    # Call the business logic handler
+                    handler(event_data)
                 
                 # Acknowledge the message
                 ch.basic_ack(delivery_tag=method.delivery_tag)
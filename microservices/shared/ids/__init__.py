@@ -0,0 +1,9 @@
+# Shared ID Generation Package
+
+from .snowflake import SnowflakeGenerator, get_id_generator, next_id
+
+__all__ = [
+    'SnowflakeGenerator',
+    'get_id_generator',
+    'next_id'
+]
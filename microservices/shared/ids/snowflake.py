@@ -0,0 +1,105 @@
+# Snowflake-style 64-bit ID generator
+
+import os
+import socket
+import threading
+import time
+import zlib
+from typing import Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 2025-01-01T00:00:00Z, keeps the 41-bit timestamp good for ~69 years
+EPOCH_MS = 1735689600000
+
+TIMESTAMP_BITS = 41
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_NODE_ID = (1 << NODE_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class SnowflakeGenerator:
+    """
+    Generates unique, roughly time-ordered 63-bit IDs (they fit a Postgres BIGINT)
+
+    Layout: 41 bits of milliseconds since EPOCH_MS | 10 bits of node ID | 12 bits of sequence,
+    i.e. up to 4096 IDs per millisecond per node without any coordination.
+    """
+
+    def __init__(self, node_id: int):
+        if not 0 <= node_id <= MAX_NODE_ID:
+            raise ValueError(f"Node ID must be between 0 and {MAX_NODE_ID}")
+        self.node_id = node_id
+        self._last_timestamp = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _now_ms() -> int:
+        return int(time.time() * 1000)
+
+    def next_id(self) -> int:
+        with self._lock:
+            timestamp = self._now_ms()
+
+            if timestamp < self._last_timestamp:
+                # Clock moved backwards: keep issuing IDs from the last timestamp seen
+                timestamp = self._last_timestamp
+
+            if timestamp == self._last_timestamp:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond, wait for the next one
+                    while timestamp <= self._last_timestamp:
+                        timestamp = self._now_ms()
+            else:
+                self._sequence = 0
+
+            self._last_timestamp = timestamp
+
+            return ((timestamp - EPOCH_MS) << (NODE_BITS + SEQUENCE_BITS)) \
+                | (self.node_id << SEQUENCE_BITS) \
+                | self._sequence
+
+    @staticmethod
+    def parse(snowflake_id: int) -> dict:
+        """Split an ID back into its timestamp (ms since the Unix epoch), node ID and sequence"""
+        return {
+            'timestamp_ms': (snowflake_id >> (NODE_BITS + SEQUENCE_BITS)) + EPOCH_MS,
+            'node_id': (snowflake_id >> SEQUENCE_BITS) & MAX_NODE_ID,
+            'sequence': snowflake_id & MAX_SEQUENCE
+        }
+
+
+def _default_node_id() -> int:
+    """
+    Node ID from the NODE_ID environment variable, or derived from the hostname
+
+    Replicas of the same service must run with distinct node IDs; set NODE_ID explicitly
+    when a hash collision between container hostnames is not acceptable.
+    """
+    node_id = os.getenv("NODE_ID")
+    if node_id is not None:
+        return int(node_id)
+    return zlib.crc32(socket.gethostname().encode()) & MAX_NODE_ID
+
+
+_generator: Optional[SnowflakeGenerator] = None
+_generator_lock = threading.Lock()
+
+
+def get_id_generator() -> SnowflakeGenerator:
+    """Get the process-wide ID generator"""
+    global _generator
+    with _generator_lock:
+        if _generator is None:
+            _generator = SnowflakeGenerator(_default_node_id())
+            logger.info(f"ID generator initialized with node ID {_generator.node_id}")
+        return _generator
+
+
+def next_id() -> int:
+    return get_id_generator().next_id()
@@ -0,0 +1,10 @@
+# Shared Transactional Outbox Package
+
+from .outbox import OutboxMixin, enqueue
+from .relay import OutboxRelay
+
+__all__ = [
+    'OutboxMixin',
+    'enqueue',
+    'OutboxRelay'
+]
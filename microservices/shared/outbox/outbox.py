@@ -0,0 +1,72 @@
+# Transactional outbox: events are stored in the service database with the state change they describe
+
+from datetime import datetime
+from typing import Dict, Any, Optional
+from sqlalchemy import Column, BigInteger, Integer, String, Text, DateTime, JSON, Index, text
+from sqlalchemy.orm import declared_attr
+import logging
+
+try:
+    from events import EventPublisher
+    from tracing import inject_context
+except ImportError:
+    # Services that mount the shared folder as a package (e.g. CQRS)
+    from shared.events import EventPublisher
+    from shared.tracing import inject_context
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxMixin:
+    """
+    Columns of an outbox table, mixed into a model of each service's own declarative Base:
+
+        class OutboxMessage(OutboxMixin, Base):
+            __tablename__ = 'outbox'
+    """
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    event_id = Column(String(36), nullable=False, unique=True)
+    event_type = Column(String(100), nullable=False)
+    aggregate_type = Column(String(50), nullable=False)
+    aggregate_id = Column(String(100), nullable=False)
+    payload = Column(JSON, nullable=False)  # Full event envelope, published as is
+    headers = Column(JSON)  # Trace context captured when the event was enqueued
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = Column(DateTime)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text)
+
+    @declared_attr.directive
+    def __table_args__(cls):
+        # The relay only ever scans unsent rows in id order
+        return (Index(f'idx_{cls.__tablename__}_unsent', 'id', postgresql_where=text('sent_at IS NULL')),)
+
+
+def enqueue(session,
+            model,
+            event_type: str,
+            aggregate_type: str,
+            aggregate_id,
+            data: Dict[str, Any],
+            correlation_id: Optional[str] = None,
+            service_name: str = "unknown") -> str:
+    """
+    Add an event to the outbox of the given session without committing
+
+    The event is only published by the OutboxRelay once the caller commits, and
+    is discarded if the transaction rolls back.
+
+    Returns:
+        event_id: Unique identifier of the event
+    """
+    event = EventPublisher.build_event(event_type, aggregate_type, str(aggregate_id), data, correlation_id, service_name)
+    session.add(model(
+        event_id=event["event_id"],
+        event_type=event_type,
+        aggregate_type=aggregate_type,
+        aggregate_id=str(aggregate_id),
+        payload=event,
+        headers=inject_context()
+    ))
+    logger.debug(f"Enqueued event {event_type} for {aggregate_type} {aggregate_id}")
+    return event["event_id"]
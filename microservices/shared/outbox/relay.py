@@ -0,0 +1,142 @@
+# Outbox relay: publishes committed outbox rows to RabbitMQ
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+import logging
+
+try:
+    from events import EventPublisher
+except ImportError:
+    # Services that mount the shared folder as a package (e.g. CQRS)
+    from shared.events import EventPublisher
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxRelay:
+    """
+    Background thread publishing outbox rows in batches
+
+    Each batch claims the oldest unsent rows with FOR UPDATE SKIP LOCKED, so
+    several replicas can relay the same table without sending a row twice,
+    publishes them in id order with publisher confirms and marks them sent in
+    the same transaction. A failed publish stops the batch, so later events are
+    never sent ahead of an earlier one; the row is retried on the next batch.
+    Delivery is at least once (a crash between publish and commit sends the
+    batch again), so every handler must be idempotent: the event store rejects
+    a known event_id, the warehouse reserves and confirms at most once per
+    order, payment replays an order's charge result and the saga handlers
+    ignore events the saga is no longer waiting for.
+    """
+
+    def __init__(self,
+                 session_factory: Callable,
+                 model,
+                 publisher_factory: Optional[Callable] = None,
+                 batch_size: Optional[int] = None,
+                 interval: Optional[float] = None):
+        self.session_factory = session_factory
+        self.model = model
+        self.publisher_factory = publisher_factory or (lambda: EventPublisher(confirm_delivery=True))
+        self.batch_size = batch_size or int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+        self.interval = interval or float(os.getenv("OUTBOX_POLL_INTERVAL", "0.5"))
+        self.retention = timedelta(hours=float(os.getenv("OUTBOX_RETENTION_HOURS", "24")))
+        self._publisher = None
+        self._last_purge = 0.0
+        self._thread = None
+
+    def start(self):
+        """Start relaying in a daemon thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"{self.model.__tablename__}-relay", daemon=True)
+            self._thread.start()
+            logger.info(f"Outbox relay started for table {self.model.__tablename__}")
+
+    def _run(self):
+        while True:
+            sent = 0
+            try:
+                sent = self.relay_batch()
+                if time.monotonic() - self._last_purge > 600:
+                    self.purge_sent()
+                    self._last_purge = time.monotonic()
+            except Exception as e:
+                logger.error(f"Outbox relay batch failed: {e}")
+            # A full batch means there is a backlog: keep draining without waiting
+            if sent < self.batch_size:
+                time.sleep(self.interval)
+
+    def _get_publisher(self):
+        if self._publisher is None:
+            self._publisher = self.publisher_factory()
+        return self._publisher
+
+    def _reset_publisher(self):
+        try:
+            self._publisher.close()
+        except Exception:
+            pass
+        self._publisher = None
+
+    def relay_batch(self) -> int:
+        """Publish one batch of unsent rows, returns the number of rows sent"""
+        model = self.model
+        session = self.session_factory()
+        try:
+            rows = (
+                session.query(model)
+                .filter(model.sent_at.is_(None))
+                .order_by(model.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+                .all()
+            )
+            if not rows:
+                session.rollback()
+                return 0
+
+            sent = 0
+            try:
+                publisher = self._get_publisher()
+                for row in rows:
+                    publisher.publish_envelope(row.payload, row.headers)
+                    row.sent_at = datetime.utcnow()
+                    sent += 1
+            except Exception as e:
+                failed = rows[sent]
+                failed.attempts += 1
+                failed.last_error = str(e)[:500]
+                logger.error(f"Failed to relay outbox event {failed.event_id} (attempt {failed.attempts}): {e}")
+                self._reset_publisher()
+
+            session.commit()
+            logger.debug(f"Relayed {sent}/{len(rows)} outbox events")
+            return sent
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def purge_sent(self) -> int:
+        """Delete rows sent longer than OUTBOX_RETENTION_HOURS ago"""
+        model = self.model
+        session = self.session_factory()
+        try:
+            deleted = (
+                session.query(model)
+                .filter(model.sent_at < datetime.utcnow() - self.retention)
+                .delete(synchronize_session=False)
+            )
+            session.commit()
+            if deleted:
+                logger.info(f"Purged {deleted} sent outbox events")
+            return deleted
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
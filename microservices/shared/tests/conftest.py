@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Services put the shared folder itself on their path and import its packages by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Spans would otherwise be exported to traces.jsonl in the working directory
+os.environ.setdefault("TRACING_ENABLED", "false")
@@ -0,0 +1,73 @@
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from ids import SnowflakeGenerator
+from ids.snowflake import EPOCH_MS, MAX_NODE_ID, MAX_SEQUENCE
+
+
+def test_ids_in_the_same_millisecond_are_unique_and_increasing():
+    generator = SnowflakeGenerator(node_id=3)
+
+    with patch.object(SnowflakeGenerator, "_now_ms", return_value=EPOCH_MS + 1000):
+        ids = [generator.next_id() for _ in range(100)]
+
+    assert ids == sorted(set(ids))
+    assert [SnowflakeGenerator.parse(i)["sequence"] for i in ids] == list(range(100))
+
+
+def test_id_layout_round_trips():
+    generator = SnowflakeGenerator(node_id=MAX_NODE_ID)
+
+    with patch.object(SnowflakeGenerator, "_now_ms", return_value=EPOCH_MS + 123456):
+        parsed = SnowflakeGenerator.parse(generator.next_id())
+
+    assert parsed == {"timestamp_ms": EPOCH_MS + 123456, "node_id": MAX_NODE_ID, "sequence": 0}
+
+
+def test_exhausted_sequence_waits_for_the_next_millisecond():
+    generator = SnowflakeGenerator(node_id=1)
+    clock = iter([EPOCH_MS] * (MAX_SEQUENCE + 3) + [EPOCH_MS + 1])
+
+    with patch.object(SnowflakeGenerator, "_now_ms", side_effect=lambda: next(clock)):
+        ids = [generator.next_id() for _ in range(MAX_SEQUENCE + 2)]
+
+    assert len(set(ids)) == len(ids)
+    assert SnowflakeGenerator.parse(ids[-1]) == {"timestamp_ms": EPOCH_MS + 1, "node_id": 1, "sequence": 0}
+
+
+def test_clock_moving_backwards_never_reissues_an_id():
+    generator = SnowflakeGenerator(node_id=1)
+    clock = iter([EPOCH_MS + 10, EPOCH_MS + 5])
+
+    with patch.object(SnowflakeGenerator, "_now_ms", side_effect=lambda: next(clock)):
+        first, second = generator.next_id(), generator.next_id()
+
+    assert second > first
+
+
+def test_ids_are_unique_across_threads_and_fit_a_bigint():
+    generator = SnowflakeGenerator(node_id=7)
+    ids = []
+    lock = threading.Lock()
+
+    def worker():
+        batch = [generator.next_id() for _ in range(2000)]
+        with lock:
+            ids.extend(batch)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(ids)) == len(ids) == 16000
+    assert max(ids) < 2 ** 63
+
+
+@pytest.mark.parametrize("node_id", [-1, MAX_NODE_ID + 1])
+def test_node_id_must_fit_its_bits(node_id):
+    with pytest.raises(ValueError):
+        SnowflakeGenerator(node_id)
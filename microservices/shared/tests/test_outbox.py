@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+import pytest
+from sqlalchemy import BigInteger, create_engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from outbox import OutboxMixin, OutboxRelay, enqueue
+
+Base = declarative_base()
+
+
+# SQLite only autoincrements an INTEGER PRIMARY KEY
+@compiles(BigInteger, "sqlite")
+def compile_bigint_sqlite(type_, compiler, **kw):
+    return "INTEGER"
+
+
+class OutboxMessage(OutboxMixin, Base):
+    __tablename__ = "outbox"
+
+
+@pytest.fixture
+def session_factory():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+
+def enqueue_events(session_factory, count):
+    session = session_factory()
+    event_ids = [
+        enqueue(session, OutboxMessage, "OrderInitiated", "order", i, {"order_id": i}, service_name="test")
+        for i in range(count)
+    ]
+    session.commit()
+    session.close()
+    return event_ids
+
+
+def make_relay(session_factory, publisher):
+    return OutboxRelay(session_factory, OutboxMessage, publisher_factory=lambda: publisher, batch_size=10, interval=0.01)
+
+
+def test_enqueue_is_only_visible_once_the_caller_commits(session_factory):
+    session = session_factory()
+    event_id = enqueue(session, OutboxMessage, "OrderInitiated", "order", 42, {"order_id": 42}, service_name="test")
+    session.rollback()
+    session.close()
+
+    session = session_factory()
+    assert session.query(OutboxMessage).count() == 0
+    session.close()
+
+    [event_id] = enqueue_events(session_factory, 1)
+    session = session_factory()
+    row = session.query(OutboxMessage).one()
+    assert row.event_id == event_id
+    assert row.aggregate_id == "0"
+    assert row.payload["event_id"] == event_id
+    assert row.payload["data"] == {"order_id": 0}
+    assert row.sent_at is None
+    session.close()
+
+
+def test_relay_publishes_in_id_order_and_marks_rows_sent(session_factory):
+    event_ids = enqueue_events(session_factory, 3)
+    publisher = MagicMock()
+
+    assert make_relay(session_factory, publisher).relay_batch() == 3
+
+    published = [call.args[0]["event_id"] for call in publisher.publish_envelope.call_args_list]
+    assert published == event_ids
+    session = session_factory()
+    assert session.query(OutboxMessage).filter(OutboxMessage.sent_at.is_(None)).count() == 0
+    session.close()
+    assert make_relay(session_factory, publisher).relay_batch() == 0
+
+
+def test_relay_stops_the_batch_at_the_first_failure(session_factory):
+    event_ids = enqueue_events(session_factory, 3)
+    publisher = MagicMock()
+    publisher.publish_envelope.side_effect = [None, ConnectionError("broker down")]
+    relay = make_relay(session_factory, publisher)
+
+    assert relay.relay_batch() == 1
+
+    # Later events stay behind the failed one so the relay never reorders them
+    assert publisher.publish_envelope.call_count == 2
+    publisher.close.assert_called_once()
+    session = session_factory()
+    rows = {row.event_id: row for row in session.query(OutboxMessage)}
+    assert rows[event_ids[0]].sent_at is not None
+    assert rows[event_ids[1]].sent_at is None
+    assert rows[event_ids[1]].attempts == 1
+    assert rows[event_ids[1]].last_error == "broker down"
+    assert rows[event_ids[2]].sent_at is None
+    assert rows[event_ids[2]].attempts == 0
+    session.close()
+
+    publisher.publish_envelope.side_effect = None
+    assert relay.relay_batch() == 2
+
+
+def test_purge_only_deletes_rows_sent_before_the_retention(session_factory):
+    enqueue_events(session_factory, 3)
+    session = session_factory()
+    old, recent, unsent = session.query(OutboxMessage).order_by(OutboxMessage.id).all()
+    old.sent_at = datetime.utcnow() - timedelta(days=2)
+    recent.sent_at = datetime.utcnow()
+    session.commit()
+    session.close()
+
+    assert make_relay(session_factory, MagicMock()).purge_sent() == 1
+
+    session = session_factory()
+    assert session.query(OutboxMessage).count() == 2
+    session.close()
@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from tracing import Tracer, SpanContext, FileSpanExporter, inject_context, extract_context, get_current_span
+
+
+def test_traceparent_round_trip():
+    context = SpanContext("a" * 32, "b" * 16)
+    parsed = SpanContext.from_traceparent(context.to_traceparent())
+
+    assert (parsed.trace_id, parsed.span_id, parsed.sampled) == ("a" * 32, "b" * 16, True)
+
+
+@pytest.mark.parametrize("value", ["", "garbage", "00-abc-def-01", f"00-{'z' * 32}-{'b' * 16}-01"])
+def test_malformed_traceparent_is_ignored(value):
+    assert SpanContext.from_traceparent(value) is None
+
+
+def test_nested_spans_share_the_trace_and_link_to_their_parent():
+    tracer = Tracer("saga-orchestrator")
+
+    with tracer.start_span("saga.order") as parent:
+        with tracer.start_span("saga.verify_stock") as child:
+            assert get_current_span() is child
+
+    assert child.context.trace_id == parent.context.trace_id
+    assert child.parent_span_id == parent.context.span_id
+    assert parent.parent_span_id is None
+    assert get_current_span() is None
+
+
+def test_context_is_propagated_through_headers():
+    tracer = Tracer("saga-orchestrator")
+
+    with tracer.start_span("POST ecommerce.add_item", kind="client") as client:
+        headers = inject_context({"Content-Type": "application/json"})
+
+    # The downstream service continues the caller's trace from the received headers
+    with Tracer("ecommerce").start_span("POST /api/v1/cart/add-item", kind="server",
+                                        parent=extract_context(headers)) as server:
+        pass
+
+    assert server.context.trace_id == client.context.trace_id
+    assert server.parent_span_id == client.context.span_id
+    assert inject_context() == {}
+
+
+def test_amqp_headers_may_carry_bytes():
+    context = SpanContext("c" * 32, "d" * 16)
+    extracted = extract_context({"Traceparent": context.to_traceparent().encode()})
+
+    assert extracted.span_id == "d" * 16
+
+
+def test_failed_span_is_exported_with_its_error(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    tracer = Tracer("warehouse", FileSpanExporter(str(path)))
+
+    with pytest.raises(RuntimeError):
+        with tracer.start_span("db.commit reserve", attributes={"db.system": "postgresql"}):
+            raise RuntimeError("deadlock detected")
+
+    exported = json.loads(path.read_text())
+    assert exported["status"] == "ERROR"
+    assert exported["error_message"] == "RuntimeError: deadlock detected"
+    assert exported["attributes"] == {"db.system": "postgresql"}
+    assert exported["end_time_unix_nano"] >= exported["start_time_unix_nano"]
@@ -0,0 +1,25 @@
+# Shared Tracing Package
+
+from .tracer import (
+    Tracer,
+    Span,
+    SpanContext,
+    FileSpanExporter,
+    get_tracer,
+    get_current_span,
+    inject_context,
+    extract_context,
+    TRACEPARENT_HEADER
+)
+
+__all__ = [
+    'Tracer',
+    'Span',
+    'SpanContext',
+    'FileSpanExporter',
+    'get_tracer',
+    'get_current_span',
+    'inject_context',
+    'extract_context',
+    'TRACEPARENT_HEADER'
+]
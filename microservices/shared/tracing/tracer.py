@@ -0,0 +1,203 @@
+# Lightweight tracer producing OpenTelemetry-compatible spans
+
+import contextvars
+import json
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+# W3C Trace Context header, understood by OpenTelemetry and Jaeger
+TRACEPARENT_HEADER = "traceparent"
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class SpanContext:
+    """Identifies a span inside a trace (W3C trace context)"""
+
+    def __init__(self, trace_id: str, span_id: str, sampled: bool = True):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+
+    def to_traceparent(self) -> str:
+        flags = "01" if self.sampled else "00"
+        return f"00-{self.trace_id}-{self.span_id}-{flags}"
+
+    @classmethod
+    def from_traceparent(cls, value: str) -> Optional["SpanContext"]:
+        """Parse a traceparent header, returning None if it is malformed"""
+        try:
+            version, trace_id, span_id, flags = value.strip().split("-")
+            if len(trace_id) != 32 or len(span_id) != 16:
+                return None
+            int(trace_id, 16)
+            int(span_id, 16)
+            return cls(trace_id, span_id, sampled=int(flags, 16) & 0x01 == 0x01)
+        except (AttributeError, ValueError):
+            return None
+
+
+class Span:
+    """A timed operation, exported once it ends"""
+
+    def __init__(self, name: str, service_name: str, context: SpanContext,
+                 parent_span_id: Optional[str] = None, kind: str = "internal",
+                 attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.service_name = service_name
+        self.context = context
+        self.parent_span_id = parent_span_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.status = "OK"
+        self.error_message = None
+        self.start_time_ns = time.time_ns()
+        self.end_time_ns = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def record_exception(self, error: Exception):
+        self.status = "ERROR"
+        self.error_message = f"{type(error).__name__}: {error}"
+
+    def end(self):
+        if self.end_time_ns is None:
+            self.end_time_ns = time.time_ns()
+
+    @property
+    def duration_seconds(self) -> float:
+        end = self.end_time_ns or time.time_ns()
+        return (end - self.start_time_ns) / 1e9
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.context.trace_id,
+            "span_id": self.context.span_id,
+            "parent_span_id": self.parent_span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "service": self.service_name,
+            "start_time_unix_nano": self.start_time_ns,
+            "end_time_unix_nano": self.end_time_ns,
+            "duration_ms": round(self.duration_seconds * 1000, 3),
+            "status": self.status,
+            "error_message": self.error_message,
+            "attributes": self.attributes
+        }
+
+
+class FileSpanExporter:
+    """Appends finished spans as JSON lines, one span per line"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        try:
+            line = json.dumps(span.to_dict(), default=str)
+            with self._lock:
+                with open(self.path, "a") as trace_file:
+                    trace_file.write(line + "\n")
+        except Exception as e:
+            # Tracing must never break the traced operation
+            logger.error(f"Failed to export span {span.name}: {e}")
+
+
+class Tracer:
+    def __init__(self, service_name: str, exporter: Optional[FileSpanExporter] = None):
+        self.service_name = service_name
+        self.exporter = exporter
+
+    @contextmanager
+    def start_span(self, name: str, kind: str = "internal",
+                   attributes: Optional[Dict[str, Any]] = None,
+                   parent: Optional[SpanContext] = None):
+        """
+        Start a span as a child of `parent`, or of the current span if no parent is given
+
+        Args:
+            name: Operation name (e.g. saga.verify_stock, POST /api/v1/cart/add-item)
+            kind: internal, server, client, producer or consumer
+            attributes: Initial span attributes
+            parent: Remote parent extracted from headers or message properties
+        """
+        if parent is None:
+            current = _current_span.get()
+            parent = current.context if current else None
+
+        trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        context = SpanContext(trace_id, secrets.token_hex(8))
+        span = Span(
+            name=name,
+            service_name=self.service_name,
+            context=context,
+            parent_span_id=parent.span_id if parent else None,
+            kind=kind,
+            attributes=attributes
+        )
+
+        token = _current_span.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.record_exception(e)
+            raise
+        finally:
+            span.end()
+            _current_span.reset(token)
+            if self.exporter:
+                self.exporter.export(span)
+
+
+_tracers: Dict[str, Tracer] = {}
+_tracers_lock = threading.Lock()
+
+
+def get_tracer(service_name: str) -> Tracer:
+    """
+    Get the process-wide tracer for a service
+
+    Spans are written to TRACE_EXPORT_FILE (default: traces.jsonl in the working
+    directory) unless TRACING_ENABLED is set to false.
+    """
+    with _tracers_lock:
+        if service_name not in _tracers:
+            exporter = None
+            if os.getenv("TRACING_ENABLED", "true").lower() != "false":
+                exporter = FileSpanExporter(os.getenv("TRACE_EXPORT_FILE", "traces.jsonl"))
+            _tracers[service_name] = Tracer(service_name, exporter)
+        return _tracers[service_name]
+
+
+def get_current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def inject_context(carrier: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Add the current trace context to HTTP headers or AMQP message headers"""
+    carrier = {} if carrier is None else carrier
+    span = _current_span.get()
+    if span:
+        carrier[TRACEPARENT_HEADER] = span.context.to_traceparent()
+    return carrier
+
+
+def extract_context(carrier: Optional[Dict[str, Any]]) -> Optional[SpanContext]:
+    """Read a remote trace context from HTTP headers or AMQP message headers"""
+    if not carrier:
+        return None
+    for key, value in carrier.items():
+        if key.lower() == TRACEPARENT_HEADER:
+            if isinstance(value, bytes):
+                value = value.decode()
+            return SpanContext.from_traceparent(value)
+    return None
@@ -1,55 +1,54 @@
-from fastapi import FastAPI, HTTPException, Depends
-from service import StoreService, StockService, ProductDepotService
+from fastapi import FastAPI, HTTPException, Depends, Request, Query, Response
+import sys
+
+# Add shared directory to path
+sys.path.append('/app/../shared')
+
+from service import StoreService, StockService, ProductDepotService, ReservationService, ReservationNotFound, WarehouseService, add_low_stock_listener
+from product_catalog import get_product_catalog
 from models.store_model import Store
 from models.stock_model import Stock
 from models.product_depot_model import Product_Depot
+from models.outbox_model import OutboxMessage
 from pydantic import BaseModel
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session
+from fastapi.responses import PlainTextResponse
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from database import SessionLocal, get_db, session_scope
 from typing import List, Optional
-import sys
+from datetime import datetime
+import hashlib
+import json
+import os
 import threading
 import time
 
 import requests 
 import logging
 
-# Add shared directory to path
-sys.path.append('/app/../shared')
 from events import (
-    EventPublisher, 
     EventSubscriber,
     InventoryEvents, 
+    ProductEvents,
     AggregateTypes,
     Exchanges,
     RoutingKeys,
     create_stock_reserved_data
 )
+from tracing import get_tracer, extract_context
+from outbox import OutboxRelay, enqueue
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Warehouse Management Service")
-engine = create_engine("postgresql+psycopg2://admin:admin@db_warehouse:5432/postgres")
-Session = sessionmaker(bind=engine)
+tracer = get_tracer("warehouse")
 
 # Event infrastructure
-event_publisher = None
+# Events are written to the outbox table and published by the outbox relay
 event_subscriber = None
 
-def get_event_publisher():
-    """Get or create event publisher instance"""
-    global event_publisher
-    if event_publisher is None:
-        try:
-            event_publisher = EventPublisher()
-            logger.info("Warehouse event publisher initialized")
-        except Exception as e:
-            logger.error(f"Failed to initialize event publisher: {e}")
-            event_publisher = None
-    return event_publisher
-
 class StoreSerializer(BaseModel):
     id: int
     name: str
@@ -62,6 +61,9 @@ class StockSerializer(BaseModel):
     product: int
     store: int
     quantite: int
+    reserved: int = 0
+    shards: int = 0
+    shard_available: int = 0
 
 class StockCreateSerializer(BaseModel):
     product: int
@@ -71,6 +73,9 @@ class StockCreateSerializer(BaseModel):
 class StockUpdateSerializer(BaseModel):
     quantite: int
 
+class StockShardSerializer(BaseModel):
+    shards: int
+
 class ProductDepotSerializer(BaseModel):
     id: int
     product: int
@@ -85,133 +90,140 @@ class TransferRequestSerializer(BaseModel):
     store: int
     quantity: int
 
+class BatchTransferRequestSerializer(BaseModel):
+    transfers: List[TransferRequestSerializer]
+
+class StockLineSerializer(BaseModel):
+    product: int
+    quantity: int
+
+class BatchReduceRequestSerializer(BaseModel):
+    store: int
+    items: List[StockLineSerializer]
+    saga_id: Optional[int] = None
+
+class ReservationRequestSerializer(BaseModel):
+    order_id: int
+    store: int
+    items: List[StockLineSerializer]
+    ttl_seconds: Optional[int] = None
+
+class ReservationSerializer(BaseModel):
+    reservation_id: str
+    order_id: int
+    product: int
+    store: int
+    quantity: int
+    status: str
+    expires_at: datetime
+    shard_id: Optional[int] = None
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Open a server span for each request, continuing the caller's trace if one was propagated"""
+    with tracer.start_span(
+        f"{request.method} {request.url.path}",
+        kind="server",
+        attributes={'http.method': request.method, 'http.target': request.url.path},
+        parent=extract_context(request.headers)
+    ) as span:
+        response = await call_next(request)
+        span.set_attribute('http.status_code', response.status_code)
+        return response
+
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the Warehouse"}
 
+@app.get("/metrics")
+def get_metrics():
+    """
+    Prometheus metrics endpoint (includes the database pool state)
+    """
+    return PlainTextResponse(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 # Store Endpoints
 @app.get("/api/v1/stores", response_model=List[StoreSerializer])
-def get_all_stores():
-    session = Session()
-    try:
-        store_service = StoreService(session)
-        stores = store_service.get_all_stores() or []
-        return stores
-    finally:
-        session.close()
+def get_all_stores(session: Session = Depends(get_db)):
+    store_service = StoreService(session)
+    stores = store_service.get_all_stores() or []
+    return stores
 
 @app.get("/api/v1/stores/{store}", response_model=StoreSerializer)
-def get_store_by_id(store: int):
-    session = Session()
-    try:
-        store_service = StoreService(session)
-        store = store_service.get_store_by_id(store)
-        if not store:
-            raise HTTPException(status_code=404, detail="Store not found")
-        return store
-    finally:
-        session.close()
+def get_store_by_id(store: int, session: Session = Depends(get_db)):
+    store_service = StoreService(session)
+    store = store_service.get_store_by_id(store)
+    if not store:
+        raise HTTPException(status_code=404, detail="Store not found")
+    return store
 
 @app.post("/api/v1/stores", response_model=StoreSerializer)
-def create_store(store_data: StoreCreateSerializer):
-    session = Session()
-    try:
-        store_service = StoreService(session)
-        store_dict = store_data.dict()
-        store = store_service.add_store(Store(**store_dict))
-        return store
-    finally:
-        session.close()
+def create_store(store_data: StoreCreateSerializer, session: Session = Depends(get_db)):
+    store_service = StoreService(session)
+    store_dict = store_data.dict()
+    store = store_service.add_store(Store(**store_dict))
+    return store
 
 @app.put("/api/v1/stores/{store}", response_model=StoreSerializer)
-def update_store(store: int, store_data: StoreCreateSerializer):
-    session = Session()
-    try:
-        store_service = StoreService(session)
-        existing_store = store_service.get_store_by_id(store)
-        if not existing_store:
-            raise HTTPException(status_code=404, detail="Store not found")
-        
-        # Update fields
-        update_data = store_data.dict(exclude_unset=True)
-        for field, value in update_data.items():
-            setattr(existing_store, field, value)
-        
-        updated_store = store_service.update_store(existing_store)
-        return updated_store
-    finally:
-        session.close()
+def update_store(store: int, store_data: StoreCreateSerializer, session: Session = Depends(get_db)):
+    store_service = StoreService(session)
+    existing_store = store_service.get_store_by_id(store)
+    if not existing_store:
+        raise HTTPException(status_code=404, detail="Store not found")
+    
+    # Update fields
+    update_data = store_data.dict(exclude_unset=True)
+    for field, value in update_data.items():
+        setattr(existing_store, field, value)
+    
+    updated_store = store_service.update_store(existing_store)
+    return updated_store
 
 @app.delete("/api/v1/stores/{store}")
-def delete_store(store: int):
-    session = Session()
-    try:
-        store_service = StoreService(session)
-        deleted_store = store_service.delete_store(store)
-        if not deleted_store:
-            raise HTTPException(status_code=404, detail="Store not found")
-        return {"detail": "Store deleted successfully"}
-    finally:
-        session.close()
+def delete_store(store: int, session: Session = Depends(get_db)):
+    store_service = StoreService(session)
+    deleted_store = store_service.delete_store(store)
+    if not deleted_store:
+        raise HTTPException(status_code=404, detail="Store not found")
+    return {"detail": "Store deleted successfully"}
 
 # Stock Endpoints
 @app.get("/api/v1/stocks", response_model=List[StockSerializer])
-def get_all_stocks():
-    session = Session()
-    try:
-        stock_service = StockService(session)
-        stocks = stock_service.get_all_stocks() or []
-        return stocks
-    finally:
-        session.close()
+def get_all_stocks(session: Session = Depends(get_db)):
+    stock_service = StockService(session)
+    stocks = stock_service.get_all_stocks() or []
+    return stocks
 
 @app.get("/api/v1/stocks/{stock_id}", response_model=StockSerializer)
-def get_stock_by_id(stock_id: int):
-    session = Session()
-    try:
-        stock_service = StockService(session)
-        stock = stock_service.get_stock_by_id(stock_id)
-        if not stock:
-            raise HTTPException(status_code=404, detail="Stock not found")
-        return stock
-    finally:
-        session.close()
+def get_stock_by_id(stock_id: int, session: Session = Depends(get_db)):
+    stock_service = StockService(session)
+    stock = stock_service.get_stock_by_id(stock_id)
+    if not stock:
+        raise HTTPException(status_code=404, detail="Stock not found")
+    return stock
 
 @app.get("/api/v1/stocks/product/{product}/store/{store}", response_model=StockSerializer)
-def get_stock_by_product_and_store(product: int, store: int):
-    session = Session()
-    try:
-        stock_service = StockService(session)
-        stock = stock_service.get_stock_by_product_and_store(product, store)
-        if not stock:
-            raise HTTPException(status_code=404, detail="Stock not found")
-        return stock
-    finally:
-        session.close()
+def get_stock_by_product_and_store(product: int, store: int, session: Session = Depends(get_db)):
+    stock_service = StockService(session)
+    stock = stock_service.get_stock_by_product_and_store(product, store)
+    if not stock:
+        raise HTTPException(status_code=404, detail="Stock not found")
+    return stock
 
 @app.get("/api/v1/stocks/store/{store}", response_model=List[StockSerializer])
-def get_stocks_by_store(store: int):
-    session = Session()
-    try:
-        stock_service = StockService(session)
-        stocks = stock_service.get_stocks_by_store(store) or []
-        return stocks
-    finally:
-        session.close()
+def get_stocks_by_store(store: int, session: Session = Depends(get_db)):
+    stock_service = StockService(session)
+    stocks = stock_service.get_stocks_by_store(store) or []
+    return stocks
 
 @app.get("/api/v1/stocks/product/{product}", response_model=List[StockSerializer])
-def get_stocks_by_product(product: int):
-    session = Session()
-    try:
-        stock_service = StockService(session)
-        stocks = stock_service.get_stocks_by_product(product) or []
-        return stocks
-    finally:
-        session.close()
+def get_stocks_by_product(product: int, session: Session = Depends(get_db)):
+    stock_service = StockService(session)
+    stocks = stock_service.get_stocks_by_product(product) or []
+    return stocks
 
 @app.post("/api/v1/stocks", response_model=StockSerializer)
-def create_stock(stock_data: StockCreateSerializer):
-    session = Session()
+def create_stock(stock_data: StockCreateSerializer, session: Session = Depends(get_db)):
     try:
         stock_service = StockService(session)
         stock_dict = stock_data.dict()
@@ -219,24 +231,27 @@ def create_stock(stock_data: StockCreateSerializer):
         return stock
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        session.close()
 
 @app.put("/api/v1/stocks/product/{product}/store/{store}", response_model=StockSerializer)
-def update_stock_quantity(product: int, store: int, stock_data: StockUpdateSerializer):
-    session = Session()
+def update_stock_quantity(product: int, store: int, stock_data: StockUpdateSerializer, session: Session = Depends(get_db)):
     try:
         stock_service = StockService(session)
         updated_stock = stock_service.update_stock_quantity(product, store, stock_data.quantite)
         return updated_stock
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        session.close()
+
+@app.put("/api/v1/stocks/product/{product}/store/{store}/shards", response_model=StockSerializer)
+def shard_stock(product: int, store: int, shard_data: StockShardSerializer, session: Session = Depends(get_db)):
+    """Spread the stock of a flash sale product over several rows so concurrent reservations do not queue on one lock"""
+    try:
+        stock_service = StockService(session)
+        return stock_service.shard_stock(product, store, shard_data.shards)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/api/v1/stocks/reduce")
-def reduce_stock(product: int, store: int, quantity: int, saga_id: Optional[int] = None):
-    session = Session()
+def reduce_stock(product: int, store: int, quantity: int, saga_id: Optional[int] = None, session: Session = Depends(get_db)):
     try:
         stock_service = StockService(session)
         reduced_stock = stock_service.reduce_stock(product, store, quantity)
@@ -255,12 +270,75 @@ def reduce_stock(product: int, store: int, quantity: int, saga_id: Optional[int]
         }
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        session.close()
+
+@app.post("/api/v1/stocks/reduce-batch")
+def reduce_stock_batch(batch_data: BatchReduceRequestSerializer, session: Session = Depends(get_db)):
+    """Reduce the stock of every line of an order at once: either all lines are reduced or none is"""
+    try:
+        stock_service = StockService(session)
+        new_quantities = stock_service.reduce_stock_batch(
+            batch_data.store,
+            [{"product_id": item.product, "quantity": item.quantity} for item in batch_data.items]
+        )
+        
+        if batch_data.saga_id:
+            publish_event(event_type="stock_reserved", saga_id=batch_data.saga_id, data={
+                "store_id": batch_data.store,
+                "items": [item.model_dump() for item in batch_data.items],
+                "new_quantities": new_quantities
+            }, success=True)
+        
+        return {
+            "message": "Stock reduced successfully",
+            "new_quantities": new_quantities
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/api/v1/reservations", response_model=List[ReservationSerializer])
+def reserve_stock(reservation_data: ReservationRequestSerializer, session: Session = Depends(get_db)):
+    """Hold stock for every line of an order until it is confirmed, released or expires"""
+    try:
+        reservation_service = ReservationService(session)
+        reservations = reservation_service.reserve_stock(
+            reservation_data.order_id,
+            reservation_data.store,
+            [{"product_id": item.product, "quantity": item.quantity} for item in reservation_data.items],
+            reservation_data.ttl_seconds
+        )
+        # Serialize while the session is still open, the lines were expired by the commit
+        return [ReservationSerializer.model_validate(reservation, from_attributes=True) for reservation in reservations]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/v1/reservations/order/{order_id}", response_model=List[ReservationSerializer])
+def get_reservations_by_order(order_id: int, session: Session = Depends(get_db)):
+    reservation_service = ReservationService(session)
+    reservations = reservation_service.get_reservations_by_order(order_id)
+    if not reservations:
+        raise HTTPException(status_code=404, detail="No reservation found for order")
+    return [ReservationSerializer.model_validate(reservation, from_attributes=True) for reservation in reservations]
+
+@app.post("/api/v1/reservations/order/{order_id}/confirm")
+def confirm_reservation(order_id: int, session: Session = Depends(get_db)):
+    try:
+        reservation_service = ReservationService(session)
+        confirmed = reservation_service.confirm_reservation(order_id)
+        return {"message": "Reservation confirmed successfully", "confirmed_lines": confirmed}
+    except ReservationNotFound as e:
+        # Not reserved yet: the caller may retry once OrderInitiated has been handled
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/api/v1/reservations/order/{order_id}/release")
+def release_reservation(order_id: int, session: Session = Depends(get_db)):
+    reservation_service = ReservationService(session)
+    released = reservation_service.release_reservation(order_id)
+    return {"message": "Reservation released successfully", "released_lines": released}
 
 @app.post("/api/v1/stocks/increase")
-def increase_stock(product: int, store: int, quantity: int):
-    session = Session()
+def increase_stock(product: int, store: int, quantity: int, session: Session = Depends(get_db)):
     try:
         stock_service = StockService(session)
         increased_stock = stock_service.increase_stock(product, store, quantity)
@@ -270,59 +348,40 @@ def increase_stock(product: int, store: int, quantity: int):
         }
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        session.close()
 
 @app.delete("/api/v1/stocks/{stock_id}")
-def delete_stock(stock_id: int):
-    session = Session()
-    try:
-        stock_service = StockService(session)
-        deleted_stock = stock_service.delete_stock(stock_id)
-        if not deleted_stock:
-            raise HTTPException(status_code=404, detail="Stock not found")
-        return {"detail": "Stock deleted successfully"}
-    finally:
-        session.close()
+def delete_stock(stock_id: int, session: Session = Depends(get_db)):
+    stock_service = StockService(session)
+    deleted_stock = stock_service.delete_stock(stock_id)
+    if not deleted_stock:
+        raise HTTPException(status_code=404, detail="Stock not found")
+    return {"detail": "Stock deleted successfully"}
 
 # Product Depot Endpoints
 @app.get("/api/v1/depot", response_model=List[ProductDepotSerializer])
-def get_all_depot_stocks():
-    session = Session()
-    try:
-        depot_service = ProductDepotService(session)
-        depots = depot_service.get_all_depot_stocks() or []
-        return depots
-    finally:
-        session.close()
+def get_all_depot_stocks(session: Session = Depends(get_db)):
+    depot_service = ProductDepotService(session)
+    depots = depot_service.get_all_depot_stocks() or []
+    return depots
 
 @app.get("/api/v1/depot/{depot_id}", response_model=ProductDepotSerializer)
-def get_depot_by_id(depot_id: int):
-    session = Session()
-    try:
-        depot_service = ProductDepotService(session)
-        depot = depot_service.get_depot_by_id(depot_id)
-        if not depot:
-            raise HTTPException(status_code=404, detail="Depot stock not found")
-        return depot
-    finally:
-        session.close()
+def get_depot_by_id(depot_id: int, session: Session = Depends(get_db)):
+    depot_service = ProductDepotService(session)
+    depot = depot_service.get_depot_by_id(depot_id)
+    if not depot:
+        raise HTTPException(status_code=404, detail="Depot stock not found")
+    return depot
 
 @app.get("/api/v1/depot/product/{product}", response_model=ProductDepotSerializer)
-def get_depot_by_product(product: int):
-    session = Session()
-    try:
-        depot_service = ProductDepotService(session)
-        depot = depot_service.get_depot_by_product_id(product)
-        if not depot:
-            raise HTTPException(status_code=404, detail="Depot stock not found for this product")
-        return depot
-    finally:
-        session.close()
+def get_depot_by_product(product: int, session: Session = Depends(get_db)):
+    depot_service = ProductDepotService(session)
+    depot = depot_service.get_depot_by_product_id(product)
+    if not depot:
+        raise HTTPException(status_code=404, detail="Depot stock not found for this product")
+    return depot
 
 @app.post("/api/v1/depot", response_model=ProductDepotSerializer)
-def create_depot_stock(depot_data: ProductDepotCreateSerializer):
-    session = Session()
+def create_depot_stock(depot_data: ProductDepotCreateSerializer, session: Session = Depends(get_db)):
     try:
         depot_service = ProductDepotService(session)
         depot_dict = depot_data.dict()
@@ -330,13 +389,10 @@ def create_depot_stock(depot_data: ProductDepotCreateSerializer):
         return depot
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        session.close()
 
 @app.post("/api/v1/depot/transfer", response_model=dict)
-def transfer_from_depot_to_store(transfer_data: TransferRequestSerializer):
+def transfer_from_depot_to_store(transfer_data: TransferRequestSerializer, session: Session = Depends(get_db)):
     """Transfer stock from depot to store"""
-    session = Session()
     try:
         depot_service = ProductDepotService(session)
         result = depot_service.transfer_to_store(
@@ -347,8 +403,23 @@ def transfer_from_depot_to_store(transfer_data: TransferRequestSerializer):
         return result
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        session.close()
+
+@app.post("/api/v1/depot/transfer-batch")
+def transfer_batch_from_depot_to_stores(transfer_data: BatchTransferRequestSerializer, session: Session = Depends(get_db)):
+    """Replenish many products and stores from the depot at once, in a single transaction"""
+    try:
+        depot_service = ProductDepotService(session)
+        transfers = depot_service.transfer_to_stores([
+            {'product_id': transfer.product, 'store_id': transfer.store, 'quantity': transfer.quantity}
+            for transfer in transfer_data.transfers
+        ])
+        return {
+            "message": "Stock transferred successfully",
+            "transfers": transfers,
+            "count": len(transfers)
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 def publish_event(event_type: str, saga_id: int, data: dict, success: bool = True):
     """Publish event to saga orchestrator"""
@@ -372,35 +443,47 @@ def publish_event(event_type: str, saga_id: int, data: dict, success: bool = Tru
         logging.error(f"Error publishing event: {e}")
 
 # # Warehouse Complex Operations
-# @app.get("/api/v1/inventory/product/{product}")
-# def get_complete_inventory_info(product: int, store: Optional[int] = None):
-#     """Get comprehensive inventory information for a product"""
-#     session = Session()
-#     try:
-#         warehouse_service = WarehouseService(session)
-#         inventory_info = warehouse_service.get_complete_inventory_info(product, store)
-#         if not inventory_info:
-#             raise HTTPException(status_code=404, detail="Inventory information not found")
-#         return inventory_info
-#     except ValueError as e:
-#         raise HTTPException(status_code=400, detail=str(e))
-#     finally:
-#         session.close()
+@app.get("/api/v1/inventory")
+def get_inventory(
+    request: Request,
+    product: Optional[List[int]] = Query(None),
+    store: Optional[List[int]] = Query(None),
+    session: Session = Depends(get_db)
+):
+    """Product x store x depot inventory matrix, optionally filtered (e.g. ?store=1&store=2&product=3)"""
+    warehouse_service = WarehouseService(session)
+    inventory = {"inventory": warehouse_service.get_inventory_matrix(product, store)}
+    
+    # Clients revalidate with If-None-Match and get a bodyless 304 while the snapshot is unchanged
+    body = json.dumps(inventory, sort_keys=True)
+    etag = f'"{hashlib.sha1(body.encode()).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.get("/api/v1/inventory/product/{product}")
+def get_complete_inventory_info(product: int, store: Optional[int] = None, session: Session = Depends(get_db)):
+    """Get comprehensive inventory information for a product"""
+    try:
+        warehouse_service = WarehouseService(session)
+        inventory_info = warehouse_service.get_complete_inventory_info(product, store)
+        if not inventory_info:
+            raise HTTPException(status_code=404, detail="Inventory information not found")
+        return inventory_info
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-# @app.get("/api/v1/alerts/low-stock")
-# def get_low_stock_alerts(minimum_threshold: int = 5):
-#     """Get products with low stock across all stores"""
-#     session = Session()
-#     try:
-#         warehouse_service = WarehouseService(session)
-#         low_stock_items = warehouse_service.get_low_stock_alerts(minimum_threshold)
-#         return {
-#             "threshold": minimum_threshold,
-#             "low_stock_items": low_stock_items,
-#             "count": len(low_stock_items)
-#         }
-#     finally:
-#         session.close()
+@app.get("/api/v1/alerts/low-stock")
+def get_low_stock_alerts(minimum_threshold: int = 5, store: Optional[int] = None, session: Session = Depends(get_db)):
+    """Get products with low stock across all stores"""
+    warehouse_service = WarehouseService(session)
+    low_stock_items = warehouse_service.get_low_stock_alerts(minimum_threshold, store)
+    return {
+        "threshold": minimum_threshold,
+        "low_stock_items": low_stock_items,
+        "count": len(low_stock_items)
+    }
 
 # @app.post("/api/v1/restock")
 # def restock_store_from_depot(transfer_data: TransferRequestSerializer):
@@ -430,100 +513,143 @@ def handle_order_initiated(event_data: dict):
         
         logger.info(f"Processing OrderInitiated for order {order_id}")
         
-        session = Session()
-        stock_service = StockService(session)
-        publisher = get_event_publisher()
-        
-        if not publisher:
-            logger.error("Event publisher not available")
-            return
-        
-        try:
-            # Check stock availability for all items
-            all_items_available = True
-            stock_items = []
+        with session_scope() as session:
+            stock_service = StockService(session)
+            reservation_service = ReservationService(session)
             
-            for item in items:
-                product_id = item.get("product_id")
-                quantity = item.get("quantity")
-                
-                if not product_id or not quantity:
-                    continue
-                
-                # Check if we have stock (simplified - assuming store_id = 1)
-                stock = stock_service.get_stock_by_product_store(product_id, 1)
-                
-                if stock and stock.quantite >= quantity:
-                    stock_items.append({
-                        "product_id": product_id,
-                        "requested_quantity": quantity,
-                        "available_quantity": stock.quantite,
-                        "status": "AVAILABLE"
-                    })
-                else:
-                    all_items_available = False
-                    stock_items.append({
-                        "product_id": product_id,
-                        "requested_quantity": quantity,
-                        "available_quantity": stock.quantite if stock else 0,
-                        "status": "UNAVAILABLE"
-                    })
+            # Hold stock for all items in one transaction until payment (simplified - assuming store_id = 1)
+            order_items = [
+                {"product_id": item.get("product_id"), "quantity": item.get("quantity")}
+                for item in items
+                if item.get("product_id") and item.get("quantity")
+            ]
             
-            if all_items_available:
-                # Reserve stock for all items
-                reservation_id = f"res_{order_id}_{int(time.time())}"
-                
-                for item in items:
-                    product_id = item.get("product_id")
-                    quantity = item.get("quantity")
-                    
-                    if product_id and quantity:
-                        # Reduce stock (simplified reservation)
-                        stock_service.reduce_stock(product_id, 1, quantity)
-                
-                # Publish StockReserved event
-                stock_data = create_stock_reserved_data(
-                    order_id=order_id,
-                    store_id=1,
-                    items=stock_items,
-                    reservation_id=reservation_id
-                )
-                
-                publisher.publish_event(
+            def enqueue_stock_reserved(reservations, available):
+                # StockReserved is committed with the reservation itself: both happen or neither does
+                stock_items = [{
+                    "product_id": item["product_id"],
+                    "requested_quantity": item["quantity"],
+                    "available_quantity": available.get(item["product_id"], 0),
+                    "status": "AVAILABLE"
+                } for item in order_items]
+                enqueue(
+                    session, OutboxMessage,
                     event_type=InventoryEvents.STOCK_RESERVED,
                     aggregate_type=AggregateTypes.INVENTORY,
                     aggregate_id=f"order_{order_id}",
-                    data=stock_data,
+                    data=create_stock_reserved_data(
+                        order_id=order_id,
+                        store_id=1,
+                        items=stock_items,
+                        reservation_id=reservations[0].reservation_id,
+                        total_amount=order_data.get("total_amount")
+                    ),
                     correlation_id=correlation_id,
                     service_name="warehouse"
                 )
-                
+            
+            try:
+                reservations = reservation_service.reserve_stock(order_id, 1, order_items, before_commit=enqueue_stock_reserved)
+                if not reservations:
+                    logger.info(f"Order {order_id} was cancelled before its stock was reserved, nothing held")
+                    return
                 logger.info(f"Stock reserved for order {order_id}")
-                
-            else:
-                # Publish StockUnavailable event
-                publisher.publish_event(
-                    event_type=InventoryEvents.STOCK_UNAVAILABLE,
-                    aggregate_type=AggregateTypes.INVENTORY,
-                    aggregate_id=f"order_{order_id}",
-                    data={
-                        "order_id": order_id,
-                        "status": "UNAVAILABLE",
-                        "items": stock_items,
-                        "reason": "insufficient_stock"
-                    },
-                    correlation_id=correlation_id,
-                    service_name="warehouse"
-                )
-                
-                logger.info(f"Stock unavailable for order {order_id}")
-                
-        finally:
-            session.close()
+                return
+            except ValueError as e:
+                logger.info(f"Reservation failed for order {order_id}: {e}")
+            
+            # Quantity still available to other orders
+            available = stock_service.get_stock_quantities(1, [item["product_id"] for item in order_items])
+            stock_items = [{
+                "product_id": item["product_id"],
+                "requested_quantity": item["quantity"],
+                "available_quantity": available.get(item["product_id"], 0),
+                "status": "AVAILABLE" if available.get(item["product_id"], 0) >= item["quantity"] else "UNAVAILABLE"
+            } for item in order_items]
+            
+            enqueue(
+                session, OutboxMessage,
+                event_type=InventoryEvents.STOCK_UNAVAILABLE,
+                aggregate_type=AggregateTypes.INVENTORY,
+                aggregate_id=f"order_{order_id}",
+                data={
+                    "order_id": order_id,
+                    "status": "UNAVAILABLE",
+                    "items": stock_items,
+                    "reason": "insufficient_stock"
+                },
+                correlation_id=correlation_id,
+                service_name="warehouse"
+            )
+            session.commit()
+            
+            logger.info(f"Stock unavailable for order {order_id}")
             
     except Exception as e:
         logger.error(f"Error handling OrderInitiated event: {e}")
 
+def handle_order_cancelled(event_data: dict):
+    """Handle OrderCancelled event - give back the stock reserved for the order"""
+    try:
+        order_id = event_data["data"]["order_id"]
+        release_order_stock(order_id)
+        logger.info(f"Stock released for cancelled order {order_id}")
+            
+    except Exception as e:
+        logger.error(f"Error handling OrderCancelled event: {e}")
+
+def handle_payment_processed(event_data: dict):
+    """Handle PaymentProcessed event - the reserved stock is now sold"""
+    try:
+        order_id = event_data["data"]["order_id"]
+        
+        with session_scope() as session:
+            ReservationService(session).confirm_reservation(order_id)
+            logger.info(f"Reservation confirmed for order {order_id}")
+            
+    except ValueError as e:
+        # Already released (expired or cancelled) before the payment went through
+        logger.warning(f"Cannot confirm reservation: {e}")
+    except Exception as e:
+        logger.error(f"Error handling PaymentProcessed event: {e}")
+
+def handle_payment_failed(event_data: dict):
+    """Handle PaymentFailed event - give back the stock reserved for the order"""
+    try:
+        order_id = event_data["data"]["order_id"]
+        release_order_stock(order_id)
+        logger.info(f"Stock released after failed payment for order {order_id}")
+            
+    except Exception as e:
+        logger.error(f"Error handling PaymentFailed event: {e}")
+
+def handle_product_changed(event_data: dict):
+    """Handle ProductCreated/Updated/Deleted events - keep the product cache in sync"""
+    try:
+        event_type = event_data["event_type"]
+        product_data = event_data["data"]
+        product_id = product_data["product_id"]
+        catalog = get_product_catalog()
+        
+        if event_type == ProductEvents.PRODUCT_DELETED:
+            catalog.invalidate(product_id)
+        else:
+            catalog.put({
+                "id": product_id,
+                "name": product_data.get("name"),
+                "category": product_data.get("category"),
+                "description": product_data.get("description"),
+                "prix_unitaire": product_data.get("prix_unitaire")
+            })
+        logger.info(f"Product cache updated from {event_type} for product {product_id}")
+            
+    except Exception as e:
+        logger.error(f"Error handling product event: {e}")
+
+def release_order_stock(order_id: int):
+    with session_scope() as session:
+        ReservationService(session).release_reservation(order_id)
+
 def start_event_consumer():
     """Start the event consumer in a background thread"""
     global event_subscriber
@@ -543,6 +669,33 @@ def start_event_consumer():
                     handler=handle_order_initiated
                 )
                 
+                # Subscribe to OrderCancelled events (saga compensation)
+                event_subscriber.subscribe_to_event(
+                    exchange=Exchanges.ORDERS,
+                    routing_key=RoutingKeys.ORDER_CANCELLED,
+                    handler=handle_order_cancelled
+                )
+                
+                # Subscribe to payment results to confirm or release reservations
+                event_subscriber.subscribe_to_event(
+                    exchange=Exchanges.PAYMENTS,
+                    routing_key=RoutingKeys.PAYMENT_PROCESSED,
+                    handler=handle_payment_processed
+                )
+                event_subscriber.subscribe_to_event(
+                    exchange=Exchanges.PAYMENTS,
+                    routing_key=RoutingKeys.PAYMENT_FAILED,
+                    handler=handle_payment_failed
+                )
+                
+                # Subscribe to catalog changes to keep the product cache fresh
+                for routing_key in (RoutingKeys.PRODUCT_CREATED, RoutingKeys.PRODUCT_UPDATED, RoutingKeys.PRODUCT_DELETED):
+                    event_subscriber.subscribe_to_event(
+                        exchange=Exchanges.PRODUCTS,
+                        routing_key=routing_key,
+                        handler=handle_product_changed
+                    )
+                
                 logger.info("Warehouse event consumer subscribed to events")
                 event_subscriber.start_consuming()
                 break
@@ -560,8 +713,67 @@ def start_event_consumer():
     consumer_thread.start()
     logger.info("Warehouse event consumer thread started")
 
+def publish_low_stock_alert(alert: dict):
+    """Emit a LowStockAlert when a stock drops to the low stock threshold"""
+    # Listeners run once the stock change is committed, the alert gets its own outbox transaction
+    with session_scope() as session:
+        enqueue(
+            session, OutboxMessage,
+            event_type=InventoryEvents.LOW_STOCK_ALERT,
+            aggregate_type=AggregateTypes.INVENTORY,
+            aggregate_id=f"stock_{alert['store_id']}_{alert['product_id']}",
+            data=alert,
+            service_name="warehouse"
+        )
+        session.commit()
+    logger.info(f"Low stock alert for product {alert['product_id']} in store {alert['store_id']}")
+
+def start_reservation_sweeper():
+    """Periodically give back the stock of reservations whose saga never confirmed nor released them"""
+    interval = int(os.getenv("RESERVATION_SWEEP_INTERVAL", "30"))
+    
+    def sweeper_loop():
+        while True:
+            time.sleep(interval)
+            try:
+                with session_scope() as session:
+                    expired = ReservationService(session).expire_reservations()
+                if expired:
+                    logger.info(f"Expired {expired} reservation lines")
+            except Exception as e:
+                logger.error(f"Reservation sweeper failed: {e}")
+    
+    sweeper_thread = threading.Thread(target=sweeper_loop)
+    sweeper_thread.daemon = True
+    sweeper_thread.start()
+    logger.info("Reservation sweeper thread started")
+
+def start_shard_rebalancer():
+    """Periodically fold the sales made on stock shards into their stock rows and hand restocks out to the shards"""
+    interval = float(os.getenv("SHARD_REBALANCE_INTERVAL", "5"))
+    
+    def rebalancer_loop():
+        while True:
+            time.sleep(interval)
+            try:
+                with session_scope() as session:
+                    StockService(session).rebalance_shards()
+            except Exception as e:
+                logger.error(f"Shard rebalancer failed: {e}")
+    
+    rebalancer_thread = threading.Thread(target=rebalancer_loop)
+    rebalancer_thread.daemon = True
+    rebalancer_thread.start()
+    logger.info("Shard rebalancer thread started")
+
 # Initialize event consumer on startup
 @app.on_event("startup")
 async def startup_event():
-    """Initialize event consumer when the app starts"""
-    start_event_consumer()
\ No newline at end of file
+    """Initialize event consumer, outbox relay, reservation sweeper, shard rebalancer and product cache when the app starts"""
+    start_event_consumer()
+    OutboxRelay(SessionLocal, OutboxMessage).start()
+    start_reservation_sweeper()
+    start_shard_rebalancer()
+    add_low_stock_listener(publish_low_stock_alert)
+    # Warm the product cache without blocking startup on the products service
+    threading.Thread(target=get_product_catalog().warmup, daemon=True).start()
\ No newline at end of file
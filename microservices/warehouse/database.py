@@ -0,0 +1,67 @@
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from prometheus_client import Counter
+from prometheus_client.core import GaugeMetricFamily, REGISTRY
+import logging
+import os
+
+logging.basicConfig(level=logging.DEBUG, filename='app.log', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logging = logging.getLogger(__name__)
+
+DATABASE_URL = os.getenv("DATABASE_URL_WAREHOUSE", "postgresql+psycopg2://admin:admin@db_warehouse:5432/postgres")
+
+# Both replicas share db_warehouse: keep pool_size + max_overflow per replica well under its max_connections
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "10")),
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    pool_pre_ping=True
+)
+SessionLocal = sessionmaker(bind=engine)
+
+def get_db():
+    """FastAPI dependency: one session per request, always closed"""
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+@contextmanager
+def session_scope():
+    """Session for event handlers and background threads, rolled back on error and always closed"""
+    session = SessionLocal()
+    try:
+        yield session
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+# Prometheus metrics
+db_pool_connections_created = Counter('warehouse_db_pool_connections_created_total', 'Database connections opened by the pool')
+db_pool_invalidated = Counter('warehouse_db_pool_connections_invalidated_total', 'Pooled connections found dead or invalidated')
+
+@event.listens_for(engine, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    db_pool_connections_created.inc()
+
+@event.listens_for(engine, "invalidate")
+def _on_invalidate(dbapi_connection, connection_record, exception):
+    db_pool_invalidated.inc()
+
+class PoolCollector:
+    """Reads the pool state at scrape time"""
+    def collect(self):
+        pool = engine.pool
+        yield GaugeMetricFamily('warehouse_db_pool_size', 'Configured pool size', value=pool.size())
+        yield GaugeMetricFamily('warehouse_db_pool_checked_out', 'Connections currently in use', value=pool.checkedout())
+        yield GaugeMetricFamily('warehouse_db_pool_checked_in', 'Idle connections in the pool', value=pool.checkedin())
+        yield GaugeMetricFamily('warehouse_db_pool_overflow', 'Connections opened beyond the pool size', value=max(pool.overflow(), 0))
+
+REGISTRY.register(PoolCollector())
@@ -6,10 +6,67 @@ CREATE TABLE stores (
 CREATE TABLE stocks (
     id SERIAL PRIMARY KEY,
     quantite INTEGER,
+    reserved INTEGER NOT NULL DEFAULT 0,
+    shards INTEGER NOT NULL DEFAULT 0,
     product INTEGER NOT NULL,
     store INTEGER REFERENCES stores(id)
 );
 
+CREATE INDEX idx_stocks_available ON stocks ((quantite - reserved));
+
+-- Hot stock rows can be split across shards so concurrent reservations do not all lock the same row
+CREATE TABLE stock_shards (
+    id SERIAL PRIMARY KEY,
+    stock_id INTEGER NOT NULL REFERENCES stocks(id) ON DELETE CASCADE,
+    shard_no INTEGER NOT NULL,
+    available INTEGER NOT NULL DEFAULT 0,
+    sold INTEGER NOT NULL DEFAULT 0,
+    CONSTRAINT uq_stock_shards_stock_shard UNIQUE (stock_id, shard_no)
+);
+
+CREATE TABLE stock_reservations (
+    id SERIAL PRIMARY KEY,
+    reservation_id VARCHAR(100) NOT NULL,
+    order_id BIGINT NOT NULL,
+    product INTEGER NOT NULL,
+    store INTEGER REFERENCES stores(id),
+    quantity INTEGER NOT NULL,
+    shard_id INTEGER,
+    status VARCHAR(20) NOT NULL DEFAULT 'active',
+    expires_at TIMESTAMP NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT uq_stock_reservations_order_product UNIQUE (order_id, product)
+);
+
+CREATE INDEX ix_stock_reservations_reservation_id ON stock_reservations (reservation_id);
+CREATE INDEX ix_stock_reservations_order_id ON stock_reservations (order_id);
+CREATE INDEX idx_stock_reservations_status_expires ON stock_reservations (status, expires_at);
+
+-- Orders whose stock was given back, so that a reservation arriving after the cancellation holds nothing
+CREATE TABLE released_orders (
+    order_id BIGINT PRIMARY KEY,
+    released_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_released_orders_released_at ON released_orders (released_at);
+
+-- Transactional outbox: events written with the state change, published by the outbox relay
+CREATE TABLE outbox (
+    id BIGSERIAL PRIMARY KEY,
+    event_id VARCHAR(36) NOT NULL UNIQUE,
+    event_type VARCHAR(100) NOT NULL,
+    aggregate_type VARCHAR(50) NOT NULL,
+    aggregate_id VARCHAR(100) NOT NULL,
+    payload JSON NOT NULL,
+    headers JSON,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+
+CREATE INDEX idx_outbox_unsent ON outbox (id) WHERE sent_at IS NULL;
+
 CREATE TABLE products_depot (
     id SERIAL PRIMARY KEY,
     quantite_depot INTEGER,
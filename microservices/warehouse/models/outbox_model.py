@@ -0,0 +1,8 @@
+from sqlalchemy.orm import declarative_base
+from outbox import OutboxMixin
+
+Base = declarative_base()
+
+class OutboxMessage(OutboxMixin, Base):
+    """Event waiting in the warehouse database to be published by the outbox relay"""
+    __tablename__ = "outbox"
@@ -0,0 +1,56 @@
+from sqlalchemy.orm import declarative_base
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Index, UniqueConstraint, create_engine
+from dotenv import load_dotenv
+from datetime import datetime
+import logging
+import os 
+
+logging.basicConfig(level=logging.DEBUG, filename='app.log', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logging = logging.getLogger(__name__)
+
+load_dotenv()
+DATABASE_URL_WAREHOUSE = os.getenv("DATABASE_URL_WAREHOUSE")
+
+engine = create_engine(DATABASE_URL_WAREHOUSE)
+Base = declarative_base()
+
+class ReservationStatus:
+    ACTIVE = "active"
+    CONFIRMED = "confirmed"
+    RELEASED = "released"
+    EXPIRED = "expired"
+
+class StockReservation(Base):
+    """One reserved line of an order: the quantity is held in stocks.reserved until confirmed, released or expired"""
+    __tablename__ = "stock_reservations"
+
+    id = Column(Integer, primary_key=True)
+    reservation_id = Column(String(100), nullable=False, index=True)
+    order_id = Column(BigInteger, nullable=False, index=True)
+    quantity = Column(Integer, nullable=False)
+    status = Column(String(20), nullable=False, default=ReservationStatus.ACTIVE)
+    expires_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    #Relationships
+    product = Column(Integer, nullable=False)
+    store = Column(Integer, nullable=False)
+    # Shard the quantity was taken from, None when it is held in stocks.reserved
+    shard_id = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        # One line per product and order: a redelivered OrderInitiated cannot hold the stock twice
+        UniqueConstraint('order_id', 'product', name='uq_stock_reservations_order_product'),
+        # Expiry sweeper scans active reservations by deadline
+        Index('idx_stock_reservations_status_expires', 'status', 'expires_at'),
+    )
+
+class ReleasedOrder(Base):
+    """
+    Order whose stock was given back. OrderInitiated reaches the warehouse asynchronously, so an order
+    can be cancelled before it is reserved: its reservation, arriving late, must then hold nothing
+    """
+    __tablename__ = "released_orders"
+
+    order_id = Column(BigInteger, primary_key=True)
+    released_at = Column(DateTime, nullable=False, default=datetime.utcnow)
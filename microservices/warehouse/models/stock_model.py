@@ -1,5 +1,5 @@
-from sqlalchemy.orm import declarative_base, relationship
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, create_engine 
+from sqlalchemy.orm import declarative_base, relationship, column_property
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Index, UniqueConstraint, create_engine, select, func
 from dotenv import load_dotenv
 import logging
 import os 
@@ -17,7 +17,47 @@ class Stock(Base):
     __tablename__ = "stocks"
     id = Column(Integer, primary_key=True)
     quantite = Column(Integer)
+    # Held by active reservations, available = quantite - reserved
+    reserved = Column(Integer, nullable=False, default=0, server_default="0")
+
+    # Number of shards the reservable quantity is split across, 0 = not sharded (see StockShard)
+    shards = Column(Integer, nullable=False, default=0, server_default="0")
 
     #Relationsips
     product = Column(Integer, nullable=False)
     store = Column(Integer, nullable=False)
+
+    @property
+    def available(self):
+        return self.quantite - self.reserved + self.shard_available
+
+class StockShard(Base):
+    """
+    Slice of the reservable quantity of a hot stock row
+
+    Sharding moves the free quantity of a stock into N shard rows and counts it
+    in stocks.reserved, so concurrent reservations decrement different shard rows
+    instead of all locking the stock row. Units sold from a shard are counted in
+    `sold` and folded back into the stock row in the background.
+    """
+    __tablename__ = "stock_shards"
+    id = Column(Integer, primary_key=True)
+    stock_id = Column(Integer, ForeignKey("stocks.id", ondelete="CASCADE"), nullable=False)
+    shard_no = Column(Integer, nullable=False)
+    available = Column(Integer, nullable=False, default=0, server_default="0")
+    sold = Column(Integer, nullable=False, default=0, server_default="0")
+
+    __table_args__ = (
+        UniqueConstraint('stock_id', 'shard_no', name='uq_stock_shards_stock_shard'),
+    )
+
+# Still free in the shards, available = quantite - reserved + shard_available
+Stock.shard_available = column_property(
+    select(func.coalesce(func.sum(StockShard.available), 0))
+    .where(StockShard.stock_id == Stock.id)
+    .correlate_except(StockShard)
+    .scalar_subquery()
+)
+
+# Low stock alerts filter on the available quantity
+Index('idx_stocks_available', Stock.quantite - Stock.reserved)
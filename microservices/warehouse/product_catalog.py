@@ -0,0 +1,132 @@
+import logging
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+logging.basicConfig(level=logging.DEBUG, filename='app.log', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logging = logging.getLogger(__name__)
+
+PRODUCTS_URL = "http://kong-api_gateway:8000/products/api/v1/products"
+
+class ProductCatalog:
+    """
+    Local cache of the products service catalog
+
+    Products found are kept for PRODUCT_CACHE_TTL seconds, unknown products for
+    PRODUCT_CACHE_NEGATIVE_TTL seconds, and entries are refreshed as soon as a
+    ProductCreated/Updated/Deleted event arrives. Misses go through a pooled HTTP
+    session with timeouts; a failed call is never cached.
+    """
+    def __init__(self, base_url=PRODUCTS_URL):
+        self.base_url = base_url
+        self.ttl = float(os.getenv("PRODUCT_CACHE_TTL", "300"))
+        self.negative_ttl = float(os.getenv("PRODUCT_CACHE_NEGATIVE_TTL", "30"))
+        self.timeout = (
+            float(os.getenv("PRODUCTS_CONNECT_TIMEOUT", "1")),
+            float(os.getenv("PRODUCTS_READ_TIMEOUT", "3"))
+        )
+        self._entries = {}  # product_id -> (expires_at, product dict or None if it does not exist)
+        self._lock = threading.Lock()
+
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=int(os.getenv("PRODUCTS_POOL_SIZE", "20")))
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+
+    def get(self, product_id):
+        """Product as returned by the products service, or None if it does not exist or cannot be fetched"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(product_id)
+        if entry and entry[0] > now:
+            return entry[1]
+
+        try:
+            response = self.http.get(f"{self.base_url}/{product_id}", timeout=self.timeout)
+        except requests.RequestException as e:
+            logging.error(f"Failed to fetch product {product_id}: {e}")
+            return None
+
+        if response.status_code == 200:
+            product = response.json()
+            self._store(product_id, product)
+            return product
+        if response.status_code == 404:
+            self._store(product_id, None)
+        else:
+            logging.error(f"Unexpected status {response.status_code} fetching product {product_id}")
+        return None
+
+    def exists(self, product_id):
+        return self.get(product_id) is not None
+
+    def get_many(self, product_ids):
+        """{product_id: product} for the products that exist, fetching all the misses in a single call"""
+        now = time.monotonic()
+        products = {}
+        missing = []
+        with self._lock:
+            for product_id in set(product_ids):
+                entry = self._entries.get(product_id)
+                if entry and entry[0] > now:
+                    if entry[1] is not None:
+                        products[product_id] = entry[1]
+                else:
+                    missing.append(product_id)
+
+        if not missing:
+            return products
+
+        try:
+            response = self.http.get(self.base_url, params={"ids": missing}, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logging.error(f"Failed to fetch {len(missing)} products: {e}")
+            return products
+
+        found = {product["id"]: product for product in response.json()}
+        for product_id in missing:
+            self._store(product_id, found.get(product_id))
+        products.update(found)
+        return products
+
+    def put(self, product):
+        self._store(product["id"], product)
+
+    def invalidate(self, product_id):
+        with self._lock:
+            self._entries.pop(product_id, None)
+
+    def warmup(self):
+        """Load the whole catalog with a single call"""
+        try:
+            response = self.http.get(self.base_url, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logging.error(f"Failed to warm up product cache: {e}")
+            return 0
+
+        products = response.json()
+        for product in products:
+            self.put(product)
+        logging.info(f"Product cache warmed up with {len(products)} products")
+        return len(products)
+
+    def _store(self, product_id, product):
+        ttl = self.ttl if product is not None else self.negative_ttl
+        with self._lock:
+            self._entries[product_id] = (time.monotonic() + ttl, product)
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+def get_product_catalog():
+    """Get the process-wide product catalog cache"""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = ProductCatalog()
+        return _catalog
@@ -1,7 +1,11 @@
 import logging
+import random
+from sqlalchemy import select, update, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from models.store_model import Store
-from models.stock_model import Stock
+from models.stock_model import Stock, StockShard
 from models.product_depot_model import Product_Depot
+from models.reservation_model import StockReservation, ReservationStatus, ReleasedOrder
 
 logging.basicConfig(level=logging.DEBUG, filename='app.log', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logging = logging.getLogger(__name__)
@@ -79,6 +83,21 @@ class StockRepository:
         logging.debug(f"Fetched successfully stock for product {product_id} in store {store_id}")
         return stock
     
+    def get_low_stocks(self, threshold, store_id=None):
+        """Stocks whose available quantity is at or below the threshold, with their store name, in one query"""
+        logging.debug(f"Fetching stocks at or below {threshold}")
+        available = Stock.quantite - Stock.reserved + Stock.shard_available
+        query = self.session.query(Stock, Store.name).outerjoin(Store, Store.id == Stock.store).filter(
+            # Shards only add to the available quantity: the indexed expression narrows the scan first
+            Stock.quantite - Stock.reserved <= threshold,
+            available <= threshold
+        )
+        if store_id:
+            query = query.filter(Stock.store == store_id)
+        low_stocks = query.order_by(available, Stock.store, Stock.product).all()
+        logging.debug(f"Fetched successfully {len(low_stocks)} low stocks")
+        return low_stocks
+    
     def get_all_stocks(self):
         logging.debug("Fetching all stocks")
         stocks = self.session.query(Stock).all()
@@ -125,18 +144,116 @@ class StockRepository:
     
     def reduce_stock(self, product_id, store_id, quantity_to_reduce):
         logging.debug(f"Reducing stock by {quantity_to_reduce} for product {product_id} in store {store_id}")
-        stock = self.get_by_product_and_store(product_id, store_id)
+        sharded = self.session.execute(
+            select(Stock.id, Stock.shards).where(Stock.product == product_id, Stock.store == store_id, Stock.shards > 0)
+        ).first()
+        if sharded:
+            # The free quantity of a sharded stock is in its shards, not in quantite - reserved
+            sold = StockShardRepository(self.session).sell(sharded.id, sharded.shards, quantity_to_reduce)
+            if not sold:
+                self.session.rollback()
+                logging.error(f"Insufficient stock for sharded product {product_id} in store {store_id}. Requested: {quantity_to_reduce}")
+                return None
+            self.session.commit()
+            return self.session.get(Stock, sharded.id, populate_existing=True)
+
+        # Check and decrement in a single statement so concurrent reductions cannot oversell
+        statement = (
+            update(Stock)
+            .where(Stock.product == product_id, Stock.store == store_id, Stock.quantite - Stock.reserved >= quantity_to_reduce)
+            .values(quantite=Stock.quantite - quantity_to_reduce)
+            .returning(Stock)
+        )
+        stock = self.session.execute(
+            select(Stock).from_statement(statement).execution_options(populate_existing=True)
+        ).scalars().first()
+        self.session.commit()
         if not stock:
-            logging.error(f"Stock not found for product {product_id} in store {store_id}")
-            return None
-        if stock.quantite < quantity_to_reduce:
-            logging.error(f"Insufficient stock. Available: {stock.quantite}, Requested: {quantity_to_reduce}")
+            logging.error(f"Insufficient stock or stock not found for product {product_id} in store {store_id}. Requested: {quantity_to_reduce}")
             return None
-        stock.quantite -= quantity_to_reduce
-        self.session.commit()
         logging.debug(f"Stock reduced by {quantity_to_reduce}. New quantity: {stock.quantite}")
         return stock
     
+    def reduce_stocks(self, store_id, lines):
+        """
+        Decrement several products of a store in one transaction, all or nothing
+        lines: [(product_id, quantity)], several lines of the same product are added up
+        Returns {product_id: (new quantity, new available quantity)}
+        """
+        logging.debug(f"Reducing stock of {len(lines)} lines in store {store_id}")
+        quantities = {}
+        for product_id, quantity in lines:
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+        sharded = {
+            product: (stock_id, shards) for product, stock_id, shards in self.session.execute(
+                text(
+                    "SELECT product, id, shards FROM stocks "
+                    "WHERE store = :store AND product = ANY(CAST(:products AS integer[])) AND shards > 0"
+                ),
+                {'store': store_id, 'products': list(quantities)}
+            ).all()
+        }
+        plain = [(product_id, quantity) for product_id, quantity in lines if product_id not in sharded]
+
+        reduced = {}
+        if plain:
+            params = {
+                'products': [product_id for product_id, _ in plain],
+                'quantities': [quantity for _, quantity in plain],
+                'store': store_id
+            }
+            product_count = len(set(params['products']))
+
+            # Lock rows in a fixed order (by product), like transfer_to_stores, so overlapping batches cannot deadlock
+            self.session.execute(text(
+                "SELECT id FROM stocks WHERE store = :store AND product = ANY(CAST(:products AS integer[])) "
+                "ORDER BY product, id FOR UPDATE"
+            ), params)
+            rows = self.session.execute(
+                text(
+                    "UPDATE stocks AS s SET quantite = s.quantite - r.quantity "
+                    "FROM ("
+                    "  SELECT product, SUM(quantity) AS quantity "
+                    "  FROM unnest(CAST(:products AS integer[]), CAST(:quantities AS integer[])) AS l(product, quantity) "
+                    "  GROUP BY product"
+                    ") AS r "
+                    "WHERE s.product = r.product AND s.store = :store AND s.quantite - s.reserved >= r.quantity "
+                    "RETURNING s.product, s.quantite, s.quantite - s.reserved + "
+                    "  COALESCE((SELECT SUM(sh.available) FROM stock_shards sh WHERE sh.stock_id = s.id), 0)"
+                ),
+                params
+            ).all()
+            if len(rows) != product_count:
+                self.session.rollback()
+                logging.error(f"Insufficient stock or stock not found in store {store_id}, batch reduction rolled back")
+                return None
+            reduced.update({product: (quantite, available) for product, quantite, available in rows})
+
+        shard_repository = StockShardRepository(self.session)
+        for product_id in sorted(sharded):
+            stock_id, shards = sharded[product_id]
+            if not shard_repository.sell(stock_id, shards, quantities[product_id]):
+                self.session.rollback()
+                logging.error(f"Insufficient stock for sharded product {product_id} in store {store_id}, batch reduction rolled back")
+                return None
+        if sharded:
+            reduced.update({
+                product: (quantite, available) for product, quantite, available in self.session.query(
+                    Stock.product, Stock.quantite, Stock.quantite - Stock.reserved + Stock.shard_available
+                ).filter(Stock.id.in_([stock_id for stock_id, _ in sharded.values()])).all()
+            })
+        self.session.commit()
+        logging.debug(f"Stock reduced for {len(reduced)} products in store {store_id}")
+        return reduced
+    
+    def get_quantities(self, store_id, product_ids):
+        """Available (not reserved) quantity of each product in a store"""
+        logging.debug(f"Fetching stock quantities of {len(product_ids)} products in store {store_id}")
+        rows = self.session.query(Stock.product, Stock.quantite - Stock.reserved + Stock.shard_available).filter(
+            Stock.store == store_id, Stock.product.in_(product_ids)
+        ).all()
+        return {product: quantite for product, quantite in rows}
+    
     def increase_stock(self, product_id, store_id, quantity_to_add):
         logging.debug(f"Increasing stock by {quantity_to_add} for product {product_id} in store {store_id}")
         stock = self.get_by_product_and_store(product_id, store_id)
@@ -164,6 +281,152 @@ class StockRepository:
         return stock
 
 
+class StockShardRepository:
+    def __init__(self, session):
+        self.session = session
+
+    def shard(self, product_id, store_id, shard_count):
+        """
+        Split the free quantity of a stock evenly across shard_count shards, 0 puts it back in the stock row
+        Shards past shard_count are emptied but kept for the reservations still pointing at them
+        """
+        logging.debug(f"Sharding stock of product {product_id} in store {store_id} into {shard_count} shards")
+        try:
+            stock = self.session.query(Stock).filter_by(product=product_id, store=store_id).with_for_update().first()
+            if not stock:
+                self.session.rollback()
+                logging.error(f"Stock not found for product {product_id} in store {store_id}")
+                return None
+            shards = {
+                shard.shard_no: shard for shard in
+                self.session.query(StockShard).filter_by(stock_id=stock.id).order_by(StockShard.shard_no).with_for_update().all()
+            }
+
+            # Take back what is still free in the shards, then deal it out again
+            for shard in shards.values():
+                stock.reserved -= shard.available
+                shard.available = 0
+            free = max(stock.quantite - stock.reserved, 0)
+            if shard_count:
+                share, extra = divmod(free, shard_count)
+                for shard_no in range(shard_count):
+                    shard = shards.get(shard_no)
+                    if shard is None:
+                        shard = StockShard(stock_id=stock.id, shard_no=shard_no, sold=0)
+                        self.session.add(shard)
+                    shard.available = share + (1 if shard_no < extra else 0)
+                stock.reserved += free
+            stock.shards = shard_count
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        logging.debug(f"Stock {stock.id} sharded into {shard_count} shards")
+        return stock
+
+    def take(self, stock_id, shards, quantity):
+        """
+        Hold quantity on one shard of a sharded stock: a random shard first, then the next ones,
+        without waiting on busy shards, then waiting on them, then the stock row itself
+        Returns the shard id, 0 when it was held on the stock row, None when nothing can hold it
+        """
+        params = {'stock': stock_id, 'shards': shards, 'start': random.randrange(shards), 'quantity': quantity}
+        for lock in ("FOR UPDATE SKIP LOCKED", "FOR UPDATE"):
+            shard_id = self.session.execute(
+                text(
+                    "UPDATE stock_shards SET available = available - :quantity "
+                    "WHERE id = ("
+                    "  SELECT id FROM stock_shards "
+                    "  WHERE stock_id = :stock AND shard_no < :shards AND available >= :quantity "
+                    "  ORDER BY (shard_no + :shards - :start) % :shards LIMIT 1 " + lock +
+                    ") AND available >= :quantity "
+                    "RETURNING id"
+                ),
+                params
+            ).scalar()
+            if shard_id:
+                return shard_id
+
+        held = self.session.execute(
+            text(
+                "UPDATE stocks SET reserved = reserved + :quantity "
+                "WHERE id = :stock AND quantite - reserved >= :quantity RETURNING id"
+            ),
+            params
+        ).scalar()
+        return 0 if held else None
+
+    def sell(self, stock_id, shards, quantity):
+        """
+        Sell quantity of a sharded stock right away: taken like a reservation (see take), then counted
+        as sold the way a confirmed reservation is. Returns False when nothing can provide it
+        """
+        taken = self.take(stock_id, shards, quantity)
+        if taken is None:
+            return False
+        if taken:
+            self.session.execute(
+                text("UPDATE stock_shards SET sold = sold + :quantity WHERE id = :shard"),
+                {'shard': taken, 'quantity': quantity}
+            )
+        else:
+            self.session.execute(
+                text("UPDATE stocks SET quantite = quantite - :quantity, reserved = reserved - :quantity WHERE id = :stock"),
+                {'stock': stock_id, 'quantity': quantity}
+            )
+        return True
+
+    def rebalance(self):
+        """
+        Fold the units sold from shards into their stock rows, then deal out to the shards
+        the quantity restocked in the stock rows since. Busy rows are left for the next run
+        Returns the number of stock rows updated
+        """
+        logging.debug("Rebalancing stock shards")
+        try:
+            folded = self.session.execute(text(
+                "WITH locked AS ("
+                "  SELECT id, stock_id, sold FROM stock_shards WHERE sold > 0 FOR UPDATE SKIP LOCKED"
+                "), cleared AS ("
+                "  UPDATE stock_shards sh SET sold = sh.sold - l.sold FROM locked l WHERE sh.id = l.id"
+                "), totals AS ("
+                "  SELECT stock_id, SUM(sold) AS sold FROM locked GROUP BY stock_id"
+                ") "
+                "UPDATE stocks AS s SET quantite = s.quantite - t.sold, reserved = s.reserved - t.sold "
+                "FROM totals t WHERE s.id = t.stock_id"
+            )).rowcount
+
+            restocked = self.session.query(Stock).filter(
+                Stock.shards > 0, Stock.quantite > Stock.reserved
+            ).with_for_update(skip_locked=True).all()
+            lines = []
+            for stock in restocked:
+                share, extra = divmod(stock.quantite - stock.reserved, stock.shards)
+                lines += [(stock.id, shard_no, share + (1 if shard_no < extra else 0)) for shard_no in range(stock.shards)]
+                stock.reserved = stock.quantite
+            if lines:
+                self.session.execute(
+                    text(
+                        "UPDATE stock_shards AS sh SET available = sh.available + r.amount "
+                        "FROM unnest(CAST(:stocks AS integer[]), CAST(:shard_nos AS integer[]), CAST(:amounts AS integer[])) "
+                        "  AS r(stock_id, shard_no, amount) "
+                        "WHERE sh.stock_id = r.stock_id AND sh.shard_no = r.shard_no"
+                    ),
+                    {
+                        'stocks': [line[0] for line in lines],
+                        'shard_nos': [line[1] for line in lines],
+                        'amounts': [line[2] for line in lines]
+                    }
+                )
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        if folded or restocked:
+            logging.debug(f"Folded sales of {folded} stocks and topped up shards of {len(restocked)} stocks")
+        return folded + len(restocked)
+
+
 class ProductDepotRepository:
     def __init__(self, session):
         self.session = session
@@ -232,8 +495,7 @@ class ProductDepotRepository:
         if not depot:
             # Create new depot entry if doesn't exist
             logging.debug(f"No existing depot stock found, creating new entry")
-            from models.stock_model import ProductDepot
-            depot = ProductDepot(product_id=product_id, quantite_depot=quantity_to_add)
+            depot = Product_Depot(product=product_id, quantite_depot=quantity_to_add)
             self.session.add(depot)
         else:
             depot.quantite_depot += quantity_to_add
@@ -241,6 +503,78 @@ class ProductDepotRepository:
         logging.debug(f"Depot stock increased by {quantity_to_add}. New quantity: {depot.quantite_depot}")
         return depot
         
+    def transfer_to_stores(self, transfers):
+        """
+        Move stock from the depot to stores in a single transaction, all or nothing
+        transfers: {(product_id, store_id): quantity}
+        Returns {(product_id, store_id): (remaining depot quantity, new store quantity)}
+        """
+        logging.debug(f"Transferring {len(transfers)} lines from depot to stores")
+        depot_quantities = {}
+        for (product_id, _), quantity in transfers.items():
+            depot_quantities[product_id] = depot_quantities.get(product_id, 0) + quantity
+        lines = sorted(transfers)
+        params = {
+            'depot_products': list(depot_quantities.keys()),
+            'depot_quantities': list(depot_quantities.values()),
+            'products': [product_id for product_id, _ in lines],
+            'stores': [store_id for _, store_id in lines],
+            'quantities': [transfers[line] for line in lines]
+        }
+
+        try:
+            # Lock rows in a fixed order (depot then stores, by product then store) so concurrent transfers cannot deadlock
+            self.session.execute(text(
+                "SELECT id FROM products_depot WHERE product = ANY(CAST(:depot_products AS integer[])) "
+                "ORDER BY product, id FOR UPDATE"
+            ), params)
+            self.session.execute(text(
+                "SELECT s.id FROM stocks s "
+                "JOIN unnest(CAST(:products AS integer[]), CAST(:stores AS integer[])) AS r(product, store) "
+                "  ON s.product = r.product AND s.store = r.store "
+                "ORDER BY s.product, s.store, s.id FOR UPDATE OF s"
+            ), params)
+
+            depot_rows = self.session.execute(text(
+                "UPDATE products_depot AS d SET quantite_depot = d.quantite_depot - r.quantity "
+                "FROM unnest(CAST(:depot_products AS integer[]), CAST(:depot_quantities AS integer[])) AS r(product, quantity) "
+                "WHERE d.product = r.product AND d.quantite_depot >= r.quantity "
+                "RETURNING d.product, d.quantite_depot"
+            ), params).all()
+            if len(depot_rows) != len(depot_quantities):
+                self.session.rollback()
+                logging.error("Insufficient depot stock or depot not found, transfer rolled back")
+                return None
+
+            store_rows = self.session.execute(text(
+                "UPDATE stocks AS s SET quantite = s.quantite + r.quantity "
+                "FROM unnest(CAST(:products AS integer[]), CAST(:stores AS integer[]), CAST(:quantities AS integer[])) "
+                "  AS r(product, store, quantity) "
+                "WHERE s.product = r.product AND s.store = r.store "
+                "RETURNING s.product, s.store, s.quantite"
+            ), params).all()
+            # Stores that never held the product get a new stock row
+            store_rows += self.session.execute(text(
+                "INSERT INTO stocks (product, store, quantite) "
+                "SELECT r.product, r.store, r.quantity "
+                "FROM unnest(CAST(:products AS integer[]), CAST(:stores AS integer[]), CAST(:quantities AS integer[])) "
+                "  AS r(product, store, quantity) "
+                "WHERE NOT EXISTS (SELECT 1 FROM stocks s WHERE s.product = r.product AND s.store = r.store) "
+                "RETURNING product, store, quantite"
+            ), params).all()
+
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+        depot_remaining = dict(depot_rows)
+        logging.debug(f"Transferred {len(transfers)} lines from depot to stores")
+        return {
+            (product_id, store_id): (depot_remaining[product_id], quantite)
+            for product_id, store_id, quantite in store_rows
+        }
+        
     def delete_depot_stock(self, depot_id):
         logging.debug(f"Deleting depot stock with id {depot_id}")
         depot = self.get_by_id(depot_id)
@@ -251,3 +585,254 @@ class ProductDepotRepository:
         self.session.commit()
         logging.debug(f"Depot stock with id {depot_id} deleted successfully")
         return depot
+
+
+class InventoryRepository:
+    def __init__(self, session):
+        self.session = session
+
+    def get_matrix(self, product_ids=None, store_ids=None):
+        """
+        Product x store x depot inventory in one grouped query
+        Returns rows (product, depot quantity, [{store_id, store_name, quantite, reserved, shard_available}, ...])
+        """
+        logging.debug(f"Fetching inventory matrix for products {product_ids or 'all'} and stores {store_ids or 'all'}")
+        params = {}
+        store_filter = ""
+        product_filter = ""
+        if store_ids:
+            store_filter = "AND s.store = ANY(CAST(:stores AS integer[])) "
+            params['stores'] = list(store_ids)
+        if product_ids:
+            product_filter = "WHERE p.product = ANY(CAST(:products AS integer[])) "
+            params['products'] = list(product_ids)
+
+        rows = self.session.execute(
+            text(
+                "SELECT p.product, COALESCE(d.quantite_depot, 0) AS depot, "
+                "  COALESCE(json_agg(json_build_object("
+                "    'store_id', s.store, 'store_name', st.name, 'quantite', s.quantite, 'reserved', s.reserved, "
+                "    'shard_available', COALESCE(sh.available, 0)"
+                "  ) ORDER BY s.store) FILTER (WHERE s.store IS NOT NULL), '[]') AS stores "
+                "FROM (SELECT product FROM stocks UNION SELECT product FROM products_depot) p "
+                "LEFT JOIN (SELECT product, SUM(quantite_depot) AS quantite_depot FROM products_depot GROUP BY product) d "
+                "  ON d.product = p.product "
+                "LEFT JOIN stocks s ON s.product = p.product " + store_filter +
+                "LEFT JOIN stores st ON st.id = s.store "
+                "LEFT JOIN (SELECT stock_id, SUM(available) AS available FROM stock_shards GROUP BY stock_id) sh "
+                "  ON sh.stock_id = s.id " +
+                product_filter +
+                "GROUP BY p.product, d.quantite_depot "
+                "ORDER BY p.product"
+            ),
+            params
+        ).all()
+        logging.debug(f"Fetched successfully inventory of {len(rows)} products")
+        return rows
+
+
+class ReservationRepository:
+    def __init__(self, session):
+        self.session = session
+
+    def get_by_order_id(self, order_id):
+        logging.debug(f"Fetching reservations for order {order_id}")
+        reservations = self.session.query(StockReservation).filter_by(order_id=order_id).all()
+        if not reservations:
+            logging.warning(f"No reservations found for order {order_id}")
+            return None
+        logging.debug(f"Fetched successfully {len(reservations)} reservation lines for order {order_id}")
+        return reservations
+
+    def reserve(self, reservation_id, order_id, store_id, quantities, expires_at, before_commit=None):
+        """
+        Hold stock for every product of an order, all or nothing. quantities: {product_id: quantity}
+        before_commit(reservations, available) runs in the same transaction, e.g. to write outbox events
+        Returns the reservation lines and {product_id: available quantity left}; when the order is already
+        reserved, its existing lines and {} without holding anything or calling before_commit; when the
+        order was released before it got here, [] and {}
+        """
+        logging.debug(f"Reserving {len(quantities)} products in store {store_id} for order {order_id}")
+        # Serialized with release() of the same order: a cancellation cannot slip in between the check and the hold
+        self.session.execute(text("SELECT pg_advisory_xact_lock(:order_id)"), {'order_id': order_id})
+        if self.session.get(ReleasedOrder, order_id):
+            self.session.rollback()
+            logging.warning(f"Order {order_id} was released before its reservation, holding nothing")
+            return [], {}
+        sharded = {
+            product: (stock_id, shards) for product, stock_id, shards in self.session.execute(
+                text(
+                    "SELECT product, id, shards FROM stocks "
+                    "WHERE store = :store AND product = ANY(CAST(:products AS integer[])) AND shards > 0"
+                ),
+                {'store': store_id, 'products': list(quantities.keys())}
+            ).all()
+        }
+        plain = {product: quantity for product, quantity in quantities.items() if product not in sharded}
+
+        available = {}
+        if plain:
+            params = {'products': list(plain.keys()), 'quantities': list(plain.values()), 'store': store_id}
+            # Lock rows in a fixed order (by product), like reduce_stocks, so overlapping orders cannot deadlock
+            self.session.execute(text(
+                "SELECT id FROM stocks WHERE store = :store AND product = ANY(CAST(:products AS integer[])) "
+                "ORDER BY product, id FOR UPDATE"
+            ), params)
+            rows = self.session.execute(
+                text(
+                    "UPDATE stocks AS s SET reserved = s.reserved + r.quantity "
+                    "FROM unnest(CAST(:products AS integer[]), CAST(:quantities AS integer[])) AS r(product, quantity) "
+                    "WHERE s.product = r.product AND s.store = :store AND s.quantite - s.reserved >= r.quantity "
+                    "RETURNING s.product, s.quantite - s.reserved"
+                ),
+                params
+            ).all()
+            if len(rows) != len(plain):
+                self.session.rollback()
+                logging.error(f"Insufficient stock or stock not found in store {store_id}, reservation for order {order_id} rolled back")
+                return None
+            available.update(rows)
+
+        shard_ids = {}
+        for product_id in sorted(sharded):
+            stock_id, shards = sharded[product_id]
+            taken = StockShardRepository(self.session).take(stock_id, shards, quantities[product_id])
+            if taken is None:
+                self.session.rollback()
+                logging.error(f"Insufficient stock for sharded product {product_id} in store {store_id}, reservation for order {order_id} rolled back")
+                return None
+            shard_ids[product_id] = taken or None
+        if sharded:
+            available.update(self.session.query(Stock.product, Stock.quantite - Stock.reserved + Stock.shard_available).filter(
+                Stock.id.in_([stock_id for stock_id, _ in sharded.values()])
+            ).all())
+
+        # UNIQUE (order_id, product): a concurrent delivery of the same order waits here and gets
+        # nothing back once the first one commits, its hold is then rolled back
+        reservations = self.session.scalars(
+            pg_insert(StockReservation).values([
+                {
+                    'reservation_id': reservation_id,
+                    'order_id': order_id,
+                    'product': product_id,
+                    'store': store_id,
+                    'shard_id': shard_ids.get(product_id),
+                    'quantity': quantity,
+                    'status': ReservationStatus.ACTIVE,
+                    'expires_at': expires_at
+                }
+                for product_id, quantity in quantities.items()
+            ]).on_conflict_do_nothing(index_elements=['order_id', 'product']).returning(StockReservation)
+        ).all()
+        if len(reservations) != len(quantities):
+            self.session.rollback()
+            logging.warning(f"Order {order_id} is already reserved, duplicate reservation rolled back")
+            return self.get_by_order_id(order_id), {}
+        if before_commit:
+            before_commit(reservations, available)
+        self.session.commit()
+        logging.debug(f"Reservation {reservation_id} created for order {order_id}")
+        return reservations, available
+
+    def confirm(self, order_id):
+        """Turn the active reservations of an order into a definitive stock reduction"""
+        logging.debug(f"Confirming reservations for order {order_id}")
+        result = self.session.execute(
+            text(
+                "WITH confirmed AS ("
+                "  UPDATE stock_reservations SET status = :confirmed "
+                "  WHERE order_id = :order_id AND status = :active "
+                "  RETURNING store, product, shard_id, quantity"
+                "), sharded AS ("
+                # Sales from a shard are folded into the stock row later, keeping it out of the hot path
+                "  UPDATE stock_shards sh SET sold = sh.sold + c.quantity FROM confirmed c WHERE sh.id = c.shard_id"
+                "), plain AS ("
+                "  UPDATE stocks AS s SET quantite = s.quantite - c.quantity, reserved = s.reserved - c.quantity "
+                "  FROM confirmed c WHERE c.shard_id IS NULL AND s.store = c.store AND s.product = c.product"
+                ") "
+                "SELECT count(*) FROM confirmed"
+            ),
+            {'order_id': order_id, 'active': ReservationStatus.ACTIVE, 'confirmed': ReservationStatus.CONFIRMED}
+        ).scalar()
+        self.session.commit()
+        logging.debug(f"Confirmed {result} reservation lines for order {order_id}")
+        return result
+
+    def release(self, order_id):
+        """
+        Give back the stock of an order: active reservations stop holding stock,
+        confirmed ones (the order was cancelled after payment) are restocked
+        """
+        logging.debug(f"Releasing reservations for order {order_id}")
+        self.session.execute(text("SELECT pg_advisory_xact_lock(:order_id)"), {'order_id': order_id})
+        result = self.session.execute(
+            text(
+                "WITH lines AS ("
+                "  SELECT id, store, product, shard_id, quantity, status FROM stock_reservations "
+                "  WHERE order_id = :order_id AND status IN (:active, :confirmed) FOR UPDATE"
+                "), released AS ("
+                "  UPDATE stock_reservations r SET status = :released FROM lines l WHERE r.id = l.id"
+                "), sharded AS ("
+                "  UPDATE stock_shards sh SET available = sh.available + l.quantity "
+                "  FROM lines l WHERE sh.id = l.shard_id AND l.status = :active"
+                "), plain AS ("
+                # Units sold from a shard are restocked in the stock row, like any other
+                "  UPDATE stocks AS s SET "
+                "    reserved = s.reserved - CASE WHEN l.status = :active THEN l.quantity ELSE 0 END, "
+                "    quantite = s.quantite + CASE WHEN l.status = :confirmed THEN l.quantity ELSE 0 END "
+                "  FROM lines l WHERE s.store = l.store AND s.product = l.product "
+                "  AND (l.shard_id IS NULL OR l.status = :confirmed)"
+                ") "
+                "SELECT count(*) FROM lines"
+            ),
+            {
+                'order_id': order_id,
+                'active': ReservationStatus.ACTIVE,
+                'confirmed': ReservationStatus.CONFIRMED,
+                'released': ReservationStatus.RELEASED
+            }
+        ).scalar()
+        # Remembered even with nothing to release yet: the order may be reserved after its cancellation
+        self.session.execute(pg_insert(ReleasedOrder).values(order_id=order_id).on_conflict_do_nothing())
+        self.session.commit()
+        logging.debug(f"Released {result} reservation lines for order {order_id}")
+        return result
+
+    def purge_released_orders(self, before):
+        """Forget the orders released before `before`, a late reservation can no longer reach them"""
+        result = self.session.execute(
+            text("DELETE FROM released_orders WHERE released_at < :before"), {'before': before}
+        ).rowcount
+        self.session.commit()
+        return result
+
+    def expire(self, now, limit):
+        """Release up to `limit` overdue reservations; replicas sweep disjoint rows thanks to SKIP LOCKED"""
+        logging.debug("Expiring overdue reservations")
+        result = self.session.execute(
+            text(
+                "WITH overdue AS ("
+                "  SELECT id FROM stock_reservations "
+                "  WHERE status = :active AND expires_at < :now "
+                "  ORDER BY expires_at LIMIT :limit FOR UPDATE SKIP LOCKED"
+                "), expired AS ("
+                "  UPDATE stock_reservations r SET status = :expired FROM overdue o WHERE r.id = o.id "
+                "  RETURNING r.store, r.product, r.shard_id, r.quantity"
+                "), shard_totals AS ("
+                "  SELECT shard_id, SUM(quantity) AS quantity FROM expired WHERE shard_id IS NOT NULL GROUP BY shard_id"
+                "), sharded AS ("
+                "  UPDATE stock_shards sh SET available = sh.available + t.quantity FROM shard_totals t WHERE sh.id = t.shard_id"
+                "), totals AS ("
+                "  SELECT store, product, SUM(quantity) AS quantity FROM expired WHERE shard_id IS NULL GROUP BY store, product"
+                "), plain AS ("
+                "  UPDATE stocks AS s SET reserved = s.reserved - t.quantity "
+                "  FROM totals t WHERE s.store = t.store AND s.product = t.product"
+                ") "
+                "SELECT count(*) FROM expired"
+            ),
+            {'active': ReservationStatus.ACTIVE, 'expired': ReservationStatus.EXPIRED, 'now': now, 'limit': limit}
+        ).scalar()
+        self.session.commit()
+        if result:
+            logging.debug(f"Expired {result} reservation lines")
+        return result
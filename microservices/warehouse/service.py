@@ -1,10 +1,59 @@
-from repository import StoreRepository, StockRepository, ProductDepotRepository
+from repository import StoreRepository, StockRepository, StockShardRepository, ProductDepotRepository, ReservationRepository, InventoryRepository
+from product_catalog import get_product_catalog
+from models.reservation_model import ReservationStatus
+from datetime import datetime, timedelta
 import logging 
-import requests
+import os
 
 logging.basicConfig(level=logging.DEBUG, filename='app.log', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logging = logging.getLogger(__name__)
 
+# How long a reservation holds stock before the sweeper gives it back
+RESERVATION_TTL_SECONDS = int(os.getenv("RESERVATION_TTL_SECONDS", "300"))
+
+# How long a released order is remembered, to turn away its OrderInitiated if it arrives late
+RELEASED_ORDER_RETENTION_SECONDS = int(os.getenv("RELEASED_ORDER_RETENTION_SECONDS", "86400"))
+
+# Available quantity at or below which a stock is reported as low
+LOW_STOCK_THRESHOLD = int(os.getenv("LOW_STOCK_THRESHOLD", "5"))
+
+# Upper bound on the shards a hot stock row can be split across
+MAX_STOCK_SHARDS = int(os.getenv("MAX_STOCK_SHARDS", "64"))
+
+_low_stock_listeners = []
+
+def add_low_stock_listener(listener):
+    """Register a callable receiving an alert dict each time a stock drops to the low stock threshold"""
+    _low_stock_listeners.append(listener)
+
+def _notify_low_stock(store_id, product_id, available, quantity_removed):
+    # Only report the crossing itself, not every movement below the threshold
+    if not available <= LOW_STOCK_THRESHOLD < available + quantity_removed:
+        return
+    alert = {
+        'product_id': product_id,
+        'store_id': store_id,
+        'available_quantity': available,
+        'threshold': LOW_STOCK_THRESHOLD
+    }
+    for listener in _low_stock_listeners:
+        try:
+            listener(alert)
+        except Exception as e:
+            logging.error(f"Low stock listener failed for product {product_id} in store {store_id}: {e}")
+
+def _merge_quantities(items):
+    """{product_id: total quantity} from order lines, several lines may refer to the same product"""
+    quantities = {}
+    for item in items:
+        if item["quantity"] <= 0:
+            raise ValueError("Quantity must be positive")
+        quantities[item["product_id"]] = quantities.get(item["product_id"], 0) + item["quantity"]
+    
+    if not quantities:
+        raise ValueError("No items given")
+    return quantities
+
 class StoreService:
     def __init__(self, session):
         self.session = session
@@ -35,6 +84,7 @@ class StockService:
     def __init__(self, session):
         self.session = session
         self.stock_repository = StockRepository(session)
+        self.shard_repository = StockShardRepository(session)
 
     def get_stock_by_id(self, stock_id):
         stock = self.stock_repository.get_by_id(stock_id)
@@ -53,6 +103,9 @@ class StockService:
         stocks = self.stock_repository.get_all_stocks()
         return stocks
     
+    def get_low_stocks(self, threshold, store_id=None):
+        return self.stock_repository.get_low_stocks(threshold, store_id)
+    
     def get_stocks_by_store(self, store_id):
         stocks = self.stock_repository.get_stocks_by_store(store_id)
         return stocks
@@ -87,6 +140,19 @@ class StockService:
             raise ValueError(f"Stock not found for product {product_id} in store {store_id}")
         return updated_stock
     
+    def shard_stock(self, product_id, store_id, shard_count):
+        """Split the reservable quantity of a hot stock across shard_count rows, 0 turns sharding off"""
+        if not 0 <= shard_count <= MAX_STOCK_SHARDS:
+            raise ValueError(f"Shard count must be between 0 and {MAX_STOCK_SHARDS}")
+        
+        stock = self.shard_repository.shard(product_id, store_id, shard_count)
+        if not stock:
+            raise ValueError(f"Stock not found for product {product_id} in store {store_id}")
+        return stock
+    
+    def rebalance_shards(self):
+        return self.shard_repository.rebalance()
+    
     def reduce_stock(self, product_id, store_id, quantity_to_reduce):
         if quantity_to_reduce <= 0:
             raise ValueError("Quantity to reduce must be positive")
@@ -94,8 +160,33 @@ class StockService:
         reduced_stock = self.stock_repository.reduce_stock(product_id, store_id, quantity_to_reduce)
         if not reduced_stock:
             raise ValueError("Insufficient stock or stock not found")
+        _notify_low_stock(store_id, product_id, reduced_stock.available, quantity_to_reduce)
         return reduced_stock
     
+    def reduce_stock_batch(self, store_id, items):
+        """Reduce the stock of every line of an order in a single transaction, all or nothing"""
+        quantities = _merge_quantities(items)
+        
+        reduced = self.stock_repository.reduce_stocks(
+            store_id, [(item["product_id"], item["quantity"]) for item in items]
+        )
+        if reduced is None:
+            available = self.stock_repository.get_quantities(store_id, list(quantities))
+            unavailable = [
+                product_id for product_id, quantity in quantities.items()
+                if available.get(product_id, 0) < quantity
+            ]
+            raise ValueError(f"Insufficient stock or stock not found for products {unavailable}")
+        
+        new_quantities = {}
+        for product_id, (quantite, available) in reduced.items():
+            _notify_low_stock(store_id, product_id, available, quantities[product_id])
+            new_quantities[product_id] = quantite
+        return new_quantities
+    
+    def get_stock_quantities(self, store_id, product_ids):
+        return self.stock_repository.get_quantities(store_id, product_ids)
+    
     def increase_stock(self, product_id, store_id, quantity_to_increase):
         if quantity_to_increase <= 0:
             raise ValueError("Quantity to increase must be positive")
@@ -110,12 +201,8 @@ class StockService:
         return deleted_stock
     
     def _validate_product_exists(self, product_id):
-        try:
-            response = requests.get(f"http://kong-api_gateway:8000/products/api/v1/products/{product_id}")
-            return response.status_code == 200
-        except Exception as e:
-            logging.error(f"Failed to validate product {product_id}: {e}")
-            return False
+        """Validate product exists against the cached products catalog"""
+        return get_product_catalog().exists(product_id)
 
 
 class ProductDepotService:
@@ -181,40 +268,113 @@ class ProductDepotService:
 
     def transfer_to_store(self, product_id, store_id, quantity):
         """Transfer stock from depot to store"""
-        if quantity <= 0:
-            raise ValueError("Transfer quantity must be positive")
+        return self.transfer_to_stores([
+            {'product_id': product_id, 'store_id': store_id, 'quantity': quantity}
+        ])[0]
+    
+    def transfer_to_stores(self, transfers):
+        """Transfer many lines from depot to stores in a single transaction: all lines are moved or none is"""
+        quantities = {}
+        for transfer in transfers:
+            if transfer['quantity'] <= 0:
+                raise ValueError("Transfer quantity must be positive")
+            line = (transfer['product_id'], transfer['store_id'])
+            quantities[line] = quantities.get(line, 0) + transfer['quantity']
         
-        # Reduce depot stock
-        depot_result = self.reduce_depot_stock(product_id, quantity)
-        if not depot_result:
-            raise ValueError("Failed to reduce depot stock")
+        if not quantities:
+            raise ValueError("No transfers given")
         
-        try:
-            # Increase store stock
-            stock_service = StockService(self.session)
-            stock_result = stock_service.increase_stock(product_id, store_id, quantity)
-            
-            logging.info(f"Transferred {quantity} units of product {product_id} from depot to store {store_id}")
-            return {
-                'product_id': product_id,
-                'store_id': store_id,
-                'quantity_transferred': quantity,
-                'remaining_depot_stock': depot_result.quantite_depot,
-                'new_store_stock': stock_result.quantite
-            }
-        except Exception as e:
-            # Rollback depot reduction if store increase fails
-            self.increase_depot_stock(product_id, quantity)
-            raise ValueError(f"Failed to transfer stock: {e}")
+        # Validate stores exist locally
+        store_service = StoreService(self.session)
+        for store_id in {store_id for _, store_id in quantities}:
+            if not store_service.get_store_by_id(store_id):
+                raise ValueError(f"Store {store_id} does not exist")
+        
+        result = self.depot_repository.transfer_to_stores(quantities)
+        if result is None:
+            raise ValueError("Insufficient depot stock or depot not found")
+        
+        logging.info(f"Transferred {len(quantities)} lines from depot to stores")
+        return [{
+            'product_id': product_id,
+            'store_id': store_id,
+            'quantity_transferred': quantity,
+            'remaining_depot_stock': result[(product_id, store_id)][0],
+            'new_store_stock': result[(product_id, store_id)][1]
+        } for (product_id, store_id), quantity in quantities.items()]
     
     def _validate_product_exists(self, product_id):
-        """Validate product exists by calling products microservice"""
-        try:
-            response = requests.get(f"http://kong-api_gateway:8000/products/api/v1/products/{product_id}")
-            return response.status_code == 200
-        except Exception as e:
-            logging.error(f"Failed to validate product {product_id}: {e}")
-            return False
+        """Validate product exists against the cached products catalog"""
+        return get_product_catalog().exists(product_id)
+
+
+class ReservationNotFound(ValueError):
+    """The order has no reservation (yet): OrderInitiated has not reached the warehouse"""
+
+
+class ReservationService:
+    """Holds stock for in-flight orders until their payment is confirmed or fails"""
+    def __init__(self, session):
+        self.session = session
+        self.reservation_repository = ReservationRepository(session)
+        self.stock_repository = StockRepository(session)
+
+    def reserve_stock(self, order_id, store_id, items, ttl_seconds=None, before_commit=None):
+        """
+        Reserve every line of an order, all or nothing, returning the reservation lines
+        before_commit(reservations, available) runs in the reservation transaction
+        Reserving is idempotent per order: a redelivered or retried request gets the existing lines back
+        """
+        existing = self.reservation_repository.get_by_order_id(order_id)
+        if existing:
+            logging.info(f"Order {order_id} is already reserved, skipping")
+            return existing
+        
+        quantities = _merge_quantities(items)
+        expires_at = datetime.utcnow() + timedelta(seconds=ttl_seconds or RESERVATION_TTL_SECONDS)
+        reservation_id = f"res_{order_id}"
+        
+        reserved = self.reservation_repository.reserve(reservation_id, order_id, store_id, quantities, expires_at, before_commit)
+        if reserved is None:
+            available = self.stock_repository.get_quantities(store_id, list(quantities))
+            unavailable = [
+                product_id for product_id, quantity in quantities.items()
+                if available.get(product_id, 0) < quantity
+            ]
+            raise ValueError(f"Insufficient stock or stock not found for products {unavailable}")
+        
+        reservations, available = reserved
+        if not reservations:
+            # Released (cancelled) before its OrderInitiated got here
+            return []
+        for product_id, available_quantity in available.items():
+            _notify_low_stock(store_id, product_id, available_quantity, quantities[product_id])
+        return reservations
+
+    def get_reservations_by_order(self, order_id):
+        return self.reservation_repository.get_by_order_id(order_id)
+
+    def confirm_reservation(self, order_id):
+        """
+        Confirm the reservation of an order. Both checkout completion and PaymentProcessed confirm it,
+        so an already confirmed reservation is not an error (0 lines confirmed)
+        """
+        confirmed = self.reservation_repository.confirm(order_id)
+        if not confirmed:
+            reservations = self.reservation_repository.get_by_order_id(order_id)
+            if not reservations:
+                raise ReservationNotFound(f"No reservation for order {order_id}")
+            if any(r.status != ReservationStatus.CONFIRMED for r in reservations):
+                raise ValueError(f"No active reservation for order {order_id}")
+        return confirmed
+
+    def release_reservation(self, order_id):
+        return self.reservation_repository.release(order_id)
+
+    def expire_reservations(self, limit=500):
+        now = datetime.utcnow()
+        self.reservation_repository.purge_released_orders(now - timedelta(seconds=RELEASED_ORDER_RETENTION_SECONDS))
+        return self.reservation_repository.expire(now, limit)
 
 
 class WarehouseService:
@@ -224,82 +384,56 @@ class WarehouseService:
         self.store_service = StoreService(session)
         self.stock_service = StockService(session)
         self.depot_service = ProductDepotService(session)
+        self.inventory_repository = InventoryRepository(session)
 
+    def get_inventory_matrix(self, product_ids=None, store_ids=None):
+        """Inventory of every product (or the given ones) in every store (or the given ones) and in the depot"""
+        inventory = []
+        for product_id, depot_quantity, stores in self.inventory_repository.get_matrix(product_ids, store_ids):
+            for store in stores:
+                store['available'] = store['quantite'] - store['reserved'] + store['shard_available']
+            inventory.append({
+                'product_id': product_id,
+                'depot_stock': depot_quantity,
+                'stores': stores,
+                'total_available': sum(store['available'] for store in stores),
+                'total_system_stock': sum(store['quantite'] for store in stores) + depot_quantity
+            })
+        return inventory
+    
     def get_complete_inventory_info(self, product_id, store_id=None):
         """Get comprehensive inventory information for a product"""
         # Validate product exists
         if not self._validate_product_exists(product_id):
             raise ValueError(f"Product {product_id} does not exist")
         
-        if store_id:
-            # Get info for specific store
-            return self.warehouse_repository.get_complete_stock_info(product_id, store_id)
-        else:
-            # Get info for all stores
-            all_stores = self.store_service.get_all_stores()
-            if not all_stores:
-                return None
-            
-            inventory_info = []
-            for store in all_stores:
-                store_info = self.warehouse_repository.get_complete_stock_info(product_id, store.id)
-                store_info['store_name'] = store.name
-                inventory_info.append(store_info)
-            
-            # Add depot info
-            depot_stock = self.depot_service.get_depot_by_product_id(product_id)
-            depot_quantity = depot_stock.quantite_depot if depot_stock else 0
-            
-            return {
-                'product_id': product_id,
-                'depot_stock': depot_quantity,
-                'stores': inventory_info,
-                'total_system_stock': sum(info['total_available'] for info in inventory_info) + depot_quantity
-            }
+        inventory = self.get_inventory_matrix([product_id], [store_id] if store_id else None)
+        return inventory[0] if inventory else None
     
     def restock_store_from_depot(self, product_id, store_id, quantity):
         """Move stock from depot to store"""
         return self.depot_service.transfer_to_store(product_id, store_id, quantity)
     
-    def get_low_stock_alerts(self, minimum_threshold=5):
-        """Get products with low stock across all stores"""
-        low_stock_items = []
-        all_stocks = self.stock_service.get_all_stocks()
+    def get_low_stock_alerts(self, minimum_threshold=LOW_STOCK_THRESHOLD, store_id=None):
+        """Get products with low stock across all stores (or one store)"""
+        low_stocks = self.stock_service.get_low_stocks(minimum_threshold, store_id)
+        products = get_product_catalog().get_many([stock.product for stock, _ in low_stocks])
         
-        if all_stocks:
-            for stock in all_stocks:
-                if stock.quantite <= minimum_threshold:
-                    # Get product info
-                    product_info = self._get_product_info(stock.product)
-                    store_info = self.store_service.get_store_by_id(stock.store)
-                    
-                    low_stock_items.append({
-                        'product_id': stock.product_id,
-                        'product_name': product_info.get('name', 'Unknown'),
-                        'store_id': stock.store,
-                        'store_name': store_info.name if store_info else 'Unknown',
-                        'current_stock': stock.quantite,
-                        'threshold': minimum_threshold
-                    })
-        
-        return low_stock_items
+        return [{
+            'product_id': stock.product,
+            'product_name': products.get(stock.product, {}).get('name', 'Unknown'),
+            'store_id': stock.store,
+            'store_name': store_name or 'Unknown',
+            'current_stock': stock.quantite,
+            'reserved_stock': stock.reserved - stock.shard_available,
+            'available_stock': stock.available,
+            'threshold': minimum_threshold
+        } for stock, store_name in low_stocks]
     
     def _validate_product_exists(self, product_id):
-        """Validate product exists by calling products microservice"""
-        try:
-            response = requests.get(f"http://kong-api_gateway:8000/products/api/v1/products/{product_id}")
-            return response.status_code == 200
-        except Exception as e:
-            logging.error(f"Failed to validate product {product_id}: {e}")
-            return False
+        """Validate product exists against the cached products catalog"""
+        return get_product_catalog().exists(product_id)
     
     def _get_product_info(self, product_id):
-        """Get product information from products microservice"""
-        try:
-            response = requests.get(f"http://kong-api_gateway:8000/products/api/v1/products/{product_id}")
-            if response.status_code == 200:
-                return response.json()
-            return {}
-        except Exception as e:
-            logging.error(f"Failed to get product info for {product_id}: {e}")
-            return {}
\ No newline at end of file
+        """Get product information from the cached products catalog"""
+        return get_product_catalog().get(product_id) or {}
\ No newline at end of file
@@ -0,0 +1,94 @@
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app as warehouse_app
+from database import get_db
+from models.reservation_model import ReservationStatus
+from service import ReservationNotFound
+
+
+@pytest.fixture
+def client():
+    warehouse_app.app.dependency_overrides[get_db] = lambda: MagicMock()
+    yield TestClient(warehouse_app.app)
+    warehouse_app.app.dependency_overrides.clear()
+
+
+def test_reduce_batch_reduces_every_line_at_once(client):
+    with patch.object(warehouse_app, "StockService") as stock_service:
+        stock_service.return_value.reduce_stock_batch.return_value = {10: 3, 11: 0}
+        response = client.post("/api/v1/stocks/reduce-batch", json={
+            "store": 1, "items": [{"product": 10, "quantity": 2}, {"product": 11, "quantity": 1}]
+        })
+
+    assert response.status_code == 200
+    assert response.json()["new_quantities"] == {"10": 3, "11": 0}
+    stock_service.return_value.reduce_stock_batch.assert_called_once_with(
+        1, [{"product_id": 10, "quantity": 2}, {"product_id": 11, "quantity": 1}]
+    )
+
+
+def test_reduce_batch_short_of_stock_is_a_client_error(client):
+    with patch.object(warehouse_app, "StockService") as stock_service:
+        stock_service.return_value.reduce_stock_batch.side_effect = ValueError("Insufficient stock or stock not found for products [11]")
+        response = client.post("/api/v1/stocks/reduce-batch", json={"store": 1, "items": [{"product": 11, "quantity": 9}]})
+
+    assert response.status_code == 400
+    assert "[11]" in response.json()["detail"]
+
+
+def test_reserve_returns_one_line_per_product(client):
+    line = SimpleNamespace(
+        reservation_id="res_42", order_id=42, product=10, store=1, quantity=2,
+        status=ReservationStatus.ACTIVE, expires_at=datetime(2026, 1, 1), shard_id=None
+    )
+    with patch.object(warehouse_app, "ReservationService") as reservation_service:
+        reservation_service.return_value.reserve_stock.return_value = [line]
+        response = client.post("/api/v1/reservations", json={
+            "order_id": 42, "store": 1, "items": [{"product": 10, "quantity": 2}], "ttl_seconds": 60
+        })
+
+    assert response.status_code == 200
+    assert response.json()[0]["reservation_id"] == "res_42"
+    reservation_service.return_value.reserve_stock.assert_called_once_with(
+        42, 1, [{"product_id": 10, "quantity": 2}], 60
+    )
+
+
+def test_confirming_a_released_reservation_is_a_client_error(client):
+    with patch.object(warehouse_app, "ReservationService") as reservation_service:
+        reservation_service.return_value.confirm_reservation.side_effect = ValueError("No active reservation for order 42")
+        response = client.post("/api/v1/reservations/order/42/confirm")
+
+    assert response.status_code == 400
+
+
+def test_confirming_an_order_not_reserved_yet_is_not_found(client):
+    with patch.object(warehouse_app, "ReservationService") as reservation_service:
+        reservation_service.return_value.confirm_reservation.side_effect = ReservationNotFound("No reservation for order 42")
+        response = client.post("/api/v1/reservations/order/42/confirm")
+
+    assert response.status_code == 404
+
+
+def test_shard_stock_returns_the_sharded_stock(client):
+    stock = SimpleNamespace(id=7, product=10, store=1, quantite=10, reserved=10, shards=4, shard_available=10)
+    with patch.object(warehouse_app, "StockService") as stock_service:
+        stock_service.return_value.shard_stock.return_value = stock
+        response = client.put("/api/v1/stocks/product/10/store/1/shards", json={"shards": 4})
+
+    assert response.status_code == 200
+    assert response.json()["shards"] == 4
+    stock_service.return_value.shard_stock.assert_called_once_with(10, 1, 4)
+
+
+def test_shard_stock_with_too_many_shards_is_a_client_error(client):
+    with patch.object(warehouse_app, "StockService") as stock_service:
+        stock_service.return_value.shard_stock.side_effect = ValueError("Shard count must be between 0 and 64")
+        response = client.put("/api/v1/stocks/product/10/store/1/shards", json={"shards": 65})
+
+    assert response.status_code == 400
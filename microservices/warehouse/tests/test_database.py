@@ -0,0 +1,65 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+import app as warehouse_app
+import database
+
+
+@pytest.fixture
+def session():
+    session = MagicMock()
+    with patch.object(database, "SessionLocal", return_value=session):
+        yield session
+
+
+def test_request_session_is_closed_after_the_request(session):
+    dependency = database.get_db()
+    assert next(dependency) is session
+
+    with pytest.raises(StopIteration):
+        next(dependency)
+    session.close.assert_called_once()
+
+
+def test_request_session_is_closed_when_the_handler_fails(session):
+    dependency = database.get_db()
+    next(dependency)
+
+    with pytest.raises(RuntimeError):
+        dependency.throw(RuntimeError("handler failed"))
+    session.close.assert_called_once()
+
+
+def test_session_scope_rolls_back_and_closes_on_error(session):
+    with pytest.raises(ValueError):
+        with database.session_scope():
+            raise ValueError("insufficient stock")
+
+    session.rollback.assert_called_once()
+    session.close.assert_called_once()
+
+
+def test_session_scope_closes_on_early_return(session):
+    def handler():
+        with database.session_scope():
+            return "done"
+
+    assert handler() == "done"
+    session.rollback.assert_not_called()
+    session.close.assert_called_once()
+
+
+def test_pool_is_pre_pinged_and_exported_to_prometheus():
+    assert database.engine.pool._pre_ping
+    assert REGISTRY.get_sample_value('warehouse_db_pool_size') == database.engine.pool.size()
+    assert REGISTRY.get_sample_value('warehouse_db_pool_checked_out') == 0
+
+
+def test_metrics_endpoint_exposes_the_pool_state():
+    response = TestClient(warehouse_app.app).get("/metrics")
+
+    assert response.status_code == 200
+    assert "warehouse_db_pool_checked_out" in response.text
@@ -0,0 +1,86 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import service
+from repository import ProductDepotRepository
+from service import ProductDepotService
+
+
+@pytest.fixture
+def depot_service():
+    depot_service = ProductDepotService(MagicMock())
+    depot_service.depot_repository = MagicMock()
+    with patch.object(service, "StoreService") as store_service:
+        store_service.return_value.get_store_by_id.side_effect = lambda store_id: store_id in (1, 2) or None
+        yield depot_service
+
+
+def test_transfers_are_merged_per_product_and_store_into_one_transaction(depot_service):
+    depot_service.depot_repository.transfer_to_stores.return_value = {(10, 1): (90, 15), (10, 2): (90, 5)}
+
+    result = depot_service.transfer_to_stores([
+        {'product_id': 10, 'store_id': 1, 'quantity': 3},
+        {'product_id': 10, 'store_id': 2, 'quantity': 5},
+        {'product_id': 10, 'store_id': 1, 'quantity': 2}
+    ])
+
+    depot_service.depot_repository.transfer_to_stores.assert_called_once_with({(10, 1): 5, (10, 2): 5})
+    assert result[0] == {
+        'product_id': 10, 'store_id': 1, 'quantity_transferred': 5, 'remaining_depot_stock': 90, 'new_store_stock': 15
+    }
+
+
+@pytest.mark.parametrize("transfers", [
+    [],
+    [{'product_id': 10, 'store_id': 1, 'quantity': 0}],
+    [{'product_id': 10, 'store_id': 3, 'quantity': 1}]
+])
+def test_invalid_transfers_touch_nothing(depot_service, transfers):
+    with pytest.raises(ValueError):
+        depot_service.transfer_to_stores(transfers)
+    depot_service.depot_repository.transfer_to_stores.assert_not_called()
+
+
+def test_short_depot_fails_the_whole_batch(depot_service):
+    depot_service.depot_repository.transfer_to_stores.return_value = None
+
+    with pytest.raises(ValueError):
+        depot_service.transfer_to_stores([{'product_id': 10, 'store_id': 1, 'quantity': 500}])
+
+
+def test_single_transfer_goes_through_the_batch_path(depot_service):
+    depot_service.depot_repository.transfer_to_stores.return_value = {(10, 1): (95, 5)}
+
+    assert depot_service.transfer_to_store(10, 1, 5)['new_store_stock'] == 5
+
+
+def make_repository(depot_rows):
+    session = MagicMock()
+    results = [MagicMock(), MagicMock(), MagicMock(all=MagicMock(return_value=depot_rows)),
+               MagicMock(all=MagicMock(return_value=[(10, 1, 15)])), MagicMock(all=MagicMock(return_value=[(11, 2, 4)]))]
+    session.execute.side_effect = results
+    return ProductDepotRepository(session), session
+
+
+def test_repository_locks_depot_then_stores_in_a_fixed_order_and_commits_once():
+    repository, session = make_repository([(10, 90), (11, 6)])
+
+    result = repository.transfer_to_stores({(11, 2): 4, (10, 1): 5, (10, 2): 5})
+
+    sql = [str(call.args[0]) for call in session.execute.call_args_list]
+    assert "ORDER BY product, id FOR UPDATE" in sql[0]
+    assert "ORDER BY s.product, s.store, s.id FOR UPDATE OF s" in sql[1]
+    params = session.execute.call_args_list[1].args[1]
+    assert list(zip(params['products'], params['stores'])) == [(10, 1), (10, 2), (11, 2)]
+    assert dict(zip(params['depot_products'], params['depot_quantities'])) == {11: 4, 10: 10}
+    assert result == {(10, 1): (90, 15), (11, 2): (6, 4)}
+    session.commit.assert_called_once()
+
+
+def test_repository_rolls_back_when_the_depot_is_short():
+    repository, session = make_repository([(10, 90)])
+
+    assert repository.transfer_to_stores({(10, 1): 5, (11, 2): 4}) is None
+    session.rollback.assert_called_once()
+    session.commit.assert_not_called()
@@ -0,0 +1,76 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app as warehouse_app
+import service
+from database import get_db
+from service import WarehouseService
+
+
+MATRIX_ROWS = [
+    (10, 100, [
+        {'store_id': 1, 'store_name': 'Centre', 'quantite': 20, 'reserved': 5, 'shard_available': 0},
+        {'store_id': 2, 'store_name': 'Nord', 'quantite': 10, 'reserved': 10, 'shard_available': 4}
+    ]),
+    (11, 30, [])
+]
+
+
+def make_warehouse_service(rows=MATRIX_ROWS):
+    warehouse_service = WarehouseService(MagicMock())
+    warehouse_service.inventory_repository = MagicMock()
+    warehouse_service.inventory_repository.get_matrix.return_value = rows
+    return warehouse_service
+
+
+def test_inventory_matrix_totals_stores_and_depot():
+    inventory = make_warehouse_service().get_inventory_matrix()
+
+    assert [store['available'] for store in inventory[0]['stores']] == [15, 4]
+    assert (inventory[0]['total_available'], inventory[0]['total_system_stock']) == (19, 130)
+    assert inventory[1] == {
+        'product_id': 11, 'depot_stock': 30, 'stores': [], 'total_available': 0, 'total_system_stock': 30
+    }
+
+
+def test_complete_inventory_info_is_a_slice_of_the_matrix():
+    warehouse_service = make_warehouse_service(MATRIX_ROWS[:1])
+
+    with patch.object(service, "get_product_catalog") as catalog:
+        catalog.return_value.exists.return_value = True
+        info = warehouse_service.get_complete_inventory_info(10, store_id=2)
+
+    assert info['product_id'] == 10
+    warehouse_service.inventory_repository.get_matrix.assert_called_once_with([10], [2])
+
+
+def test_complete_inventory_info_of_an_unknown_product_fails():
+    with patch.object(service, "get_product_catalog") as catalog:
+        catalog.return_value.exists.return_value = False
+        with pytest.raises(ValueError):
+            make_warehouse_service().get_complete_inventory_info(99)
+
+
+@pytest.fixture
+def client():
+    warehouse_app.app.dependency_overrides[get_db] = lambda: MagicMock()
+    yield TestClient(warehouse_app.app)
+    warehouse_app.app.dependency_overrides.clear()
+
+
+def test_unchanged_inventory_is_revalidated_with_a_bodyless_304(client):
+    with patch.object(warehouse_app, "WarehouseService") as warehouse_service:
+        warehouse_service.return_value.get_inventory_matrix.return_value = [{'product_id': 10}]
+
+        first = client.get("/api/v1/inventory", params={"store": [1, 2]})
+        again = client.get("/api/v1/inventory", params={"store": [1, 2]}, headers={"If-None-Match": first.headers["ETag"]})
+
+        warehouse_service.return_value.get_inventory_matrix.return_value = [{'product_id': 11}]
+        changed = client.get("/api/v1/inventory", params={"store": [1, 2]}, headers={"If-None-Match": first.headers["ETag"]})
+
+    assert first.status_code == 200 and first.json() == {"inventory": [{"product_id": 10}]}
+    assert again.status_code == 304 and again.content == b""
+    assert changed.status_code == 200 and changed.headers["ETag"] != first.headers["ETag"]
+    warehouse_service.return_value.get_inventory_matrix.assert_called_with(None, [1, 2])
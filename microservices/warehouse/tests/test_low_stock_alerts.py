@@ -0,0 +1,51 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import service
+from models.stock_model import Stock, StockShard
+from models.store_model import Store
+from service import WarehouseService
+
+
+@pytest.fixture
+def stocks(stock_db):
+    stock_db.add_all([Store(id=1, name="Centre"), Store(id=2, name="Nord")])
+    stock_db.add_all([
+        Stock(id=1, product=10, store=1, quantite=3, reserved=0),
+        Stock(id=2, product=11, store=1, quantite=50, reserved=48),
+        Stock(id=3, product=10, store=2, quantite=40, reserved=0),
+        # Sharded: everything looks reserved but the shards still hold 20 units
+        Stock(id=4, product=12, store=2, quantite=20, reserved=20, shards=2)
+    ])
+    stock_db.add_all([
+        StockShard(stock_id=4, shard_no=0, available=10),
+        StockShard(stock_id=4, shard_no=1, available=10)
+    ])
+    stock_db.commit()
+    return stock_db
+
+
+@pytest.fixture
+def catalog():
+    catalog = MagicMock()
+    catalog.get_many.return_value = {10: {"id": 10, "name": "Pommes"}}
+    with patch.object(service, "get_product_catalog", return_value=catalog):
+        yield catalog
+
+
+def test_low_stock_alerts_come_from_one_query_and_one_catalog_lookup(stocks, catalog):
+    alerts = WarehouseService(stocks).get_low_stock_alerts(minimum_threshold=5)
+
+    assert [(alert['product_id'], alert['store_id']) for alert in alerts] == [(11, 1), (10, 1)]
+    assert alerts[0] == {
+        'product_id': 11, 'product_name': 'Unknown', 'store_id': 1, 'store_name': 'Centre',
+        'current_stock': 50, 'reserved_stock': 48, 'available_stock': 2, 'threshold': 5
+    }
+    assert alerts[1]['product_name'] == 'Pommes'
+    catalog.get_many.assert_called_once()
+
+
+def test_low_stock_alerts_of_one_store(stocks, catalog):
+    assert WarehouseService(stocks).get_low_stock_alerts(minimum_threshold=5, store_id=2) == []
+    assert [alert['product_id'] for alert in WarehouseService(stocks).get_low_stock_alerts(40, 2)] == [12, 10]
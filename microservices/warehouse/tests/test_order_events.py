@@ -0,0 +1,107 @@
+from contextlib import contextmanager
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import app as warehouse_app
+from events import InventoryEvents
+
+
+def order_initiated(order_id=42):
+    return {
+        "data": {
+            "order_id": order_id,
+            "total_amount": 30.0,
+            "items": [{"product_id": 10, "quantity": 2}, {"product_id": 11, "quantity": 1}]
+        },
+        "metadata": {"correlation_id": "corr"}
+    }
+
+
+@pytest.fixture
+def session():
+    session = MagicMock()
+
+    @contextmanager
+    def session_scope():
+        yield session
+
+    with patch.object(warehouse_app, "session_scope", session_scope):
+        yield session
+
+
+@pytest.fixture
+def enqueue():
+    with patch.object(warehouse_app, "enqueue") as enqueue:
+        yield enqueue
+
+
+def test_order_initiated_reserves_and_enqueues_stock_reserved_in_the_same_transaction(session, enqueue):
+    def reserve_stock(order_id, store_id, items, before_commit):
+        # The event is written by the reservation transaction, before it commits
+        reservations = [SimpleNamespace(reservation_id="res_42")]
+        before_commit(reservations, {10: 5, 11: 0})
+        return reservations
+
+    with patch.object(warehouse_app, "ReservationService") as reservation_service:
+        reservation_service.return_value.reserve_stock.side_effect = reserve_stock
+        warehouse_app.handle_order_initiated(order_initiated())
+
+    reservation_service.return_value.reserve_stock.assert_called_once()
+    assert reservation_service.return_value.reserve_stock.call_args.args[:3] == (
+        42, 1, [{"product_id": 10, "quantity": 2}, {"product_id": 11, "quantity": 1}]
+    )
+    kwargs = enqueue.call_args.kwargs
+    assert kwargs["event_type"] == InventoryEvents.STOCK_RESERVED
+    assert kwargs["data"]["reservation_id"] == "res_42"
+    assert kwargs["data"]["total_amount"] == 30.0
+    assert [item["available_quantity"] for item in kwargs["data"]["items"]] == [5, 0]
+
+
+def test_order_initiated_after_its_cancellation_holds_nothing(session, enqueue):
+    with patch.object(warehouse_app, "ReservationService") as reservation_service:
+        reservation_service.return_value.reserve_stock.return_value = []
+        warehouse_app.handle_order_initiated(order_initiated())
+
+    enqueue.assert_not_called()
+
+
+def test_order_initiated_without_stock_enqueues_stock_unavailable(session, enqueue):
+    with patch.object(warehouse_app, "ReservationService") as reservation_service, \
+            patch.object(warehouse_app, "StockService") as stock_service:
+        reservation_service.return_value.reserve_stock.side_effect = ValueError("Insufficient stock")
+        stock_service.return_value.get_stock_quantities.return_value = {10: 5}
+        warehouse_app.handle_order_initiated(order_initiated())
+
+    kwargs = enqueue.call_args.kwargs
+    assert kwargs["event_type"] == InventoryEvents.STOCK_UNAVAILABLE
+    assert [item["status"] for item in kwargs["data"]["items"]] == ["AVAILABLE", "UNAVAILABLE"]
+    session.commit.assert_called_once()
+
+
+def test_payment_processed_confirms_the_reservation(session):
+    with patch.object(warehouse_app, "ReservationService") as reservation_service:
+        warehouse_app.handle_payment_processed({"data": {"order_id": 42}})
+
+    reservation_service.return_value.confirm_reservation.assert_called_once_with(42)
+
+
+@pytest.mark.parametrize("handler", ["handle_order_cancelled", "handle_payment_failed"])
+def test_cancelled_or_unpaid_orders_release_their_reservation(session, handler):
+    with patch.object(warehouse_app, "ReservationService") as reservation_service:
+        getattr(warehouse_app, handler)({"data": {"order_id": 42}})
+
+    reservation_service.return_value.release_reservation.assert_called_once_with(42)
+
+
+def test_low_stock_alert_is_written_to_the_outbox(session, enqueue):
+    alert = {'product_id': 10, 'store_id': 1, 'available_quantity': 4, 'threshold': 5}
+
+    warehouse_app.publish_low_stock_alert(alert)
+
+    kwargs = enqueue.call_args.kwargs
+    assert kwargs["event_type"] == InventoryEvents.LOW_STOCK_ALERT
+    assert kwargs["aggregate_id"] == "stock_1_10"
+    assert kwargs["data"] == alert
+    session.commit.assert_called_once()
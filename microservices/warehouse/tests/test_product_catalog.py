@@ -0,0 +1,113 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+import requests
+
+import app as warehouse_app
+import product_catalog
+from events import ProductEvents
+from product_catalog import ProductCatalog, PRODUCTS_URL
+
+
+def response(status_code, body=None):
+    def raise_for_status():
+        if status_code >= 400:
+            raise requests.HTTPError(f"{status_code}")
+    return SimpleNamespace(status_code=status_code, json=lambda: body, raise_for_status=raise_for_status)
+
+
+@pytest.fixture
+def catalog():
+    catalog = ProductCatalog()
+    catalog.http = MagicMock()
+    return catalog
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(product_catalog.time, "monotonic", lambda: clock.now)
+    return clock
+
+
+def test_found_products_are_cached_until_their_ttl(catalog, clock):
+    catalog.http.get.return_value = response(200, {"id": 10, "name": "Pommes"})
+
+    assert catalog.get(10)["name"] == "Pommes"
+    assert catalog.get(10)["name"] == "Pommes"
+    assert catalog.http.get.call_count == 1
+
+    clock.now += catalog.ttl + 1
+    catalog.get(10)
+    assert catalog.http.get.call_count == 2
+
+
+def test_unknown_products_are_cached_for_the_negative_ttl(catalog, clock):
+    catalog.http.get.return_value = response(404)
+
+    assert catalog.exists(99) is False
+    assert catalog.exists(99) is False
+    assert catalog.http.get.call_count == 1
+
+    clock.now += catalog.negative_ttl + 1
+    catalog.exists(99)
+    assert catalog.http.get.call_count == 2
+
+
+def test_failed_lookups_are_never_cached(catalog, clock):
+    catalog.http.get.side_effect = [requests.ConnectTimeout("timeout"), response(500), response(200, {"id": 10})]
+
+    assert catalog.get(10) is None
+    assert catalog.get(10) is None
+    assert catalog.get(10) == {"id": 10}
+    assert all(call.kwargs["timeout"] == catalog.timeout for call in catalog.http.get.call_args_list)
+
+
+def test_get_many_fetches_only_the_misses_in_one_call(catalog, clock):
+    catalog.put({"id": 10, "name": "Pommes"})
+    catalog.http.get.return_value = response(200, [{"id": 11, "name": "Poires"}])
+
+    products = catalog.get_many([10, 11, 12])
+
+    assert products == {10: {"id": 10, "name": "Pommes"}, 11: {"id": 11, "name": "Poires"}}
+    assert sorted(catalog.http.get.call_args.kwargs["params"]["ids"]) == [11, 12]
+    # 12 does not exist and is now negatively cached
+    assert catalog.get_many([11, 12]) == {11: {"id": 11, "name": "Poires"}}
+    assert catalog.http.get.call_count == 1
+
+
+def test_product_events_replace_or_drop_entries(catalog, clock):
+    catalog.put({"id": 10, "name": "Pommes"})
+    catalog.put({"id": 10, "name": "Pommes bio"})
+    assert catalog.get(10)["name"] == "Pommes bio"
+
+    catalog.invalidate(10)
+    catalog.http.get.return_value = response(404)
+    assert catalog.get(10) is None
+    catalog.http.get.assert_called_once_with(f"{PRODUCTS_URL}/10", timeout=catalog.timeout)
+
+
+def test_warmup_loads_the_whole_catalog_in_one_call(catalog, clock):
+    catalog.http.get.return_value = response(200, [{"id": 10}, {"id": 11}])
+
+    assert catalog.warmup() == 2
+    assert catalog.get_many([10, 11]) == {10: {"id": 10}, 11: {"id": 11}}
+    assert catalog.http.get.call_count == 1
+
+
+@pytest.mark.parametrize("event_type, name", [
+    (ProductEvents.PRODUCT_UPDATED, "Pommes bio"),
+    (ProductEvents.PRODUCT_DELETED, None)
+])
+def test_product_events_keep_the_warehouse_cache_in_sync(catalog, event_type, name, monkeypatch):
+    monkeypatch.setattr(warehouse_app, "get_product_catalog", lambda: catalog)
+    catalog.put({"id": 10, "name": "Pommes"})
+    catalog.http.get.return_value = response(404)
+
+    warehouse_app.handle_product_changed({
+        "event_type": event_type,
+        "data": {"product_id": 10, "name": "Pommes bio", "prix_unitaire": 2.5}
+    })
+
+    assert (catalog.get(10) or {}).get("name") == name
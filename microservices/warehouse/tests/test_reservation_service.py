@@ -0,0 +1,86 @@
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+
+from models.reservation_model import ReservationStatus
+from service import ReservationNotFound, ReservationService
+
+
+def make_reservation_service(confirmed, lines):
+    reservation_service = ReservationService(MagicMock())
+    reservation_service.reservation_repository = MagicMock()
+    reservation_service.reservation_repository.confirm.return_value = confirmed
+    reservation_service.reservation_repository.get_by_order_id.return_value = [
+        SimpleNamespace(status=status) for status in lines
+    ] or None
+    return reservation_service
+
+
+def test_confirm_reservation_returns_confirmed_lines():
+    assert make_reservation_service(2, []).confirm_reservation(42) == 2
+
+
+def test_confirming_an_already_confirmed_reservation_is_not_an_error():
+    # Checkout completion and PaymentProcessed both confirm the same order
+    service = make_reservation_service(0, [ReservationStatus.CONFIRMED, ReservationStatus.CONFIRMED])
+    assert service.confirm_reservation(42) == 0
+
+
+@pytest.mark.parametrize("lines", [[], [ReservationStatus.RELEASED], [ReservationStatus.EXPIRED]])
+def test_confirming_a_missing_or_released_reservation_fails(lines):
+    with pytest.raises(ValueError):
+        make_reservation_service(0, lines).confirm_reservation(42)
+
+
+def test_confirming_an_order_not_reserved_yet_is_not_found():
+    # OrderInitiated reaches the warehouse asynchronously, the caller may retry
+    with pytest.raises(ReservationNotFound):
+        make_reservation_service(0, []).confirm_reservation(42)
+
+
+def test_reserving_an_order_released_first_holds_nothing():
+    service = make_reservation_service(0, [])
+    service.reservation_repository.reserve.return_value = ([], {})
+
+    assert service.reserve_stock(42, 1, [{"product_id": 10, "quantity": 2}]) == []
+
+
+def test_reserving_an_already_reserved_order_returns_its_lines():
+    # OrderInitiated is delivered at least once: the second delivery must not hold the stock again
+    existing = [SimpleNamespace(status=ReservationStatus.ACTIVE, product=10)]
+    service = make_reservation_service(0, [])
+    service.reservation_repository.get_by_order_id.return_value = existing
+    before_commit = MagicMock()
+
+    assert service.reserve_stock(42, 1, [{"product_id": 10, "quantity": 2}], before_commit=before_commit) is existing
+    service.reservation_repository.reserve.assert_not_called()
+    before_commit.assert_not_called()
+
+
+def test_reserve_stock_merges_lines_and_holds_them_once():
+    service = make_reservation_service(0, [])
+    reservation = SimpleNamespace(reservation_id="res_42")
+    service.reservation_repository.reserve.return_value = ([reservation], {10: 100})
+
+    reservations = service.reserve_stock(42, 1, [
+        {"product_id": 10, "quantity": 2},
+        {"product_id": 10, "quantity": 3}
+    ])
+
+    assert reservations == [reservation]
+    reservation_id, order_id, store_id, quantities = service.reservation_repository.reserve.call_args.args[:4]
+    assert (reservation_id, order_id, store_id, quantities) == ("res_42", 42, 1, {10: 5})
+
+
+def test_expire_reservations_sweeps_overdue_lines_in_batches():
+    service = make_reservation_service(0, [])
+    service.reservation_repository.expire.return_value = 3
+
+    assert service.expire_reservations(limit=50) == 3
+    now, limit = service.reservation_repository.expire.call_args.args
+    assert limit == 50 and abs((datetime.utcnow() - now).total_seconds()) < 5
+    # Released orders are only remembered until their OrderInitiated can no longer arrive
+    [before] = service.reservation_repository.purge_released_orders.call_args.args
+    assert before < now
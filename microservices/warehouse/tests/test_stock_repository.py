@@ -0,0 +1,113 @@
+from unittest.mock import MagicMock, patch
+
+from models.stock_model import Stock
+from repository import StockRepository, StockShardRepository
+
+
+def make_repository(updated_rows, sharded_rows=()):
+    session = MagicMock()
+    session.execute.return_value.all.side_effect = [list(sharded_rows), updated_rows]
+    return StockRepository(session), session
+
+
+def executed_sql(session):
+    return [str(call.args[0]) for call in session.execute.call_args_list]
+
+
+def test_reduce_stocks_locks_rows_by_product_before_updating():
+    repository, session = make_repository([(3, 7, 7), (5, 1, 1)])
+
+    assert repository.reduce_stocks(1, [(5, 2), (3, 1)]) == {3: (7, 7), 5: (1, 1)}
+
+    _, lock, update = executed_sql(session)
+    assert "ORDER BY product, id FOR UPDATE" in lock
+    assert update.startswith("UPDATE stocks")
+    session.commit.assert_called_once()
+
+
+def test_reduce_stocks_adds_up_lines_of_the_same_product():
+    repository, session = make_repository([(3, 5, 5)])
+
+    # Two lines of product 3 are one product: a single updated row is a complete reduction
+    assert repository.reduce_stocks(1, [(3, 1), (3, 2)]) == {3: (5, 5)}
+
+    update = executed_sql(session)[2]
+    assert "SUM(quantity)" in update and "GROUP BY product" in update
+    params = session.execute.call_args.args[1]
+    assert params['products'] == [3, 3] and params['quantities'] == [1, 2]
+    session.commit.assert_called_once()
+
+
+def test_reduce_stocks_rolls_back_when_a_product_is_short():
+    repository, session = make_repository([(3, 5, 5)])
+
+    assert repository.reduce_stocks(1, [(3, 1), (4, 1)]) is None
+    session.rollback.assert_called_once()
+    session.commit.assert_not_called()
+
+
+def test_reduce_stocks_sells_sharded_products_from_their_shards():
+    repository, session = make_repository([(3, 5, 5)], sharded_rows=[(4, 70, 2)])
+    session.query.return_value.filter.return_value.all.return_value = [(4, 20, 9)]
+
+    with patch.object(StockShardRepository, "sell", return_value=True) as sell:
+        assert repository.reduce_stocks(1, [(3, 1), (4, 2), (4, 1)]) == {3: (5, 5), 4: (20, 9)}
+
+    # Only the plain product goes through the stock row update
+    sell.assert_called_once_with(70, 2, 3)
+    assert session.execute.call_args_list[2].args[1]['products'] == [3]
+    session.commit.assert_called_once()
+
+
+def test_reduce_stocks_rolls_back_when_the_shards_are_short():
+    repository, session = make_repository([], sharded_rows=[(4, 70, 2)])
+
+    with patch.object(StockShardRepository, "sell", return_value=False):
+        assert repository.reduce_stocks(1, [(4, 2)]) is None
+
+    session.rollback.assert_called_once()
+    session.commit.assert_not_called()
+
+
+def add_stock(session, product, store, quantite, reserved=0):
+    stock = Stock(product=product, store=store, quantite=quantite, reserved=reserved)
+    session.add(stock)
+    session.commit()
+    return stock
+
+
+def test_reduce_stock_decrements_in_one_conditional_update(stock_db):
+    add_stock(stock_db, product=10, store=1, quantite=5)
+
+    stock = StockRepository(stock_db).reduce_stock(10, 1, 3)
+
+    assert (stock.quantite, stock.available) == (2, 2)
+
+
+def test_reduce_stock_never_sells_reserved_units(stock_db):
+    stock = add_stock(stock_db, product=10, store=1, quantite=5, reserved=3)
+
+    assert StockRepository(stock_db).reduce_stock(10, 1, 3) is None
+    stock_db.refresh(stock)
+    assert stock.quantite == 5
+
+
+def test_reduce_stock_of_a_missing_stock_returns_none(stock_db):
+    add_stock(stock_db, product=10, store=1, quantite=5)
+
+    assert StockRepository(stock_db).reduce_stock(10, 2, 1) is None
+    assert StockRepository(stock_db).reduce_stock(11, 1, 1) is None
+
+
+def test_reduce_stock_of_a_sharded_product_sells_from_its_shards(stock_db):
+    stock = Stock(product=10, store=1, quantite=10, reserved=10, shards=2)
+    stock_db.add(stock)
+    stock_db.commit()
+
+    # Nothing is free in quantite - reserved, all of it is in the shards
+    with patch.object(StockShardRepository, "sell", return_value=True) as sell:
+        assert StockRepository(stock_db).reduce_stock(10, 1, 3).id == stock.id
+    sell.assert_called_once_with(stock.id, 2, 3)
+
+    with patch.object(StockShardRepository, "sell", return_value=False):
+        assert StockRepository(stock_db).reduce_stock(10, 1, 30) is None
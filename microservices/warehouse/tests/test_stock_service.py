@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+
+import service
+from service import StockService, LOW_STOCK_THRESHOLD
+
+
+@pytest.fixture
+def alerts(monkeypatch):
+    alerts = []
+    monkeypatch.setattr(service, "_low_stock_listeners", [alerts.append])
+    return alerts
+
+
+def make_stock_service():
+    stock_service = StockService(MagicMock())
+    stock_service.stock_repository = MagicMock()
+    return stock_service
+
+
+@pytest.mark.parametrize("quantity", [0, -2])
+def test_reduce_stock_rejects_non_positive_quantities(quantity):
+    stock_service = make_stock_service()
+
+    with pytest.raises(ValueError):
+        stock_service.reduce_stock(10, 1, quantity)
+    stock_service.stock_repository.reduce_stock.assert_not_called()
+
+
+def test_reduce_stock_reports_insufficient_stock():
+    stock_service = make_stock_service()
+    stock_service.stock_repository.reduce_stock.return_value = None
+
+    with pytest.raises(ValueError):
+        stock_service.reduce_stock(10, 1, 3)
+
+
+def test_reduce_stock_alerts_when_crossing_the_low_stock_threshold(alerts):
+    stock_service = make_stock_service()
+    stock_service.stock_repository.reduce_stock.return_value = SimpleNamespace(available=LOW_STOCK_THRESHOLD - 1)
+
+    stock_service.reduce_stock(10, 1, 2)
+
+    assert alerts == [{
+        'product_id': 10, 'store_id': 1, 'available_quantity': LOW_STOCK_THRESHOLD - 1, 'threshold': LOW_STOCK_THRESHOLD
+    }]
+
+
+def test_reduce_stock_below_the_threshold_does_not_alert_again(alerts):
+    stock_service = make_stock_service()
+    stock_service.stock_repository.reduce_stock.return_value = SimpleNamespace(available=LOW_STOCK_THRESHOLD - 5)
+
+    stock_service.reduce_stock(10, 1, 2)
+
+    assert alerts == []
+
+
+def test_reduce_stock_batch_passes_every_line_and_names_the_missing_products():
+    stock_service = make_stock_service()
+    stock_service.stock_repository.reduce_stocks.return_value = None
+    stock_service.stock_repository.get_quantities.return_value = {10: 9, 11: 1}
+
+    with pytest.raises(ValueError, match=r"\[11\]"):
+        stock_service.reduce_stock_batch(1, [
+            {"product_id": 10, "quantity": 2},
+            {"product_id": 11, "quantity": 1},
+            {"product_id": 11, "quantity": 1}
+        ])
+
+    stock_service.stock_repository.reduce_stocks.assert_called_once_with(1, [(10, 2), (11, 1), (11, 1)])
+
+
+def test_reduce_stock_batch_returns_the_new_quantities():
+    stock_service = make_stock_service()
+    stock_service.stock_repository.reduce_stocks.return_value = {10: (8, 8), 11: (20, 15)}
+
+    assert stock_service.reduce_stock_batch(1, [
+        {"product_id": 10, "quantity": 2}, {"product_id": 11, "quantity": 1}
+    ]) == {10: 8, 11: 20}
@@ -0,0 +1,211 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from models.stock_model import Stock, StockShard
+from repository import ReservationRepository, StockShardRepository
+from service import MAX_STOCK_SHARDS, StockService
+
+
+def add_stock(session, quantite, reserved=0):
+    stock = Stock(product=10, store=1, quantite=quantite, reserved=reserved)
+    session.add(stock)
+    session.commit()
+    return stock
+
+
+def shard_amounts(session, stock):
+    shards = session.query(StockShard).filter_by(stock_id=stock.id).order_by(StockShard.shard_no).all()
+    return [shard.available for shard in shards]
+
+
+def test_shard_deals_the_free_quantity_out_evenly(stock_db):
+    stock = add_stock(stock_db, quantite=10, reserved=2)
+
+    stock = StockShardRepository(stock_db).shard(10, 1, 3)
+
+    assert stock.shards == 3
+    assert shard_amounts(stock_db, stock) == [3, 3, 2]
+    # The free quantity moved to the shards without changing what can be reserved
+    assert stock.reserved == 10
+    stock_db.expire_all()
+    assert stock.available == 8
+
+
+def test_resharding_takes_back_the_free_quantity_of_every_shard(stock_db):
+    stock = add_stock(stock_db, quantite=10)
+    repository = StockShardRepository(stock_db)
+    repository.shard(10, 1, 4)
+
+    repository.shard(10, 1, 2)
+    # Shards past the new count stay for the reservations still pointing at them, empty
+    assert shard_amounts(stock_db, stock) == [5, 5, 0, 0]
+
+    stock = repository.shard(10, 1, 0)
+    assert stock.shards == 0
+    assert stock.reserved == 0
+    assert shard_amounts(stock_db, stock) == [0, 0, 0, 0]
+    stock_db.expire_all()
+    assert stock.available == 10
+
+
+def test_shard_of_a_missing_stock_returns_none(stock_db):
+    assert StockShardRepository(stock_db).shard(99, 1, 2) is None
+
+
+def test_shard_stock_bounds_the_shard_count():
+    service = StockService(MagicMock())
+
+    with pytest.raises(ValueError, match="Shard count"):
+        service.shard_stock(10, 1, MAX_STOCK_SHARDS + 1)
+    with pytest.raises(ValueError, match="Shard count"):
+        service.shard_stock(10, 1, -1)
+
+
+def test_shard_stock_of_a_missing_stock_is_an_error():
+    service = StockService(MagicMock())
+    service.shard_repository = MagicMock()
+    service.shard_repository.shard.return_value = None
+
+    with pytest.raises(ValueError, match="Stock not found"):
+        service.shard_stock(10, 1, 2)
+
+
+def take_from_shards(*results):
+    session = MagicMock()
+    session.execute.return_value.scalar.side_effect = results
+    with patch("repository.random.randrange", return_value=1):
+        taken = StockShardRepository(session).take(7, 4, 2)
+    return taken, [str(call.args[0]) for call in session.execute.call_args_list], session
+
+
+def test_take_from_shards_skips_busy_shards_first():
+    taken, statements, session = take_from_shards(12)
+
+    assert taken == 12
+    assert len(statements) == 1
+    assert "FOR UPDATE SKIP LOCKED" in statements[0]
+    params = session.execute.call_args.args[1]
+    assert params == {'stock': 7, 'shards': 4, 'start': 1, 'quantity': 2}
+
+
+def test_take_from_shards_waits_on_busy_shards_before_the_stock_row():
+    taken, statements, _ = take_from_shards(None, 13)
+
+    assert taken == 13
+    assert "SKIP LOCKED" not in statements[1] and "FOR UPDATE" in statements[1]
+
+
+def test_take_from_shards_falls_back_to_the_stock_row():
+    taken, statements, _ = take_from_shards(None, None, 7)
+
+    assert taken == 0
+    assert statements[2].startswith("UPDATE stocks SET reserved")
+
+
+def test_take_from_shards_without_stock_anywhere_returns_none():
+    taken, _, _ = take_from_shards(None, None, None)
+
+    assert taken is None
+
+
+def sell(*results):
+    session = MagicMock()
+    session.execute.return_value.scalar.side_effect = results
+    with patch("repository.random.randrange", return_value=1):
+        sold = StockShardRepository(session).sell(7, 4, 2)
+    return sold, session
+
+
+def test_sale_from_a_shard_is_counted_as_sold_on_it():
+    sold, session = sell(12)
+
+    assert sold
+    statement, params = session.execute.call_args.args
+    assert str(statement).startswith("UPDATE stock_shards SET sold = sold + :quantity")
+    assert params == {'shard': 12, 'quantity': 2}
+
+
+def test_sale_held_on_the_stock_row_reduces_it():
+    sold, session = sell(None, None, 7)
+
+    assert sold
+    statement, params = session.execute.call_args.args
+    assert str(statement).startswith("UPDATE stocks SET quantite = quantite - :quantity, reserved = reserved - :quantity")
+    assert params == {'stock': 7, 'quantity': 2}
+
+
+def test_sale_without_stock_anywhere_sells_nothing():
+    sold, session = sell(None, None, None)
+
+    assert not sold
+    assert session.execute.call_count == 3
+
+
+def test_rebalance_deals_restocked_quantity_out_to_the_shards():
+    session = MagicMock()
+    session.execute.return_value.rowcount = 1
+    stock = SimpleNamespace(id=7, shards=3, quantite=25, reserved=20)
+    session.query.return_value.filter.return_value.with_for_update.return_value.all.return_value = [stock]
+
+    assert StockShardRepository(session).rebalance() == 2
+
+    fold, top_up = [call.args[0] for call in session.execute.call_args_list]
+    assert "FOR UPDATE SKIP LOCKED" in str(fold)
+    assert str(top_up).startswith("UPDATE stock_shards")
+    assert session.execute.call_args.args[1] == {'stocks': [7, 7, 7], 'shard_nos': [0, 1, 2], 'amounts': [2, 2, 1]}
+    assert stock.reserved == 25
+    session.commit.assert_called_once()
+
+
+def test_rebalance_rolls_back_on_error():
+    session = MagicMock()
+    session.execute.side_effect = RuntimeError("deadlock detected")
+
+    with pytest.raises(RuntimeError):
+        StockShardRepository(session).rebalance()
+
+    session.rollback.assert_called_once()
+    session.commit.assert_not_called()
+
+
+def test_reserve_locks_plain_stock_rows_by_product_before_holding_them():
+    session = MagicMock()
+    session.execute.return_value.all.side_effect = [[], [(5, 3), (3, 7)]]
+    session.scalars.return_value.all.return_value = [MagicMock(), MagicMock()]
+    session.get.return_value = None
+
+    reservations, available = ReservationRepository(session).reserve("r1", 42, 1, {5: 2, 3: 1}, None)
+
+    assert available == {5: 3, 3: 7}
+    _, _, lock, hold = [str(call.args[0]) for call in session.execute.call_args_list]
+    assert "ORDER BY product, id FOR UPDATE" in lock
+    assert hold.startswith("UPDATE stocks AS s SET reserved")
+    session.commit.assert_called_once()
+
+
+def test_order_released_before_its_reservation_holds_nothing():
+    session = MagicMock()
+    session.get.return_value = SimpleNamespace(order_id=42)
+
+    assert ReservationRepository(session).reserve("r1", 42, 1, {5: 2}, None) == ([], {})
+
+    [advisory_lock] = [str(call.args[0]) for call in session.execute.call_args_list]
+    assert "pg_advisory_xact_lock" in advisory_lock
+    session.rollback.assert_called_once()
+    session.commit.assert_not_called()
+
+
+def test_release_remembers_the_order_even_with_nothing_reserved_yet():
+    session = MagicMock()
+    session.execute.return_value.scalar.return_value = 0
+
+    assert ReservationRepository(session).release(42) == 0
+
+    advisory_lock, _, remember = [call.args[0] for call in session.execute.call_args_list]
+    assert "pg_advisory_xact_lock" in str(advisory_lock)
+    remember = str(remember.compile(dialect=postgresql.dialect()))
+    assert remember.startswith("INSERT INTO released_orders") and "ON CONFLICT DO NOTHING" in remember
+    session.commit.assert_called_once()
@@ -23,6 +23,9 @@ class MainController:
     def get_product_with_stocks(self, store_id):
         return self.domaine_service.get_product_with_stocks(store_id)
 
+    def get_products_with_stocks_by_store(self, store_ids):
+        return self.domaine_service.get_products_with_stocks_by_store(store_ids)
+
     def performances(self):
         return self.domaine_service.performances()
 
@@ -70,6 +70,40 @@ class DomainService:
         
         return products_with_stocks
 
+    def get_products_with_stocks_by_store(self, store_ids):
+        """Même résultat que get_product_with_stocks pour plusieurs magasins, en un seul appel au warehouse"""
+        products = self._get_all_products_from_microservice()
+        
+        if not products:
+            logging.warning("Aucun produit récupéré du microservice, utilisation fallback")
+            raise Exception("Aucune produit")
+        
+        inventory = self._get_inventory_from_microservice(store_ids)
+        
+        # Index des stocks par (produit, magasin)
+        stocks = {}
+        for product_inventory in inventory:
+            for store in product_inventory['stores']:
+                stocks[(product_inventory['product_id'], store['store_id'])] = {
+                    'id': None,
+                    'product': product_inventory['product_id'],
+                    'store': store['store_id'],
+                    'quantite': store['quantite']
+                }
+        
+        return {
+            store_id: [
+                (product, stocks.get((product.get('id'), store_id), {
+                    'id': None,
+                    'product': product.get('id'),
+                    'store': store_id,
+                    'quantite': 0
+                }))
+                for product in products
+            ]
+            for store_id in store_ids
+        }
+
     def performances(self):
         # Generate the total in sales for each stores, and for each stock of the products in each store, indicates whether the stock is sufficient or not.
         stores = Store.get_all_stores(self.session)
@@ -122,6 +156,23 @@ class DomainService:
             logging.error(f"Erreur connexion microservice products: {e}")
             return None
 
+    def _get_inventory_from_microservice(self, store_ids):
+        """Récupérer l'inventaire de plusieurs magasins via microservice warehouse"""
+        try:
+            response = requests.get(
+                f"http://localhost:8000/warehouse/api/v1/inventory",
+                params={'store': store_ids}
+            )
+            
+            if response.status_code == 200:
+                return response.json()['inventory']
+            else:
+                logging.error(f"Erreur récupération inventaire: HTTP {response.status_code}")
+                return []
+        except Exception as e:
+            logging.error(f"Erreur connexion microservice warehouse: {e}")
+            return []
+
     def _get_stocks_by_store_from_microservice(self, store_id):
         """Récupérer stocks par magasin via microservice warehouse"""
         try:
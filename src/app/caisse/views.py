@@ -42,18 +42,14 @@ def search_products(request):
     r_id = request.GET.get('id')
 
     if not r_id: 
-        zipped1 = mainController.get_product_with_stocks(1)
-        zipped2 = mainController.get_product_with_stocks(2)
-        zipped3 = mainController.get_product_with_stocks(3)
-        zipped4 = mainController.get_product_with_stocks(4)
-        zipped5 = mainController.get_product_with_stocks(5)
+        zipped = mainController.get_products_with_stocks_by_store([1, 2, 3, 4, 5])
 
         return render(request, "products.html", {
-            "zipped1": zipped1,
-            "zipped2": zipped2,
-            "zipped3": zipped3,
-            "zipped4": zipped4,
-            "zipped5": zipped5
+            "zipped1": zipped[1],
+            "zipped2": zipped[2],
+            "zipped3": zipped[3],
+            "zipped4": zipped[4],
+            "zipped5": zipped[5]
         })
     else: 
         product = Product.get_by_id(session, r_id)